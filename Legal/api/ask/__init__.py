@@ -1,29 +1,26 @@
 import logging
-import os, json, requests, re, time, random
+import os, json, requests, re, time
 import azure.functions as func
+from typing import Optional
 from requests.adapters import HTTPAdapter
 from openai import AzureOpenAI
+from shared_code import index_alias, ratelimit, resilience, routing, snapshot, telemetry, usage, vector_fields
 
 # --- Prompts and Helper Functions ---
 # Note: Environment variables are loaded within the main() function to prevent module-level errors.
 
-def with_retries(fn, attempts=1, initial_delay=0.4, factor=2.0, jitter=0.1, max_delay=5.0):
-    """Retry helper: runs fn() with exponential backoff and jitter.
+def with_retries(fn, attempts=1, initial_delay=0.4, endpoint=None, deadline=None):
+    """Retry helper: runs fn() and retries only retryable failures (see shared_code.resilience).
     attempts denotes the number of additional retries beyond the first attempt.
+    Retry-After / rate-limit headers are honored and the endpoint's circuit breaker is applied.
     """
-    delay = initial_delay
-    last_exc = None
-    for i in range(attempts + 1):
-        try:
-            return fn()
-        except Exception as e:
-            last_exc = e
-            logging.warning(f"Retryable error on attempt {i+1}/{attempts+1}: {e}")
-            if i == attempts:
-                raise
-            sleep_for = min(delay + (random.random() * jitter), max_delay)
-            time.sleep(sleep_for)
-            delay *= factor
+    return resilience.call_with_retries(
+        fn,
+        attempts=attempts,
+        initial_delay=initial_delay,
+        endpoint=endpoint,
+        deadline=deadline,
+    )
 
 # Connection pooling for outbound HTTP (e.g., Azure Cognitive Search)
 SESSION = None
@@ -94,12 +91,156 @@ FORMATTING RULES
 •  If nothing is found, return `[]`.
 """
 
-def embed(text: str, client: AzureOpenAI, deploy_embed: str) -> list[float]:
-    """Generates embeddings for a given text using a specific deployment."""
-    return client.embeddings.create(
-        input=[text],
-        model=deploy_embed
-    ).data[0].embedding
+# In-process retrieval: RETRIEVAL_BACKEND=snapshot answers vector queries from a
+# memory-mapped snapshot published by ingestion (see shared_code.snapshot) and
+# falls back to Azure Cognitive Search when a country is missing, its index state
+# stamp differs from the snapshot's, or loading fails.
+SNAPSHOT = None
+
+def get_snapshot() -> Optional[snapshot.Snapshot]:
+    """The current index snapshot, or None when the search backend is configured."""
+    global SNAPSHOT
+    if os.environ.get("RETRIEVAL_BACKEND", "search").lower() != "snapshot":
+        return None
+    if SNAPSHOT is None:
+        container_url = os.environ.get("KNIFE_SNAPSHOT_URL")
+        if not container_url:
+            logging.warning("RETRIEVAL_BACKEND=snapshot but KNIFE_SNAPSHOT_URL is not set; using search")
+            return None
+        SNAPSHOT = snapshot.RemoteSnapshot(
+            container_url,
+            cache_dir=os.environ.get("SNAPSHOT_CACHE_DIR"),
+            refresh_s=float(os.environ.get("SNAPSHOT_REFRESH_S", "60")),
+        )
+    return SNAPSHOT.get()
+
+def stale_countries(snap: snapshot.Snapshot, iso_codes) -> list[str]:
+    """Countries the snapshot does not hold as currently indexed."""
+    return SNAPSHOT.stale(snap, iso_codes) if SNAPSHOT is not None else []
+
+def snapshot_info() -> Optional[dict]:
+    """Version and size of the loaded snapshot, for ?metrics=1."""
+    loaded = SNAPSHOT.loaded if SNAPSHOT is not None else None
+    if loaded is None:
+        return None
+    return {"version": loaded.version, "rows": loaded.rows, "countries": len(loaded.countries)}
+
+# Blue/green indexes: the index name follows the pointer record that scripts/rebuild_index.py
+# switches (KNIFE_INDEX_ALIAS_URL, default KNIFE_SNAPSHOT_URL); without one it is KNIFE_SEARCH_INDEX
+INDEX_ALIAS = None
+
+def get_index_name() -> str:
+    global INDEX_ALIAS
+    default = os.environ.get("KNIFE_SEARCH_INDEX", "knife-index")
+    container_url = os.environ.get("KNIFE_INDEX_ALIAS_URL") or os.environ.get("KNIFE_SNAPSHOT_URL")
+    if not container_url:
+        return default
+    if INDEX_ALIAS is None:
+        INDEX_ALIAS = index_alias.RemoteAlias(
+            container_url, default, refresh_s=float(os.environ.get("INDEX_ALIAS_REFRESH_S", "30"))
+        )
+    return INDEX_ALIAS.current()
+
+# Embedding migrations: countries may be queried on another vector field, with another model, while
+# scripts/migrate_embeddings.py backfills it (record next to the index alias; see shared_code.vector_fields)
+VECTOR_FIELDS = None
+
+def get_vector_fields(index_name: str) -> dict:
+    global VECTOR_FIELDS
+    container_url = os.environ.get("KNIFE_INDEX_ALIAS_URL") or os.environ.get("KNIFE_SNAPSHOT_URL")
+    if not container_url:
+        return vector_fields.default_record()
+    if VECTOR_FIELDS is None:
+        VECTOR_FIELDS = vector_fields.RemoteVectorFields(
+            container_url, refresh_s=float(os.environ.get("INDEX_ALIAS_REFRESH_S", "30"))
+        )
+    return VECTOR_FIELDS.current(index_name)
+
+# Rolling token/cost aggregates per ISO code and question shape for this instance
+USAGE_WINDOW = usage.RollingUsage(window_s=float(os.environ.get("USAGE_WINDOW_S", "3600")))
+
+# Model routing: each pipeline stage maps to a pool of deployments (see shared_code.routing)
+ROUTER = None
+CLIENTS = {}
+
+def get_router(config: dict) -> routing.StageRouter:
+    """Builds the process-wide stage router on first use."""
+    global ROUTER
+    if ROUTER is None:
+        ROUTER = routing.StageRouter(routing.load_routes(
+            config['openai_endpoint'],
+            config['openai_key'],
+            {
+                # Country detection is cheap: prefer the small model, fall back to the chat model
+                "iso_detection": [config.get('deploy_fast_chat'), config['deploy_chat']],
+                "draft": [config['deploy_chat']],
+                "refine": [config['deploy_chat']],
+                "embed": [config['deploy_embed']],
+            },
+        ))
+    return ROUTER
+
+def get_client(dep: routing.Deployment, api_version: str) -> AzureOpenAI:
+    """Returns a cached Azure OpenAI client for a routed deployment's endpoint."""
+    key = (dep.endpoint, dep.api_key, api_version)
+    if key not in CLIENTS:
+        CLIENTS[key] = AzureOpenAI(
+            azure_endpoint=dep.endpoint,
+            api_key=dep.api_key,
+            api_version=api_version,
+            max_retries=0,  # retries are owned by shared_code.resilience
+        )
+    return CLIENTS[key]
+
+def _observe_error_headers(limiter: ratelimit.DeploymentLimiter, error: Exception) -> None:
+    """Feeds quota headers from a failed OpenAI call (e.g., a 429) back into the limiter."""
+    response = getattr(error, 'response', None)
+    limiter.observe(getattr(response, 'headers', None))
+
+def create_chat_completion(stage: str, config: dict, messages: list[dict], **kwargs):
+    """Runs a chat completion for a pipeline stage on its routed deployment, at interactive priority."""
+    def on_deployment(dep: routing.Deployment):
+        limiter = ratelimit.get_limiter(dep.label)
+        limiter.acquire(ratelimit.estimate_chat_tokens(messages, kwargs.get('max_tokens')), ratelimit.INTERACTIVE)
+        try:
+            raw = get_client(dep, config['api_version']).chat.completions.with_raw_response.create(
+                model=dep.deployment, messages=messages, **kwargs
+            )
+        except Exception as e:
+            _observe_error_headers(limiter, e)
+            raise
+        limiter.observe(raw.headers)
+        completion = raw.parse()
+        completion_usage = getattr(completion, 'usage', None)
+        usage.record(stage, dep.label, completion_usage)
+        telemetry.annotate(
+            deployment=dep.label,
+            prompt_tokens=getattr(completion_usage, 'prompt_tokens', None),
+            completion_tokens=getattr(completion_usage, 'completion_tokens', None),
+        )
+        return completion
+    return get_router(config).call(stage, on_deployment)
+
+def embed(text: str, config: dict, deployment: Optional[str] = None) -> list[float]:
+    """Generates embeddings for a given text on the routed embedding deployment (or on ``deployment``'s model)."""
+    def on_deployment(dep: routing.Deployment):
+        limiter = ratelimit.get_limiter(dep.label)
+        limiter.acquire(ratelimit.estimate_embedding_tokens(text), ratelimit.INTERACTIVE)
+        try:
+            raw = get_client(dep, config['api_version']).embeddings.with_raw_response.create(
+                input=[text],
+                model=dep.deployment
+            )
+        except Exception as e:
+            _observe_error_headers(limiter, e)
+            raise
+        limiter.observe(raw.headers)
+        result = raw.parse()
+        usage.record("embed", dep.label, result.usage)
+        telemetry.annotate(deployment=dep.label, prompt_tokens=getattr(result.usage, 'prompt_tokens', None))
+        return result.data[0].embedding
+    router = get_router(config)
+    return router.call(router.embedding_stage(deployment) if deployment else "embed", on_deployment)
 
 def balance_country_representation(results: list[dict], iso_codes: list[str], target_k: int) -> list[dict]:
     """Ensures balanced representation from all detected countries in search results.
@@ -155,12 +296,13 @@ def balance_country_representation(results: list[dict], iso_codes: list[str], ta
     
     return balanced_results[:target_k]
 
-def extract_iso_codes(text: str, client: AzureOpenAI, deploy_chat: str) -> list[str]:
+def extract_iso_codes(text: str, config: dict) -> list[str]:
     """Extracts ISO-3166-1 alpha-2 country codes from text using an LLM call."""
     try:
         response = with_retries(
-            lambda: client.chat.completions.create(
-                model=deploy_chat,
+            lambda: create_chat_completion(
+                "iso_detection",
+                config,
                 messages=[
                     {"role": "system", "content": COUNTRY_DETECTION_PROMPT},
                     {"role": "user", "content": text}
@@ -190,81 +332,258 @@ def extract_iso_codes(text: str, client: AzureOpenAI, deploy_chat: str) -> list[
         logging.error(f"Error parsing country detection response: {e}")
         return []
 
-def retrieve(query: str, iso_codes: list[str], client: AzureOpenAI, config: dict, k: int = 5) -> list[dict]:
-    """Retrieves documents from Azure Cognitive Search based on a vector query and filters.
+# Query-intent routing: threshold/table and figure questions are answered from
+# fewer, type-targeted chunks. INTENT_ROUTING=boost (default) re-ranks a wider
+# candidate set in favour of the chunk type, restrict filters on it, off disables.
+TABLE_INTENT_RE = re.compile(
+    r"\b(tables?|thresholds?|rates?|percent(age)?|amounts?|fees?|fines?|penalt(y|ies)|"
+    r"schedules?|rows?|columns?|how much|how many|maximum|minimum|at least|at most|"
+    r"more than|less than|exceed(s|ing)?)\b|\d+(\.\d+)?\s?(%|cm|mm|eur|€)",
+    re.IGNORECASE,
+)
+IMAGE_INTENT_RE = re.compile(
+    r"\b(figures?|fig\.|images?|pictures?|photos?|diagrams?|charts?|graphs?|illustrations?|"
+    r"drawings?|maps?|symbols?|logos?|pictograms?|signs?|shown|depicted)\b",
+    re.IGNORECASE,
+)
+
+def route_query(question: str) -> dict:
+    """Classifies a question as table, image or general intent and picks the retrieval plan."""
+    mode = os.environ.get("INTENT_ROUTING", "boost").lower()
+    general = {"intent": "general", "chunk_types": None, "mode": "off", "k_per_country": None}
+    if mode == "off":
+        return general
+    # Figure wording is more specific than threshold wording, so it wins when both match
+    if IMAGE_INTENT_RE.search(question):
+        intent, chunk_types = "image", ["image"]
+    elif TABLE_INTENT_RE.search(question):
+        intent, chunk_types = "table", ["table"]
+    else:
+        return general
+    return {
+        "intent": intent,
+        "chunk_types": chunk_types,
+        "mode": mode,
+        "k_per_country": int(os.environ.get("INTENT_K", "6")),
+    }
+
+def boost_chunk_types(results: list[dict], chunk_types: list[str], factor: float) -> list[dict]:
+    """Re-ranks hits, multiplying the score of the preferred chunk types by factor."""
+    return sorted(
+        results,
+        key=lambda r: r.get('@search.score', 0.0) * (factor if r.get('chunk_type') in chunk_types else 1.0),
+        reverse=True,
+    )
+
+# Cleared when the index rejects a query naming the chunk metadata fields (see index.json), i.e. it
+# predates them; probed again after INDEX_TYPE_FIELDS_RETRY_S, since a reindex or switch may add them
+INDEX_TYPE_FIELDS = True
+INDEX_TYPE_FIELDS_RETRY_AT = 0.0
+METADATA_FIELDS = ("chunk_type", "table_id", "figure_id", "parent_id", "section_path")
+
+def index_type_fields() -> bool:
+    """Whether queries select and filter on the chunk metadata fields."""
+    global INDEX_TYPE_FIELDS
+    if not INDEX_TYPE_FIELDS and time.monotonic() >= INDEX_TYPE_FIELDS_RETRY_AT:
+        INDEX_TYPE_FIELDS = True
+    return INDEX_TYPE_FIELDS
+
+def retrieve(query: str, iso_codes: list[str], config: dict, k: int = 5, route: Optional[dict] = None) -> list[dict]:
+    """Retrieves documents from Azure Cognitive Search (or the in-process snapshot) based on a vector query and filters.
     
     For multi-country queries (e.g., EuroAirport), ensures balanced representation
     from all detected countries rather than just the most semantically similar documents.
+    A route from route_query() restricts or boosts table/image chunks.
     """
-    logging.info(f"DEBUG: retrieve() called with query='{query}', iso_codes={iso_codes}")
-    
     if not iso_codes:
-        logging.info("DEBUG: No ISO codes provided, returning empty list")
         return []
+    route = route or {"intent": "general", "chunk_types": None, "mode": "off"}
     
-    try:
-        logging.info("DEBUG: Generating embedding for query...")
-        t_embed_start = time.monotonic()
-        vec = with_retries(lambda: embed(query, client, config['deploy_embed']), attempts=2, initial_delay=0.4)
-        embed_ms = int((time.monotonic() - t_embed_start) * 1000)
-        logging.info(f"DEBUG: Embedding generated successfully, length={len(vec)}")
-        logging.info(f"TIMING: embed_ms={embed_ms}")
-    except Exception as e:
-        logging.error(f"DEBUG: Failed to generate embedding: {e}")
-        raise
+    # Countries share one vector field unless an embedding migration is under way
+    record = get_vector_fields(config['index_name'])
+    field_groups = vector_fields.groups(record, iso_codes)
+    vecs = []
+    for field, deployment, _ in field_groups:
+        with telemetry.span("embed", stage="embed", query_chars=len(query), field=field) as span:
+            vec = with_retries(lambda: embed(query, config, deployment), attempts=2, initial_delay=0.4)
+            span.set(dims=len(vec))
+        vecs.append(vec)
+    # The snapshot holds the default field's vectors, and is only republished once a migration finishes
+    snapshot_field = record["default"] if not record.get("target") else None
+    
+    # For multi-country queries, increase k to ensure we get documents from all countries
+    search_k = max(k * len(iso_codes), 10) if len(iso_codes) > 1 else k
+    restrict = route["chunk_types"] if route["mode"] == "restrict" else None
+    boost = route["chunk_types"] if route["mode"] == "boost" else None
+    if boost:
+        # Boosting only helps if preferred chunks just outside the top k are fetched too
+        search_k *= 2
+    
+    with telemetry.span("search", stage="search", k=k, search_k=search_k, iso_codes=iso_codes,
+                        intent=route["intent"], intent_mode=route["mode"]) as span:
+        raw_results = []
+        for (field, _, codes), vec in zip(field_groups, vecs):
+            hits = _search_hits(vec, codes, config, search_k, restrict, span, field, field == snapshot_field)
+            if restrict and not hits:
+                # No chunks of the targeted type for these countries: fall back to all types
+                hits = _search_hits(vec, codes, config, search_k, None, span, field, field == snapshot_field)
+            raw_results.extend(hits)
+        if len(field_groups) > 1:
+            raw_results.sort(key=lambda r: r.get('@search.score', 0), reverse=True)
+        if boost:
+            raw_results = boost_chunk_types(raw_results, boost, float(os.environ.get("INTENT_BOOST", "1.15")))
+        return _select_results(raw_results, iso_codes, k, span)
+
+def _search_hits(vec: list[float], iso_codes: list[str], config: dict, search_k: int,
+                 chunk_types: Optional[list[str]], span, vector_field: str = "embedding",
+                 use_snapshot: bool = True) -> list[dict]:
+    """Ranked vector hits from the snapshot when it covers the countries, else from the search service."""
+    global INDEX_TYPE_FIELDS, INDEX_TYPE_FIELDS_RETRY_AT
+    snap = get_snapshot() if use_snapshot else None
+    if snap is not None and snap.dims == len(vec) and all(code in snap.countries for code in iso_codes):
+        stale = stale_countries(snap, iso_codes)
+        if not stale:
+            span.set(backend="snapshot", snapshot_version=snap.version)
+            return snap.search(vec, iso_codes, search_k, chunk_types=chunk_types)
+        span.set(snapshot_stale=",".join(stale))
+    span.set(backend="search")
     
     search_url = f"{config['search_endpoint']}/indexes/{config['index_name']}/docs/search?api-version=2023-11-01"
     headers = {'Content-Type': 'application/json', 'api-key': config['search_key']}
     filter_str = f"search.in(iso_code, '{','.join(iso_codes)}', ',')"
-    
-    # For multi-country queries, increase k to ensure we get documents from all countries
-    search_k = max(k * len(iso_codes), 10) if len(iso_codes) > 1 else k
+    select = "chunk,iso_code,id"
+    type_fields = index_type_fields()
+    if type_fields:
+        select += ",chunk_type,table_id,figure_id,parent_id,section_path"
+        if chunk_types:
+            filter_str += f" and search.in(chunk_type, '{','.join(chunk_types)}', ',')"
     
     payload = {
         "vectorQueries": [
             {
                 "kind": "vector",
                 "vector": vec,
-                "fields": "embedding",
+                "fields": vector_field,
                 "k": search_k
             }
         ],
         "filter": filter_str,
-        "select": "chunk,iso_code,id"
+        "select": select
     }
     
-    logging.info(f"DEBUG: Sending search request to {search_url}")
-    logging.info(f"DEBUG: Filter: {filter_str}")
-    logging.info(f"DEBUG: Search k adjusted from {k} to {search_k} for {len(iso_codes)} countries")
-    logging.info(f"DEBUG: Payload keys: {list(payload.keys())}")
-    
     session = get_session()
     try:
-        t_search_start = time.monotonic()
-        response = with_retries(lambda: _post_and_raise(session, search_url, headers, payload), attempts=2, initial_delay=0.4)
-        logging.info(f"DEBUG: Search response status: {response.status_code}")
-        response.raise_for_status()
-        raw_results = response.json().get('value', [])
-        search_ms = int((time.monotonic() - t_search_start) * 1000)
-        logging.info(f"TIMING: search_ms={search_ms}")
-        logging.info(f"DEBUG: Raw search returned {len(raw_results)} documents")
-        
-        # For multi-country queries, ensure balanced representation
-        if len(iso_codes) > 1 and raw_results:
-            balanced_results = balance_country_representation(raw_results, iso_codes, k)
-            logging.info(f"DEBUG: Balanced results: {len(balanced_results)} documents from {len(set(r['iso_code'] for r in balanced_results))} countries")
-            return balanced_results
-        else:
-            return raw_results[:k]  # Limit to original k for single-country queries
-            
+        # Hedge the search call: if it runs into the latency tail, race a duplicate request
+        hedge_delay = resilience.hedge_delay("search", "SEARCH_HEDGE_DELAY_MS")
+        response = with_retries(
+            lambda: resilience.hedged_call(
+                lambda: _post_and_raise(session, search_url, headers, payload),
+                name="search",
+                delay=hedge_delay,
+            ),
+            attempts=2,
+            initial_delay=0.4,
+            endpoint="search"
+        )
     except requests.exceptions.RequestException as e:
-        logging.error(f"DEBUG: Search request failed: {e}")
-        if hasattr(e, 'response') and e.response is not None:
-            logging.error(f"DEBUG: Response content: {e.response.text}")
-        raise
-    except Exception as e:
-        logging.error(f"DEBUG: Unexpected error in retrieve: {e}")
+        response_text = e.response.text if getattr(e, 'response', None) is not None else ''
+        # Only a 400 that names a metadata field means the index lacks them; any other bad request is raised
+        if type_fields and getattr(e, 'response', None) is not None and e.response.status_code == 400 \
+                and any(name in response_text for name in METADATA_FIELDS):
+            logging.warning("Index rejected chunk metadata fields; retrieving without them: %s", response_text[:300])
+            INDEX_TYPE_FIELDS = False
+            INDEX_TYPE_FIELDS_RETRY_AT = time.monotonic() + float(os.environ.get("INDEX_TYPE_FIELDS_RETRY_S", "300"))
+            return _search_hits(vec, iso_codes, config, search_k, None, span, vector_field, use_snapshot)
+        logging.error("Search request failed: %s %s", e, response_text[:500])
         raise
+    return response.json().get('value', [])
+
+def _select_results(raw_results: list[dict], iso_codes: list[str], k: int, span) -> list[dict]:
+    """Trims ranked hits to k, balancing countries for multi-country queries."""
+    span.set(results=len(raw_results))
+    if len(iso_codes) > 1 and raw_results:
+        balanced_results = balance_country_representation(raw_results, iso_codes, k)
+        span.set(returned=len(balanced_results), countries_returned=len({r['iso_code'] for r in balanced_results}))
+        return balanced_results
+    span.set(returned=min(k, len(raw_results)))
+    return raw_results[:k]  # Limit to original k for single-country queries
+
+def fetch_parents(parent_ids: list[str], config: dict) -> dict:
+    """Parent section texts by id, from the loaded snapshot where possible, else from the index."""
+    found = {}
+    snap = get_snapshot()
+    if snap is not None:
+        parents = {parent_id: snap.parent(parent_id) for parent_id in parent_ids}
+        stale = set(stale_countries(snap, {p['iso_code'] for p in parents.values() if p is not None}))
+        for parent_id, parent in parents.items():
+            if parent is not None and parent['iso_code'] not in stale:
+                found[parent_id] = parent['chunk']
+    missing = [parent_id for parent_id in parent_ids if parent_id not in found]
+    if not missing or not index_type_fields():
+        return found
+    search_url = f"{config['search_endpoint']}/indexes/{config['index_name']}/docs/search?api-version=2023-11-01"
+    headers = {'Content-Type': 'application/json', 'api-key': config['search_key']}
+    payload = {
+        "search": "*",
+        "filter": f"search.in(parent_id, '{','.join(missing)}', ',') and chunk_type eq 'section'",
+        "select": "id,chunk",
+        "top": len(missing)
+    }
+    session = get_session()
+    response = with_retries(
+        lambda: _post_and_raise(session, search_url, headers, payload),
+        attempts=2,
+        initial_delay=0.4,
+        endpoint="search"
+    )
+    for doc in response.json().get('value', []):
+        found[doc['id']] = doc['chunk']
+    return found
+
+def expand_parents(chunks: list[dict], config: dict, mode: str) -> list[dict]:
+    """Late chunking: replaces the top child hits with their parent sections.
+    
+    Only the LATE_CHUNK_EXPAND_TOP best hits are expanded in hybrid mode (all hits in
+    late mode). Siblings of an expanded parent are dropped, and the whole context is
+    kept under LATE_CHUNK_MAX_TOKENS; a parent that does not fit stays a child.
+    """
+    expand_top = len(chunks) if mode == "late" else int(os.environ.get("LATE_CHUNK_EXPAND_TOP", "3"))
+    max_tokens = int(os.environ.get("LATE_CHUNK_MAX_TOKENS", "4000"))
+    top_hits = sorted(chunks, key=lambda c: c.get('@search.score', 0.0), reverse=True)[:expand_top]
+    wanted = list(dict.fromkeys(c['parent_id'] for c in top_hits if c.get('parent_id')))
+    parents = fetch_parents(wanted, config) if wanted else {}
+    
+    expanded = []
+    covered = set()
+    used_tokens = 0
+    for chunk in chunks:
+        parent_id = chunk.get('parent_id')
+        if parent_id in covered:
+            continue  # a sibling already brought in the whole section
+        candidate = chunk
+        if parent_id in parents:
+            candidate = dict(chunk, chunk=parents[parent_id], expanded_from=chunk['id'])
+            if used_tokens + ratelimit.estimate_tokens(candidate['chunk']) > max_tokens:
+                candidate = chunk
+            else:
+                covered.add(parent_id)
+        tokens = ratelimit.estimate_tokens(candidate['chunk'])
+        if expanded and used_tokens + tokens > max_tokens:
+            break
+        expanded.append(candidate)
+        used_tokens += tokens
+    return expanded
+
+def source_label(chunk: dict) -> str:
+    """Names the kind of source a chunk comes from, with its table/figure id for citations."""
+    if chunk.get('chunk_type') == 'table':
+        return f"Table {chunk['table_id']}" if chunk.get('table_id') else "Table"
+    if chunk.get('chunk_type') == 'image':
+        return f"Figure {chunk['figure_id']}" if chunk.get('figure_id') else "Figure"
+    if chunk.get('section_path'):
+        # The innermost headings are enough to cite, e.g. "Chapter II > Article 40"
+        return " > ".join(chunk['section_path'].split(" > ")[-2:])
+    return "Document Section"
 
 def iso_to_flag(iso_code: str) -> str:
     """Converts a two-letter ISO country code to a flag emoji."""
@@ -424,22 +743,42 @@ Provide a JSON response with this exact structure:
 - Present information professionally without technical chunk citations
 """
 
-def chat(question: str, client: AzureOpenAI, config: dict, grade: bool = False) -> str:
+def question_shape(question: str, iso_codes: list[str], grade: bool) -> str:
+    """Coarse label for usage aggregation, e.g. 'multi-country/graded/long'."""
+    countries = "multi-country" if len(iso_codes) > 1 else "single-country" if iso_codes else "no-country"
+    length = "short" if len(question) < 80 else "medium" if len(question) < 240 else "long"
+    return f"{countries}/{'graded' if grade else 'draft'}/{length}"
+
+def chat(question: str, config: dict, grade: bool = False, include_usage: bool = False) -> str:
     """Orchestrates the RAG pipeline to answer a question."""
-    logging.info("DEBUG: Starting chat function")
     t_total_start = time.monotonic()
+    timings = {}
     
-    try:
-        logging.info("DEBUG: Step 1 - Extracting ISO codes")
-        t_iso_start = time.monotonic()
-        iso_codes = extract_iso_codes(question, client, config['deploy_chat'])
-        iso_ms = int((time.monotonic() - t_iso_start) * 1000)
-        logging.info(f"TIMING: iso_detection_ms={iso_ms}")
-        logging.info(f"DEBUG: ISO codes extracted: {iso_codes}")
+    def finish(response: dict, iso_codes: list[str]) -> str:
+        """Records the request's token usage and serializes the response."""
+        totals = tracker.totals()
+        USAGE_WINDOW.add(iso_codes, question_shape(question, iso_codes, grade), totals)
+        request_span.set(
+            prompt_tokens=totals['prompt_tokens'],
+            completion_tokens=totals['completion_tokens'],
+            cached_tokens=totals['cached_tokens'],
+            cost_usd=totals['cost_usd'],
+        )
+        if include_usage:
+            response["usage"] = tracker.to_dict()
+        return json.dumps(response, indent=2)
+    
+    with usage.track() as tracker, telemetry.span("ask", grade=grade, question_chars=len(question)) as request_span:
+        with telemetry.span("iso_detection", stage="iso_detection") as span:
+            t_iso_start = time.monotonic()
+            iso_codes = extract_iso_codes(question, config)
+            timings['iso_detection_ms'] = int((time.monotonic() - t_iso_start) * 1000)
+            span.set(iso_codes=iso_codes)
+        request_span.set(iso_codes=iso_codes)
         
         if not iso_codes:
-            logging.info("DEBUG: No ISO codes found, returning error message")
-            return json.dumps({
+            telemetry.event("ask.no_country", **timings)
+            return finish({
                 "country_header": "",
                 "refined_answer": "Could not determine a country from your query. Please be more specific.",
                 "country_detection": {
@@ -447,9 +786,8 @@ def chat(question: str, client: AzureOpenAI, config: dict, grade: bool = False)
                     "available": [],
                     "summary": ""
                 }
-            }, indent=2)
+            }, iso_codes)
 
-        logging.info("DEBUG: Step 2 - Retrieving documents")
         # Dynamic k strategy based on query complexity and country count
         # Legal documents need higher k due to complexity and verbosity
         base_k = 15  # Higher baseline for legal documents (vs typical k=4)
@@ -462,16 +800,33 @@ def chat(question: str, client: AzureOpenAI, config: dict, grade: bool = False)
             # Minimum 10 per country, but cap at reasonable limit
             retrieval_k = min(len(iso_codes) * 10, 50)
         
-        logging.info(f"DEBUG: Using dynamic k={retrieval_k} for {len(iso_codes)} countries: {iso_codes}")
-        logging.info(f"DEBUG: Multi-jurisdictional query detected: {len(iso_codes) > 1}")
+        # Parent/child index: retrieve small children, then expand the best ones to their sections
+        chunking_mode = os.environ.get("RAG_CHUNKING_MODE", "early").lower()
+        if chunking_mode in ("late", "hybrid"):
+            retrieval_k = min(retrieval_k, int(os.environ.get("LATE_CHUNK_CHILDREN_K", "8")) * len(iso_codes))
+        
+        # Threshold/table and figure questions need fewer, type-targeted chunks
+        route = route_query(question)
+        if route['k_per_country']:
+            retrieval_k = min(retrieval_k, route['k_per_country'] * len(iso_codes))
+        
         t_retrieve_start = time.monotonic()
-        chunks = retrieve(question, iso_codes, client, config, k=retrieval_k)
-        retrieve_ms = int((time.monotonic() - t_retrieve_start) * 1000)
-        logging.info(f"TIMING: retrieve_total_ms={retrieve_ms}")
-        logging.info(f"DEBUG: Retrieved {len(chunks)} chunks")
+        chunks = retrieve(question, iso_codes, config, k=retrieval_k, route=route)
+        timings['retrieve_ms'] = int((time.monotonic() - t_retrieve_start) * 1000)
+        request_span.set(k=retrieval_k, chunks=len(chunks), intent=route['intent'])
+        
+        if chunking_mode in ("late", "hybrid") and chunks:
+            with telemetry.span("expand", mode=chunking_mode, children=len(chunks)) as span:
+                t_expand_start = time.monotonic()
+                try:
+                    chunks = expand_parents(chunks, config, chunking_mode)
+                except requests.exceptions.RequestException as e:
+                    # Children alone still answer the question, just with less surrounding context
+                    logging.warning("Parent expansion failed, using child chunks: %s", e)
+                span.set(chunks=len(chunks), expanded=sum(1 for c in chunks if c.get('expanded_from')))
+                timings['expand_ms'] = int((time.monotonic() - t_expand_start) * 1000)
 
         if not chunks:
-            logging.info("DEBUG: No chunks found, building no-docs response")
             # Even if no docs are found, we can still show the header with availability status
             found_iso_codes = set()
             header = build_response_header(iso_codes, found_iso_codes)
@@ -483,25 +838,20 @@ def chat(question: str, client: AzureOpenAI, config: dict, grade: bool = False)
                 "summary": ", ".join(summary_list)
             }
             no_docs_message = f"No documents found for the specified countries: {', '.join(iso_codes)}. Please try another query or check if the relevant legislation is available."
-            logging.info("DEBUG: Returning no-docs message")
-            return json.dumps({
+            telemetry.event("ask.no_documents", iso_codes=iso_codes, k=retrieval_k, **timings)
+            return finish({
                 "country_header": header,
                 "refined_answer": no_docs_message,
                 "country_detection": country_detection
-            }, indent=2)
+            }, iso_codes)
 
-        logging.info("DEBUG: Step 3 - Preparing context for single-pass answer generation")
         # Build structured context with source mapping
         structured_context = []
         for i, chunk in enumerate(chunks):
-            structured_context.append(f"**SOURCE {i+1}: KL {chunk['iso_code']} (Document Section)**\n{chunk['chunk']}")
+            structured_context.append(f"**SOURCE {i+1}: KL {chunk['iso_code']} ({source_label(chunk)})**\n{chunk['chunk']}")
 
         context = "\n\n---\n\n".join(structured_context)
-        logging.info(f"DEBUG: Structured context built with {len(chunks)} sources, {len(context)} characters")
-        # Build jurisdiction list for logging
-        jurisdiction_list = [f"KL {chunk['iso_code']}" for chunk in chunks]
-        logging.info(f"DEBUG: Sources by jurisdiction: {jurisdiction_list}")
-        logging.info(f"DEBUG: Jurisdiction-aware evaluation will expect comprehensive coverage of: {iso_codes}")
+        request_span.set(context_chars=len(context))
 
         # Build the dynamic markdown table header for UI (not passed to the model)
         found_iso_codes = {chunk['iso_code'] for chunk in chunks}
@@ -513,15 +863,14 @@ def chat(question: str, client: AzureOpenAI, config: dict, grade: bool = False)
             "available": sorted(list(found_iso_codes)),
             "summary": ", ".join(summary_list)
         }
-        logging.info("DEBUG: Header and country_detection built for UI")
 
-        # Step 4: Generate a draft answer first (align with grader/refiner expectations)
-        logging.info("DEBUG: Step 4 - Generating draft answer...")
-        try:
+        # Generate a draft answer first (align with grader/refiner expectations)
+        with telemetry.span("draft", stage="draft", sources=len(chunks), context_chars=len(context)):
             t_draft_start = time.monotonic()
             draft_resp = with_retries(
-                lambda: client.chat.completions.create(
-                    model=config['deploy_chat'],
+                lambda: create_chat_completion(
+                    "draft",
+                    config,
                     messages=[
                         {"role": "system", "content": DRAFTER_SYSTEM_MESSAGE},
                         {"role": "user", "content": f"QUESTION:\n{question}\n\nCONTEXT:\n{context}"}
@@ -532,29 +881,22 @@ def chat(question: str, client: AzureOpenAI, config: dict, grade: bool = False)
                 initial_delay=0.4
             )
             draft_answer = draft_resp.choices[0].message.content.strip()
-            llm_draft_ms = int((time.monotonic() - t_draft_start) * 1000)
-            logging.info("DEBUG: Draft answer generated successfully")
-            logging.info(f"TIMING: llm_draft_ms={llm_draft_ms}")
-        except Exception as draft_error:
-            logging.error(f"DEBUG: Draft step failed: {draft_error}")
-            raise
+            timings['llm_draft_ms'] = int((time.monotonic() - t_draft_start) * 1000)
 
         answer = ""
         refined_data = {}
         if grade:
-            # Step 5: Grade and refine the draft using the full grader prompt
-            logging.info("DEBUG: Step 5 - Grading and refining draft...")
+            # Grade and refine the draft using the full grader prompt
             refiner_user_message = (
                 f"CONTEXT:\n{context}\n\n"
                 f"QUESTION:\n{question}\n\n"
                 f"DRAFT_ANSWER:\n{draft_answer}\n\n"
                 f"Return the exact JSON structure specified in the system message."
             )
-            logging.info(f"DEBUG: Systematic evaluation message length: {len(refiner_user_message)} characters")
 
             # Conservative token limit for systematic evaluation with structured context
             if len(refiner_user_message) > 40000:
-                logging.warning("DEBUG: Message too long for systematic evaluation, truncating context")
+                logging.warning("Refiner message too long (%d chars), truncating context", len(refiner_user_message))
                 # Preserve source structure while truncating
                 context_lines = context.split('\n')
                 truncated_lines = context_lines[:int(len(context_lines) * 0.7)]  # Keep 70% of context
@@ -567,11 +909,12 @@ def chat(question: str, client: AzureOpenAI, config: dict, grade: bool = False)
                     f"Return the exact JSON structure specified in the system message."
                 )
 
-            try:
+            with telemetry.span("refine", stage="refine", message_chars=len(refiner_user_message)) as span:
                 t_llm_start = time.monotonic()
                 refine_resp = with_retries(
-                    lambda: client.chat.completions.create(
-                        model=config['deploy_chat'],
+                    lambda: create_chat_completion(
+                        "refine",
+                        config,
                         response_format={"type": "json_object"},
                         messages=[
                             {"role": "system", "content": GRADER_REFINER_PROMPT},
@@ -583,53 +926,34 @@ def chat(question: str, client: AzureOpenAI, config: dict, grade: bool = False)
                     initial_delay=0.4
                 )
                 refined_output_text = refine_resp.choices[0].message.content.strip()
-                logging.info("DEBUG: Refined answer generated successfully")
-                llm_ms = int((time.monotonic() - t_llm_start) * 1000)
-                logging.info(f"TIMING: llm_refine_ms={llm_ms}")
-            except Exception as refine_error:
-                logging.error(f"DEBUG: Refine step failed: {refine_error}")
-                raise
-
-            logging.info("DEBUG: Step 7 - Processing model response")
-            try:
-                # Try to parse JSON if the model returned structured data
-                parsed = json.loads(refined_output_text)
+                timings['llm_refine_ms'] = int((time.monotonic() - t_llm_start) * 1000)
+
+                try:
+                    # Try to parse JSON if the model returned structured data
+                    parsed = json.loads(refined_output_text)
+                except ValueError:
+                    parsed = None
                 if isinstance(parsed, dict) and 'refined_answer' in parsed:
                     refined_data = parsed
-                    # Optional evaluation logging if present
-                    evaluation = refined_data.get('evaluation', {})
-                    if 'recall_analysis' in evaluation:
-                        recall_score = evaluation['recall_analysis'].get('recall_score', 'N/A')
-                        logging.info(f"DEBUG: Evaluation recall score: {recall_score}")
-                    if 'precision_analysis' in evaluation:
-                        precision_score = evaluation['precision_analysis'].get('precision_score', 'N/A')
-                        logging.info(f"DEBUG: Evaluation precision score: {precision_score}")
-                    if 'f1_score' in evaluation:
-                        f1_score = evaluation.get('f1_score', 'N/A')
-                        logging.info(f"DEBUG: Evaluation F1 score: {f1_score}")
-                    missing_facts = evaluation.get('missing_facts', [])
-                    unsupported_claims = evaluation.get('unsupported_claims', [])
-                    logging.info(f"DEBUG: Missing facts count: {len(missing_facts)}")
-                    logging.info(f"DEBUG: Unsupported claims count: {len(unsupported_claims)}")
-                    if 'recall_analysis' in evaluation:
-                        jurisdictions_covered = evaluation['recall_analysis'].get('jurisdictions_covered', [])
-                        jurisdictions_missing = evaluation['recall_analysis'].get('jurisdictions_missing', [])
-                        logging.info(f"DEBUG: Jurisdictions covered: {jurisdictions_covered}")
-                        logging.info(f"DEBUG: Jurisdictions missing facts: {jurisdictions_missing}")
                     answer = refined_data.get('refined_answer', '')
-                    logging.info("DEBUG: Model returned structured JSON; using 'refined_answer'")
+                    evaluation = refined_data.get('evaluation', {})
+                    recall = evaluation.get('recall_analysis', {})
+                    span.set(
+                        structured=True,
+                        recall_score=recall.get('recall_score'),
+                        precision_score=evaluation.get('precision_analysis', {}).get('precision_score'),
+                        f1_score=evaluation.get('f1_score'),
+                        missing_facts=len(evaluation.get('missing_facts', [])),
+                        unsupported_claims=len(evaluation.get('unsupported_claims', [])),
+                        jurisdictions_missing=recall.get('jurisdictions_missing'),
+                    )
                 else:
+                    # Plain text or unexpected format: use raw text
                     answer = refined_output_text
-                    logging.info("DEBUG: Model returned plain text; using raw text answer")
-            except Exception:
-                # Non-JSON or unexpected format: use raw text
-                answer = refined_output_text
-                logging.info("DEBUG: Model returned non-JSON or parse failed; using raw text answer")
+                    span.set(structured=False)
         else:
-            logging.info("DEBUG: Skipping grading/refinement (grade=False); using draft as final answer")
             answer = draft_answer
 
-        logging.info("DEBUG: Step 8 - Building final systematic evaluation response")
         final_response = {
             "country_header": header,
             "refined_answer": answer,
@@ -640,24 +964,44 @@ def chat(question: str, client: AzureOpenAI, config: dict, grade: bool = False)
             "draft_answer": draft_answer
         }
         
-        total_ms = int((time.monotonic() - t_total_start) * 1000)
-        logging.info(f"TIMING: total_pipeline_ms={total_ms}")
-        logging.info("DEBUG: Systematic evaluation pipeline completed")
-        return json.dumps(final_response, indent=2)
-        
-    except Exception as e:
-        logging.error(f"DEBUG: Chat function failed at some step: {e}", exc_info=True)
-        # Bubble up to main() so that a proper 5xx is returned and the front-end can retry
-        raise
+        timings['total_pipeline_ms'] = int((time.monotonic() - t_total_start) * 1000)
+        telemetry.event(
+            "ask.completed",
+            iso_codes=iso_codes,
+            k=retrieval_k,
+            chunks=len(chunks),
+            context_chars=len(context),
+            grade=grade,
+            intent=route['intent'],
+            prompt_tokens=tracker.totals()['prompt_tokens'],
+            **timings
+        )
+        return finish(final_response, iso_codes)
 
 # --- Azure Function Main Entry Point ---
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('API function invoked.')
+    telemetry.configure("legalchat-ask")
 
     # Lightweight health check to warm instance without heavy work
     if req.params.get('ping'):
         return func.HttpResponse("ok", mimetype="text/plain", status_code=200)
 
+    # Resilience counters (retries, hedges, breaker trips) for this instance
+    if req.params.get('metrics'):
+        return func.HttpResponse(
+            json.dumps({
+                "resilience": resilience.metrics_snapshot(),
+                "deployments": ROUTER.stats() if ROUTER is not None else {},
+                "usage": USAGE_WINDOW.snapshot(),
+                "snapshot": snapshot_info(),
+                "index": get_index_name(),
+                "vector_fields": get_vector_fields(get_index_name()),
+            }, indent=2),
+            mimetype="application/json",
+            status_code=200
+        )
+
     # 1. Load and validate all required environment variables
     try:
         required_vars = {
@@ -670,9 +1014,11 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
         # Add optional vars with defaults
         config.update({
-            "index_name": os.environ.get("KNIFE_SEARCH_INDEX", "knife-index"),
+            "index_name": get_index_name(),
             "deploy_chat": os.environ.get("OPENAI_CHAT_DEPLOY", "gpt-4.1"),
             "deploy_embed": os.environ.get("OPENAI_EMBED_DEPLOY", "text-embedding-3-large"),
+            # Optional small/fast model for cheap stages such as country detection
+            "deploy_fast_chat": os.environ.get("OPENAI_FAST_CHAT_DEPLOY"),
             "api_version": os.environ.get("OPENAI_API_VERSION", "2024-02-15-preview")
         })
     except KeyError as e:
@@ -692,6 +1038,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             s = str(val).strip().lower()
             return s in ("1", "true", "yes", "y", "on")
         grade = to_bool(req.params.get('grade'))
+        # Optional per-request token/cost block in the response
+        include_usage = to_bool(req.params.get('usage'))
         if not question:
             try:
                 req_body = req.get_json()
@@ -701,6 +1049,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 question = req_body.get('question')
                 if 'grade' in req_body:
                     grade = to_bool(req_body.get('grade'))
+                if 'usage' in req_body:
+                    include_usage = to_bool(req_body.get('usage'))
 
         if not question:
             return func.HttpResponse(
@@ -708,15 +1058,8 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
 
-        # Initialize the Azure OpenAI client
-        client = AzureOpenAI(
-            azure_endpoint=config['openai_endpoint'],
-            api_key=config['openai_key'],
-            api_version=config['api_version'],
-        )
-
-        # Execute the RAG pipeline
-        answer = chat(question, client, config, grade=grade)
+        # Execute the RAG pipeline (Azure OpenAI clients are created per routed deployment)
+        answer = chat(question, config, grade=grade, include_usage=include_usage)
 
         # Return the response
         return func.HttpResponse(answer, mimetype="application/json", status_code=200)
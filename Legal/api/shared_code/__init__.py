@@ -0,0 +1,5 @@
+"""Helpers shared by the functions in this Function App.
+
+The Functions host puts the app root on sys.path, so function folders import
+these modules as ``from shared_code import <module>``.
+"""
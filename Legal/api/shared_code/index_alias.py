@@ -0,0 +1,54 @@
+"""The search index ``/api/ask`` queries, following the blue/green pointer record.
+
+``scripts/rebuild_index.py`` fills a new versioned index (``knife-index-v2``,
+...) next to the live one and switches to it by rewriting
+``index/alias.json`` (see ``LegalDocProcessor/shared_code/index_alias.py``).
+``RemoteAlias`` reads that record through a container SAS URL with plain
+``requests``, at most every ``refresh_s`` seconds, so a switch or rollback
+reaches every instance within that time without a restart. Without a record,
+or while it cannot be read, the last known name (or the configured default)
+is used.
+"""
+import logging
+import threading
+import time
+from typing import Optional
+
+import requests
+
+POINTER_BLOB = "index/alias.json"
+
+
+def blob_url(container_url: str, blob_name: str) -> str:
+    base, _, sas = container_url.partition("?")
+    return f"{base.rstrip('/')}/{blob_name}" + (f"?{sas}" if sas else "")
+
+
+class RemoteAlias:
+    def __init__(self, container_url: str, default: str, refresh_s: float = 30.0):
+        self.container_url = container_url
+        self.default = default
+        self.refresh_s = refresh_s
+        self._name: Optional[str] = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def current(self) -> str:
+        with self._lock:
+            if self._name is not None and time.monotonic() - self._checked < self.refresh_s:
+                return self._name
+            try:
+                resp = requests.get(blob_url(self.container_url, POINTER_BLOB), timeout=5)
+                if resp.status_code == 404:
+                    name = self.default
+                else:
+                    resp.raise_for_status()
+                    name = resp.json().get("active") or self.default
+                if name != self._name and self._name is not None:
+                    logging.info(f"Search index switched from {self._name} to {name}")
+                self._name = name
+            except Exception as e:
+                logging.warning(f"Could not read the index alias record: {e}")
+                self._name = self._name or self.default
+            self._checked = time.monotonic()
+            return self._name
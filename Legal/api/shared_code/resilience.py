@@ -0,0 +1,385 @@
+"""Resilience helpers for outbound calls to Azure OpenAI and Azure Cognitive Search.
+
+Provides error classification, retries that honor Retry-After and the Azure
+OpenAI rate-limit headers, a per-endpoint circuit breaker, hedged requests for
+latency-sensitive calls, and in-process counters for all of the above.
+
+This file is kept identical in ``Legal/api/shared_code`` and
+``LegalDocProcessor/shared_code`` because the two Function Apps are deployed as
+separate packages.
+"""
+import contextvars
+import email.utils
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Mapping, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# HTTP statuses worth retrying: timeouts, throttling and transient server errors.
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+# Exception class names (requests, openai, azure-core) that signal a transport
+# problem rather than a bad request. Matched by name so this module does not
+# need to import every SDK.
+_TRANSIENT_EXC_NAMES = (
+    "Timeout",
+    "ConnectionError",
+    "APIConnectionError",
+    "APITimeoutError",
+    "ServiceRequestError",
+    "ServiceResponseError",
+    "ChunkedEncodingError",
+)
+
+
+# --- Metrics ---
+
+_METRICS: Dict[str, int] = defaultdict(int)
+_METRICS_LOCK = threading.Lock()
+
+
+def incr(name: str, amount: int = 1) -> None:
+    """Increments an in-process counter."""
+    with _METRICS_LOCK:
+        _METRICS[name] += amount
+
+
+def metrics_snapshot() -> Dict[str, int]:
+    """Returns a copy of all counters (retries, hedges, breaker trips, ...)."""
+    with _METRICS_LOCK:
+        return dict(sorted(_METRICS.items()))
+
+
+# --- Error classification ---
+
+def status_and_headers(exc: BaseException) -> Tuple[Optional[int], Mapping[str, str]]:
+    """Extracts the HTTP status and response headers from SDK or requests exceptions."""
+    response = getattr(exc, "response", None)
+    status = getattr(exc, "status_code", None)
+    if status is None and response is not None:
+        status = getattr(response, "status_code", None) or getattr(response, "status", None)
+    headers = getattr(response, "headers", None) or {}
+    return (int(status) if isinstance(status, int) else None), headers
+
+
+def _parse_duration(value: str) -> Optional[float]:
+    """Parses durations such as '20ms', '1s' or '6m0s' (x-ratelimit-reset-* headers)."""
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h)", value):
+        matched = True
+        total += float(amount) * {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}[unit]
+    return total if matched else None
+
+
+def parse_retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Returns the server-requested wait in seconds, or None if the headers carry no hint."""
+    if not headers:
+        return None
+    lowered = {str(k).lower(): str(v) for k, v in headers.items()}
+    for key in ("retry-after-ms", "x-ms-retry-after-ms"):
+        if key in lowered:
+            try:
+                return max(0.0, float(lowered[key]) / 1000.0)
+            except ValueError:
+                pass
+    if "retry-after" in lowered:
+        value = lowered["retry-after"].strip()
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            parsed = email.utils.parsedate_to_datetime(value) if value else None
+            if parsed is not None:
+                return max(0.0, parsed.timestamp() - time.time())
+    # Azure OpenAI also reports when the exhausted quota window resets.
+    resets = [
+        _parse_duration(lowered[key])
+        for key in ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")
+        if key in lowered
+    ]
+    resets = [r for r in resets if r is not None]
+    return max(resets) if resets else None
+
+
+def classify(exc: BaseException) -> Tuple[bool, Optional[float]]:
+    """Classifies an exception as retryable or not.
+
+    Returns:
+        (retryable, retry_after_seconds) where retry_after_seconds is the
+        server's Retry-After hint when present.
+    """
+    if isinstance(exc, CircuitOpenError):
+        return False, None
+    status, headers = status_and_headers(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUS, parse_retry_after(headers)
+    # Malformed payloads and programming errors will fail the same way again.
+    if isinstance(exc, (ValueError, KeyError, TypeError, IndexError, AttributeError)):
+        return False, None
+    if any(name in type(exc).__name__ for name in _TRANSIENT_EXC_NAMES):
+        return True, None
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True, None
+    return False, None
+
+
+def _counts_against_endpoint(exc: BaseException) -> bool:
+    """True for failures that indicate an unhealthy endpoint (not throttling or bad input)."""
+    status, _ = status_and_headers(exc)
+    if status is not None:
+        return status >= 500 or status == 408
+    retryable, _ = classify(exc)
+    return retryable
+
+
+# --- Circuit breaker ---
+
+class CircuitOpenError(RuntimeError):
+    """Raised when a call is rejected because the endpoint's circuit is open."""
+
+
+class CircuitBreaker:
+    """Per-endpoint circuit breaker (closed -> open -> half-open -> closed)."""
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+            incr(f"breaker.rejected.{self.name}")
+            raise CircuitOpenError(f"Circuit for '{self.name}' is open")
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                logging.info(f"Circuit for '{self.name}' closed again")
+            self.state = "closed"
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def release(self) -> None:
+        """Ends a call that never reached the endpoint, without counting it either way.
+
+        A half-open breaker lets the next caller probe instead.
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    incr("breaker.trips")
+                    incr(f"breaker.trips.{self.name}")
+                    logging.warning(f"Circuit for '{self.name}' opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+
+_BREAKERS: Dict[str, CircuitBreaker] = {}
+_BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(name: str) -> CircuitBreaker:
+    """Returns the process-wide circuit breaker for an endpoint name."""
+    with _BREAKERS_LOCK:
+        breaker = _BREAKERS.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                name,
+                failure_threshold=int(os.environ.get("RESILIENCE_BREAKER_THRESHOLD", "5")),
+                reset_timeout=float(os.environ.get("RESILIENCE_BREAKER_RESET_S", "30")),
+            )
+            _BREAKERS[name] = breaker
+        return breaker
+
+
+# --- Retries ---
+
+# Callbacks invoked as hook(endpoint_label, attempt_number, error) before each retry
+# (used by shared_code.telemetry to count retries per span).
+RETRY_HOOKS = []
+
+def call_with_retries(
+    fn: Callable[[], T],
+    attempts: int = 2,
+    initial_delay: float = 0.4,
+    factor: float = 2.0,
+    max_delay: float = 5.0,
+    endpoint: Optional[str] = None,
+    deadline: Optional[float] = None,
+    max_retry_after: float = 30.0,
+) -> T:
+    """Runs fn() and retries only retryable failures.
+
+    attempts denotes the number of additional retries beyond the first attempt.
+    Waits honor Retry-After / rate-limit reset headers when the server sends
+    them, otherwise use exponential backoff with jitter. ``deadline`` caps the
+    total time (seconds) spent including waits, so a request thread never
+    sleeps past its own budget. When ``endpoint`` is given, the call goes
+    through that endpoint's circuit breaker.
+    """
+    breaker = get_breaker(endpoint) if endpoint else None
+    label = endpoint or "call"
+    start = time.monotonic()
+    delay = initial_delay
+    for attempt in range(attempts + 1):
+        if breaker:
+            breaker.before_call()
+        try:
+            result = fn()
+        except Exception as e:
+            retryable, retry_after = classify(e)
+            if breaker:
+                # A 4xx/429 still proves the endpoint is up and answering.
+                if _counts_against_endpoint(e):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            if not retryable:
+                incr(f"errors.non_retryable.{label}")
+                raise
+            if attempt == attempts:
+                incr(f"retries.exhausted.{label}")
+                raise
+            if retry_after is not None:
+                if retry_after > max_retry_after:
+                    incr(f"retries.exhausted.{label}")
+                    raise
+                sleep_for = retry_after
+            else:
+                capped = min(delay, max_delay)
+                sleep_for = capped / 2 + random.random() * capped / 2
+            if deadline is not None and time.monotonic() - start + sleep_for > deadline:
+                incr(f"retries.deadline.{label}")
+                raise
+            incr("retries")
+            incr(f"retries.{label}")
+            for hook in RETRY_HOOKS:
+                hook(label, attempt + 1, e)
+            logging.warning(
+                f"Retryable error on {label} attempt {attempt + 1}/{attempts + 1}: {e}; "
+                f"retrying in {sleep_for:.2f}s"
+            )
+            time.sleep(sleep_for)
+            delay *= factor
+        else:
+            if breaker:
+                breaker.record_success()
+            return result
+    raise RuntimeError("unreachable")  # pragma: no cover
+
+
+# --- Hedged requests ---
+
+class LatencyTracker:
+    """Keeps a sliding window of recent call latencies (seconds) for percentile estimates."""
+
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        idx = min(len(samples) - 1, int(q * len(samples)))
+        return samples[idx]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+_LATENCY: Dict[str, LatencyTracker] = defaultdict(LatencyTracker)
+_HEDGE_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="hedge")
+
+
+def latency_tracker(name: str) -> LatencyTracker:
+    return _LATENCY[name]
+
+
+def hedge_delay(name: str, env_var: str, min_samples: int = 20) -> Optional[float]:
+    """Returns the hedge delay in seconds for a call, or None to disable hedging.
+
+    A fixed delay can be configured in milliseconds via ``env_var`` ("0" turns
+    hedging off). Otherwise the delay tracks the observed tail latency, p99 by
+    default (``HEDGE_PERCENTILE``), so only about 1% of calls are duplicated.
+    """
+    configured = os.environ.get(env_var)
+    if configured is not None:
+        ms = float(configured)
+        return ms / 1000.0 if ms > 0 else None
+    tracker = _LATENCY[name]
+    if len(tracker) < min_samples:
+        return None
+    return tracker.percentile(float(os.environ.get("HEDGE_PERCENTILE", "0.99")))
+
+
+def hedged_call(fn: Callable[[], T], name: str, delay: Optional[float]) -> T:
+    """Runs fn(); if it has not finished after ``delay`` seconds, races a duplicate.
+
+    Only use for idempotent calls (e.g., search queries). The first successful
+    result wins; the slower call is left to finish in the background. Both calls
+    run in a copy of the caller's context, so its telemetry span and usage
+    tracker see them.
+    """
+    tracker = _LATENCY[name]
+
+    def timed() -> T:
+        t0 = time.monotonic()
+        result = fn()
+        tracker.record(time.monotonic() - t0)
+        return result
+
+    if delay is None:
+        return timed()
+
+    primary = _HEDGE_POOL.submit(contextvars.copy_context().run, timed)
+    done, _ = wait([primary], timeout=delay)
+    if done:
+        return primary.result()
+
+    incr("hedges.launched")
+    incr(f"hedges.launched.{name}")
+    hedge = _HEDGE_POOL.submit(contextvars.copy_context().run, timed)
+    pending = {primary, hedge}
+    first_error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    incr("hedges.won")
+                    incr(f"hedges.won.{name}")
+                return future.result()
+            first_error = first_error or future.exception()
+    raise first_error
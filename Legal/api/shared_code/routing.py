@@ -0,0 +1,244 @@
+"""Per-stage model routing across Azure OpenAI deployments and endpoints.
+
+Every pipeline stage (``iso_detection``, ``draft``, ``refine``, ``caption``,
+``embed``) maps to an ordered pool of deployments. Within the lowest
+``priority`` tier that still has a healthy member, a deployment is picked at
+random weighted by ``weight / latency`` so faster regions take more traffic.
+Throttled (429) or failing deployments are skipped for their Retry-After
+window and the call spills over to the next candidate, eventually to the next
+tier (e.g., from a small fast model to the full chat model). The same goes for
+a deployment whose client-side quota (``ratelimit``) stays exhausted for
+``ROUTING_SPILL_WAIT_S`` seconds (default 2) while other candidates remain;
+only the last candidate waits for quota as long as its caller allows.
+
+Routes come from ``OPENAI_ROUTES``, a JSON object such as::
+
+    {"iso_detection": [{"deployment": "gpt-4.1-mini"},
+                       {"deployment": "gpt-4.1", "priority": 1}],
+     "draft": [{"deployment": "gpt-4.1"},
+               {"deployment": "gpt-4.1", "endpoint": "https://swc.openai.azure.com",
+                "key_env": "KNIFE_OPENAI_KEY_SWC"}]}
+
+``endpoint`` and the key default to the app's main Azure OpenAI resource.
+Pools for ``embed`` must only contain deployments of the same embedding
+model, since query and document vectors have to match; a second model gets
+its own ``embed@<deployment>`` stage (see ``StageRouter.embedding_stage``).
+
+This file is kept identical in ``Legal/api/shared_code`` and
+``LegalDocProcessor/shared_code``.
+"""
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, TypeVar
+from urllib.parse import urlparse
+
+from . import ratelimit, resilience
+
+T = TypeVar("T")
+
+STAGES = ("iso_detection", "draft", "refine", "caption", "embed")
+
+# Seconds a deployment is skipped after a 429 without Retry-After, or after a server error.
+DEFAULT_THROTTLE_S = 5.0
+DEFAULT_ERROR_BACKOFF_S = 10.0
+
+
+@dataclass
+class Deployment:
+    """One Azure OpenAI deployment on one endpoint."""
+
+    endpoint: str
+    api_key: str
+    deployment: str
+    weight: float = 1.0
+    priority: int = 0
+
+    @property
+    def label(self) -> str:
+        host = urlparse(self.endpoint).netloc or self.endpoint
+        return f"{self.deployment}@{host.split('.')[0]}"
+
+
+@dataclass
+class DeploymentStats:
+    calls: int = 0
+    errors: int = 0
+    throttles: int = 0
+    ewma_ms: Optional[float] = None
+    throttled_until: float = 0.0
+    latencies: deque = field(default_factory=lambda: deque(maxlen=200))
+
+    def record_latency(self, ms: float) -> None:
+        self.latencies.append(ms)
+        self.ewma_ms = ms if self.ewma_ms is None else 0.8 * self.ewma_ms + 0.2 * ms
+
+    def snapshot(self) -> dict:
+        samples = sorted(self.latencies)
+        pct = lambda q: int(samples[min(len(samples) - 1, int(q * len(samples)))]) if samples else None
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "throttles": self.throttles,
+            "ewma_ms": int(self.ewma_ms) if self.ewma_ms is not None else None,
+            "p50_ms": pct(0.5),
+            "p95_ms": pct(0.95),
+            "throttled_for_s": max(0.0, round(self.throttled_until - time.monotonic(), 1)),
+        }
+
+
+class StageRouter:
+    """Selects deployments per stage and records per-deployment latency and errors."""
+
+    def __init__(self, routes: Dict[str, List[Deployment]]):
+        self.routes = routes
+        self._stats: Dict[str, DeploymentStats] = {}
+        self._lock = threading.Lock()
+
+    def _stat(self, dep: Deployment) -> DeploymentStats:
+        with self._lock:
+            return self._stats.setdefault(dep.label, DeploymentStats())
+
+    def primary(self, stage: str) -> Deployment:
+        """The preferred deployment for a stage (first entry of its pool)."""
+        return self.routes[stage][0]
+
+    def candidates(self, stage: str) -> List[Deployment]:
+        """Orders a stage's pool for one call: healthy tiers first, latency-weighted within a tier."""
+        pool = self.routes.get(stage)
+        if not pool:
+            raise KeyError(f"No deployments routed for stage '{stage}'")
+        now = time.monotonic()
+        healthy, resting = [], []
+        for dep in pool:
+            (resting if self._stat(dep).throttled_until > now else healthy).append(dep)
+        ordered = []
+        for tier in sorted({dep.priority for dep in healthy}):
+            members = [dep for dep in healthy if dep.priority == tier]
+            while members:
+                weights = [dep.weight / max(self._stat(dep).ewma_ms or 100.0, 1.0) for dep in members]
+                pick = random.choices(members, weights=weights)[0]
+                ordered.append(pick)
+                members.remove(pick)
+        # Deployments in back-off are still tried as a last resort, soonest-available first.
+        ordered.extend(sorted(resting, key=lambda dep: self._stat(dep).throttled_until))
+        return ordered
+
+    def embedding_stage(self, deployment: str) -> str:
+        """The stage that embeds with ``deployment``.
+
+        ``embed`` when its pool serves that model; otherwise ``embed@<deployment>``,
+        routed by ``OPENAI_ROUTES`` when configured there, else the deployment on the
+        ``embed`` pool's primary endpoint. Used while an index carries vectors of two models.
+        """
+        pool = self.routes.get("embed", [])
+        if not pool or any(dep.deployment == deployment for dep in pool):
+            return "embed"
+        stage = f"embed@{deployment}"
+        with self._lock:
+            if stage not in self.routes:
+                self.routes[stage] = [Deployment(pool[0].endpoint, pool[0].api_key, deployment)]
+        return stage
+
+    def call(self, stage: str, fn: Callable[[Deployment], T]) -> T:
+        """Runs fn(deployment), spilling over to the next candidate on throttling or endpoint errors."""
+        last_error = None
+        candidates = self.candidates(stage)
+        spill_wait = float(os.environ.get("ROUTING_SPILL_WAIT_S", "2"))
+        for position, dep in enumerate(candidates):
+            stat = self._stat(dep)
+            breaker = resilience.get_breaker(dep.label)
+            try:
+                breaker.before_call()
+            except resilience.CircuitOpenError as e:
+                last_error = e
+                continue
+            t0 = time.monotonic()
+            try:
+                with ratelimit.wait_limit(spill_wait if position < len(candidates) - 1 else None):
+                    result = fn(dep)
+            except ratelimit.RateLimitTimeout as e:
+                # Local quota exhausted before anything was sent: like a 429, without the call
+                breaker.release()
+                with self._lock:
+                    stat.throttles += 1
+                    stat.throttled_until = time.monotonic() + DEFAULT_THROTTLE_S
+                resilience.incr(f"routing.spillover.{stage}")
+                logging.warning(f"Stage '{stage}' spilling over from {dep.label}: {e}")
+                last_error = e
+                continue
+            except Exception as e:
+                retryable, retry_after = resilience.classify(e)
+                status, _ = resilience.status_and_headers(e)
+                with self._lock:
+                    stat.calls += 1
+                    stat.errors += 1
+                    if status == 429:
+                        stat.throttles += 1
+                        stat.throttled_until = time.monotonic() + (retry_after or DEFAULT_THROTTLE_S)
+                    elif retryable:
+                        stat.throttled_until = time.monotonic() + DEFAULT_ERROR_BACKOFF_S
+                if status == 429:
+                    breaker.record_success()
+                elif retryable:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                    raise
+                resilience.incr(f"routing.spillover.{stage}")
+                logging.warning(f"Stage '{stage}' spilling over from {dep.label}: {e}")
+                last_error = e
+                continue
+            with self._lock:
+                stat.calls += 1
+                stat.record_latency((time.monotonic() - t0) * 1000)
+            breaker.record_success()
+            return result
+        raise last_error
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            return {label: stat.snapshot() for label, stat in sorted(self._stats.items())}
+
+
+def load_routes(
+    default_endpoint: str,
+    default_key: str,
+    defaults: Dict[str, List[str]],
+) -> Dict[str, List[Deployment]]:
+    """Builds stage pools from OPENAI_ROUTES, falling back to ``defaults`` (stage -> deployment names).
+
+    Default pools list deployment names in priority order; empty names are skipped.
+    """
+    routes = {}
+    for stage, names in defaults.items():
+        pool = [
+            Deployment(default_endpoint, default_key, name, priority=i)
+            for i, name in enumerate(n for n in names if n)
+        ]
+        if pool:
+            routes[stage] = pool
+    raw = os.environ.get("OPENAI_ROUTES", "").strip()
+    if raw:
+        try:
+            configured = json.loads(raw)
+        except ValueError:
+            logging.error("OPENAI_ROUTES is not valid JSON; using default routes")
+            configured = {}
+        for stage, entries in configured.items():
+            routes[stage] = [
+                Deployment(
+                    endpoint=(entry.get("endpoint") or default_endpoint).rstrip("/"),
+                    api_key=os.environ.get(entry["key_env"], "") if entry.get("key_env") else default_key,
+                    deployment=entry["deployment"],
+                    weight=float(entry.get("weight", 1.0)),
+                    priority=int(entry.get("priority", 0)),
+                )
+                for entry in entries
+            ]
+    return routes
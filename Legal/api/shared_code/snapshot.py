@@ -0,0 +1,464 @@
+"""Memory-mapped vector snapshots of the search index for in-process retrieval.
+
+A snapshot file holds every indexed chunk's ``id``, ``iso_code``, ``chunk``
+and ``embedding``:
+
+- an 8-byte magic, a little-endian uint32 header length and a JSON header
+  (``version``, ``dims``, ``dtype``, ``rows``, the ``countries`` row ranges
+  and their index state ``stamps``);
+- the embedding matrix (``rows x dims``, float32 or float16, L2-normalized),
+  sorted by ISO code so each country is one contiguous row range;
+- a string table: ``n * rows + 1`` int64 offsets followed by UTF-8 bytes,
+  where the header's ``fields`` (``id``, ``chunk``, ``chunk_type``, ...) name
+  the ``n`` strings stored for each row, row ``i`` starting at position ``n * i``;
+  after the rows come ``id``, ``iso_code`` and ``chunk`` of each parent section
+  (stored without a vector, used for late chunk expansion).
+
+``Snapshot`` maps the file read-only and answers filtered top-k queries with
+NumPy dot products over the requested countries' row ranges only.
+
+Snapshots are published by ingestion into their own blob container
+(``snapshots/<version>.snap`` plus a ``latest.json`` pointer).
+``RemoteSnapshot`` follows that pointer through a container SAS URL with plain
+``requests``, so the SWA API needs no storage SDK.
+
+Ingestion also keeps ``index_state.json`` in that container: per country, the
+stamp of the last index write and whether it completed. A snapshot records the
+stamp its rows were read at; ``RemoteSnapshot.stale`` names the countries whose
+state moved on (or is being rewritten), which are then queried on the index.
+
+This file is kept identical in ``Legal/api/shared_code`` and
+``LegalDocProcessor/shared_code``.
+"""
+import json
+import logging
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+import requests
+
+MAGIC = b"KNIFESN1"
+ALIGN = 64
+FORMAT = 1
+POINTER_BLOB = "latest.json"
+STATE_BLOB = "index_state.json"
+# Rows copied from the spool per block while a snapshot is written
+COPY_ROWS = 4096
+# String fields stored per row; snapshots written before ``fields`` existed hold id and chunk only.
+DEFAULT_FIELDS = ("id", "chunk", "chunk_type", "table_id", "figure_id", "parent_id", "section_path")
+LEGACY_FIELDS = ("id", "chunk")
+
+
+def new_version(tag: str = "") -> str:
+    """Sortable snapshot version, e.g. ``20240131T120501123Z-AE``."""
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")[:-3] + "Z"
+    return f"{stamp}-{tag}" if tag else stamp
+
+
+def snapshot_blob_name(version: str) -> str:
+    return f"snapshots/{version}.snap"
+
+
+def _aligned(n: int) -> int:
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _normalized(vector: Any, dims: int) -> np.ndarray:
+    vec = np.asarray(vector, dtype=np.float32)
+    if vec.shape != (dims,):
+        raise ValueError(f"Expected a {dims}-dimensional embedding, got shape {vec.shape}")
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm > 0 else vec
+
+
+def _int64(values: array) -> np.ndarray:
+    return np.frombuffer(values, dtype=np.int64) if len(values) else np.zeros(0, dtype=np.int64)
+
+
+def write_snapshot(
+    path: str,
+    rows: Iterable[Dict[str, Any]],
+    version: str,
+    dtype: str = "float32",
+    fields: Iterable[str] = DEFAULT_FIELDS,
+    parents: Iterable[Dict[str, Any]] = (),
+    stamps: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    """Writes rows (``iso_code``, ``embedding`` and the string ``fields``) to a snapshot file.
+
+    Rows are grouped by ISO code; their order within a country is kept.
+    ``parents`` (``id``, ``iso_code``, ``chunk``) are stored as text only.
+    ``stamps`` maps ISO codes to the index state stamp the rows were read at.
+    Rows are spooled to temporary files next to ``path`` as they arrive, so
+    memory holds a row number and string lengths per row rather than the rows.
+    Returns the header.
+    """
+    fields = list(fields)
+    if fields[:2] != ["id", "chunk"]:
+        raise ValueError("Snapshot fields must start with 'id' and 'chunk'")
+    if dtype not in ("float32", "float16"):
+        raise ValueError(f"Unsupported snapshot dtype '{dtype}'")
+    item_dtype = np.dtype("<f4" if dtype == "float32" else "<f2")
+    stride = len(fields)
+
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(path))) as spool:
+        vectors_path = os.path.join(spool, "vectors")
+        strings_path = os.path.join(spool, "strings")
+        parents_path = os.path.join(spool, "parents")
+        by_country: Dict[str, array] = {}
+        lengths, parent_lengths = array("q"), array("q")
+        count, dims = 0, 0
+        with open(vectors_path, "wb") as vf, open(strings_path, "wb") as sf:
+            for row in rows:
+                if not count:
+                    dims = len(row["embedding"])
+                vf.write(_normalized(row["embedding"], dims).astype(item_dtype).tobytes())
+                for name in fields:
+                    encoded = str(row.get(name) or "").encode("utf-8")
+                    sf.write(encoded)
+                    lengths.append(len(encoded))
+                by_country.setdefault(row["iso_code"], array("q")).append(count)
+                count += 1
+        with open(parents_path, "wb") as pf:
+            for parent in parents:
+                for name in ("id", "iso_code", "chunk"):
+                    encoded = str(parent.get(name) or "").encode("utf-8")
+                    pf.write(encoded)
+                    parent_lengths.append(len(encoded))
+
+        countries, start = {}, 0
+        for iso in sorted(by_country):
+            countries[iso] = [start, start + len(by_country[iso])]
+            start += len(by_country[iso])
+        # Spool row numbers in output order, and where each row's strings start in the spool
+        order = np.concatenate(
+            [_int64(by_country[iso]) for iso in sorted(by_country)]
+        ) if count else _int64(array("q"))
+        row_lengths = _int64(lengths).reshape(count, stride)
+        row_bytes = row_lengths.sum(axis=1)
+        row_starts = np.concatenate(([0], np.cumsum(row_bytes)[:-1])) if count else row_bytes
+        offsets = np.zeros(len(lengths) + len(parent_lengths) + 1, dtype="<i8")
+        np.cumsum(
+            np.concatenate((row_lengths[order].ravel(), _int64(parent_lengths))),
+            out=offsets[1:],
+        )
+
+        matrix_bytes = count * dims * item_dtype.itemsize
+        header = {
+            "format": FORMAT,
+            "version": version,
+            "created": datetime.now(timezone.utc).isoformat(),
+            "dims": dims,
+            "dtype": dtype,
+            "rows": count,
+            "countries": countries,
+            "fields": fields,
+            "parents": len(parent_lengths) // 3,
+            "stamps": {iso: stamps[iso] for iso in countries if stamps and stamps.get(iso)},
+            # Offsets are relative to the (aligned) end of the header.
+            "matrix_offset": 0,
+            "strings_offset": _aligned(matrix_bytes),
+        }
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        data_start = _aligned(len(MAGIC) + 4 + len(header_bytes))
+
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<I", len(header_bytes)))
+            f.write(header_bytes)
+            f.write(b"\0" * (data_start - f.tell()))
+            if matrix_bytes:
+                spooled = np.memmap(vectors_path, dtype=item_dtype, mode="r", shape=(count, dims))
+                for block in range(0, count, COPY_ROWS):
+                    f.write(np.ascontiguousarray(spooled[order[block:block + COPY_ROWS]]).tobytes())
+                del spooled
+            f.write(b"\0" * (data_start + header["strings_offset"] - f.tell()))
+            f.write(offsets.tobytes())
+            if int(row_bytes.sum()):
+                strings = np.memmap(strings_path, dtype=np.uint8, mode="r")
+                # Rows that arrived in output order are copied as one run
+                breaks = np.flatnonzero(np.diff(order) != 1) + 1
+                for run in np.split(order, breaks):
+                    first, last = int(run[0]), int(run[-1])
+                    f.write(memoryview(strings[row_starts[first]:row_starts[last] + row_bytes[last]]))
+                del strings
+            with open(parents_path, "rb") as pf:
+                shutil.copyfileobj(pf, f)
+    return header
+
+
+class Snapshot:
+    """A read-only, memory-mapped snapshot file."""
+
+    def __init__(self, path: str, float16_cache_countries: int = 8):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not an index snapshot")
+            (header_len,) = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_len).decode("utf-8"))
+        if self.header.get("format") != FORMAT:
+            raise ValueError(f"Unsupported snapshot format {self.header.get('format')}")
+        data_start = _aligned(len(MAGIC) + 4 + header_len)
+        self.version: str = self.header["version"]
+        self.dims: int = self.header["dims"]
+        self.rows: int = self.header["rows"]
+        self.countries: Dict[str, List[int]] = self.header["countries"]
+        self.fields: List[str] = list(self.header.get("fields", LEGACY_FIELDS))
+        self.parent_count: int = self.header.get("parents", 0)
+        self.stamps: Dict[str, str] = self.header.get("stamps", {})
+        stride = len(self.fields)
+        dtype = np.dtype("<f4" if self.header["dtype"] == "float32" else "<f2")
+        strings_start = data_start + self.header["strings_offset"]
+        string_count = stride * self.rows + 3 * self.parent_count
+        if self.rows:
+            self.matrix = np.memmap(path, dtype=dtype, mode="r", offset=data_start, shape=(self.rows, self.dims))
+        else:
+            self.matrix = np.zeros((0, self.dims), dtype=dtype)
+        if string_count:
+            self._offsets = np.memmap(path, dtype="<i8", mode="r", offset=strings_start, shape=(string_count + 1,))
+            self._strings = np.memmap(path, dtype=np.uint8, mode="r", offset=strings_start + self._offsets.nbytes)
+        else:
+            self._offsets = np.zeros(1, dtype="<i8")
+            self._strings = np.zeros(0, dtype=np.uint8)
+        self._parent_index: Optional[Dict[str, int]] = None
+        # float16 blocks are widened per country on first use (matmul on float16 is slow on CPUs).
+        self._blocks: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._cache_countries = float16_cache_countries
+        self._columns: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    def _string(self, index: int) -> str:
+        return bytes(self._strings[self._offsets[index]:self._offsets[index + 1]]).decode("utf-8")
+
+    def value(self, row: int, name: str) -> str:
+        """A string field of one row ('' for fields this snapshot does not store)."""
+        if name not in self.fields:
+            return ""
+        return self._string(len(self.fields) * row + self.fields.index(name))
+
+    def row_id(self, row: int) -> str:
+        return self.value(row, "id")
+
+    def row_chunk(self, row: int) -> str:
+        return self.value(row, "chunk")
+
+    def column(self, name: str) -> np.ndarray:
+        """All values of a short string field (e.g. ``chunk_type``) as an array, decoded once."""
+        with self._lock:
+            values = self._columns.get(name)
+        if values is None:
+            values = np.array([self.value(row, name) for row in range(self.rows)], dtype=object)
+            with self._lock:
+                self._columns[name] = values
+        return values
+
+    def _row(self, row: int, iso_code: str) -> Dict[str, Any]:
+        result = {name: self.value(row, name) for name in self.fields}
+        result["iso_code"] = iso_code
+        return result
+
+    def _block(self, iso_code: str) -> np.ndarray:
+        start, stop = self.countries[iso_code]
+        if self.matrix.dtype == np.float32:
+            return self.matrix[start:stop]
+        with self._lock:
+            block = self._blocks.get(iso_code)
+            if block is not None:
+                self._blocks.move_to_end(iso_code)
+                return block
+        block = np.asarray(self.matrix[start:stop], dtype=np.float32)
+        with self._lock:
+            self._blocks[iso_code] = block
+            while len(self._blocks) > self._cache_countries:
+                self._blocks.popitem(last=False)
+        return block
+
+    def search(
+        self,
+        vector: Any,
+        iso_codes: Iterable[str],
+        k: int,
+        chunk_types: Optional[Iterable[str]] = None,
+    ) -> List[Dict[str, Any]]:
+        """Top-k rows by cosine similarity among the given countries.
+
+        Results look like Azure Cognitive Search hits (the stored fields plus
+        ``iso_code`` and ``@search.score``), with the score computed the way
+        the service does for the cosine metric: ``1 / (2 - cos)``.
+        ``chunk_types`` restricts the hits like an OData ``chunk_type`` filter.
+        """
+        query = _normalized(vector, self.dims)
+        allowed = set(chunk_types) if chunk_types else None
+        types = self.column("chunk_type") if allowed else None
+        scores, row_ids, row_isos = [], [], []
+        for iso in dict.fromkeys(iso_codes):
+            if iso not in self.countries:
+                continue
+            start, stop = self.countries[iso]
+            if stop == start:
+                continue
+            block_scores = self._block(iso) @ query
+            rows = np.arange(start, stop)
+            if allowed is not None:
+                keep = np.fromiter((t in allowed for t in types[start:stop]), dtype=bool, count=stop - start)
+                block_scores, rows = block_scores[keep], rows[keep]
+            scores.append(block_scores)
+            row_ids.append(rows)
+            row_isos.extend([iso] * len(rows))
+        if not scores or k <= 0:
+            return []
+        all_scores = np.concatenate(scores)
+        all_rows = np.concatenate(row_ids)
+        if not len(all_scores):
+            return []
+        k = min(k, len(all_scores))
+        top = np.argpartition(-all_scores, k - 1)[:k]
+        top = top[np.argsort(-all_scores[top])]
+        results = []
+        for i in top:
+            hit = self._row(int(all_rows[i]), row_isos[i])
+            hit["@search.score"] = float(1.0 / (2.0 - float(all_scores[i])))
+            results.append(hit)
+        return results
+
+    def _parent(self, index: int) -> Dict[str, Any]:
+        base = len(self.fields) * self.rows + 3 * index
+        return {"id": self._string(base), "iso_code": self._string(base + 1), "chunk": self._string(base + 2)}
+
+    def parent(self, parent_id: str) -> Optional[Dict[str, Any]]:
+        """A parent section by id, or None."""
+        if self._parent_index is None:
+            base = len(self.fields) * self.rows
+            index = {self._string(base + 3 * i): i for i in range(self.parent_count)}
+            with self._lock:
+                self._parent_index = index
+        position = self._parent_index.get(parent_id)
+        return self._parent(position) if position is not None else None
+
+    def iter_parents(self, exclude: Iterable[str] = ()) -> Iterator[Dict[str, Any]]:
+        """Yields parent sections, skipping the excluded countries."""
+        skipped = set(exclude)
+        for i in range(self.parent_count):
+            parent = self._parent(i)
+            if parent["iso_code"] not in skipped:
+                yield parent
+
+    def iter_rows(self, exclude: Iterable[str] = ()) -> Iterator[Dict[str, Any]]:
+        """Yields rows as dicts (float32 embeddings), skipping the excluded countries."""
+        skipped = set(exclude)
+        for iso, (start, stop) in self.countries.items():
+            if iso in skipped:
+                continue
+            for row in range(start, stop):
+                result = self._row(row, iso)
+                result["embedding"] = np.asarray(self.matrix[row], dtype=np.float32)
+                yield result
+
+
+def _blob_url(container_url: str, blob_name: str) -> str:
+    base, _, sas = container_url.partition("?")
+    return f"{base.rstrip('/')}/{blob_name}" + (f"?{sas}" if sas else "")
+
+
+class RemoteSnapshot:
+    """Keeps the latest published snapshot downloaded and mapped.
+
+    The ``latest.json`` pointer and the index state are re-read at most every
+    ``refresh_s`` seconds; a new version is downloaded to ``cache_dir`` and
+    swapped in. While a refresh fails, the previously loaded snapshot and state
+    keep serving.
+    """
+
+    def __init__(self, container_url: str, cache_dir: Optional[str] = None, refresh_s: float = 60.0):
+        self.container_url = container_url
+        self.cache_dir = cache_dir or os.path.join(tempfile.gettempdir(), "knife-snapshots")
+        self.refresh_s = refresh_s
+        self._snapshot: Optional[Snapshot] = None
+        self._state: Dict[str, Dict[str, Any]] = {}
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> Optional[Snapshot]:
+        """The snapshot currently in memory, without checking for a newer one."""
+        return self._snapshot
+
+    def get(self) -> Optional[Snapshot]:
+        """The current snapshot, refreshing the pointer when it is due."""
+        if self._snapshot is not None and time.monotonic() - self._checked < self.refresh_s:
+            return self._snapshot
+        with self._lock:
+            if self._snapshot is None or time.monotonic() - self._checked >= self.refresh_s:
+                try:
+                    self._refresh()
+                except Exception as e:
+                    logging.warning(f"Snapshot refresh failed, keeping version "
+                                    f"{self._snapshot.version if self._snapshot else None}: {e}")
+                self._checked = time.monotonic()
+        return self._snapshot
+
+    def stale(self, snap: Snapshot, iso_codes: Iterable[str]) -> List[str]:
+        """Countries whose index changed since ``snap`` was read, or is being written.
+
+        A country is current when its state stamp is the snapshot's and its last
+        index write completed; countries without a stamp on either side (state
+        or snapshot from before stamps existed) count as current.
+        """
+        state = self._state
+        stale = []
+        for iso in iso_codes:
+            entry = state.get(iso) or {}
+            if entry.get("stamp") != snap.stamps.get(iso) or not entry.get("indexed", True):
+                stale.append(iso)
+        return stale
+
+    def _read_state(self) -> None:
+        try:
+            resp = requests.get(_blob_url(self.container_url, STATE_BLOB), timeout=10)
+            if resp.status_code == 404:
+                self._state = {}
+                return
+            resp.raise_for_status()
+            self._state = resp.json().get("countries", {})
+        except Exception as e:
+            logging.warning(f"Index state refresh failed, keeping the previous state: {e}")
+
+    def _refresh(self) -> None:
+        self._read_state()
+        resp = requests.get(_blob_url(self.container_url, POINTER_BLOB), timeout=10)
+        resp.raise_for_status()
+        pointer = resp.json()
+        version = pointer["version"]
+        if self._snapshot is not None and self._snapshot.version == version:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, f"{version}.snap")
+        if not os.path.exists(path):
+            t0 = time.monotonic()
+            partial = path + ".part"
+            with requests.get(_blob_url(self.container_url, pointer["blob"]), stream=True, timeout=60) as download:
+                download.raise_for_status()
+                with open(partial, "wb") as f:
+                    for block in download.iter_content(chunk_size=1 << 20):
+                        f.write(block)
+            os.replace(partial, path)
+            logging.info(f"Downloaded snapshot {version} ({os.path.getsize(path)} bytes) "
+                         f"in {int((time.monotonic() - t0) * 1000)} ms")
+        self._snapshot = Snapshot(path)
+        # Older files can go; a mapped file stays readable until it is unmapped.
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".snap") and name != os.path.basename(path):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
@@ -0,0 +1,190 @@
+"""Token and cost accounting for model calls, per request or ingestion job.
+
+``track()`` opens a ``UsageTracker`` for the current request/job; model-call
+helpers report each response's ``usage`` block through ``record()``, which
+aggregates prompt, completion and cached prompt tokens per stage and computes
+an estimated cost from the price table.
+
+Prices are USD per million tokens and keyed by deployment name (or routing
+label ``deployment@resource``). ``OPENAI_PRICE_TABLE`` (JSON) overrides or
+extends the defaults, e.g.
+``{"gpt-4.1": {"input": 2.0, "cached_input": 0.5, "output": 8.0}}``.
+
+This file is kept identical in ``Legal/api/shared_code`` and
+``LegalDocProcessor/shared_code``.
+"""
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, Optional
+
+DEFAULT_PRICES = {
+    "gpt-4.1": {"input": 2.00, "cached_input": 0.50, "output": 8.00},
+    "gpt-4.1-mini": {"input": 0.40, "cached_input": 0.10, "output": 1.60},
+    "gpt-4.1-nano": {"input": 0.10, "cached_input": 0.025, "output": 0.40},
+    "gpt-4o": {"input": 2.50, "cached_input": 1.25, "output": 10.00},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.60},
+    "text-embedding-3-large": {"input": 0.13},
+    "text-embedding-3-small": {"input": 0.02},
+}
+
+_PRICES = None
+_CURRENT: contextvars.ContextVar = contextvars.ContextVar("usage_tracker", default=None)
+
+
+def price_table() -> Dict[str, Dict[str, float]]:
+    global _PRICES
+    if _PRICES is None:
+        prices = dict(DEFAULT_PRICES)
+        raw = os.environ.get("OPENAI_PRICE_TABLE", "").strip()
+        if raw:
+            try:
+                prices.update(json.loads(raw))
+            except ValueError:
+                logging.error("OPENAI_PRICE_TABLE is not valid JSON; using default prices")
+        _PRICES = prices
+    return _PRICES
+
+
+def estimate_cost(deployment: str, prompt_tokens: int, completion_tokens: int = 0, cached_tokens: int = 0) -> float:
+    """Estimated USD cost of one call; unknown deployments cost 0."""
+    prices = price_table()
+    price = prices.get(deployment) or prices.get(deployment.split("@")[0]) or {}
+    uncached = max(0, prompt_tokens - cached_tokens)
+    cost = (
+        uncached * price.get("input", 0.0)
+        + cached_tokens * price.get("cached_input", price.get("input", 0.0))
+        + completion_tokens * price.get("output", 0.0)
+    )
+    return cost / 1_000_000
+
+
+def _field(obj: Any, name: str) -> Any:
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+class UsageTracker:
+    """Aggregates token usage and cost per stage for one request or ingestion job."""
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, deployment: str, usage: Any) -> None:
+        """Adds a response's usage block (OpenAI SDK object or REST dict)."""
+        if usage is None:
+            return
+        prompt = int(_field(usage, "prompt_tokens") or 0)
+        completion = int(_field(usage, "completion_tokens") or 0)
+        cached = int(_field(_field(usage, "prompt_tokens_details"), "cached_tokens") or 0)
+        cost = estimate_cost(deployment, prompt, completion, cached)
+        with self._lock:
+            entry = self.stages.setdefault(stage, {
+                "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "cost_usd": 0.0,
+            })
+            entry["calls"] += 1
+            entry["prompt_tokens"] += prompt
+            entry["completion_tokens"] += completion
+            entry["cached_tokens"] += cached
+            entry["cost_usd"] += cost
+
+    def totals(self) -> Dict[str, float]:
+        with self._lock:
+            total = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0, "cost_usd": 0.0}
+            for entry in self.stages.values():
+                for key in total:
+                    total[key] += entry[key]
+        total["cost_usd"] = round(total["cost_usd"], 6)
+        return total
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {
+                stage: dict(entry, cost_usd=round(entry["cost_usd"], 6))
+                for stage, entry in self.stages.items()
+            }
+        return {"stages": stages, "total": self.totals()}
+
+
+@contextmanager
+def track() -> Iterator[UsageTracker]:
+    """Makes a fresh tracker current for the enclosed request or job."""
+    tracker = UsageTracker()
+    token = _CURRENT.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _CURRENT.reset(token)
+
+
+def current() -> Optional[UsageTracker]:
+    return _CURRENT.get()
+
+
+def record(stage: str, deployment: str, usage: Any) -> None:
+    """Records usage on the current tracker, if any."""
+    tracker = _CURRENT.get()
+    if tracker is not None:
+        tracker.record(stage, deployment, usage)
+
+
+class RollingUsage:
+    """Sliding-window usage aggregates per ISO code and per question shape."""
+
+    def __init__(self, window_s: float = 3600.0):
+        self.window_s = window_s
+        self._entries = deque()
+        self._lock = threading.Lock()
+
+    def add(self, iso_codes: Iterable[str], shape: str, totals: Dict[str, float]) -> None:
+        codes = list(iso_codes) or ["none"]
+        with self._lock:
+            self._entries.append((time.time(), codes, shape, totals))
+            self._expire()
+
+    def _expire(self) -> None:
+        cutoff = time.time() - self.window_s
+        while self._entries and self._entries[0][0] < cutoff:
+            self._entries.popleft()
+
+    def snapshot(self) -> Dict[str, Any]:
+        by_iso = defaultdict(lambda: defaultdict(float))
+        by_shape = defaultdict(lambda: defaultdict(float))
+        with self._lock:
+            self._expire()
+            entries = list(self._entries)
+        for _, codes, shape, totals in entries:
+            share = 1.0 / len(codes)  # multi-country requests are split evenly
+            for code in codes:
+                bucket = by_iso[code]
+                bucket["requests"] += share
+                for key in ("prompt_tokens", "completion_tokens", "cost_usd"):
+                    bucket[key] += totals.get(key, 0) * share
+            bucket = by_shape[shape]
+            bucket["requests"] += 1
+            for key in ("prompt_tokens", "completion_tokens", "cost_usd"):
+                bucket[key] += totals.get(key, 0)
+
+        def finish(groups):
+            out = {}
+            for name, bucket in sorted(groups.items()):
+                requests = bucket["requests"] or 1
+                out[name] = {
+                    "requests": round(bucket["requests"], 2),
+                    "prompt_tokens": int(bucket["prompt_tokens"]),
+                    "completion_tokens": int(bucket["completion_tokens"]),
+                    "avg_prompt_tokens": int(bucket["prompt_tokens"] / requests),
+                    "cost_usd": round(bucket["cost_usd"], 4),
+                }
+            return out
+
+        return {"window_s": self.window_s, "by_iso": finish(by_iso), "by_shape": finish(by_shape)}
@@ -0,0 +1,63 @@
+"""Which vector field, and embedding model, ``/api/ask`` queries each country on.
+
+While ``scripts/migrate_embeddings.py`` moves an index to a new embedding
+model, its countries are split between two vector fields. The record
+``index/vectors/<index>.json`` (see ``LegalDocProcessor/shared_code/vector_fields.py``)
+says which: ``countries`` lists those already served from another field,
+the rest use ``default``. ``RemoteVectorFields`` reads it through the same
+container SAS URL as the index alias, at most every ``refresh_s`` seconds.
+Without a record, every country is queried on ``embedding`` with the
+configured embedding deployment; while it cannot be read, the last known
+record is kept.
+"""
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+
+from .index_alias import blob_url
+
+PREFIX = "index/vectors/"
+DEFAULT_FIELD = "embedding"
+
+
+def default_record() -> Dict[str, Any]:
+    return {"fields": {DEFAULT_FIELD: {"deployment": None, "dims": None}}, "default": DEFAULT_FIELD,
+            "target": None, "countries": {}}
+
+
+def groups(record: Dict[str, Any], iso_codes: List[str]) -> List[Tuple[str, Optional[str], List[str]]]:
+    """(field, deployment, ISO codes) per vector field the countries are queried on, default field first."""
+    by_field: Dict[str, List[str]] = {}
+    for iso_code in iso_codes:
+        by_field.setdefault(record.get("countries", {}).get(iso_code, record["default"]), []).append(iso_code)
+    ordered = sorted(by_field, key=lambda name: name != record["default"])
+    return [(name, (record["fields"].get(name) or {}).get("deployment"), by_field[name]) for name in ordered]
+
+
+class RemoteVectorFields:
+    def __init__(self, container_url: str, refresh_s: float = 30.0):
+        self.container_url = container_url
+        self.refresh_s = refresh_s
+        self._records: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def current(self, index_name: str) -> Dict[str, Any]:
+        with self._lock:
+            cached = self._records.get(index_name)
+            if cached is not None and time.monotonic() - cached[0] < self.refresh_s:
+                return cached[1]
+            try:
+                resp = requests.get(blob_url(self.container_url, f"{PREFIX}{index_name}.json"), timeout=5)
+                if resp.status_code == 404:
+                    record = default_record()
+                else:
+                    resp.raise_for_status()
+                    record = resp.json()
+            except Exception as e:
+                logging.warning(f"Could not read the vector field record of {index_name}: {e}")
+                record = cached[1] if cached is not None else default_record()
+            self._records[index_name] = (time.monotonic(), record)
+            return record
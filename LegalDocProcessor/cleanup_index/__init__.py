@@ -5,6 +5,8 @@ import json
 import azure.functions as func
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
+from azure.storage.blob import BlobServiceClient
+from shared_code import index_alias, manifest, purge, snapshot_store, status_cache
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -13,6 +15,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     Usage:
     POST /api/cleanup_index
     Body: {"iso_code": "FR"} or {"iso_code": "all"}
+          optional "resume_after" (the key returned by an interrupted run) and "max_seconds"
     
     This provides a reliable alternative to Event Grid for index cleanup.
     """
@@ -41,7 +44,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         # Azure Cognitive Search settings from environment variables
         search_endpoint = os.environ.get("KNIFE_SEARCH_ENDPOINT")
         search_key = os.environ.get("KNIFE_SEARCH_KEY")
-        search_index_name = os.environ.get("KNIFE_SEARCH_INDEX")
+        search_index_name = os.environ.get("KNIFE_SEARCH_INDEX") and index_alias.resolve()
 
         # Check required environment variables
         env_vars = {
@@ -67,8 +70,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         if iso_code == "ALL":
             # Clean up all documents (admin function)
             logging.info("Processing cleanup for ALL documents")
-            results = search_client.search(search_text="*", select="id,iso_code")
-            docs_to_delete = [{"id": doc["id"]} for doc in results]
+            filter_expr = None
             cleanup_type = "all documents"
         else:
             # Validate ISO code format
@@ -80,53 +82,78 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 )
             
             # Clean up specific country
-            logging.info(f"Searching for documents with iso_code: {iso_code}")
-            results = search_client.search(search_text="*", filter=f"iso_code eq '{iso_code}'", select="id")
-            docs_to_delete = [{"id": doc["id"]} for doc in results]
+            filter_expr = f"iso_code eq '{iso_code}'"
             cleanup_type = f"documents for {iso_code}"
 
-        if docs_to_delete:
-            logging.info(f"Found {len(docs_to_delete)} documents to delete")
-            
-            # Delete the documents from the search index
-            delete_result = search_client.delete_documents(documents=docs_to_delete)
-            
-            # Check results
-            successful_deletes = [res for res in delete_result if res.succeeded]
-            failed_deletes = [res for res in delete_result if not res.succeeded]
-            
-            if successful_deletes:
-                logging.info(f"Successfully deleted {len(successful_deletes)} documents")
-            
-            if failed_deletes:
-                logging.error(f"Failed to delete {len(failed_deletes)} documents")
-                for failed in failed_deletes:
-                    logging.error(f"Failed deletion: {failed}")
-            
-            # Prepare response
-            response_data = {
-                "success": True,
-                "message": f"Cleaned up {cleanup_type}",
-                "deleted_count": len(successful_deletes),
-                "failed_count": len(failed_deletes),
-                "iso_code": iso_code
-            }
-            
-            if len(successful_deletes) == len(docs_to_delete):
-                logging.info(f"✅ Complete cleanup: All {cleanup_type} removed from search index")
+        # Stop /api/ask answering the countries from the snapshot while their documents are deleted,
+        # so a purge that stops part-way leaves them on live search
+        storage_connection_string = os.environ.get("KNIFE_STORAGE_CONNECTION_STRING")
+        blob_service_client = (
+            BlobServiceClient.from_connection_string(storage_connection_string) if storage_connection_string else None
+        )
+        if blob_service_client is not None:
+            if iso_code == "ALL":
+                facets = search_client.search(search_text="*", facets=["iso_code,count:1000"], top=0).get_facets()
+                snapshot_store.mark_all_indexing(
+                    blob_service_client, [facet["value"] for facet in (facets or {}).get("iso_code", [])]
+                )
             else:
-                logging.warning(f"⚠️ Partial cleanup: {len(successful_deletes)}/{len(docs_to_delete)} documents deleted")
-                response_data["warning"] = "Some documents failed to delete"
-                
+                snapshot_store.mark_indexing(blob_service_client, iso_code)
+
+        # Page through the ids and delete them in concurrent batches; stop before the HTTP timeout
+        # and let the caller resume from the last deleted key
+        progress = purge.purge(
+            search_client,
+            filter_expr,
+            resume_after=req_body.get('resume_after') or None,
+            max_seconds=float(req_body.get('max_seconds') or os.environ.get("PURGE_MAX_SECONDS", "200")),
+            on_progress=lambda p: logging.info(f"Cleanup progress ({cleanup_type}): {p['succeeded']} deleted, {p['pages']} pages"),
+        )
+        status_cache.invalidate()
+        
+        response_data = {
+            "success": progress["failed"] == 0,
+            "complete": progress["complete"],
+            "message": f"Cleaned up {cleanup_type}" if progress["deleted"] else f"No {cleanup_type} found to clean up",
+            "deleted_count": progress["deleted"],
+            "failed_count": progress["failed"],
+            "iso_code": iso_code,
+            "progress": progress
+        }
+        if progress["complete"]:
+            logging.info(f"✅ Complete cleanup: All {cleanup_type} removed from search index")
+        elif "resume_after" in progress:
+            response_data["warning"] = "Time budget reached; repeat the request with resume_after to continue"
+            response_data["resume_after"] = progress["resume_after"]
         else:
-            logging.info(f"No documents found for cleanup: {cleanup_type}")
-            response_data = {
-                "success": True,
-                "message": f"No {cleanup_type} found to clean up",
-                "deleted_count": 0,
-                "failed_count": 0,
-                "iso_code": iso_code
-            }
+            logging.warning(f"⚠️ Partial cleanup: {progress['remaining']} {cleanup_type} remain, {progress['failed']} failed")
+            response_data["warning"] = "Some documents failed to delete"
+
+        # Keep the manifest and the in-process retrieval snapshot in line with the index
+        store = manifest.from_env(blob_service_client)
+        if store is not None and progress["complete"]:
+            try:
+                if iso_code == "ALL":
+                    store.clear()
+                else:
+                    store.remove(iso_code)
+            except Exception as e:
+                logging.error(f"Manifest update failed: {e}")
+                response_data["manifest_warning"] = f"Manifest not updated: {e}"
+        if snapshot_store.container_name() and blob_service_client is not None and progress["complete"]:
+            try:
+                header = snapshot_store.update_snapshot(
+                    blob_service_client,
+                    [] if iso_code == "ALL" else [iso_code],
+                    [],
+                    tag=f"del-{iso_code}",
+                    replace_all=iso_code == "ALL",
+                )
+                snapshot_store.forget(blob_service_client, [iso_code], everything=iso_code == "ALL")
+                response_data["snapshot_version"] = header["version"]
+            except Exception as e:
+                logging.error(f"Snapshot update failed: {e}")
+                response_data["snapshot_warning"] = f"Snapshot not updated: {e}"
 
         return func.HttpResponse(
             json.dumps(response_data, indent=2),
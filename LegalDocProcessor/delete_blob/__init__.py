@@ -3,6 +3,7 @@ import os
 import json
 import azure.functions as func
 from azure.storage.blob import BlobServiceClient
+from shared_code import status_cache
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     """
@@ -79,6 +80,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             # Delete the blob
             try:
                 delete_result = blob_client.delete_blob()
+                status_cache.invalidate()
                 logging.info(f"Successfully deleted blob '{filename}' from container '{container_name}'")
                 
                 response_data = {
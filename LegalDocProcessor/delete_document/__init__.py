@@ -5,6 +5,8 @@ import json
 import azure.functions as func
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
+from azure.storage.blob import BlobServiceClient
+from shared_code import image_store, index_alias, manifest, purge, snapshot_store, status_cache
 
 def main(eventGridEvent: func.EventGridEvent):
     """
@@ -47,7 +49,7 @@ def main(eventGridEvent: func.EventGridEvent):
     # Azure Cognitive Search settings from environment variables
     search_endpoint = os.environ.get("KNIFE_SEARCH_ENDPOINT")
     search_key = os.environ.get("KNIFE_SEARCH_KEY")
-    search_index_name = os.environ.get("KNIFE_SEARCH_INDEX")
+    search_index_name = os.environ.get("KNIFE_SEARCH_INDEX") and index_alias.resolve()
 
     # Check required environment variables
     env_vars = {
@@ -65,37 +67,37 @@ def main(eventGridEvent: func.EventGridEvent):
     search_client = SearchClient(endpoint=search_endpoint, index_name=search_index_name, credential=search_credential)
 
     try:
-        # Search for existing documents with this ISO code
-        logging.info(f"Searching for documents with iso_code: {iso_code}")
-        results = search_client.search(search_text="*", filter=f"iso_code eq '{iso_code}'", select="id")
-        docs_to_delete = [{"id": doc["id"]} for doc in results]
+        storage_connection_string = os.environ.get("KNIFE_STORAGE_CONNECTION_STRING")
+        blob_service_client = (
+            BlobServiceClient.from_connection_string(storage_connection_string) if storage_connection_string else None
+        )
+        # Stop /api/ask answering the country from the snapshot while its documents are deleted
+        if blob_service_client is not None:
+            snapshot_store.mark_indexing(blob_service_client, iso_code)
 
-        if docs_to_delete:
-            logging.info(f"Found {len(docs_to_delete)} documents to delete for ISO code {iso_code}")
-            
-            # Delete the documents from the search index
-            delete_result = search_client.delete_documents(documents=docs_to_delete)
-            
-            # Check results
-            successful_deletes = [res for res in delete_result if res.succeeded]
-            failed_deletes = [res for res in delete_result if not res.succeeded]
-            
-            if successful_deletes:
-                logging.info(f"Successfully deleted {len(successful_deletes)} documents for {iso_code}")
-            
-            if failed_deletes:
-                logging.error(f"Failed to delete {len(failed_deletes)} documents for {iso_code}")
-                for failed in failed_deletes:
-                    logging.error(f"Failed deletion: {failed}")
-            
-            # Log final status
-            if len(successful_deletes) == len(docs_to_delete):
-                logging.info(f"✅ Complete cleanup: All documents for {iso_code} removed from search index")
-            else:
-                logging.warning(f"⚠️ Partial cleanup: {len(successful_deletes)}/{len(docs_to_delete)} documents deleted")
-                
+        # Page through the country's ids and delete them in concurrent batches
+        logging.info(f"Purging documents with iso_code: {iso_code}")
+        progress = purge.purge(search_client, f"iso_code eq '{iso_code}'")
+        status_cache.invalidate()
+        
+        if progress["complete"]:
+            logging.info(f"✅ Complete cleanup: {progress['deleted']} documents for {iso_code} removed from search index")
         else:
-            logging.info(f"No documents found in search index for ISO code {iso_code} - nothing to clean up")
+            logging.warning(
+                f"⚠️ Partial cleanup for {iso_code}: {progress['deleted']} deleted, {progress['failed']} failed, "
+                f"{progress['remaining']} remaining"
+            )
+
+        # Drop the country from the manifest and the in-process retrieval snapshot, and remove its image blobs
+        store = manifest.from_env(blob_service_client)
+        if store is not None and progress["complete"]:
+            store.remove(iso_code)
+        if blob_service_client is not None:
+            if snapshot_store.container_name():
+                snapshot_store.update_snapshot(blob_service_client, [iso_code], [], tag=f"del-{iso_code}")
+                snapshot_store.forget(blob_service_client, [iso_code])
+            deleted_images = image_store.delete_country_images(blob_service_client, "legaldocsrag", iso_code)
+            logging.info(f"Deleted {deleted_images} image blobs for {iso_code}")
 
     except Exception as e:
         logging.error(f"Error during index cleanup for {iso_code}: {e}")
@@ -4,8 +4,137 @@ import logging
 import os
 from azure.search.documents import SearchClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
 from azure.storage.blob import BlobServiceClient
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict
+from shared_code import index_alias, manifest, status_cache
+
+def count_chunks(search_client: SearchClient) -> Dict[str, int]:
+    """Indexed chunks per ISO code, from the iso_code facet (not capped by a result page).
+
+    Parent sections are index documents too but not chunks, so they are left out.
+    """
+    try:
+        results = search_client.search(search_text="*", facets=["iso_code,count:1000"], top=0,
+                                       filter="chunk_type ne 'section'")
+        facets = results.get_facets()
+    except HttpResponseError as e:
+        if e.status_code != 400:
+            raise
+        # An index from before chunk_type holds no parent sections
+        results = search_client.search(search_text="*", facets=["iso_code,count:1000"], top=0)
+        facets = results.get_facets()
+    return {
+        str(facet['value']).upper(): facet['count']
+        for facet in (facets or {}).get('iso_code', [])
+        if facet.get('value')
+    }
+
+def list_country_files(container_client) -> Dict[str, Dict[str, Any]]:
+    """The XX.docx files at the root of the container; image folders are not walked."""
+    storage_files = {}
+    try:
+        for blob in container_client.walk_blobs(delimiter='/'):
+            if blob.name.endswith('.docx') and len(blob.name) == 7:
+                iso_code = blob.name[:2].upper()
+                storage_files[iso_code] = {
+                    'filename': blob.name,
+                    'size': blob.size,
+                    'last_modified': blob.last_modified.isoformat() if blob.last_modified else None
+                }
+    except Exception as e:
+        logging.warning(f"Could not list storage blobs: {str(e)}")
+    return storage_files
+
+def read_catalog(store) -> Dict[str, Dict[str, Any]]:
+    if store is None:
+        return {}
+    try:
+        return store.catalog()
+    except Exception as e:
+        logging.warning(f"Could not read the ingestion manifest: {str(e)}")
+        return {}
+
+def build_status(search_client: SearchClient, container_client, store=None) -> Dict[str, Any]:
+    """Assembles the per-country status from chunk counts, the container listing and the manifest."""
+    # Count chunks per country with one facet query while the root of the container and the
+    # manifest catalog are read
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="status") as pool:
+        counts_future = pool.submit(count_chunks, search_client)
+        files_future = pool.submit(list_country_files, container_client)
+        catalog_future = pool.submit(read_catalog, store)
+        country_docs = counts_future.result()
+        storage_files = files_future.result()
+        catalog = catalog_future.result()
+    
+    # Define all European countries
+    all_countries = {
+        'AD': 'Andorra', 'AL': 'Albania', 'AT': 'Austria', 'BA': 'Bosnia and Herzegovina',
+        'BE': 'Belgium', 'BG': 'Bulgaria', 'BY': 'Belarus', 'CH': 'Switzerland',
+        'CY': 'Cyprus', 'CZ': 'Czech Republic', 'DE': 'Germany', 'DK': 'Denmark',
+        'EE': 'Estonia', 'ES': 'Spain', 'FI': 'Finland', 'FR': 'France',
+        'GB': 'United Kingdom', 'GR': 'Greece', 'HR': 'Croatia', 'HU': 'Hungary',
+        'IE': 'Ireland', 'IS': 'Iceland', 'IT': 'Italy', 'LI': 'Liechtenstein',
+        'LT': 'Lithuania', 'LU': 'Luxembourg', 'LV': 'Latvia', 'MC': 'Monaco',
+        'MD': 'Moldova', 'ME': 'Montenegro', 'MK': 'North Macedonia', 'MT': 'Malta',
+        'NL': 'Netherlands', 'NO': 'Norway', 'PL': 'Poland', 'PT': 'Portugal',
+        'RO': 'Romania', 'RS': 'Serbia', 'RU': 'Russia', 'SE': 'Sweden',
+        'SI': 'Slovenia', 'SK': 'Slovakia', 'SM': 'San Marino', 'UA': 'Ukraine',
+        'VA': 'Vatican City', 'XK': 'Kosovo'
+    }
+    
+    # Build status for all countries
+    document_status = []
+    for iso_code, country_name in all_countries.items():
+        chunk_count = country_docs.get(iso_code, 0)
+        file_info = storage_files.get(iso_code)
+        
+        status = {
+            'iso_code': iso_code,
+            'country_name': country_name,
+            'has_document': chunk_count > 0,
+            'chunk_count': chunk_count,
+            'has_file': file_info is not None,
+            'file_info': file_info
+        }
+        if iso_code in catalog:
+            entry = catalog[iso_code]
+            status['ingest'] = {
+                'ingested_at': entry.get('ingested_at'),
+                'source_sha256': (entry.get('source') or {}).get('sha256'),
+                'image_count': entry.get('image_count'),
+                'failed_uploads': entry.get('failed_uploads'),
+                'embedding': entry.get('embedding'),
+                'total_ms': (entry.get('stage_ms') or {}).get('total'),
+            }
+        
+        # Determine overall status
+        if chunk_count > 0 and file_info:
+            status['status'] = 'available'
+            status['status_text'] = f'Available ({chunk_count} chunks)'
+        elif chunk_count > 0 and not file_info:
+            status['status'] = 'indexed_only'
+            status['status_text'] = f'Indexed only ({chunk_count} chunks)'
+        elif not chunk_count and file_info:
+            status['status'] = 'processing'
+            status['status_text'] = 'Processing...'
+        else:
+            status['status'] = 'missing'
+            status['status_text'] = 'Missing'
+        
+        document_status.append(status)
+    
+    # Sort by country name
+    document_status.sort(key=lambda x: x['country_name'])
+    
+    return {
+        "success": True,
+        "document_status": document_status,
+        "total_countries": len(document_status),
+        "available_count": len([d for d in document_status if d['status'] == 'available']),
+        "missing_count": len([d for d in document_status if d['status'] == 'missing'])
+    }
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Document status function processed a request.')
@@ -14,7 +143,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         # Get environment variables
         search_endpoint = os.environ.get('KNIFE_SEARCH_ENDPOINT')
         search_key = os.environ.get('KNIFE_SEARCH_KEY')
-        search_index = os.environ.get('KNIFE_SEARCH_INDEX')
+        search_index = os.environ.get('KNIFE_SEARCH_INDEX') and index_alias.resolve()
         storage_connection = os.environ.get('KNIFE_STORAGE_CONNECTION_STRING')
         
         if not all([search_endpoint, search_key, search_index, storage_connection]):
@@ -35,93 +164,14 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         blob_service_client = BlobServiceClient.from_connection_string(storage_connection)
         container_client = blob_service_client.get_container_client('legaldocsrag')
         
-        # Get all documents from search index
-        search_results = search_client.search(
-            search_text="*",
-            select=["iso_code", "id"],
-            top=1000
-        )
-        
-        # Count documents per country
-        country_docs = defaultdict(int)
-        for result in search_results:
-            iso_code = result.get('iso_code', '').upper()
-            if iso_code:
-                country_docs[iso_code] += 1
-        
-        # Get all blobs from storage
-        storage_files = {}
-        try:
-            blobs = container_client.list_blobs()
-            for blob in blobs:
-                if blob.name.endswith('.docx') and len(blob.name) == 7:
-                    iso_code = blob.name[:2].upper()
-                    storage_files[iso_code] = {
-                        'filename': blob.name,
-                        'size': blob.size,
-                        'last_modified': blob.last_modified.isoformat() if blob.last_modified else None
-                    }
-        except Exception as e:
-            logging.warning(f"Could not list storage blobs: {str(e)}")
-        
-        # Define all European countries
-        all_countries = {
-            'AD': 'Andorra', 'AL': 'Albania', 'AT': 'Austria', 'BA': 'Bosnia and Herzegovina',
-            'BE': 'Belgium', 'BG': 'Bulgaria', 'BY': 'Belarus', 'CH': 'Switzerland',
-            'CY': 'Cyprus', 'CZ': 'Czech Republic', 'DE': 'Germany', 'DK': 'Denmark',
-            'EE': 'Estonia', 'ES': 'Spain', 'FI': 'Finland', 'FR': 'France',
-            'GB': 'United Kingdom', 'GR': 'Greece', 'HR': 'Croatia', 'HU': 'Hungary',
-            'IE': 'Ireland', 'IS': 'Iceland', 'IT': 'Italy', 'LI': 'Liechtenstein',
-            'LT': 'Lithuania', 'LU': 'Luxembourg', 'LV': 'Latvia', 'MC': 'Monaco',
-            'MD': 'Moldova', 'ME': 'Montenegro', 'MK': 'North Macedonia', 'MT': 'Malta',
-            'NL': 'Netherlands', 'NO': 'Norway', 'PL': 'Poland', 'PT': 'Portugal',
-            'RO': 'Romania', 'RS': 'Serbia', 'RU': 'Russia', 'SE': 'Sweden',
-            'SI': 'Slovenia', 'SK': 'Slovakia', 'SM': 'San Marino', 'UA': 'Ukraine',
-            'VA': 'Vatican City', 'XK': 'Kosovo'
-        }
-        
-        # Build status for all countries
-        document_status = []
-        for iso_code, country_name in all_countries.items():
-            chunk_count = country_docs.get(iso_code, 0)
-            file_info = storage_files.get(iso_code)
-            
-            status = {
-                'iso_code': iso_code,
-                'country_name': country_name,
-                'has_document': chunk_count > 0,
-                'chunk_count': chunk_count,
-                'has_file': file_info is not None,
-                'file_info': file_info
-            }
-            
-            # Determine overall status
-            if chunk_count > 0 and file_info:
-                status['status'] = 'available'
-                status['status_text'] = f'Available ({chunk_count} chunks)'
-            elif chunk_count > 0 and not file_info:
-                status['status'] = 'indexed_only'
-                status['status_text'] = f'Indexed only ({chunk_count} chunks)'
-            elif not chunk_count and file_info:
-                status['status'] = 'processing'
-                status['status_text'] = 'Processing...'
-            else:
-                status['status'] = 'missing'
-                status['status_text'] = 'Missing'
-            
-            document_status.append(status)
-        
-        # Sort by country name
-        document_status.sort(key=lambda x: x['country_name'])
+        # Polls within the cache TTL are answered from memory; ?refresh=1 forces a rebuild
+        if req.params.get('refresh', '').lower() in ('1', 'true', 'yes'):
+            status_cache.invalidate()
+        store = manifest.from_env(blob_service_client)
+        payload = status_cache.get(lambda: build_status(search_client, container_client, store))
         
         return func.HttpResponse(
-            json.dumps({
-                "success": True,
-                "document_status": document_status,
-                "total_countries": len(document_status),
-                "available_count": len([d for d in document_status if d['status'] == 'available']),
-                "missing_count": len([d for d in document_status if d['status'] == 'missing'])
-            }),
+            json.dumps(payload),
             status_code=200,
             mimetype="application/json"
         )
@@ -0,0 +1,11 @@
+import logging
+import azure.functions as func
+from process_document import staged
+
+def main(msg: func.QueueMessage):
+    """
+    Queue-triggered embed stage of staged ingestion (INGEST_MODE=staged).
+    Messages come from the ingest-embed queue; see process_document/staged.py.
+    """
+    logging.info(f"ingest-embed message {msg.id} (delivery {msg.dequeue_count})")
+    staged.handle("embed", msg.get_json(), delivery=msg.dequeue_count)
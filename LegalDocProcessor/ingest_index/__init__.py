@@ -0,0 +1,11 @@
+import logging
+import azure.functions as func
+from process_document import staged
+
+def main(msg: func.QueueMessage):
+    """
+    Queue-triggered index stage of staged ingestion (INGEST_MODE=staged).
+    Messages come from the ingest-index queue; see process_document/staged.py.
+    """
+    logging.info(f"ingest-index message {msg.id} (delivery {msg.dequeue_count})")
+    staged.handle("index", msg.get_json(), delivery=msg.dequeue_count)
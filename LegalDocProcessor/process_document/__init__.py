@@ -6,54 +6,83 @@ import logging
 import os
 import json
 import re
+import time
 import requests
 from docx import Document
 from docx.table import Table
-from PIL import Image
+from docx.text.paragraph import Paragraph
 import base64
-from io import BytesIO
-from tenacity import retry, stop_after_attempt, wait_exponential
+import contextvars
 import hashlib
-from typing import List, Dict, Any, Optional, Tuple
+import queue
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+import numpy as np
+from typing import Iterator, List, Dict, Any, Optional, Tuple
+from shared_code import chunking, coordination, dedup, docx_stream, image_prep, image_store, index_alias, index_schema, index_writer, manifest, ratelimit, resilience, routing, snapshot_store, status_cache, telemetry, usage, vector_fields
 
-def upload_images_to_blob(images, blob_service_client, container_name, iso_code):
-    """Upload images to blob storage."""
-    for image in images:
-        try:
-            blob_name = f"images/{iso_code}/{image['filename']}"
-            blob_client = blob_service_client.get_blob_client(
-                container=container_name,
-                blob=blob_name
-            )
-            
-            blob_client.upload_blob(
-                image['data'],
-                overwrite=True,
-                content_settings={'content_type': image.get('content_type', 'image/jpeg')}
-            )
-            
-            image['blob_url'] = blob_client.url
-            logging.info(f"Uploaded image {image['filename']} to blob storage")
-        except Exception as e:
-            logging.error(f"Failed to upload image {image['filename']}: {str(e)}")
-            image['blob_url'] = ""
-
-def split_text_into_chunks(text, max_chunk_size=2000, chunk_overlap=200):
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = start + max_chunk_size
-        if end < len(text):
-            # Find the last space within the chunk to avoid breaking words
-            while end > start and text[end] != ' ':
-                end -= 1
-            if end == start:  # No space found, use original end
-                end = start + max_chunk_size
-        chunk = text[start:end].strip()
-        if chunk:
-            chunks.append(chunk)
-        start = end - chunk_overlap if end > chunk_overlap else end
-    return chunks
+def _post_json(url: str, headers: dict, payload: dict, timeout: int, limiter=None) -> dict:
+    """POST helper that raises for HTTP errors so retries can classify them.
+    When a rate limiter is given, the response's x-ratelimit-* headers are fed back into it.
+    """
+    resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
+    if limiter is not None:
+        limiter.observe(resp.headers)
+    resp.raise_for_status()
+    return resp.json()
+
+def _limited_post_json(url: str, headers: dict, payload: dict, timeout: int, limiter, tokens: int) -> dict:
+    """Acquires background-priority quota for one request, then posts it."""
+    limiter.acquire(tokens, ratelimit.BACKGROUND)
+    return _post_json(url, headers, payload, timeout, limiter=limiter)
+
+# Model routing: caption and embed stages map to pools of deployments (see shared_code.routing)
+ROUTER = None
+
+def get_router(openai_endpoint: str, openai_key: str, embedding_deployment: str, chat_deployment: Optional[str]) -> routing.StageRouter:
+    """Builds the process-wide stage router on first use."""
+    global ROUTER
+    if ROUTER is None:
+        ROUTER = routing.StageRouter(routing.load_routes(
+            openai_endpoint.rstrip('/'),
+            openai_key,
+            {"caption": [chat_deployment], "embed": [embedding_deployment]},
+        ))
+    return ROUTER
+
+def _openai_headers(dep: routing.Deployment) -> dict:
+    return {"Content-Type": "application/json", "api-key": dep.api_key}
+
+def embed_text(text: str, router: routing.StageRouter, stage: str = "embed") -> List[float]:
+    """Embeds one text on the routed embedding deployment at background priority."""
+    payload = {"input": text}
+    tokens = ratelimit.estimate_embedding_tokens(text)
+
+    def on_deployment(dep: routing.Deployment) -> dict:
+        url = f"{dep.endpoint}/openai/deployments/{dep.deployment}/embeddings?api-version=2023-05-15"
+        result = _limited_post_json(url, _openai_headers(dep), payload, 30, ratelimit.get_limiter(dep.label), tokens)
+        usage.record("embed", dep.label, result.get("usage"))
+        return result
+
+    embedding_data = resilience.call_with_retries(
+        lambda: router.call(stage, on_deployment),
+        attempts=4,
+        initial_delay=1.0,
+        max_delay=20.0
+    )
+    return embedding_data['data'][0]['embedding']
+
+# One BlobServiceClient per worker process; its connection pool is shared by the upload threads
+BLOB_SERVICE_CLIENT = None
+
+def get_blob_service_client(connection_string: str) -> BlobServiceClient:
+    """Builds the process-wide blob client on first use."""
+    global BLOB_SERVICE_CLIENT
+    if BLOB_SERVICE_CLIENT is None:
+        BLOB_SERVICE_CLIENT = BlobServiceClient.from_connection_string(connection_string)
+    return BLOB_SERVICE_CLIENT
 
 def extract_table_data(table: Table) -> Optional[Dict[str, Any]]:
     """Extract table data with headers, merged cells handling, and convert to Markdown and JSON."""
@@ -113,42 +142,10 @@ def extract_table_data(table: Table) -> Optional[Dict[str, Any]]:
         logging.error(f"Error extracting table data: {str(e)}")
         return None
 
-def extract_images_from_docx(doc: Document, enable_captioning: bool) -> List[Dict[str, Any]]:
-    """Extract images from DOCX document."""
-    images = []
-    try:
-        # Extract images from document relationships
-        for rel in doc.part.rels.values():
-            if "image" in rel.reltype:
-                image_part = rel.target_part
-                image_data = image_part.blob
-                
-                # Generate image ID
-                img_hash = hashlib.md5(image_data).hexdigest()[:8]
-                img_id = f"figure_{img_hash}"
-                filename = f"image_{img_hash}.{image_part.content_type.split('/')[-1]}"
-                
-                images.append({
-                    'id': img_id,
-                    'filename': filename,
-                    'data': image_data,
-                    'content_type': image_part.content_type
-                })
-    except Exception as e:
-        logging.error(f"Error extracting images: {str(e)}")
-    
-    return images
-
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-def generate_image_captions(images, openai_endpoint, openai_key, deployment_name):
-    # Chat completions (vision) endpoint
+def generate_image_captions(images, router: routing.StageRouter):
+    # Chat completions (vision) endpoint, resolved per routed deployment
     chat_api_version = os.environ.get("OPENAI_API_VERSION", "2024-02-15-preview")
-    openai_chat_url = (
-        f"{openai_endpoint}/openai/deployments/{deployment_name}/chat/completions?api-version={chat_api_version}"
-        if deployment_name else None
-    )
-    
-    if not openai_chat_url:
+    if "caption" not in router.routes:
         return images
     
     for image in images:
@@ -173,9 +170,22 @@ def generate_image_captions(images, openai_endpoint, openai_key, deployment_name
                 "max_tokens": 1500,
                 "response_format": {"type": "json_object"}
             }
-            cr = requests.post(openai_chat_url, headers={"Content-Type": "application/json", "api-key": openai_key}, json=payload_chat, timeout=45)
-            cr.raise_for_status()
-            content = cr.json()["choices"][0]["message"]["content"].strip()
+            tokens = ratelimit.estimate_chat_tokens(payload_chat["messages"], payload_chat["max_tokens"])
+
+            def on_deployment(dep: routing.Deployment) -> dict:
+                url = f"{dep.endpoint}/openai/deployments/{dep.deployment}/chat/completions?api-version={chat_api_version}"
+                result = _limited_post_json(url, _openai_headers(dep), payload_chat, 45, ratelimit.get_limiter(dep.label), tokens)
+                usage.record("caption", dep.label, result.get("usage"))
+                return result
+
+            # Retry each image on its own so one throttled call doesn't redo the whole batch
+            result = resilience.call_with_retries(
+                lambda: router.call("caption", on_deployment),
+                attempts=3,
+                initial_delay=2.0,
+                max_delay=20.0
+            )
+            content = result["choices"][0]["message"]["content"].strip()
             try:
                 obj = json.loads(content)
                 caption = (obj.get("caption") or "").strip()
@@ -189,92 +199,497 @@ def generate_image_captions(images, openai_endpoint, openai_key, deployment_name
     
     return images
 
-def extract_document_elements(blob_content, doc_name, storage_connection_string, enable_captioning):
-    """Extract text blocks, tables, and images from a DOCX file using python-docx."""
+def paragraph_structure(para: Paragraph) -> Dict[str, Any]:
+    """Style name, outline level and list numbering of a paragraph, used by the chunker."""
+    element = para._p
     try:
-        elements = []
-        with BytesIO(blob_content) as doc_io:
-            doc = Document(doc_io)
-            
-            # Process document elements in order
-            for element in doc.element.body:
-                if element.tag.endswith('p'):
-                    # Paragraph
-                    para = None
-                    for p in doc.paragraphs:
-                        if p._element == element:
-                            para = p
-                            break
-                    if para and para.text.strip():
-                        elements.append({
-                            'type': 'text',
-                            'content': para.text,
-                            'metadata': {}
-                        })
-                
-                elif element.tag.endswith('tbl'):
-                    # Table
-                    table = None
-                    for t in doc.tables:
-                        if t._element == element:
-                            table = t
-                            break
-                    if table:
-                        table_data = extract_table_data(table)
-                        if table_data:
-                            elements.append({
-                                'type': 'table',
-                                'content': table_data['markdown'],
-                                'metadata': {
-                                    'table_id': table_data['id'],
-                                    'headers': table_data['headers'],
-                                    'json_data': table_data['json']
-                                }
-                            })
-            
-            # Extract images and add as elements with data attached
-            images = extract_images_from_docx(doc, enable_captioning)
-            for img in images:
-                elements.append({
-                    'type': 'image',
-                    'content': f"Image: {img['filename']}",
-                    'metadata': {
-                        'figure_id': img['id'],
-                        'filename': img['filename'],
-                        'ocr_text': ''
-                    },
-                    'data': img['data'],  # Attach image data
-                    'content_type': img['content_type']
-                })
-            
-            return elements
+        style = para.style.name if para.style is not None else ''
+    except Exception:  # documents can reference styles they do not define
+        style = ''
+    outline = element.xpath('./w:pPr/w:outlineLvl/@w:val')
+    num_id = element.xpath('./w:pPr/w:numPr/w:numId/@w:val')
+    level = element.xpath('./w:pPr/w:numPr/w:ilvl/@w:val')
+    structure = {'style': style}
+    # Outline level 9 means "body text"
+    if outline and outline[0].isdigit() and int(outline[0]) < 9:
+        structure['outline_level'] = int(outline[0])
+    if num_id:
+        structure['numbering'] = [num_id[0], int(level[0]) if level and level[0].isdigit() else 0]
+    return structure
+
+def iter_document_elements(doc) -> Iterator[Dict[str, Any]]:
+    """Yields text and table elements in document order, one body block at a time."""
+    for block in docx_stream.iter_blocks(doc):
+        if isinstance(block, Paragraph):
+            if block.text.strip():
+                yield {
+                    'type': 'text',
+                    'content': block.text,
+                    'metadata': paragraph_structure(block)
+                }
+            continue
+        table_data = extract_table_data(block)
+        if table_data:
+            yield {
+                'type': 'table',
+                'content': table_data['markdown'],
+                'metadata': {
+                    'table_id': table_data['id'],
+                    'headers': table_data['headers'],
+                    'json_data': table_data['json']
+                }
+            }
+
+def parse_document(package_path: str, workdir: str) -> Tuple[List[Dict[str, Any]], List[Tuple[str, str]], int]:
+    """Extracts text and table elements and lists the image parts of a spooled DOCX.
+    
+    The package is opened from a copy without media, so image bytes are never loaded here.
+    Returns (elements, image parts, media bytes left out).
+    """
+    try:
+        text_path = os.path.join(workdir, "text.docx")
+        media_bytes = docx_stream.text_package(package_path, text_path)
+        doc = Document(text_path)
+        return list(iter_document_elements(doc)), docx_stream.image_parts(doc), media_bytes
     except Exception as e:
         logging.error(f"Error extracting document elements: {str(e)}")
-        return []
+        return [], [], 0
+
+def process_images(package_path, image_parts, router, uploader: Optional[image_store.ImageUploader],
+                   on_element=None) -> Tuple[List[Dict[str, Any]], int, image_prep.ImagePrepReport]:
+    """Captions a document's images one at a time, queues their uploads, and returns their elements.
+    
+    Each image first goes through image_prep: repeats and decorative images are dropped,
+    large ones are downscaled for the vision model. Uploads are content-addressed and run
+    concurrently with the captioning of the next image. Without a caption router, images keep
+    their "Image: filename" placeholder and are not uploaded. ``on_element`` is called with each
+    element, in document order, as soon as it is captioned. Returns (elements, captioned count,
+    preprocessing report).
+    """
+    elements = []
+    uploads = []
+    captioned = 0
+    seen = set()
+    report = image_prep.ImagePrepReport()
+    settings = image_prep.Settings.from_env()
+    for name, content_type, data in docx_stream.iter_images(package_path, image_parts):
+        img_hash = hashlib.md5(data).hexdigest()[:8]
+        prepared = image_prep.prepare(data, content_type, seen, report, settings, name=name)
+        del data
+        if prepared.data is None:
+            continue
+        image = {
+            'id': f"figure_{img_hash}",
+            'filename': f"image_{img_hash}.{prepared.content_type.split('/')[-1]}",
+            'data': prepared.data,
+            'content_type': prepared.content_type
+        }
+        del prepared
+        blob_name = None
+        if router is not None:
+            generate_image_captions([image], router)
+            if uploader is not None:
+                blob_name = image_store.blob_name(uploader.iso_code, image['data'], image['content_type'])
+                image['blob_url'] = uploader.submit(image['data'], image['content_type'])
+        del image['data']
+
+        caption = image.get('caption', '')
+        ocr_text = image.get('ocr_text', '')
+        if caption or ocr_text:
+            captioned += 1
+        content = "\n\n".join(part for part in (caption, ocr_text) if part) or f"Image: {image['filename']}"
+        element = {
+            'type': 'image',
+            'content': content,
+            'metadata': {
+                'figure_id': image['id'],
+                'filename': image['filename'],
+                'ocr_text': ocr_text,
+                'blob_url': image.get('blob_url', '')
+            }
+        }
+        elements.append(element)
+        if on_element is not None:
+            on_element(element)
+        if blob_name:
+            uploads.append((element, blob_name))
+    
+    if uploader is not None:
+        uploader.wait()
+        for element, blob_name in uploads:
+            if blob_name in uploader.failed:
+                element['metadata']['blob_url'] = ""
+    return elements, captioned, report
+
+def chunk_document(iso_code: str, i: int, chunk_data: Dict[str, Any], embedding,
+                   vector_field: str = "embedding") -> Dict[str, Any]:
+    """The index document for the i-th chunk of a country."""
+    doc = {
+        "id": f"{iso_code}_{i}",
+        "iso_code": iso_code,
+        "chunk": chunk_data['text'],
+        vector_field: embedding,
+        "chunk_type": chunk_data['metadata'].get('chunk_type', 'text')
+    }
+    
+    # Add table markdown and ids so retrieval can filter and cite them
+    if chunk_data['metadata'].get('chunk_type') == 'table':
+        doc['table_md'] = chunk_data['text']
+        doc['table_id'] = chunk_data['metadata'].get('table_id', '')
+    elif chunk_data['metadata'].get('chunk_type') == 'image':
+        doc['figure_id'] = chunk_data['metadata'].get('figure_id', '')
+    if chunk_data['metadata'].get('section_path'):
+        doc['section_path'] = chunking.PATH_SEPARATOR.join(chunk_data['metadata']['section_path'])
+    if 'parent_index' in chunk_data['metadata']:
+        doc['parent_id'] = f"{iso_code}_p{chunk_data['metadata']['parent_index']}"
+    return doc
+
+def parent_document(iso_code: str, n: int, parent: Dict[str, Any]) -> Dict[str, Any]:
+    """Parent sections carry no vector; vector queries only ever match their children."""
+    return {
+        "id": f"{iso_code}_p{n}",
+        "iso_code": iso_code,
+        "chunk": parent['text'],
+        "chunk_type": "section",
+        "parent_id": f"{iso_code}_p{n}",
+        "section_path": chunking.PATH_SEPARATOR.join(parent['metadata'].get('section_path', [])),
+    }
+
+@contextmanager
+def timed(durations: Dict[str, int], stage: str):
+    """Adds the time spent in the block to ``durations[stage]`` (milliseconds)."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        durations[stage] = durations.get(stage, 0) + int((time.monotonic() - start) * 1000)
+
+def build_parent_child(chunks: List[Dict[str, Any]], child_tokens: int, child_overlap: int) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Splits text chunks into small children that point at their parent section.
+    
+    Text chunks longer than one child become parents (indexed once, without a vector,
+    and expanded at query time). Short text chunks, tables and images stay leaf chunks.
+    """
+    parents = []
+    children = []
+    for chunk in chunks:
+        if chunk['metadata'].get('chunk_type', 'text') != 'text' or chunking.count_tokens(chunk['text']) <= child_tokens:
+            children.append(chunk)
+            continue
+        parent_index = len(parents)
+        section_path = chunk['metadata'].get('section_path', [])
+        parents.append({'text': chunk['text'], 'metadata': {'chunk_type': 'section', 'section_path': section_path}})
+        for piece in chunking.split_text(chunk['text'], child_tokens, child_overlap):
+            children.append({
+                'text': piece,
+                'metadata': {'chunk_type': 'text', 'parent_index': parent_index, 'section_path': section_path}
+            })
+    return parents, children
+
+# Bump when a code change alters what ingestion writes for the same document
+PIPELINE_VERSION = "1"
+
+# Settings that change chunks, captions or vectors; a change re-ingests unchanged documents
+PIPELINE_SETTINGS = (
+    "RAG_CHUNKING_MODE", "CHUNK_MAX_TOKENS", "CHUNK_OVERLAP_TOKENS", "CHUNK_MIN_TOKENS",
+    "LATE_CHUNK_CHILD_TOKENS", "LATE_CHUNK_CHILD_OVERLAP",
+    "DEDUP_ENABLED", "DEDUP_NEAR_THRESHOLD", "BOILERPLATE_MIN_REPEATS", "BOILERPLATE_MAX_CHARS",
+    "IMAGE_PREP_ENABLED", "IMAGE_MIN_SIDE", "IMAGE_MIN_PIXELS", "IMAGE_MIN_ENTROPY",
+    "IMAGE_MAX_SIDE", "IMAGE_SHORT_SIDE", "IMAGE_JPEG_QUALITY", "OPENAI_ROUTES",
+)
+
+def pipeline_fingerprint(embedding_deployment: str, chat_deployment: Optional[str], dims: Optional[int] = None) -> str:
+    """Identifies the code version and settings that shape an ingestion's output."""
+    settings = {name: os.environ.get(name) for name in PIPELINE_SETTINGS}
+    settings.update(
+        version=PIPELINE_VERSION,
+        embedding_deployment=embedding_deployment,
+        chat_deployment=chat_deployment,
+        dims=dims or index_schema.expected_dimensions(),
+    )
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+def force_requested(myblob) -> bool:
+    """Re-ingestion is forced by INGEST_FORCE=true or a ``force_reingest`` metadata value on the blob."""
+    if os.environ.get("INGEST_FORCE", "false").lower() in ("1", "true", "yes"):
+        return True
+    metadata = getattr(myblob, 'metadata', None) or {}
+    return str(metadata.get('force_reingest', '')).lower() in ("1", "true", "yes")
+
+def source_info(myblob, sha256: Optional[str], content_md5: Optional[str], size: int) -> Dict[str, Any]:
+    """Name, ETag, hashes and size of the ingested blob, as recorded in the manifest."""
+    properties = getattr(myblob, 'blob_properties', None) or {}
+    return {
+        "blob": myblob.name,
+        "etag": properties.get('ETag') or properties.get('etag'),
+        "sha256": sha256,
+        "content_md5": content_md5,
+        "size": size,
+    }
+
+def manifest_entry(iso_code, source, chunks, parents, failed, image_count, embedding_deployment, dims,
+                   pipeline, stage_ms) -> Dict[str, Any]:
+    """The manifest entry for a finished ingestion; keys that failed to upload are left out."""
+    chunk_hashes = {f"{iso_code}_{i}": manifest.chunk_hash(chunk['text']) for i, chunk in enumerate(chunks)}
+    chunk_hashes.update({f"{iso_code}_p{n}": manifest.chunk_hash(parent['text']) for n, parent in enumerate(parents)})
+    for key in failed:
+        chunk_hashes.pop(key, None)
+    return {
+        "iso_code": iso_code,
+        "source": source,
+        "chunk_hashes": chunk_hashes,
+        "chunk_count": len(chunks),
+        "parent_count": len(parents),
+        "image_count": image_count,
+        "failed_uploads": len(failed),
+        "embedding": {"deployment": embedding_deployment, "dims": dims},
+        "chunking_mode": os.environ.get("RAG_CHUNKING_MODE", "early").lower(),
+        "pipeline": pipeline,
+        "stage_ms": stage_ms,
+        "ingested_at": manifest.now(),
+    }
+
+def caption_images(iso_code: str, package_path: str, image_parts, router: Optional[routing.StageRouter],
+                   blob_service_client, stage_ms: Dict[str, int], on_element=None) -> Tuple[List[Dict[str, Any]], Optional[image_store.ImageUploader], image_prep.ImagePrepReport]:
+    """Captions and uploads a document's images under the caption span; ``router`` None skips captioning.
+    
+    Returns (image elements, uploader or None, preprocessing report).
+    """
+    uploader = None
+    if router is not None and blob_service_client is not None:
+        uploader = image_store.ImageUploader(blob_service_client, "legaldocsrag", iso_code)
+    with telemetry.span("caption", stage="caption", images=len(image_parts)) as span, timed(stage_ms, "caption"):
+        image_elements, captioned, image_report = process_images(package_path, image_parts, router, uploader, on_element)
+        image_summary = {k: v for k, v in image_report.to_dict().items() if k != 'decisions'}
+        span.set(captioned=captioned, **image_summary)
+        if uploader is not None:
+            span.set(**{f"upload_{k}": v for k, v in uploader.to_dict().items()})
+    logging.info(f"Image prep for {iso_code}: {json.dumps(image_summary)}")
+    return image_elements, uploader, image_report
+
+def text_chunks(iso_code: str, content_elements: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], dedup.DedupReport]:
+    """Text and table chunks of a document, with parent sections in late/hybrid mode.
+    
+    Image chunks follow these (see image_chunks), so text chunk ids never depend on the
+    images. Returns (chunks, parents, dedup report).
+    """
+    # Strip recurring header/footer lines before chunking (headings are never touched)
+    dedup_enabled = os.environ.get("DEDUP_ENABLED", "true").lower() in ("1", "true", "yes")
+    dedup_report = dedup.DedupReport()
+    if dedup_enabled:
+        dedup_report = dedup.strip_boilerplate(
+            content_elements,
+            lambda elem: chunking.heading_level(elem) is not None,
+            min_repeats=int(os.environ.get("BOILERPLATE_MIN_REPEATS", "3")),
+            max_chars=int(os.environ.get("BOILERPLATE_MAX_CHARS", "200")),
+        )
+    
+    # Chunk along headings and articles under a token budget
+    chunks = chunking.build_chunks(
+        content_elements,
+        [],
+        max_tokens=int(os.environ.get("CHUNK_MAX_TOKENS", chunking.DEFAULT_MAX_TOKENS)),
+        overlap_tokens=int(os.environ.get("CHUNK_OVERLAP_TOKENS", chunking.DEFAULT_OVERLAP_TOKENS)),
+        min_tokens=int(os.environ.get("CHUNK_MIN_TOKENS", chunking.DEFAULT_MIN_TOKENS)),
+    )
+    
+    # Drop exact and near-duplicate chunks so they are neither embedded nor retrieved twice
+    if dedup_enabled:
+        with telemetry.span("dedup", chunks=len(chunks)) as span:
+            chunks = dedup.dedupe_chunks(
+                chunks,
+                near_threshold=float(os.environ.get("DEDUP_NEAR_THRESHOLD", "0.9")),
+                report=dedup_report,
+            )
+            span.set(**{k: v for k, v in dedup_report.to_dict().items() if k != 'samples'})
+        logging.info(f"Dedup for {iso_code}: {json.dumps(dedup_report.to_dict(), ensure_ascii=False)}")
+    
+    # Parent/child mode: embed small children, store their sections once for late expansion
+    chunking_mode = os.environ.get("RAG_CHUNKING_MODE", "early").lower()
+    parents = []
+    if chunking_mode in ("late", "hybrid"):
+        parents, chunks = build_parent_child(
+            chunks,
+            int(os.environ.get("LATE_CHUNK_CHILD_TOKENS", "150")),
+            int(os.environ.get("LATE_CHUNK_CHILD_OVERLAP", "25")),
+        )
+    return chunks, parents, dedup_report
+
+def image_chunks(image_elements: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """One chunk per image element; they follow the text chunks."""
+    return chunking.build_chunks([], image_elements)
+
+class CaptionsCancelled(Exception):
+    """The ingestion stopped while its images were still being captioned."""
+
+def caption_in_background(captioned: "queue.Queue", cancel: threading.Event, *args):
+    """Runs caption_images, putting each element on ``captioned`` and ``None`` once done.
+    
+    Setting ``cancel`` stops captioning after the current image.
+    """
+    def on_element(element):
+        if cancel.is_set():
+            raise CaptionsCancelled()
+        captioned.put(element)
+    try:
+        return caption_images(*args, on_element=on_element)
+    finally:
+        captioned.put(None)
+
+def drain_captions(captioned: "queue.Queue", images: List[Dict[str, Any]], block: bool) -> bool:
+    """Appends the chunks of the captioned images received so far; True once captioning finished.
+    
+    With ``block``, waits for at least one more element (or the end of captioning).
+    """
+    while True:
+        try:
+            element = captioned.get(block=block)
+        except queue.Empty:
+            return False
+        if element is None:
+            return True
+        images.extend(image_chunks([element]))
+        block = False
+
+def embed_batch(batch: List[Dict[str, Any]], router: routing.StageRouter, expected_dims: int,
+                stage: str = "embed") -> List[List[float]]:
+    """Embeds a batch of chunks, checking the deployment's dimensions against the index."""
+    embeddings = [embed_text(chunk_data['text'], router, stage) for chunk_data in batch]
+    if embeddings and len(embeddings[0]) != expected_dims:
+        raise index_schema.SchemaError(
+            f"Embedding deployment returns {len(embeddings[0])} dimensions, index expects {expected_dims}"
+        )
+    return embeddings
+
+def country_ids(search_client, iso_code: str) -> set:
+    """Ids indexed for a country; those a new ingestion does not overwrite are deleted after it."""
+    return {
+        doc["id"] for doc in search_client.search(
+            search_text="*", filter=f"iso_code eq '{iso_code}'", select=["id"]
+        )
+    }
+
+def confirm_unchanged(search_client, blob_service_client, store, coordinator, iso_code: str, generation: int,
+                      pipeline: str, **hashes) -> bool:
+    """Whether skipping an unchanged upload still leaves the recorded ingestion in the index.
+    
+    Runs after this upload registered, so the runs it superseded stop at their next check; the
+    country's lock is awaited, so one that was already writing finishes first. The manifest entry
+    is then read again: the skip stands when it still matches the upload and the index holds
+    exactly its ids with no index write left incomplete. Otherwise the upload is ingested,
+    restoring what it contains.
+    """
+    with coordinator.lock(iso_code, coordination.lock_timeout()):
+        coordinator.check(iso_code, generation)
+        entry = store.get(iso_code)
+        if not manifest.unchanged(entry, pipeline, **hashes):
+            return False
+        if blob_service_client is not None and snapshot_store.write_pending(blob_service_client, iso_code):
+            return False
+        return country_ids(search_client, iso_code) == set(entry.get("chunk_hashes") or {})
+
+def finish_country(search_client, blob_service_client, store, iso_code: str, existing_ids: set,
+                   chunks, parents, failed: Dict[str, str], vectors, collect_garbage,
+                   stage_ms: Dict[str, int], started_at: float, manifest_fields: Dict[str, Any],
+                   live: bool = True, stamp: Optional[str] = None) -> Tuple[List[str], Optional[int]]:
+    """Runs the steps after a country's chunks are indexed, under the country's lock.
+    
+    Deletes stale ids, collects unreferenced image blobs (``collect_garbage``, when the
+    upload had no failures), publishes the snapshot (when ``vectors`` holds the chunk
+    vectors; not while an embedding migration runs) and writes the manifest entry (``manifest_fields`` holds the remaining
+    manifest_entry arguments; ``started_at`` is the ingestion's start, in epoch seconds).
+    A rebuild candidate index (not ``live``) gets no image GC or snapshot, since
+    readers still use the active index and its images. ``stamp`` is the index state
+    stamp from ``snapshot_store.mark_indexing``; it is marked complete here.
+    Returns (stale ids, snapshot version).
+    """
+    # Delete what the previous ingestion indexed beyond this one's ids
+    new_ids = {f"{iso_code}_{i}" for i in range(len(chunks))} | {f"{iso_code}_p{n}" for n in range(len(parents))}
+    stale_ids = sorted(existing_ids - new_ids)
+    with telemetry.span("stale_delete", iso_code=iso_code, documents=len(stale_ids)), timed(stage_ms, "stale_delete"):
+        with index_writer.IndexWriter(search_client, action="delete") as deleter:
+            deleter.add({"id": doc_id} for doc_id in stale_ids)
+    status_cache.invalidate()
+    if stamp is not None:
+        try:
+            snapshot_store.mark_indexed(blob_service_client, iso_code, stamp)
+        except Exception as e:
+            # The country stays marked as being written, so /api/ask keeps querying the index for it
+            logging.error(f"Index state update failed for {iso_code}: {e}")
+    
+    # Image blobs of the previous version that no indexed chunk refers to any more
+    if live and collect_garbage is not None and not failed:
+        with telemetry.span("image_gc", iso_code=iso_code) as span:
+            span.set(deleted=collect_garbage())
+    
+    # Publish a new in-process retrieval snapshot with this country's indexed chunks
+    snapshot_version = None
+    if live and vectors is not None and snapshot_store.container_name() and blob_service_client is not None:
+        with telemetry.span("snapshot_publish", iso_code=iso_code) as span, timed(stage_ms, "snapshot"):
+            try:
+                failed_keys = set(failed)
+                rows = [
+                    chunk_document(iso_code, i, chunk_data, vectors[i]) for i, chunk_data in enumerate(chunks)
+                    if f"{iso_code}_{i}" not in failed_keys
+                ]
+                header = snapshot_store.update_snapshot(
+                    blob_service_client,
+                    [iso_code],
+                    rows,
+                    tag=iso_code,
+                    stamps={iso_code: stamp} if stamp else None,
+                    parents=[
+                        parent_document(iso_code, n, parent) for n, parent in enumerate(parents)
+                        if f"{iso_code}_p{n}" not in failed_keys
+                    ],
+                )
+                snapshot_version = header['version']
+                span.set(version=snapshot_version, rows=header['rows'])
+            except Exception as e:
+                # The search index stays authoritative; ask falls back to it for stale countries
+                logging.error(f"Snapshot publish failed for {iso_code}: {e}")
+    
+    # Record what this ingestion produced, once the index holds it
+    if store is not None:
+        with telemetry.span("manifest_write", iso_code=iso_code):
+            try:
+                store.put(manifest_entry(
+                    iso_code, chunks=chunks, parents=parents, failed=failed,
+                    stage_ms=dict(stage_ms, total=int((time.time() - started_at) * 1000)), **manifest_fields
+                ))
+            except Exception as e:
+                logging.error(f"Manifest write failed for {iso_code}: {e}")
+    return stale_ids, snapshot_version
 
 def main(myblob: func.InputStream):
-    logging.info(f"Python blob trigger function processed blob")
-    logging.info(f"Name: {myblob.name}")
-    logging.info(f"Size: {myblob.length} Bytes")
+    logging.info(f"Blob trigger for {myblob.name} ({myblob.length} bytes)")
+    ingest(myblob)
+
+def ingest(myblob) -> Dict[str, Any]:
+    """Ingests one uploaded country document; returns what happened, for bulk runs.
+    
+    ``myblob`` is the blob trigger's input stream, or anything with its ``name``,
+    ``length``, ``read()`` and (optionally) ``blob_properties`` and ``metadata``.
+    The result's ``status`` is completed, skipped, superseded, staged, empty or invalid.
+    """
+    telemetry.configure("legaldocs-processor")
 
     # Extract ISO code from filename
     filename = myblob.name.split('/')[-1]
     match = re.match(r"([A-Z]{2})\.docx", filename)
     if not match:
         logging.error(f"Invalid filename format: {filename}. Expected 'XX.docx' where XX is a 2-letter ISO code.")
-        return
+        return {"status": "invalid", "error": f"Invalid filename format: {filename}"}
     
     iso_code = match.group(1)
-    logging.info(f"Processing document for ISO code: {iso_code}")
     
     # Caption/OCR is always enabled
     enable_captioning = True
-    logging.info(f"Caption/OCR is enabled by default")
 
     # Azure Cognitive Search and OpenAI settings from environment variables
     search_endpoint = os.environ.get("KNIFE_SEARCH_ENDPOINT")
     search_key = os.environ.get("KNIFE_SEARCH_KEY")
-    search_index_name = os.environ.get("KNIFE_SEARCH_INDEX")
+    search_index_name = os.environ.get("KNIFE_SEARCH_INDEX") and index_alias.resolve()
     openai_endpoint = os.environ.get("KNIFE_OPENAI_ENDPOINT")
     openai_key = os.environ.get("KNIFE_OPENAI_KEY")
     openai_embedding_deployment = os.environ.get("KNIFE_OPENAI_DEPLOY")
@@ -294,197 +709,269 @@ def main(myblob: func.InputStream):
     missing_vars = [key for key, value in env_vars.items() if not value]
     if missing_vars:
         logging.error(f"Missing required environment variables: {', '.join(missing_vars)}")
-        return
+        return {"status": "invalid", "iso_code": iso_code, "error": f"Missing environment variables: {', '.join(missing_vars)}"}
 
-    # Prepare OpenAI REST API headers and endpoint
-    openai_headers = {
-        "Content-Type": "application/json",
-        "api-key": openai_key
-    }
-    openai_url = f"{openai_endpoint}/openai/deployments/{openai_embedding_deployment}/embeddings?api-version=2023-05-15"
+    # Route caption and embedding calls across the configured deployments
+    router = get_router(openai_endpoint, openai_key, openai_embedding_deployment, openai_chat_deployment)
     
     # Initialize Search client
     search_credential = AzureKeyCredential(search_key)
     search_client = SearchClient(endpoint=search_endpoint, index_name=search_index_name, credential=search_credential)
 
     try:
-        # Extract document elements (text, tables, images)
-        elements = extract_document_elements(
-            myblob.read(), 
-            myblob.name, 
-            storage_connection_string,
-            enable_captioning and openai_chat_deployment is not None
-        )
-        
-        if not elements:
-            logging.warning(f"No content extracted from {myblob.name}")
-            return
-        
-        # Separate images from other elements
-        image_elements = [e for e in elements if e['type'] == 'image']
-        content_elements = [e for e in elements if e['type'] != 'image']
-        
-        # Process images: generate captions and upload to blob
-        if openai_chat_deployment and image_elements:
-            logging.info(f"Processing {len(image_elements)} images")
+        t_start = time.monotonic()
+        started_at = time.time()
+        stage_ms: Dict[str, int] = {}
+        with usage.track() as tracker, \
+                telemetry.span("ingest", iso_code=iso_code, blob_bytes=myblob.length) as ingest_span, \
+                tempfile.TemporaryDirectory(prefix="ingest-") as workdir, \
+                ExitStack() as held:
+            blob_service_client = (
+                get_blob_service_client(storage_connection_string) if storage_connection_string else None
+            )
             
-            # Prepare image data for caption generation
-            image_data = []
-            for elem in image_elements:
-                image_data.append({
-                    'id': elem['metadata']['figure_id'],
-                    'filename': elem['metadata']['filename'],
-                    'data': elem.get('data', b''),
-                    'content_type': elem.get('content_type', 'image/jpeg')
-                })
+            # Skip documents whose content and pipeline settings match the last ingestion
+            store = manifest.from_env(blob_service_client)
+            properties = getattr(myblob, 'blob_properties', None) or {}
+            content_md5 = manifest.normalize_md5(properties.get('ContentMD5') or properties.get('content_md5'))
+            # The index's default vector field decides the embedding model (see shared_code.vector_fields)
+            vectors_record = vector_fields.current(search_index_name)
+            vector_field, vector_spec = vector_fields.write_field(vectors_record)
+            embedding_deployment = vector_spec["deployment"] or openai_embedding_deployment
+            embed_stage = router.embedding_stage(embedding_deployment)
+            pipeline = pipeline_fingerprint(embedding_deployment, openai_chat_deployment, vector_spec["dims"])
             
-            # Generate captions and OCR
-            image_data = generate_image_captions(
-                image_data,
-                openai_endpoint,
-                openai_key,
-                openai_chat_deployment
+            # Take a generation for this country first: a later upload supersedes this run, and this
+            # upload supersedes earlier runs even when it turns out to be unchanged
+            coordinator = coordination.from_env(blob_service_client)
+            if staged.enabled():
+                staged.require_shared_coordination(coordinator)
+            generation = coordinator.register(iso_code)
+            ingest_span.set(generation=generation)
+            
+            def skip_unchanged(**hashes) -> bool:
+                return manifest.unchanged(previous, pipeline, **hashes) and confirm_unchanged(
+                    search_client, blob_service_client, store, coordinator, iso_code, generation, pipeline, **hashes
+                )
+            
+            previous = None
+            if store is not None and not force_requested(myblob):
+                previous = store.get(iso_code)
+                if skip_unchanged(content_md5=content_md5):
+                    ingest_span.set(skipped="unchanged")
+                    logging.info(f"{filename} is unchanged since {previous.get('ingested_at')} (Content-MD5); skipping")
+                    return {"status": "skipped", "iso_code": iso_code, "reason": "unchanged"}
+                if manifest.unchanged(previous, pipeline, content_md5=content_md5):
+                    # The recorded ingestion is no longer what the index holds; ingest it again
+                    previous = None
+            
+            # The debounce lets a correction uploaded right after this one win before any work is done;
+            # it only waits while the blob is younger than INGEST_DEBOUNCE_S
+            debounce = coordination.debounce_seconds(properties.get('LastModified') or properties.get('last_modified'))
+            if generation and debounce > 0:
+                time.sleep(debounce)
+                coordinator.check(iso_code, generation)
+            
+            # Spool the blob to disk and parse a copy of the package without media, so neither
+            # the whole upload nor the document's images are held in memory while text is read
+            with telemetry.span("parse", stage="parse") as span, timed(stage_ms, "parse"):
+                package_path = os.path.join(workdir, "source.docx")
+                source_bytes = docx_stream.spool(myblob, package_path)
+                source_sha256 = manifest.file_sha256(package_path)
+                if skip_unchanged(sha256=source_sha256):
+                    ingest_span.set(skipped="unchanged")
+                    logging.info(f"{filename} is unchanged since {previous.get('ingested_at')} (SHA-256); skipping")
+                    return {"status": "skipped", "iso_code": iso_code, "reason": "unchanged"}
+                content_elements, image_parts, media_bytes = parse_document(package_path, workdir)
+                span.set(elements=len(content_elements), images=len(image_parts), media_bytes=media_bytes)
+            
+            if not content_elements and not image_parts:
+                logging.warning(f"No content extracted from {myblob.name}")
+                return {"status": "empty", "iso_code": iso_code}
+            coordinator.check(iso_code, generation)
+            source = source_info(myblob, source_sha256, content_md5, source_bytes)
+            captioning = enable_captioning and openai_chat_deployment is not None
+            
+            # Staged mode: chunk the text here and hand captioning, embedding and the index write
+            # to the queue-connected stages (see staged.py)
+            if staged.enabled():
+                ingest_span.set(mode="staged")
+                run = staged.start(
+                    iso_code, generation, myblob.name, package_path, content_elements, image_parts, source,
+                    pipeline, captioning, blob_service_client, stage_ms, started_at,
+                )
+                return {"status": "staged", "iso_code": iso_code, "run": run}
+            
+            # Text chunks do not depend on the images, so they are built first and get the first ids
+            with timed(stage_ms, "chunk"):
+                chunks, parents, dedup_report = text_chunks(iso_code, content_elements)
+            text_count = len(chunks)
+            
+            # Caption (with OCR) images one at a time in the background while the text is embedded;
+            # their uploads run concurrently and skip content-addressed blobs that already exist
+            captioned = queue.Queue()
+            cancel_captions = threading.Event()
+            caption_pool = held.enter_context(ThreadPoolExecutor(max_workers=1, thread_name_prefix="caption"))
+            held.callback(cancel_captions.set)
+            caption_future = caption_pool.submit(
+                contextvars.copy_context().run, caption_in_background, captioned, cancel_captions,
+                iso_code, package_path, image_parts, router if captioning else None, blob_service_client, stage_ms,
             )
             
-            # Upload images to blob storage
-            blob_service_client = BlobServiceClient.from_connection_string(storage_connection_string)
-            upload_images_to_blob(image_data, blob_service_client, "legaldocsrag", iso_code)
+            # Check the live index against index.json before spending tokens on embeddings
+            with telemetry.span("schema_check", index=search_index_name) as span:
+                writable_fields = index_schema.validate(search_endpoint, search_key, search_index_name)
+                # Vector fields added by a migration are not in index.json
+                writable_fields = set(writable_fields) | set(vectors_record["fields"])
+                span.set(fields=sorted(writable_fields))
             
-            # Update image elements with captions and URLs
-            for elem in image_elements:
-                for img in image_data:
-                    if elem['metadata'].get('figure_id') == img['id']:
-                        elem['content'] = img.get('caption', elem['content'])
-                        caption = img.get('caption', '')
-                        ocr_text = img.get('ocr_text', '')
-                        if caption and ocr_text:
-                            elem['content'] = f"{caption}\n\n{ocr_text}"
-                        elif caption:
-                            elem['content'] = caption
-                        elif ocr_text:
-                            elem['content'] = ocr_text
-                        else:
-                            # retain existing placeholder like "Image: filename" if both are empty
-                            elem['content'] = elem['content']
-                        elem['metadata']['ocr_text'] = img.get('ocr_text', '')
-                        elem['metadata']['blob_url'] = img.get('blob_url', '')
-
-        # Create chunks from elements
-        chunks = []
-        current_chunk = []
-        current_size = 0
-        max_chunk_size = 2000
-        
-        for elem in content_elements:
-            elem_text = elem['content']
-            elem_size = len(elem_text)
+            expected_dims = vector_spec["dims"]
             
-            if elem['type'] == 'table':
-                # Tables go in their own chunk
-                if current_chunk:
-                    chunks.append({
-                        'text': '\n\n'.join([e['content'] for e in current_chunk]),
-                        'metadata': {'chunk_type': 'text'}
-                    })
-                    current_chunk = []
-                    current_size = 0
+            # Stop here if a newer upload arrived meanwhile; otherwise hold the country's lock while
+            # its index documents are read and replaced
+            coordinator.check(iso_code, generation)
+            held.enter_context(coordinator.lock(iso_code, coordination.lock_timeout()))
+            coordinator.check(iso_code, generation)
             
-                chunks.append({
-                    'text': elem_text,
-                    'metadata': {
-                        'chunk_type': 'table',
-                        'table_id': elem['metadata'].get('table_id', ''),
-                        'table_json': json.dumps(elem['metadata'].get('json_data', []))
-                    }
-                })
-            elif current_size + elem_size > max_chunk_size and current_chunk:
-                # Create a new chunk
-                chunks.append({
-                    'text': '\n\n'.join([e['content'] for e in current_chunk]),
-                    'metadata': {'chunk_type': 'text'}
-                })
-                current_chunk = [elem]
-                current_size = elem_size
-            else:
-                current_chunk.append(elem)
-                current_size += elem_size
-        
-        # Add remaining chunk
-        if current_chunk:
-            chunks.append({
-                'text': '\n\n'.join([e['content'] for e in current_chunk]),
-                'metadata': {'chunk_type': 'text'}
-            })
-        
-        # Add image chunks
-        for elem in image_elements:
-            chunks.append({
-                'text': elem['content'],
-                'metadata': {
-                    'chunk_type': 'image',
-                    'figure_id': elem['metadata'].get('figure_id', ''),
-                    'ocr_text': elem['metadata'].get('ocr_text', ''),
-                    'blob_url': elem['metadata'].get('blob_url', '')
-                }
-            })
-        
-        # Generate embeddings for each chunk
-        embeddings = []
-        for chunk_data in chunks:
-            chunk_text = chunk_data['text']
-            # Make direct REST API call to Azure OpenAI
-            payload = {
-                "input": chunk_text
-            }
-            response = requests.post(openai_url, headers=openai_headers, json=payload)
-            response.raise_for_status()
-            embedding_data = response.json()
-            embedding = embedding_data['data'][0]['embedding']
-            embeddings.append(embedding)
-        
-        # Delete existing documents for this ISO code
-        logging.info(f"Deleting existing documents for ISO code: {iso_code}")
-        filter_expr = f"iso_code eq '{iso_code}'"
-        results = search_client.search(search_text="*", filter=filter_expr, select=["id"])
-        docs_to_delete = [doc["id"] for doc in results]
-        
-        if docs_to_delete:
-            logging.info(f"Deleting {len(docs_to_delete)} existing documents")
-            delete_result = search_client.delete_documents(documents=[{"id": doc_id} for doc_id in docs_to_delete])
-            logging.info(f"Delete result: {delete_result}")
-        
-        # Prepare documents for indexing
-        documents = []
-        for i, chunk_data in enumerate(chunks):
-            doc = {
-                "id": f"{iso_code}_{i}",
-                "iso_code": iso_code,
-                "chunk": chunk_data['text'],  
-                "embedding": embeddings[i] if i < len(embeddings) else [0] * 3072,  
-                "chunk_type": chunk_data['metadata'].get('chunk_type', 'text')
-            }
+            # Ids indexed for this country before this run; those the new upload does not overwrite
+            # are deleted at the end, so the country is never missing from the index mid-run
+            existing_ids = country_ids(search_client, iso_code)
+            
+            # Every chunk is embedded before the first index write, so a run that fails or is superseded
+            # midway leaves the country's documents as they were. The vectors wait in a disk-backed float32
+            # matrix instead of Python lists; image rows are reserved for every image part, since
+            # preprocessing may drop some
+            embedded = np.memmap(
+                os.path.join(workdir, "vectors.f32"), dtype="float32", mode="w+",
+                shape=(max(1, text_count + len(image_parts)), expected_dims),
+            )
+            # Snapshots hold one model's vectors, so none is published while an embedding migration runs
+            live = index_alias.is_live(search_index_name)
+            vectors = None
+            if live and not vector_fields.migrating(vectors_record) and snapshot_store.container_name() and blob_service_client is not None and (chunks or image_parts):
+                vectors = embedded
+            
+            # Embed (background priority so /api/ask keeps its quota headroom) in bounded batches.
+            # Image chunks are embedded in batches as their captions arrive and keep the ids after the
+            # text's in document order, so ids do not depend on how captioning and embedding interleave
+            batch_size = max(1, int(os.environ.get("INGEST_BATCH_SIZE", "64")))
+            images: List[Dict[str, Any]] = []
+            embedded_images = 0
+            captions_done = False
+            
+            def embed(start: int, batch: List[Dict[str, Any]]) -> None:
+                coordinator.check(iso_code, generation)
+                with telemetry.span("embed_batch", stage="embed", chunks=len(batch), offset=start), timed(stage_ms, "embed"):
+                    embedded[start:start + len(batch)] = embed_batch(batch, router, expected_dims, embed_stage)
+            
+            def embed_ready_images(flush: bool) -> None:
+                nonlocal embedded_images
+                while len(images) - embedded_images >= batch_size or (flush and embedded_images < len(images)):
+                    batch = images[embedded_images:embedded_images + batch_size]
+                    embed(text_count + embedded_images, batch)
+                    embedded_images += len(batch)
             
-            # Add table markdown if it's a table
-            if chunk_data['metadata'].get('chunk_type') == 'table':
-                doc['table_md'] = chunk_data['text']  
-
-            documents.append(doc)
-
-        # Upload new documents
-        if documents:
-            logging.info(f"Uploading {len(documents)} new documents to the search index")
-            upload_result = search_client.upload_documents(documents=documents)
-            success_count = sum(1 for r in upload_result if r.succeeded)
-            logging.info(f"Successfully uploaded {success_count}/{len(documents)} documents")
+            for start in range(0, text_count, batch_size):
+                embed(start, chunks[start:start + batch_size])
+                if not captions_done:
+                    captions_done = drain_captions(captioned, images, block=False)
+                embed_ready_images(flush=False)
+            while not captions_done:
+                captions_done = drain_captions(captioned, images, block=True)
+                embed_ready_images(flush=captions_done)
+            embed_ready_images(flush=True)
+            image_elements, uploader, image_report = caption_future.result()
+            chunks += images
             
-            if success_count < len(documents):
-                failed = [r for r in upload_result if not r.succeeded]
-                logging.error(f"Failed uploads: {failed}")
+            # Mark the country as being rewritten before the live index changes, so /api/ask stops
+            # answering it from the snapshot until this run's rows are published. The index writer
+            # uploads size-bounded batches concurrently and resends only the keys that failed
+            coordinator.check(iso_code, generation)
+            stamp = snapshot_store.mark_indexing(blob_service_client, iso_code) if live and blob_service_client is not None else None
+            with index_writer.IndexWriter(search_client, writable_fields) as writer:
+                for start in range(0, len(chunks), batch_size):
+                    writer.add(
+                        chunk_document(iso_code, start + j, chunk_data, embedded[start + j].tolist(), vector_field)
+                        for j, chunk_data in enumerate(chunks[start:start + batch_size])
+                    )
+                writer.add(parent_document(iso_code, n, parent) for n, parent in enumerate(parents))
+            failed = writer.failed
+            failed_count = len(failed)
+            upload_stats = writer.stats()
+            stage_ms["index_upload"] = int(upload_stats["seconds"] * 1000)
+            logging.info(f"Index upload for {iso_code}: {json.dumps(upload_stats)}")
+            if failed:
+                logging.error(f"Failed uploads for {iso_code}: {failed}")
+            
+            stale_ids, snapshot_version = finish_country(
+                search_client, blob_service_client, store, iso_code, existing_ids, chunks, parents, failed,
+                vectors,
+                uploader.collect_garbage if uploader is not None else None,
+                stage_ms,
+                started_at,
+                dict(source=source, image_count=len(image_elements), embedding_deployment=embedding_deployment,
+                     dims=expected_dims, pipeline=pipeline),
+                live,
+                stamp,
+            )
+            vector_fields.settle(search_index_name, iso_code, vector_field)
+            
+            totals = tracker.totals()
+            ingest_span.set(
+                chunks=len(chunks),
+                parents=len(parents),
+                images=len(image_elements),
+                failed_uploads=failed_count,
+                stale_deleted=len(stale_ids),
+                peak_rss_mb=docx_stream.peak_rss_mb(),
+                prompt_tokens=totals['prompt_tokens'],
+                completion_tokens=totals['completion_tokens'],
+                cost_usd=totals['cost_usd'],
+            )
         
-        logging.info(f"Document processing completed for {filename}")
+        telemetry.event(
+            "ingest.completed",
+            sample_rate=1.0,  # one event per document, not a hot path
+            iso_code=iso_code,
+            filename=filename,
+            chunks=len(chunks),
+            images=len(image_elements),
+            replaced_documents=len(existing_ids),
+            stale_deleted=len(stale_ids),
+            failed_uploads=failed_count,
+            index_upload=upload_stats,
+            peak_rss_mb=docx_stream.peak_rss_mb(),
+            snapshot_version=snapshot_version,
+            dedup=dedup_report.to_dict(),
+            image_prep=image_report.to_dict(),
+            image_uploads=uploader.to_dict() if uploader is not None else None,
+            duration_ms=int((time.monotonic() - t_start) * 1000),
+            usage=tracker.to_dict(),
+            resilience=resilience.metrics_snapshot(),
+            deployments=router.stats(),
+        )
+        return {
+            "status": "completed",
+            "iso_code": iso_code,
+            "chunks": len(chunks),
+            "parents": len(parents),
+            "images": len(image_elements),
+            "failed_uploads": failed_count,
+            "stale_deleted": len(stale_ids),
+            "duration_ms": int((time.monotonic() - t_start) * 1000),
+            "cost_usd": totals['cost_usd'],
+        }
         
+    except coordination.Superseded as e:
+        # Not an error: the newer run's trigger indexes the current upload
+        logging.info(f"Stopping {filename}: {e}")
+        telemetry.event("ingest.superseded", sample_rate=1.0, iso_code=iso_code, filename=filename, reason=str(e))
+        return {"status": "superseded", "iso_code": iso_code, "reason": str(e)}
     except Exception as e:
         logging.error(f"Error processing document: {str(e)}")
         import traceback
         logging.error(f"Traceback: {traceback.format_exc()}")
-        raise
\ No newline at end of file
+        raise
+
+# The queue-triggered stages reuse the helpers above, so they are imported last
+from . import staged  # noqa: E402
@@ -0,0 +1,379 @@
+"""Staged ingestion: captioning, embedding and the index write as queue-connected stages.
+
+With ``INGEST_MODE=staged`` the blob trigger (``main``) still checks the
+manifest, takes the country's generation, parses the document and chunks its
+text, then hands the run to three queue-triggered functions instead of doing
+everything in one invocation:
+
+1. ``caption`` (``ingest_caption``): captions, OCRs and uploads the images
+   from the checkpointed package; only runs when the document has images.
+2. ``embed`` (``ingest_embed``): embeds the text and image chunks in batches,
+   checkpointing each batch.
+3. ``index`` (``ingest_index``): under the country's lock, writes the chunks
+   and parents from the checkpoints, deletes stale ids, removes unreferenced
+   images, publishes the snapshot and writes the manifest entry.
+
+A stage stops when a newer upload superseded its run (see ``coordination``),
+resumes from the run's checkpoints when its message is delivered again (see
+``checkpoints``), and handles at most ``INGEST_<STAGE>_CONCURRENCY`` messages
+at a time per worker process (caption 2, embed 4, index 2). A backed-up queue
+holds back the stage that feeds it (see ``stage_queue``).
+
+Checkpoints of a run ``<ISO>/<generation>-<sha256 prefix>``:
+
+- ``run.json``: source, pipeline, image parts, batch size and parse/chunk times;
+- ``source.docx``: the uploaded package, when it has images;
+- ``text.json``: text chunks, parents and the dedup report;
+- ``images.json``: image elements, referenced image blobs and the prep report;
+- ``embed/<offset>.npy``: the vectors of one batch;
+- ``embedded.json``: the chunk count, vector field, deployment and dimensions,
+  once every batch is in.
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional
+
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+
+from shared_code import (checkpoints, coordination, image_store, index_alias, index_schema, index_writer, manifest, resilience,
+                         snapshot_store, stage_queue, telemetry, usage, vector_fields)
+
+from . import (caption_images, chunk_document, country_ids, embed_batch, finish_country, get_blob_service_client,
+               get_router, image_chunks, parent_document, text_chunks, timed)
+
+DEFAULT_CONCURRENCY = {"caption": 2, "embed": 4, "index": 2}
+
+_SLOTS: Dict[str, threading.BoundedSemaphore] = {}
+_SLOTS_LOCK = threading.Lock()
+
+
+def enabled() -> bool:
+    return os.environ.get("INGEST_MODE", "inline").lower() == "staged"
+
+
+def require_shared_coordination(coordinator: coordination.Coordinator) -> None:
+    """Refuses coordination that the stages' other processes cannot see.
+
+    On storage queues a run's stages execute in other invocations, often on other
+    instances; with a process-local coordinator they would find a different
+    generation, take the run as superseded and drop it.
+    """
+    if stage_queue.backend() == "storage" and not isinstance(
+            coordinator, (coordination.BlobCoordinator, coordination.NullCoordinator)):
+        raise RuntimeError(
+            "INGEST_MODE=staged on storage queues needs blob coordination: set KNIFE_CHECKPOINT_CONTAINER "
+            "(or KNIFE_MANIFEST_CONTAINER) and KNIFE_STORAGE_CONNECTION_STRING, or INGEST_COORDINATION=off"
+        )
+
+
+def concurrency(stage: str) -> int:
+    return max(1, int(os.environ.get(f"INGEST_{stage.upper()}_CONCURRENCY", DEFAULT_CONCURRENCY[stage])))
+
+
+def _slot(stage: str) -> threading.BoundedSemaphore:
+    with _SLOTS_LOCK:
+        if stage not in _SLOTS:
+            _SLOTS[stage] = threading.BoundedSemaphore(concurrency(stage))
+        return _SLOTS[stage]
+
+
+def run_id(iso_code: str, generation: int, sha256: str) -> str:
+    return f"{iso_code}/{generation}-{sha256[:12]}"
+
+
+def _batch_name(start: int) -> str:
+    return f"embed/{start:06d}.npy"
+
+
+@dataclass
+class StageContext:
+    blob_service_client: Any
+    router: Any
+    checkpoints: checkpoints.CheckpointStore
+    manifest_store: Optional[manifest.ManifestStore]
+    queues: stage_queue.StageQueues
+    coordinator: coordination.Coordinator
+    search_endpoint: str
+    search_key: str
+    embedding_deployment: str
+    search_clients: Dict[str, SearchClient] = field(default_factory=dict)
+
+    def search_client(self, index_name: str) -> SearchClient:
+        # One client per index; the alias record decides which one a run writes to
+        if index_name not in self.search_clients:
+            self.search_clients[index_name] = SearchClient(
+                endpoint=self.search_endpoint, index_name=index_name, credential=AzureKeyCredential(self.search_key)
+            )
+        return self.search_clients[index_name]
+
+
+CONTEXT: Optional[StageContext] = None
+
+
+def get_context() -> StageContext:
+    """Builds the process-wide clients of the queue-triggered stages on first use."""
+    global CONTEXT
+    if CONTEXT is None:
+        env = {name: os.environ.get(name) for name in (
+            "KNIFE_SEARCH_ENDPOINT", "KNIFE_SEARCH_KEY", "KNIFE_SEARCH_INDEX",
+            "KNIFE_OPENAI_ENDPOINT", "KNIFE_OPENAI_KEY", "KNIFE_OPENAI_DEPLOY",
+        )}
+        missing = [name for name, value in env.items() if not value]
+        if missing:
+            raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+        connection_string = os.environ.get("KNIFE_STORAGE_CONNECTION_STRING")
+        blob_service_client = get_blob_service_client(connection_string) if connection_string else None
+        coordinator = coordination.from_env(blob_service_client)
+        require_shared_coordination(coordinator)
+        CONTEXT = StageContext(
+            blob_service_client=blob_service_client,
+            router=get_router(
+                env["KNIFE_OPENAI_ENDPOINT"], env["KNIFE_OPENAI_KEY"], env["KNIFE_OPENAI_DEPLOY"],
+                os.environ.get("OPENAI_CHAT_DEPLOY"),
+            ),
+            checkpoints=checkpoints.from_env(blob_service_client),
+            manifest_store=manifest.from_env(blob_service_client),
+            queues=stage_queue.from_env(connection_string),
+            coordinator=coordinator,
+            search_endpoint=env["KNIFE_SEARCH_ENDPOINT"],
+            search_key=env["KNIFE_SEARCH_KEY"],
+            embedding_deployment=env["KNIFE_OPENAI_DEPLOY"],
+        )
+    return CONTEXT
+
+
+def start(iso_code: str, generation: int, blob_name: str, package_path: str, content_elements, image_parts,
+          source: Dict[str, Any], pipeline: str, captioning: bool, blob_service_client,
+          stage_ms: Dict[str, int], started_at: float) -> str:
+    """The parse/chunk stage, run by the blob trigger: checkpoints its output and enqueues the next stage.
+
+    Returns the run id.
+    """
+    store = checkpoints.from_env(blob_service_client)
+    queues = stage_queue.from_env(os.environ.get("KNIFE_STORAGE_CONNECTION_STRING"))
+    run = run_id(iso_code, generation, source["sha256"])
+    with timed(stage_ms, "chunk"):
+        chunks, parents, dedup_report = text_chunks(iso_code, content_elements)
+    store.put_json(run, "text.json", {"chunks": chunks, "parents": parents, "dedup": dedup_report.to_dict()})
+    if image_parts:
+        store.put_file(run, "source.docx", package_path)
+    store.put_json(run, "run.json", {
+        "iso_code": iso_code,
+        "generation": generation,
+        "blob": blob_name,
+        "source": source,
+        "pipeline": pipeline,
+        "captioning": captioning,
+        "image_parts": image_parts,
+        "batch_size": max(1, int(os.environ.get("INGEST_BATCH_SIZE", "64"))),
+        "stage_ms": stage_ms,
+        "started_at": started_at,
+    })
+    queues.send("caption" if image_parts else "embed", {"run": run, "iso_code": iso_code, "generation": generation})
+    logging.info(f"Staged ingestion {run}: {len(chunks)} text chunks, {len(image_parts)} images queued")
+    return run
+
+
+def _caption(ctx: StageContext, run: str, info: Dict[str, Any], message: Dict[str, Any]) -> None:
+    if "images.json" not in ctx.checkpoints.names(run):
+        iso_code = info["iso_code"]
+        stage_ms: Dict[str, int] = {}
+        with tempfile.TemporaryDirectory(prefix="ingest-") as workdir:
+            package_path = os.path.join(workdir, "source.docx")
+            if not ctx.checkpoints.get_file(run, "source.docx", package_path):
+                raise RuntimeError(f"Run {run} has no source.docx checkpoint")
+            image_elements, uploader, image_report = caption_images(
+                iso_code, package_path, info["image_parts"], ctx.router if info["captioning"] else None,
+                ctx.blob_service_client, stage_ms,
+            )
+        ctx.coordinator.check(iso_code, info["generation"])
+        ctx.checkpoints.put_json(run, "images.json", {
+            "elements": image_elements,
+            "referenced": sorted(uploader.referenced) if uploader is not None else None,
+            "uploads": uploader.to_dict() if uploader is not None else None,
+            "image_prep": image_report.to_dict(),
+            "stage_ms": stage_ms,
+        })
+    ctx.queues.send("embed", message)
+
+
+def _chunks(ctx: StageContext, run: str) -> tuple:
+    """(chunks, parents, image checkpoint) of a run, text chunks first."""
+    text = ctx.checkpoints.get_json(run, "text.json")
+    images = ctx.checkpoints.get_json(run, "images.json") or {}
+    return text["chunks"] + image_chunks(images.get("elements", [])), text["parents"], images
+
+
+def _embed(ctx: StageContext, run: str, info: Dict[str, Any], message: Dict[str, Any]) -> None:
+    names = ctx.checkpoints.names(run)
+    if "embedded.json" not in names:
+        chunks, _, _ = _chunks(ctx, run)
+        vector_field, vector_spec = vector_fields.write_field(vector_fields.current(index_alias.resolve()))
+        deployment = vector_spec["deployment"] or ctx.embedding_deployment
+        embed_stage = ctx.router.embedding_stage(deployment)
+        expected_dims = vector_spec["dims"]
+        batch_size = info["batch_size"]
+        stage_ms: Dict[str, int] = {}
+        resumed = 0
+        for start in range(0, len(chunks), batch_size):
+            if _batch_name(start) in names:
+                resumed += 1
+                continue
+            ctx.coordinator.check(info["iso_code"], info["generation"])
+            batch = chunks[start:start + batch_size]
+            with telemetry.span("embed_batch", stage="embed", chunks=len(batch), offset=start), timed(stage_ms, "embed"):
+                embeddings = embed_batch(batch, ctx.router, expected_dims, embed_stage)
+            ctx.checkpoints.put_array(run, _batch_name(start), embeddings)
+        if resumed:
+            logging.info(f"Run {run}: resumed embedding after {resumed} checkpointed batches")
+        ctx.checkpoints.put_json(run, "embedded.json", {
+            "chunks": len(chunks), "field": vector_field, "deployment": deployment, "dims": expected_dims,
+            "stage_ms": stage_ms,
+        })
+    ctx.queues.send("index", message)
+
+
+def _index(ctx: StageContext, run: str, info: Dict[str, Any], message: Dict[str, Any]) -> None:
+    iso_code, generation = info["iso_code"], info["generation"]
+    chunks, parents, images = _chunks(ctx, run)
+    embedded = ctx.checkpoints.get_json(run, "embedded.json")
+    expected_dims = embedded["dims"]
+    vector_field = embedded.get("field", vector_fields.DEFAULT_FIELD)
+    deployment = embedded.get("deployment") or ctx.embedding_deployment
+    batch_size = info["batch_size"]
+    stage_ms = dict(info["stage_ms"])
+    for part in (images, embedded):
+        for stage, ms in (part.get("stage_ms") or {}).items():
+            stage_ms[stage] = stage_ms.get(stage, 0) + ms
+
+    search_index = index_alias.resolve()
+    search_client = ctx.search_client(search_index)
+    with telemetry.span("schema_check", index=search_index) as span:
+        writable_fields = index_schema.validate(ctx.search_endpoint, ctx.search_key, search_index)
+        # Vector fields added by a migration are not in index.json
+        writable_fields = set(writable_fields) | set(vector_fields.current(search_index)["fields"])
+        span.set(fields=sorted(writable_fields))
+
+    ctx.coordinator.check(iso_code, generation)
+    with ctx.coordinator.lock(iso_code, coordination.lock_timeout()), \
+            tempfile.TemporaryDirectory(prefix="ingest-") as workdir:
+        ctx.coordinator.check(iso_code, generation)
+        existing_ids = country_ids(search_client, iso_code)
+
+        # Every embedding checkpoint is read before the first index write, so a missing one leaves the
+        # country's documents as they were
+        embedded = np.memmap(
+            os.path.join(workdir, "vectors.f32"), dtype="float32", mode="w+", shape=(max(1, len(chunks)), expected_dims)
+        )
+        for start in range(0, len(chunks), batch_size):
+            embeddings = ctx.checkpoints.get_array(run, _batch_name(start))
+            if embeddings is None:
+                raise RuntimeError(f"Run {run} is missing the embedding checkpoint at offset {start}")
+            embedded[start:start + len(embeddings)] = embeddings
+        live = index_alias.is_live(search_index)
+        vectors = None
+        if live and not vector_fields.migrating(vector_fields.current(search_index)) and snapshot_store.container_name() and ctx.blob_service_client is not None and chunks:
+            vectors = embedded
+
+        ctx.coordinator.check(iso_code, generation)
+        stamp = snapshot_store.mark_indexing(ctx.blob_service_client, iso_code) if live and ctx.blob_service_client is not None else None
+        with index_writer.IndexWriter(search_client, writable_fields) as writer:
+            for start in range(0, len(chunks), batch_size):
+                writer.add(
+                    chunk_document(iso_code, start + j, chunk_data, embedded[start + j].tolist(), vector_field)
+                    for j, chunk_data in enumerate(chunks[start:start + batch_size])
+                )
+            writer.add(parent_document(iso_code, n, parent) for n, parent in enumerate(parents))
+        failed = writer.failed
+        upload_stats = writer.stats()
+        stage_ms["index_upload"] = int(upload_stats["seconds"] * 1000)
+        logging.info(f"Index upload for {iso_code}: {json.dumps(upload_stats)}")
+
+        referenced = images.get("referenced")
+        stale_ids, snapshot_version = finish_country(
+            search_client, ctx.blob_service_client, ctx.manifest_store, iso_code, existing_ids, chunks,
+            parents, failed, vectors,
+            (lambda: image_store.delete_unreferenced(ctx.blob_service_client, "legaldocsrag", iso_code, referenced))
+            if referenced is not None and ctx.blob_service_client is not None else None,
+            stage_ms,
+            info["started_at"],
+            dict(source=info["source"], image_count=len(images.get("elements", [])),
+                 embedding_deployment=deployment, dims=expected_dims, pipeline=info["pipeline"]),
+            live,
+            stamp,
+        )
+        vector_fields.settle(search_index, iso_code, vector_field)
+
+    telemetry.event(
+        "ingest.completed",
+        sample_rate=1.0,  # one event per document, not a hot path
+        iso_code=iso_code,
+        filename=info["blob"].split('/')[-1],
+        mode="staged",
+        run=run,
+        chunks=len(chunks),
+        images=len(images.get("elements", [])),
+        replaced_documents=len(existing_ids),
+        stale_deleted=len(stale_ids),
+        failed_uploads=len(failed),
+        index_upload=upload_stats,
+        snapshot_version=snapshot_version,
+        image_prep=images.get("image_prep"),
+        image_uploads=images.get("uploads"),
+        stage_ms=stage_ms,
+        duration_ms=int((time.time() - info["started_at"]) * 1000),
+        resilience=resilience.metrics_snapshot(),
+    )
+    if os.environ.get("INGEST_KEEP_CHECKPOINTS", "false").lower() not in ("1", "true", "yes"):
+        ctx.checkpoints.delete(run)
+
+
+HANDLERS = {"caption": _caption, "embed": _embed, "index": _index}
+
+
+def handle(stage: str, message: Dict[str, Any], delivery: int = 1) -> None:
+    """Runs one stage of a staged ingestion for a queue message.
+
+    Errors propagate, so the queue delivers the message again; a superseded run
+    stops quietly and drops its checkpoints.
+    """
+    telemetry.configure("legaldocs-processor")
+    ctx = get_context()
+    run, iso_code = message["run"], message["iso_code"]
+    info = ctx.checkpoints.get_json(run, "run.json")
+    if info is None:
+        # Finished (or superseded) already; this is a duplicate delivery
+        logging.info(f"Run {run} has no checkpoints; nothing to do for {stage}")
+        return
+    started = time.monotonic()
+    try:
+        with _slot(stage), usage.track() as tracker, \
+                telemetry.span(f"ingest_{stage}", stage=stage, iso_code=iso_code, run=run, delivery=delivery):
+            ctx.coordinator.check(iso_code, info["generation"])
+            HANDLERS[stage](ctx, run, info, message)
+        telemetry.event(
+            "ingest.stage",
+            sample_rate=1.0,
+            stage=stage,
+            iso_code=iso_code,
+            run=run,
+            delivery=delivery,
+            duration_ms=int((time.monotonic() - started) * 1000),
+            usage=tracker.to_dict(),
+        )
+    except coordination.Superseded as e:
+        logging.info(f"Stopping {stage} of {run}: {e}")
+        ctx.checkpoints.delete(run)
+        telemetry.event("ingest.superseded", sample_rate=1.0, iso_code=iso_code, stage=stage, run=run, reason=str(e))
+
+
+def local_handlers() -> Dict[str, Any]:
+    """Stage handlers for ``stage_queue.LocalQueues.start``."""
+    return {stage: (lambda message, delivery, stage=stage: handle(stage, message, delivery)) for stage in HANDLERS}
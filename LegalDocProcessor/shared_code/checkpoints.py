@@ -0,0 +1,232 @@
+"""Intermediate outputs of staged ingestion, kept between stages.
+
+Each stage of a staged run (see ``stage_queue``) writes its output here
+before it enqueues the next stage, and checks for it before doing any work:
+a message delivered again after a failure finds the checkpoint and moves on
+instead of captioning or embedding the document a second time. The embed
+stage checkpoints every batch, so a failure after hours of embedding loses
+at most one batch, and an index write that fails keeps every vector.
+
+Checkpoints of a run live under ``checkpoints/<run>/``; the index stage
+deletes them once the country is written, and a superseded run deletes its
+own. Files, JSON values and NumPy arrays (``.npy``) are supported.
+
+Backends, selected by ``INGEST_CHECKPOINT``:
+
+- ``blob`` (default): ``KNIFE_CHECKPOINT_CONTAINER``, falling back to
+  ``KNIFE_MANIFEST_CONTAINER`` and ``KNIFE_SNAPSHOT_CONTAINER`` (never
+  ``legaldocsrag``, whose blob trigger starts ingestion).
+- ``dir:<path>``: files under a local directory, for development and
+  ``scripts/ingest_local.py``.
+- ``memory``: a process-local stand-in for tests.
+"""
+import io
+import json
+import os
+import shutil
+import threading
+from typing import Any, Dict, Optional, Set
+
+import numpy as np
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+from . import image_store
+
+PREFIX = "checkpoints/"
+
+
+class CheckpointStore:
+    def put(self, run: str, name: str, data: bytes) -> None:
+        raise NotImplementedError
+
+    def get(self, run: str, name: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def names(self, run: str) -> Set[str]:
+        """Names of the checkpoints a run has written so far."""
+        raise NotImplementedError
+
+    def delete(self, run: str) -> None:
+        raise NotImplementedError
+
+    def put_file(self, run: str, name: str, path: str) -> None:
+        with open(path, "rb") as f:
+            self.put(run, name, f.read())
+
+    def get_file(self, run: str, name: str, path: str) -> bool:
+        """Writes a checkpoint to ``path``; False when it does not exist."""
+        data = self.get(run, name)
+        if data is None:
+            return False
+        with open(path, "wb") as f:
+            f.write(data)
+        return True
+
+    def put_json(self, run: str, name: str, value: Any) -> None:
+        self.put(run, name, json.dumps(value, ensure_ascii=False).encode("utf-8"))
+
+    def get_json(self, run: str, name: str) -> Any:
+        data = self.get(run, name)
+        return json.loads(data) if data is not None else None
+
+    def put_array(self, run: str, name: str, array) -> None:
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(array, dtype="float32"), allow_pickle=False)
+        self.put(run, name, buffer.getvalue())
+
+    def get_array(self, run: str, name: str):
+        data = self.get(run, name)
+        return np.load(io.BytesIO(data), allow_pickle=False) if data is not None else None
+
+
+class MemoryCheckpointStore(CheckpointStore):
+    def __init__(self):
+        self._data: Dict[str, Dict[str, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def put(self, run, name, data):
+        with self._lock:
+            self._data.setdefault(run, {})[name] = bytes(data)
+
+    def get(self, run, name):
+        with self._lock:
+            return self._data.get(run, {}).get(name)
+
+    def names(self, run):
+        with self._lock:
+            return set(self._data.get(run, {}))
+
+    def delete(self, run):
+        with self._lock:
+            self._data.pop(run, None)
+
+
+class DirCheckpointStore(CheckpointStore):
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, run: str, name: str = "") -> str:
+        return os.path.join(self.root, *run.split("/"), *name.split("/"))
+
+    @staticmethod
+    def _makedirs(path: str) -> None:
+        # ``delete`` may remove an empty parent (``AE/``) between the checks of ``makedirs``
+        for attempt in range(3):
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                return
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+    def put(self, run, name, data):
+        path = self._path(run, name)
+        self._makedirs(path)
+        # Written next to the target and renamed, so a crash never leaves half a checkpoint
+        with open(f"{path}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{path}.tmp", path)
+
+    def get(self, run, name):
+        try:
+            with open(self._path(run, name), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_file(self, run, name, path):
+        target = self._path(run, name)
+        self._makedirs(target)
+        shutil.copyfile(path, f"{target}.tmp")
+        os.replace(f"{target}.tmp", target)
+
+    def names(self, run):
+        base = self._path(run)
+        found = set()
+        for folder, _, files in os.walk(base):
+            for filename in files:
+                if not filename.endswith(".tmp"):
+                    found.add(os.path.relpath(os.path.join(folder, filename), base).replace(os.sep, "/"))
+        return found
+
+    def delete(self, run):
+        folder = os.path.join(self.root, *run.split("/"))
+        shutil.rmtree(folder, ignore_errors=True)
+        # Run ids are ``<ISO>/<generation>-<sha>``; the country's folder goes with its last run
+        root = os.path.abspath(self.root)
+        parent = os.path.dirname(os.path.abspath(folder))
+        while parent != root and parent.startswith(root + os.sep):
+            try:
+                os.rmdir(parent)
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+
+class BlobCheckpointStore(CheckpointStore):
+    def __init__(self, container_client):
+        self.container = container_client
+        try:
+            self.container.create_container()
+        except ResourceExistsError:
+            pass
+
+    @staticmethod
+    def _blob(run: str, name: str = "") -> str:
+        return f"{PREFIX}{run}/{name}"
+
+    def put(self, run, name, data):
+        self.container.upload_blob(self._blob(run, name), data, overwrite=True)
+
+    def get(self, run, name):
+        try:
+            return self.container.get_blob_client(self._blob(run, name)).download_blob().readall()
+        except ResourceNotFoundError:
+            return None
+
+    def put_file(self, run, name, path):
+        # Streamed in blocks, so a large package is never held in memory
+        with open(path, "rb") as f:
+            self.container.upload_blob(self._blob(run, name), f, overwrite=True)
+
+    def get_file(self, run, name, path):
+        try:
+            downloader = self.container.get_blob_client(self._blob(run, name)).download_blob()
+        except ResourceNotFoundError:
+            return False
+        with open(path, "wb") as f:
+            downloader.readinto(f)
+        return True
+
+    def names(self, run):
+        prefix = self._blob(run)
+        return {b.name[len(prefix):] for b in self.container.list_blobs(name_starts_with=prefix)}
+
+    def delete(self, run):
+        prefix = self._blob(run)
+        image_store.delete_blobs(self.container, [b.name for b in self.container.list_blobs(name_starts_with=prefix)])
+
+
+_MEMORY: Optional[MemoryCheckpointStore] = None
+_BLOB: Dict[str, BlobCheckpointStore] = {}
+
+
+def from_env(blob_service_client=None) -> CheckpointStore:
+    global _MEMORY
+    setting = os.environ.get("INGEST_CHECKPOINT", "blob").strip()
+    if setting == "memory":
+        if _MEMORY is None:
+            _MEMORY = MemoryCheckpointStore()
+        return _MEMORY
+    if setting.startswith("dir:"):
+        return DirCheckpointStore(setting[len("dir:"):])
+    container = (
+        os.environ.get("KNIFE_CHECKPOINT_CONTAINER")
+        or os.environ.get("KNIFE_MANIFEST_CONTAINER")
+        or os.environ.get("KNIFE_SNAPSHOT_CONTAINER")
+    )
+    if not container or container == "legaldocsrag" or blob_service_client is None:
+        raise RuntimeError("INGEST_CHECKPOINT=blob needs KNIFE_CHECKPOINT_CONTAINER (not legaldocsrag) and a storage connection")
+    if container not in _BLOB:
+        _BLOB[container] = BlobCheckpointStore(blob_service_client.get_container_client(container))
+    return _BLOB[container]
@@ -0,0 +1,254 @@
+"""Structure-aware chunking of extracted DOCX elements for legal texts.
+
+Chunks follow the document's own structure instead of a character count:
+
+- headings come from paragraph styles (``Heading N``, ``Title``), outline
+  levels, or legal markers such as ``Article 5``, ``§ 3``, ``Chapter II``;
+  a heading closes the running chunk, so articles and sections are not mixed;
+- text is packed up to ``max_tokens``; paragraphs longer than the budget are
+  split at sentence boundaries (at word boundaries as a last resort), and a
+  continued chunk starts with ``overlap_tokens`` worth of the previous sentences;
+- list items (paragraphs with numbering) stay with the text that introduces them;
+- every chunk records its ``section_path`` (e.g. ``["Chapter II", "Article 5"]``);
+  continuation chunks repeat the path in their first line so they embed with
+  their context.
+
+Tables and images remain one chunk each and inherit the current section path.
+Tokens are counted with ``tiktoken`` when it is installed, otherwise estimated
+(about four characters per token).
+"""
+import json
+import re
+from typing import Any, Dict, Iterable, List, Optional
+
+from . import ratelimit
+
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception:  # optional; fall back to the character-based estimate
+    _ENCODING = None
+
+DEFAULT_MAX_TOKENS = 700
+DEFAULT_OVERLAP_TOKENS = 60
+DEFAULT_MIN_TOKENS = 120
+PATH_SEPARATOR = " > "
+
+# Legal structure markers and the heading level they imply.
+_MARKERS = [
+    (re.compile(r"^(part|title|titre|teil|book|livre|buch)\s+([IVXLC]+|\d+|[a-z]+)\b", re.IGNORECASE), 1),
+    (re.compile(r"^(chapter|chapitre|kapitel|capítulo|capitolo)\s+([IVXLC]+|\d+)\b", re.IGNORECASE), 2),
+    (re.compile(r"^(section|abschnitt|sección|sezione)\s+([IVXLC]+|\d+)\b", re.IGNORECASE), 3),
+    (re.compile(r"^(article|art\.|artikel|artículo|articolo|§|schedule|annex|annexe|anhang)\s*"
+                r"(premier|[IVXLC]+|\d+[a-z]?(\.\d+)*)\b", re.IGNORECASE), 4),
+]
+_HEADING_STYLE = re.compile(r"^heading\s*(\d)$", re.IGNORECASE)
+_SENTENCE_END = re.compile(r"(?<=[.;:!?])\s+(?=[\"'«(\[]?[A-ZÀ-Ý0-9])")
+# Marker paragraphs longer than this are body text that happens to start with "Article 5 ...".
+_MAX_HEADING_CHARS = 160
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    if _ENCODING is not None:
+        return len(_ENCODING.encode(text, disallowed_special=()))
+    return ratelimit.estimate_tokens(text)
+
+
+def heading_level(element: Dict[str, Any]) -> Optional[int]:
+    """The heading level of a text element (1 = outermost), or None for body text."""
+    metadata = element.get("metadata", {})
+    style = metadata.get("style") or ""
+    if style.lower() == "title":
+        return 1
+    match = _HEADING_STYLE.match(style)
+    if match:
+        return int(match.group(1))
+    if metadata.get("outline_level") is not None:
+        return int(metadata["outline_level"]) + 1
+    text = element.get("content", "").strip()
+    if len(text) <= _MAX_HEADING_CHARS:
+        for pattern, level in _MARKERS:
+            if pattern.match(text):
+                return level
+    return None
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s for s in (part.strip() for part in _SENTENCE_END.split(text)) if s]
+
+
+def _split_words(text: str, max_tokens: int) -> List[str]:
+    pieces, current = [], []
+    for word in text.split():
+        if current and count_tokens(" ".join(current + [word])) > max_tokens:
+            pieces.append(" ".join(current))
+            current = []
+        current.append(word)
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def split_units(text: str, max_tokens: int) -> List[str]:
+    """Splits text into sentences, and sentences longer than the budget into word runs."""
+    units = []
+    for sentence in split_sentences(text):
+        if count_tokens(sentence) <= max_tokens:
+            units.append(sentence)
+        else:
+            units.extend(_split_words(sentence, max_tokens))
+    return units
+
+
+def split_text(text: str, max_tokens: int, overlap_tokens: int = 0) -> List[str]:
+    """Packs a text's sentences into pieces of at most ``max_tokens`` with sentence overlap."""
+    pieces, current, current_tokens = [], [], 0
+    for unit in split_units(text, max_tokens):
+        tokens = count_tokens(unit)
+        if current and current_tokens + tokens > max_tokens:
+            pieces.append(" ".join(current))
+            current, current_tokens = _tail(current, overlap_tokens, max_tokens - tokens)
+        current.append(unit)
+        current_tokens += tokens
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def _tail(units: List[str], overlap_tokens: int, room: int) -> tuple:
+    """The last units of a chunk totalling at most overlap_tokens (and fitting in room)."""
+    tail, total = [], 0
+    for unit in reversed(units):
+        tokens = count_tokens(unit)
+        if total + tokens > min(overlap_tokens, room):
+            break
+        tail.insert(0, unit)
+        total += tokens
+    return tail, total
+
+
+def _common_prefix(a: List[str], b: List[str]) -> List[str]:
+    prefix = []
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        prefix.append(x)
+    return prefix
+
+
+class _Section:
+    """The running chunk: text units under one section path."""
+
+    def __init__(self, path: List[str]):
+        self.path = list(path)
+        self.units: List[str] = []
+        self.tokens = 0
+        self.continued = False
+
+    def add(self, unit: str, tokens: int) -> None:
+        self.units.append(unit)
+        self.tokens += tokens
+
+    def has_body(self, heading_units: int) -> bool:
+        return len(self.units) > heading_units
+
+
+def build_chunks(
+    content_elements: Iterable[Dict[str, Any]],
+    image_elements: Iterable[Dict[str, Any]],
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    overlap_tokens: int = DEFAULT_OVERLAP_TOKENS,
+    min_tokens: int = DEFAULT_MIN_TOKENS,
+) -> List[Dict[str, Any]]:
+    """Builds text, table and image chunks that follow headings and articles under a token budget."""
+    chunks: List[Dict[str, Any]] = []
+    path: List[tuple] = []  # (level, heading text)
+    current = _Section([])
+    heading_units = 0  # leading units of ``current`` that are headings
+
+    def path_names() -> List[str]:
+        return [name for _, name in path]
+
+    def flush() -> None:
+        """Emits the running chunk if it holds more than headings, and starts a new one."""
+        nonlocal current, heading_units
+        if current.has_body(heading_units):
+            text = "\n\n".join(current.units)
+            if current.continued and current.path:
+                text = f"[{PATH_SEPARATOR.join(current.path)}]\n{text}"
+            chunks.append({
+                "text": text,
+                "metadata": {
+                    "chunk_type": "text",
+                    "section_path": current.path,
+                    "tokens": count_tokens(text),
+                },
+            })
+            current = _Section(path_names())
+            heading_units = 0
+
+    for elem in content_elements:
+        if elem["type"] == "table":
+            # Pending headings stay in the buffer and introduce the text after the table.
+            flush()
+            chunks.append({
+                "text": elem["content"],
+                "metadata": {
+                    "chunk_type": "table",
+                    "table_id": elem["metadata"].get("table_id", ""),
+                    "table_json": json.dumps(elem["metadata"].get("json_data", [])),
+                    "section_path": path_names(),
+                },
+            })
+            continue
+
+        text = elem["content"].strip()
+        if not text:
+            continue
+        level = heading_level(elem)
+        if level is not None:
+            # A short section is merged with its next sibling or first subsection instead of
+            # standing alone; the merged chunk keeps the path both sections share.
+            merge = current.has_body(heading_units) and current.tokens < min_tokens and path and level >= path[-1][0]
+            if not merge:
+                flush()
+            while path and path[-1][0] >= level:
+                path.pop()
+            path.append((level, text))
+            if merge:
+                current.path = _common_prefix(current.path, path_names())
+            else:
+                current.path = path_names()
+                heading_units += 1
+            current.add(text, count_tokens(text))
+            continue
+
+        tokens = count_tokens(text)
+        units = [text] if tokens <= max_tokens else split_units(text, max_tokens)
+        for unit in units:
+            unit_tokens = count_tokens(unit)
+            if current.has_body(heading_units) and current.tokens + unit_tokens > max_tokens:
+                previous = current.units[heading_units:]
+                flush()
+                current.continued = True
+                tail, _ = _tail(previous, overlap_tokens, max_tokens - unit_tokens)
+                for part in tail:
+                    current.add(part, count_tokens(part))
+            current.add(unit, unit_tokens)
+
+    flush()
+
+    for elem in image_elements:
+        chunks.append({
+            "text": elem["content"],
+            "metadata": {
+                "chunk_type": "image",
+                "figure_id": elem["metadata"].get("figure_id", ""),
+                "ocr_text": elem["metadata"].get("ocr_text", ""),
+                "blob_url": elem["metadata"].get("blob_url", ""),
+                "section_path": elem["metadata"].get("section_path", []),
+            },
+        })
+    return chunks
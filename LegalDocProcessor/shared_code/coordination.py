@@ -0,0 +1,321 @@
+"""Per-country coordination of overlapping ingestions.
+
+Blob triggers for two quick uploads of the same ``XX.docx`` run concurrently,
+and without coordination the older run can finish last and win. Every run
+therefore:
+
+- registers and receives a generation number for its ISO code; a later
+  registration supersedes every earlier one;
+- waits until its blob is ``INGEST_DEBOUNCE_S`` seconds old (default 5)
+  after registering, so a correction uploaded right after a document
+  supersedes it before any work; blobs modified longer ago (late triggers,
+  bulk runs) are not delayed;
+- calls ``check()`` at stage boundaries (after parsing, before embedding and
+  between embedding batches), which raises ``Superseded`` once a newer run
+  registered, so superseded runs stop before the expensive stages;
+- holds the country's lock while it reads and replaces the country's index
+  documents, so two runs never interleave their writes and stale deletes.
+
+Backends, selected by ``INGEST_COORDINATION``:
+
+- ``blob`` (default when ``KNIFE_MANIFEST_CONTAINER``,
+  ``KNIFE_SNAPSHOT_CONTAINER`` or ``KNIFE_CHECKPOINT_CONTAINER`` is set): the
+  generation lives in ``locks/<ISO>.gen`` and is incremented with ETag
+  conditions; the lock is a 60-second lease on ``locks/<ISO>.lock``, renewed in
+  the background while held.
+- ``sqlite:<path>``: generations and leases in a SQLite file, shared by the
+  processes of one machine (``scripts/ingest_local.py``).
+- ``local``: an in-process stand-in with the same semantics, for development
+  and single-instance inline ingestion. Staged runs continue in other
+  processes, so staged mode on storage queues refuses it.
+- ``off``: no coordination.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+PREFIX = "locks/"
+LEASE_SECONDS = 60
+
+
+class Superseded(RuntimeError):
+    """A newer ingestion of the same country started; this one should stop."""
+
+
+class Coordinator:
+    def register(self, iso_code: str) -> int:
+        """Returns this run's generation; every earlier generation is superseded."""
+        raise NotImplementedError
+
+    def current(self, iso_code: str) -> int:
+        raise NotImplementedError
+
+    def check(self, iso_code: str, generation: int) -> None:
+        """Raises ``Superseded`` when a newer run registered for the country."""
+        latest = self.current(iso_code)
+        if latest != generation:
+            raise Superseded(f"{iso_code} ingestion generation {generation} superseded by {latest}")
+
+    def lock(self, iso_code: str, timeout: float):
+        """Context manager holding the country's write lock; raises ``TimeoutError`` when it cannot be taken."""
+        raise NotImplementedError
+
+
+class NullCoordinator(Coordinator):
+    def register(self, iso_code):
+        return 0
+
+    def current(self, iso_code):
+        return 0
+
+    @contextmanager
+    def lock(self, iso_code, timeout):
+        yield
+
+
+class LocalCoordinator(Coordinator):
+    def __init__(self):
+        self._generations: Dict[str, int] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def register(self, iso_code):
+        with self._guard:
+            self._generations[iso_code] = self._generations.get(iso_code, 0) + 1
+            return self._generations[iso_code]
+
+    def current(self, iso_code):
+        with self._guard:
+            return self._generations.get(iso_code, 0)
+
+    @contextmanager
+    def lock(self, iso_code, timeout):
+        with self._guard:
+            country_lock = self._locks.setdefault(iso_code, threading.Lock())
+        if not country_lock.acquire(timeout=timeout):
+            raise TimeoutError(f"Could not take the {iso_code} ingestion lock within {timeout:.0f}s")
+        try:
+            yield
+        finally:
+            country_lock.release()
+
+
+class BlobCoordinator(Coordinator):
+    def __init__(self, container_client, attempts: int = 10):
+        self.container = container_client
+        self.attempts = attempts
+        try:
+            self.container.create_container()
+        except ResourceExistsError:
+            pass
+
+    def _generation_blob(self, iso_code: str):
+        return self.container.get_blob_client(f"{PREFIX}{iso_code}.gen")
+
+    def _read(self, client):
+        try:
+            downloader = client.download_blob()
+        except ResourceNotFoundError:
+            return 0, None
+        return int(json.loads(downloader.readall()).get("generation", 0)), downloader.properties.etag
+
+    def register(self, iso_code):
+        client = self._generation_blob(iso_code)
+        for _ in range(self.attempts):
+            generation, etag = self._read(client)
+            body = json.dumps({"generation": generation + 1, "registered": time.time()})
+            try:
+                if etag:
+                    client.upload_blob(body, overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified)
+                else:
+                    client.upload_blob(body, overwrite=False)
+                return generation + 1
+            except (ResourceModifiedError, ResourceExistsError):
+                continue
+        raise RuntimeError(f"Could not register an ingestion generation for {iso_code}")
+
+    def current(self, iso_code):
+        return self._read(self._generation_blob(iso_code))[0]
+
+    @contextmanager
+    def lock(self, iso_code, timeout):
+        client = self.container.get_blob_client(f"{PREFIX}{iso_code}.lock")
+        try:
+            client.upload_blob(b"", overwrite=False)
+        except ResourceExistsError:
+            pass
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                lease = client.acquire_lease(lease_duration=LEASE_SECONDS)
+                break
+            except HttpResponseError as e:
+                # 409: another run holds the lease
+                if e.status_code != 409:
+                    raise
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Could not take the {iso_code} ingestion lock within {timeout:.0f}s") from e
+                time.sleep(2.0)
+
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(LEASE_SECONDS / 3):
+                try:
+                    lease.renew()
+                except Exception as e:
+                    logging.warning(f"Could not renew the {iso_code} ingestion lease: {e}")
+
+        renewer = threading.Thread(target=renew, name=f"lease-{iso_code}", daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            renewer.join()
+            try:
+                lease.release()
+            except Exception as e:
+                logging.warning(f"Could not release the {iso_code} ingestion lease (it expires by itself): {e}")
+
+
+class SqliteCoordinator(Coordinator):
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS generations (iso_code TEXT PRIMARY KEY, generation INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS locks (iso_code TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+
+    @contextmanager
+    def _transaction(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def register(self, iso_code):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO generations VALUES (?, 1) ON CONFLICT(iso_code) DO UPDATE SET generation = generation + 1",
+                (iso_code,),
+            )
+            return conn.execute("SELECT generation FROM generations WHERE iso_code = ?", (iso_code,)).fetchone()[0]
+
+    def current(self, iso_code):
+        with self._transaction() as conn:
+            row = conn.execute("SELECT generation FROM generations WHERE iso_code = ?", (iso_code,)).fetchone()
+        return row[0] if row else 0
+
+    def _try_lock(self, iso_code: str, owner: str) -> bool:
+        with self._transaction() as conn:
+            row = conn.execute("SELECT expires FROM locks WHERE iso_code = ?", (iso_code,)).fetchone()
+            if row is not None and row[0] > time.time():
+                return False
+            conn.execute("INSERT OR REPLACE INTO locks VALUES (?, ?, ?)", (iso_code, owner, time.time() + LEASE_SECONDS))
+            return True
+
+    @contextmanager
+    def lock(self, iso_code, timeout):
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while not self._try_lock(iso_code, owner):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Could not take the {iso_code} ingestion lock within {timeout:.0f}s")
+            time.sleep(0.5)
+
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(LEASE_SECONDS / 3):
+                with self._transaction() as conn:
+                    conn.execute("UPDATE locks SET expires = ? WHERE iso_code = ? AND owner = ?",
+                                 (time.time() + LEASE_SECONDS, iso_code, owner))
+
+        renewer = threading.Thread(target=renew, name=f"lease-{iso_code}", daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            renewer.join()
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM locks WHERE iso_code = ? AND owner = ?", (iso_code, owner))
+
+
+_LOCAL = LocalCoordinator()
+_BLOB: Dict[str, BlobCoordinator] = {}
+
+
+def durable_container() -> Optional[str]:
+    """The container holding the generations and locks of ``blob`` coordination."""
+    return (
+        os.environ.get("KNIFE_MANIFEST_CONTAINER")
+        or os.environ.get("KNIFE_SNAPSHOT_CONTAINER")
+        or os.environ.get("KNIFE_CHECKPOINT_CONTAINER")
+    )
+
+
+def from_env(blob_service_client=None) -> Coordinator:
+    container = durable_container()
+    default = "blob" if container and blob_service_client is not None else "local"
+    mode = os.environ.get("INGEST_COORDINATION") or default
+    if mode.lower() == "off":
+        return NullCoordinator()
+    if mode.startswith("sqlite:"):
+        return SqliteCoordinator(mode[len("sqlite:"):])
+    if mode.lower() == "blob":
+        if not container or container == "legaldocsrag" or blob_service_client is None:
+            logging.warning("INGEST_COORDINATION=blob needs KNIFE_MANIFEST_CONTAINER (or the snapshot or checkpoint "
+                            "container) and a storage connection; using local")
+            return _LOCAL
+        if container not in _BLOB:
+            _BLOB[container] = BlobCoordinator(blob_service_client.get_container_client(container))
+        return _BLOB[container]
+    return _LOCAL
+
+
+def _timestamp(value: Any) -> Optional[datetime]:
+    """A blob's Last-Modified as an aware datetime, from a datetime, ISO 8601 or RFC 1123 text."""
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if not value:
+        return None
+    for parse in (datetime.fromisoformat, parsedate_to_datetime):
+        try:
+            return _timestamp(parse(str(value)))
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def debounce_seconds(last_modified: Any = None) -> float:
+    """What is left of ``INGEST_DEBOUNCE_S`` since the blob was last modified (all of it when unknown)."""
+    debounce = max(0.0, float(os.environ.get("INGEST_DEBOUNCE_S", "5")))
+    modified = _timestamp(last_modified)
+    if modified is None:
+        return debounce
+    age = (datetime.now(timezone.utc) - modified).total_seconds()
+    return min(debounce, max(0.0, debounce - age))
+
+
+def lock_timeout() -> float:
+    return float(os.environ.get("INGEST_LOCK_TIMEOUT_S", "600"))
@@ -0,0 +1,175 @@
+"""Boilerplate and duplicate elimination for one document's elements and chunks.
+
+Runs at ingest, per country document, before anything is embedded:
+
+- ``strip_boilerplate()`` removes lines that recur across the document
+  (running headers and footers, disclaimers, page labels): short non-heading
+  lines seen ``min_repeats`` times or more are kept once and dropped elsewhere;
+- ``dedupe_chunks()`` drops chunks whose normalized text is identical to an
+  earlier chunk, and text chunks that are near-duplicates of an earlier one.
+  Near-duplicates are found with 64-bit SimHash over word 3-gram shingles
+  (candidates share one of four 16-bit bands, i.e. Hamming distance <= 3) and
+  confirmed with the shingles' Jaccard similarity. Chunks whose numbers differ
+  are never treated as duplicates: "6 cm" and "12 cm" are different rules.
+
+Both return a report of what they removed, merged by ``DedupReport``.
+"""
+import hashlib
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+_BANDS = 4
+_BAND_BITS = 16
+
+
+@dataclass
+class DedupReport:
+    boilerplate_lines: int = 0
+    boilerplate_chars: int = 0
+    exact_duplicates: int = 0
+    near_duplicates: int = 0
+    removed_chars: int = 0
+    chunks_before: int = 0
+    chunks_after: int = 0
+    samples: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "boilerplate_lines": self.boilerplate_lines,
+            "boilerplate_chars": self.boilerplate_chars,
+            "exact_duplicates": self.exact_duplicates,
+            "near_duplicates": self.near_duplicates,
+            "removed_chars": self.removed_chars,
+            "chunks_before": self.chunks_before,
+            "chunks_after": self.chunks_after,
+            "samples": self.samples[:5],
+        }
+
+
+def normalize(text: str) -> str:
+    """Lower-cased words joined by single spaces (punctuation and layout dropped)."""
+    return " ".join(_WORD.findall(text.lower()))
+
+
+def shingles(normalized: str, size: int = 3) -> Set[str]:
+    words = normalized.split()
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def simhash(features: Set[str]) -> int:
+    weights = [0] * 64
+    for feature in features:
+        h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if h >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+
+def _bands(value: int) -> List[Tuple[int, int]]:
+    mask = (1 << _BAND_BITS) - 1
+    return [(i, value >> (i * _BAND_BITS) & mask) for i in range(_BANDS)]
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def strip_boilerplate(
+    elements: List[Dict[str, Any]],
+    is_heading: Callable[[Dict[str, Any]], bool],
+    min_repeats: int = 3,
+    max_chars: int = 200,
+) -> DedupReport:
+    """Removes recurring short lines from text elements in place (first occurrence kept)."""
+    report = DedupReport()
+    counts: Counter = Counter()
+    for elem in elements:
+        if elem["type"] == "text" and not is_heading(elem):
+            for line in elem["content"].split("\n"):
+                key = normalize(line)
+                if key and len(line.strip()) <= max_chars:
+                    counts[key] += 1
+    recurring = {key for key, n in counts.items() if n >= min_repeats}
+    if not recurring:
+        return report
+
+    seen: Set[str] = set()
+    kept_elements = []
+    for elem in elements:
+        if elem["type"] != "text" or is_heading(elem):
+            kept_elements.append(elem)
+            continue
+        kept_lines = []
+        for line in elem["content"].split("\n"):
+            key = normalize(line)
+            if key in recurring and len(line.strip()) <= max_chars:
+                if key in seen:
+                    report.boilerplate_lines += 1
+                    report.boilerplate_chars += len(line)
+                    if line.strip() not in report.samples:
+                        report.samples.append(line.strip())
+                    continue
+                seen.add(key)
+            kept_lines.append(line)
+        if any(line.strip() for line in kept_lines):
+            elem["content"] = "\n".join(kept_lines)
+            kept_elements.append(elem)
+    elements[:] = kept_elements
+    return report
+
+
+def dedupe_chunks(
+    chunks: List[Dict[str, Any]],
+    near_threshold: float = 0.9,
+    report: Optional[DedupReport] = None,
+) -> List[Dict[str, Any]]:
+    """Drops exact duplicates (text and table chunks) and near-duplicate text chunks."""
+    report = report or DedupReport()
+    report.chunks_before += len(chunks)
+    exact: Set[str] = set()
+    buckets: Dict[Tuple[int, int], List[int]] = {}
+    kept_features: List[Tuple[Set[str], List[str]]] = []
+    kept = []
+    for chunk in chunks:
+        chunk_type = chunk["metadata"].get("chunk_type", "text")
+        if chunk_type == "image":
+            kept.append(chunk)
+            continue
+        normalized = normalize(chunk["text"])
+        digest = hashlib.sha1(f"{chunk_type}:{normalized}".encode("utf-8")).hexdigest()
+        if digest in exact:
+            report.exact_duplicates += 1
+            report.removed_chars += len(chunk["text"])
+            continue
+        exact.add(digest)
+        if chunk_type != "text":
+            kept.append(chunk)
+            continue
+
+        features = shingles(normalized)
+        numbers = sorted(_NUMBER.findall(normalized))
+        fingerprint = simhash(features)
+        candidates = {i for band in _bands(fingerprint) for i in buckets.get(band, ())}
+        duplicate = any(
+            kept_features[i][1] == numbers and jaccard(features, kept_features[i][0]) >= near_threshold
+            for i in candidates
+        )
+        if duplicate:
+            report.near_duplicates += 1
+            report.removed_chars += len(chunk["text"])
+            continue
+        index = len(kept_features)
+        kept_features.append((features, numbers))
+        for band in _bands(fingerprint):
+            buckets.setdefault(band, []).append(index)
+        kept.append(chunk)
+    report.chunks_after += len(kept)
+    return kept
@@ -0,0 +1,101 @@
+"""Memory-bounded reading of large DOCX packages for ingestion.
+
+python-docx loads every part of a package into memory when a document is
+opened, embedded images included, and ``doc.paragraphs``/``doc.tables`` wrap
+every block of the body each time they are accessed. For annex-heavy country
+documents that, plus a ``bytes`` copy of the blob, is most of the worker's
+memory. The helpers here keep it bounded:
+
+- ``spool()`` copies the blob trigger's input stream to a file in fixed-size
+  pieces instead of reading it into one ``bytes`` object;
+- ``text_package()`` writes a copy of the package whose ``word/media/`` entries
+  are empty, so python-docx only loads text, tables and styles;
+- ``iter_blocks()`` walks the body once and wraps each paragraph or table as it
+  is reached;
+- ``iter_images()`` reads the images from the original package one at a time,
+  so only the image being captioned and uploaded is held in memory.
+"""
+import resource
+import shutil
+import sys
+import zipfile
+from typing import Iterator, List, Tuple, Union
+
+from docx.oxml.ns import qn
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+
+MEDIA_PREFIX = "word/media/"
+COPY_BUFSIZE = 1024 * 1024
+
+_PARAGRAPH = qn("w:p")
+_TABLE = qn("w:tbl")
+
+
+def spool(stream, path: str, bufsize: int = COPY_BUFSIZE) -> int:
+    """Copies a readable stream to ``path``; returns the number of bytes written."""
+    with open(path, "wb") as f:
+        shutil.copyfileobj(stream, f, bufsize)
+        return f.tell()
+
+
+def text_package(source: str, path: str) -> int:
+    """Writes a copy of a DOCX package with empty media entries; returns the media bytes left out."""
+    media_bytes = 0
+    with zipfile.ZipFile(source) as src, zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as dst:
+        for info in src.infolist():
+            entry = zipfile.ZipInfo(info.filename, info.date_time)
+            entry.compress_type = zipfile.ZIP_DEFLATED
+            if info.filename.startswith(MEDIA_PREFIX):
+                # The part stays in the package so its relationships resolve; it just holds no bytes.
+                media_bytes += info.file_size
+                dst.writestr(entry, b"")
+                continue
+            with src.open(info) as fin, dst.open(entry, "w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as fout:
+                shutil.copyfileobj(fin, fout, COPY_BUFSIZE)
+    return media_bytes
+
+
+def iter_blocks(doc) -> Iterator[Union[Paragraph, Table]]:
+    """Body paragraphs and tables in document order, wrapped one at a time."""
+    for element in doc.element.body.iterchildren():
+        if element.tag == _PARAGRAPH:
+            yield Paragraph(element, doc)
+        elif element.tag == _TABLE:
+            yield Table(element, doc)
+
+
+def image_parts(doc) -> List[Tuple[str, str]]:
+    """(package entry name, content type) of each image the main document part references."""
+    parts = []
+    for rel in doc.part.rels.values():
+        if "image" in rel.reltype and not rel.is_external:
+            part = rel.target_part
+            parts.append((part.partname.lstrip("/"), part.content_type))
+    return parts
+
+
+def iter_images(source: str, parts: List[Tuple[str, str]]) -> Iterator[Tuple[str, str, bytes]]:
+    """Yields (entry name, content type, bytes) for each image part, reading one at a time."""
+    with zipfile.ZipFile(source) as package:
+        for name, content_type in parts:
+            try:
+                data = package.read(name)
+            except KeyError:
+                continue
+            yield name, content_type, data
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB."""
+    try:
+        # VmHWM starts over at exec; ru_maxrss can carry the forking parent's peak
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
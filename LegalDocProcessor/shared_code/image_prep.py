@@ -0,0 +1,188 @@
+"""Local preprocessing of document images before captioning and upload.
+
+Runs on each image as it is read from the package (see ``docx_stream``):
+
+- images whose bytes were already seen in this document are skipped, so an
+  image pasted in several places is captioned and uploaded once;
+- tiny images (bullets, icons, spacer and rule images) are skipped by size, and
+  blank or near-uniform ones by the entropy of a grayscale thumbnail;
+- large images are downscaled to what the vision model actually looks at
+  (long side at most ``max_side``, short side at most ``short_side``; at high
+  detail the service resizes to 2048 and then 768 anyway) and re-encoded:
+  PNG for line art, scans and images with transparency, JPEG for photos.
+  A re-encoding is only kept when it is smaller, or when the source format
+  is one the vision model does not accept.
+
+Images Pillow cannot open (e.g. EMF/WMF) are passed through unchanged.
+``prepare()`` returns the decision for one image and accumulates an
+``ImagePrepReport``.
+"""
+import hashlib
+import logging
+import os
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import Any, Dict, List, Optional, Set
+
+from PIL import Image, UnidentifiedImageError
+
+# Formats the vision model accepts as-is
+VISION_FORMATS = {"PNG": "image/png", "JPEG": "image/jpeg", "GIF": "image/gif", "WEBP": "image/webp"}
+_THUMBNAIL = (128, 128)
+
+
+@dataclass
+class ImagePrepReport:
+    images: int = 0
+    duplicates: int = 0
+    skipped_small: int = 0
+    skipped_blank: int = 0
+    resized: int = 0
+    reencoded: int = 0
+    bytes_in: int = 0
+    bytes_out: int = 0
+    decisions: List[str] = field(default_factory=list)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "images": self.images,
+            "duplicates": self.duplicates,
+            "skipped_small": self.skipped_small,
+            "skipped_blank": self.skipped_blank,
+            "resized": self.resized,
+            "reencoded": self.reencoded,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "bytes_saved": self.bytes_in - self.bytes_out,
+            "decisions": self.decisions[:20],
+        }
+
+
+@dataclass
+class Prepared:
+    """The outcome for one image: ``data`` is None when the image is skipped."""
+    decision: str
+    data: Optional[bytes] = None
+    content_type: str = ""
+    width: int = 0
+    height: int = 0
+
+
+@dataclass
+class Settings:
+    enabled: bool = True
+    min_side: int = 32
+    min_pixels: int = 4096
+    min_entropy: float = 0.05
+    max_side: int = 2048
+    short_side: int = 768
+    jpeg_quality: int = 85
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        return cls(
+            enabled=os.environ.get("IMAGE_PREP_ENABLED", "true").lower() in ("1", "true", "yes"),
+            min_side=int(os.environ.get("IMAGE_MIN_SIDE", "32")),
+            min_pixels=int(os.environ.get("IMAGE_MIN_PIXELS", "4096")),
+            min_entropy=float(os.environ.get("IMAGE_MIN_ENTROPY", "0.05")),
+            max_side=int(os.environ.get("IMAGE_MAX_SIDE", "2048")),
+            short_side=int(os.environ.get("IMAGE_SHORT_SIDE", "768")),
+            jpeg_quality=int(os.environ.get("IMAGE_JPEG_QUALITY", "85")),
+        )
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def target_size(width: int, height: int, max_side: int, short_side: int):
+    """The size the image is scaled down to (never up)."""
+    scale = min(1.0, max_side / max(width, height), short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def is_line_art(image: Image.Image) -> bool:
+    """Few distinct colours: diagrams, scans and screenshots, which JPEG blurs."""
+    return image.convert("RGB").getcolors(256) is not None
+
+
+def _encode(image: Image.Image, settings: Settings):
+    buf = BytesIO()
+    has_alpha = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+    if has_alpha or is_line_art(image):
+        image.save(buf, format="PNG", optimize=True)
+        return buf.getvalue(), "image/png"
+    image.convert("RGB").save(buf, format="JPEG", quality=settings.jpeg_quality, optimize=True)
+    return buf.getvalue(), "image/jpeg"
+
+
+def prepare(
+    data: bytes,
+    content_type: str,
+    seen: Set[str],
+    report: ImagePrepReport,
+    settings: Optional[Settings] = None,
+    name: str = "",
+) -> Prepared:
+    """Decides whether an image is captioned and uploaded, and in which encoding.
+
+    ``seen`` holds the content hashes of earlier images of the document and is updated.
+    """
+    settings = settings or Settings.from_env()
+    report.images += 1
+    result = _prepare(data, content_type, seen, report, settings)
+    if result.data is not None:
+        report.bytes_in += len(data)
+        report.bytes_out += len(result.data)
+    out_bytes = len(result.data) if result.data is not None else 0
+    line = f"{name or 'image'}: {result.decision} {result.width}x{result.height} {len(data)}->{out_bytes} bytes"
+    report.decisions.append(line)
+    logging.info(f"Image prep {line}")
+    return result
+
+
+def _prepare(data: bytes, content_type: str, seen: Set[str], report: ImagePrepReport, settings: Settings) -> Prepared:
+    digest = content_hash(data)
+    if digest in seen:
+        report.duplicates += 1
+        return Prepared("duplicate")
+    seen.add(digest)
+    if not settings.enabled:
+        return Prepared("kept", data, content_type)
+
+    try:
+        image = Image.open(BytesIO(data))
+        image.load()
+    except (UnidentifiedImageError, OSError, ValueError) as e:
+        logging.debug(f"Pillow cannot read {content_type} image: {e}")
+        return Prepared("passthrough", data, content_type)
+    width, height = image.size
+    source_format = image.format
+
+    if min(width, height) < settings.min_side or width * height < settings.min_pixels:
+        report.skipped_small += 1
+        return Prepared("skipped_small", width=width, height=height)
+    thumbnail = image.convert("L")
+    thumbnail.thumbnail(_THUMBNAIL)
+    if thumbnail.entropy() < settings.min_entropy:
+        report.skipped_blank += 1
+        return Prepared("skipped_blank", width=width, height=height)
+
+    size = target_size(width, height, settings.max_side, settings.short_side)
+    resized = size != (width, height)
+    accepted = source_format in VISION_FORMATS and not getattr(image, "is_animated", False)
+    if not resized and accepted:
+        # Re-encoding an image of the right size rarely pays off and can lose quality
+        return Prepared("kept", data, VISION_FORMATS[source_format], width, height)
+
+    if image.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    if resized:
+        image = image.resize(size, Image.LANCZOS)
+    encoded, encoded_type = _encode(image, settings)
+    if accepted and len(encoded) >= len(data):
+        return Prepared("kept", data, VISION_FORMATS[source_format], width, height)
+    if resized:
+        report.resized += 1
+    report.reencoded += 1
+    return Prepared("resized" if resized else "reencoded", encoded, encoded_type, size[0], size[1])
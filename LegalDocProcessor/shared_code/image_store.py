@@ -0,0 +1,156 @@
+"""Content-addressed, concurrent uploads of document images to blob storage.
+
+Images are stored as ``images/<ISO>/<sha256>.<ext>``, so a blob name only ever
+holds one content and re-ingesting an unchanged image costs no upload:
+
+- the country's existing image blobs are listed once (one paged listing, not
+  a HEAD per image) when the uploader is created, and images whose name is
+  already there are skipped;
+- the remaining uploads run on a small thread pool that shares the caller's
+  ``BlobServiceClient``; at most ``2 * max_workers`` images wait in memory, so
+  the streaming ingestion stays bounded;
+- ``collect_garbage()`` deletes the country's image blobs this run did not
+  reference (images removed or changed in the new document version), in
+  batched delete requests.
+
+Settings:
+
+- ``IMAGE_UPLOAD_WORKERS``: concurrent uploads per document (default 4).
+"""
+import contextvars
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Set
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, ContentSettings
+
+PREFIX = "images/"
+# Blob batch requests accept at most 256 sub-requests
+DELETE_BATCH = 256
+
+
+def country_prefix(iso_code: str) -> str:
+    return f"{PREFIX}{iso_code}/"
+
+
+def blob_name(iso_code: str, data: bytes, content_type: str) -> str:
+    """The content-addressed name of an image of a country."""
+    return f"{country_prefix(iso_code)}{hashlib.sha256(data).hexdigest()}.{content_type.split('/')[-1]}"
+
+
+class ImageUploader:
+    """Uploads one country's images concurrently, skipping blobs that already exist."""
+
+    def __init__(self, blob_service_client: BlobServiceClient, container_name: str, iso_code: str, max_workers: int = 0):
+        self.container = blob_service_client.get_container_client(container_name)
+        self.iso_code = iso_code
+        max_workers = max_workers or int(os.environ.get("IMAGE_UPLOAD_WORKERS", "4"))
+        self.existing: Set[str] = {
+            b.name for b in self.container.list_blobs(name_starts_with=country_prefix(iso_code))
+        }
+        self.referenced: Set[str] = set()
+        self.failed: Set[str] = set()
+        self.stats: Dict[str, int] = {"uploaded": 0, "skipped_existing": 0, "failed": 0, "bytes_uploaded": 0, "gc_deleted": 0}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(2 * max_workers)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="image-upload")
+        self._pending: List[Future] = []
+
+    def submit(self, data: bytes, content_type: str) -> str:
+        """Queues an image for upload and returns its blob URL.
+
+        The URL is known before the upload finishes; names whose upload failed are
+        in ``failed`` once ``wait()`` returns.
+        """
+        name = blob_name(self.iso_code, data, content_type)
+        url = self.container.get_blob_client(name).url
+        if name in self.referenced:
+            return url
+        self.referenced.add(name)
+        if name in self.existing:
+            self.stats["skipped_existing"] += 1
+            return url
+        self._slots.acquire()
+        try:
+            self._pending.append(self._pool.submit(
+                contextvars.copy_context().run, self._upload, name, data, content_type
+            ))
+        except Exception:
+            self._slots.release()
+            raise
+        return url
+
+    def _upload(self, name: str, data: bytes, content_type: str) -> None:
+        try:
+            self.container.upload_blob(
+                name, data, overwrite=True, content_settings=ContentSettings(content_type=content_type)
+            )
+            with self._lock:
+                self.stats["uploaded"] += 1
+                self.stats["bytes_uploaded"] += len(data)
+            logging.info(f"Uploaded image {name} ({len(data)} bytes)")
+        except Exception as e:
+            logging.error(f"Failed to upload image {name}: {e}")
+            with self._lock:
+                self.stats["failed"] += 1
+                self.failed.add(name)
+        finally:
+            self._slots.release()
+
+    def wait(self) -> None:
+        """Waits for queued uploads and shuts the pool down."""
+        for future in self._pending:
+            future.result()
+        self._pending = []
+        self._pool.shutdown(wait=True)
+
+    def collect_garbage(self) -> int:
+        """Deletes the country's image blobs that this run did not reference."""
+        orphans = sorted(self.existing - self.referenced)
+        self.stats["gc_deleted"] = delete_blobs(self.container, orphans)
+        return self.stats["gc_deleted"]
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.stats, referenced=len(self.referenced))
+
+
+def delete_blobs(container, names: Iterable[str]) -> int:
+    """Deletes blobs in batch requests; returns how many were deleted."""
+    names = list(names)
+    deleted = 0
+    for start in range(0, len(names), DELETE_BATCH):
+        batch = names[start:start + DELETE_BATCH]
+        try:
+            responses = container.delete_blobs(*batch, raise_on_any_failure=False)
+            deleted += sum(1 for r in responses if r.status_code in (200, 202, 404))
+        except Exception as e:
+            logging.warning(f"Batch delete failed ({e}); deleting {len(batch)} blobs one by one")
+            for name in batch:
+                try:
+                    container.delete_blob(name)
+                    deleted += 1
+                except ResourceNotFoundError:
+                    deleted += 1
+                except Exception as inner:
+                    logging.error(f"Failed to delete {name}: {inner}")
+    return deleted
+
+
+def delete_unreferenced(blob_service_client: BlobServiceClient, container_name: str, iso_code: str,
+                        referenced: Iterable[str]) -> int:
+    """Deletes the country's image blobs not named in ``referenced`` (for runs whose uploader is gone)."""
+    container = blob_service_client.get_container_client(container_name)
+    keep = set(referenced)
+    names = [b.name for b in container.list_blobs(name_starts_with=country_prefix(iso_code)) if b.name not in keep]
+    return delete_blobs(container, names)
+
+
+def delete_country_images(blob_service_client: BlobServiceClient, container_name: str, iso_code: str) -> int:
+    """Deletes every image blob of a country."""
+    container = blob_service_client.get_container_client(container_name)
+    names = [b.name for b in container.list_blobs(name_starts_with=country_prefix(iso_code))]
+    return delete_blobs(container, names)
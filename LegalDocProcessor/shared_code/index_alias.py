@@ -0,0 +1,204 @@
+"""Blue/green search indexes behind a pointer record.
+
+Rebuilding ``knife-index`` in place (wipe, then re-ingest) leaves countries
+missing from ``/api/ask`` until their document is back. Instead,
+``scripts/rebuild_index.py`` creates a versioned index (``knife-index-v2``,
+``-v3``, ... from ``index.json``), fills it in the background, validates it
+and then points readers and writers at it by rewriting one record. The
+previous index stays in place for a rollback.
+
+The record is ``index/alias.json`` in ``KNIFE_INDEX_ALIAS_CONTAINER``
+(default: ``KNIFE_SNAPSHOT_CONTAINER``; never ``legaldocsrag``)::
+
+    {"active": "knife-index-v3", "previous": "knife-index-v2", "building": null,
+     "switched_at": "...", "history": [{"active": "knife-index-v2", "switched_at": "..."}, ...]}
+
+It is written with an ETag condition, so two switches cannot interleave.
+``resolve()`` gives every function its index name:
+
+- ``INDEX_TARGET``, when set, pins the name (the rebuild sets it while it
+  populates a candidate index);
+- otherwise the record's ``active`` index, re-read at most every
+  ``INDEX_ALIAS_REFRESH_S`` seconds (default 30);
+- otherwise, without a record or container, ``KNIFE_SEARCH_INDEX``.
+
+The SWA API follows the same record through ``Legal/api/shared_code/index_alias.py``.
+"""
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import requests
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient
+
+from . import index_schema
+
+POINTER_BLOB = "index/alias.json"
+HISTORY = 20
+
+_SERVICE: Optional[BlobServiceClient] = None
+_CACHE: Dict[str, Any] = {"name": None, "at": 0.0}
+_LOCK = threading.Lock()
+
+
+class AliasConflict(RuntimeError):
+    """Raised when the record changed between reading and rewriting it."""
+
+
+def container_name() -> Optional[str]:
+    name = os.environ.get("KNIFE_INDEX_ALIAS_CONTAINER") or os.environ.get("KNIFE_SNAPSHOT_CONTAINER")
+    return name if name and name != "legaldocsrag" else None
+
+
+def container_client():
+    global _SERVICE
+    name = container_name()
+    connection_string = os.environ.get("KNIFE_STORAGE_CONNECTION_STRING")
+    if name is None or not connection_string:
+        return None
+    if _SERVICE is None:
+        _SERVICE = BlobServiceClient.from_connection_string(connection_string)
+    return _SERVICE.get_container_client(name)
+
+
+def read() -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """The record and its ETag, or (None, None) when there is none."""
+    container = container_client()
+    if container is None:
+        return None, None
+    try:
+        downloader = container.get_blob_client(POINTER_BLOB).download_blob()
+    except ResourceNotFoundError:
+        return None, None
+    return json.loads(downloader.readall()), downloader.properties.etag
+
+
+def write(record: Dict[str, Any], etag: Optional[str]) -> None:
+    """Replaces the record read with ``etag`` (None: creates it); AliasConflict if it changed since."""
+    container = container_client()
+    if container is None:
+        raise RuntimeError("The index alias needs KNIFE_INDEX_ALIAS_CONTAINER (or KNIFE_SNAPSHOT_CONTAINER) "
+                           "and KNIFE_STORAGE_CONNECTION_STRING")
+    try:
+        container.create_container()
+    except ResourceExistsError:
+        pass
+    client = container.get_blob_client(POINTER_BLOB)
+    try:
+        if etag:
+            client.upload_blob(json.dumps(record, indent=2), overwrite=True, etag=etag,
+                               match_condition=MatchConditions.IfNotModified)
+        else:
+            client.upload_blob(json.dumps(record, indent=2), overwrite=False)
+    except (ResourceModifiedError, ResourceExistsError):
+        raise AliasConflict("The index alias record changed meanwhile; read it again and retry")
+    invalidate()
+
+
+def invalidate() -> None:
+    with _LOCK:
+        _CACHE.update(name=None, at=0.0)
+
+
+def active() -> str:
+    """The record's active index (``KNIFE_SEARCH_INDEX`` without a record), cached for ``INDEX_ALIAS_REFRESH_S``."""
+    default = os.environ.get("KNIFE_SEARCH_INDEX")
+    refresh_s = float(os.environ.get("INDEX_ALIAS_REFRESH_S", "30"))
+    with _LOCK:
+        if _CACHE["name"] and time.monotonic() - _CACHE["at"] < refresh_s:
+            return _CACHE["name"]
+        try:
+            record, _ = read()
+            name = (record or {}).get("active") or default
+        except Exception as e:
+            # Keep serving the last known index; the record is re-read on the next refresh
+            logging.warning(f"Could not read the index alias record: {e}")
+            name = _CACHE["name"] or default
+        _CACHE.update(name=name, at=time.monotonic())
+        return name
+
+
+def resolve() -> str:
+    """The index a function reads and writes: ``INDEX_TARGET`` when set, else the active one."""
+    return os.environ.get("INDEX_TARGET") or active()
+
+
+def is_live(index_name: str) -> bool:
+    """Whether ``index_name`` is the index readers use (false for a rebuild candidate)."""
+    return active() == index_name
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def switch(index_name: str) -> Dict[str, Any]:
+    """Makes ``index_name`` the active index; the current one becomes the rollback target."""
+    record, etag = read()
+    current = (record or {}).get("active") or os.environ.get("KNIFE_SEARCH_INDEX")
+    if current == index_name:
+        raise ValueError(f"{index_name} is already the active index")
+    history = ((record or {}).get("history") or []) + [{"active": index_name, "switched_at": now()}]
+    updated = dict(record or {}, active=index_name, previous=current, building=None, switched_at=now(),
+                   history=history[-HISTORY:])
+    write(updated, etag)
+    return updated
+
+
+def rollback() -> Dict[str, Any]:
+    """Switches back to the previous index."""
+    record, _ = read()
+    previous = (record or {}).get("previous")
+    if not previous:
+        raise ValueError("No previous index to roll back to")
+    return switch(previous)
+
+
+def set_building(index_name: Optional[str]) -> Dict[str, Any]:
+    """Records (or clears) the candidate index a rebuild is populating."""
+    record, etag = read()
+    updated = dict(record or {"active": os.environ.get("KNIFE_SEARCH_INDEX"), "history": []}, building=index_name)
+    write(updated, etag)
+    return updated
+
+
+def versioned_name(base: str, existing: List[str]) -> str:
+    """The next ``<base>-vN`` after the versions in ``existing``; ``base`` itself counts as v1."""
+    base = re.sub(r"-v\d+$", "", base)
+    versions = [1]
+    for name in existing:
+        match = re.fullmatch(re.escape(base) + r"-v(\d+)", name)
+        if match:
+            versions.append(int(match.group(1)))
+    return f"{base}-v{max(versions) + 1}"
+
+
+def list_indexes(endpoint: str, key: str) -> List[str]:
+    resp = requests.get(f"{endpoint.rstrip('/')}/indexes?api-version={index_schema.API_VERSION}&$select=name",
+                        headers={"api-key": key}, timeout=15)
+    resp.raise_for_status()
+    return sorted(index["name"] for index in resp.json().get("value", []))
+
+
+def create_index(endpoint: str, key: str, index_name: str, definition: Optional[Dict[str, Any]] = None) -> None:
+    """Creates ``index_name`` from ``definition`` (default ``index.json``); fails if it already exists."""
+    definition = dict(definition or index_schema.expected_schema(), name=index_name)
+    resp = requests.put(
+        index_schema.index_url(endpoint, index_name),
+        headers={"api-key": key, "Content-Type": "application/json", "If-None-Match": "*"},
+        json=definition, timeout=30,
+    )
+    resp.raise_for_status()
+
+
+def delete_index(endpoint: str, key: str, index_name: str) -> None:
+    resp = requests.delete(index_schema.index_url(endpoint, index_name), headers={"api-key": key}, timeout=30)
+    if resp.status_code != 404:
+        resp.raise_for_status()
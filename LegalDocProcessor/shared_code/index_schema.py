@@ -0,0 +1,127 @@
+"""Checks the live search index against ``LegalDocProcessor/index.json`` before ingestion writes to it.
+
+Azure Cognitive Search rejects a whole upload batch when a document carries a
+field the index does not declare, and filters or facets on a field only work
+when the field was created with those attributes. ``validate()`` runs once per
+process and index:
+
+- required fields (``id``, ``iso_code``, ``chunk``, ``embedding``) must exist,
+  and the vector dimensions must match, otherwise ``SchemaError`` is raised;
+- optional fields missing from the live index are added when
+  ``INDEX_SCHEMA_AUTO_UPDATE`` is true (adding fields is non-destructive),
+  otherwise they are stripped from uploaded documents with a warning;
+- attribute differences (e.g. ``chunk_type`` not filterable) are logged, since
+  changing them needs an index rebuild.
+"""
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Set
+
+import requests
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "index.json")
+API_VERSION = "2023-11-01"
+REQUIRED_FIELDS = ("id", "iso_code", "chunk", "embedding")
+CHECKED_ATTRIBUTES = ("type", "key", "searchable", "filterable", "sortable", "facetable", "retrievable")
+
+_VALIDATED: Dict[str, Set[str]] = {}
+_LOCK = threading.Lock()
+
+
+class SchemaError(RuntimeError):
+    """Raised when the live index cannot hold the documents ingestion writes."""
+
+
+def expected_schema() -> Dict[str, Any]:
+    with open(SCHEMA_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def index_url(endpoint: str, index_name: str) -> str:
+    return f"{endpoint.rstrip('/')}/indexes/{index_name}?api-version={API_VERSION}"
+
+
+def fetch_index(endpoint: str, key: str, index_name: str) -> Dict[str, Any]:
+    resp = requests.get(index_url(endpoint, index_name), headers={"api-key": key}, timeout=15)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def compare(expected: Dict[str, Any], live: Dict[str, Any]):
+    """Returns (fields missing from the live index, attribute mismatch descriptions)."""
+    live_fields = {f["name"]: f for f in live.get("fields", [])}
+    missing, mismatches = [], []
+    for field in expected.get("fields", []):
+        current = live_fields.get(field["name"])
+        if current is None:
+            missing.append(field)
+            continue
+        for attr in CHECKED_ATTRIBUTES:
+            if attr not in field:
+                continue
+            want, have = field[attr], current.get(attr)
+            differs = want != have if attr == "type" else bool(want) != bool(have)
+            if differs:
+                mismatches.append(f"{field['name']}.{attr}: index.json {want!r}, live {have!r}")
+        if field.get("dimensions") and field.get("dimensions") != current.get("dimensions"):
+            mismatches.append(f"{field['name']}.dimensions: index.json {field['dimensions']}, live {current.get('dimensions')}")
+    return missing, mismatches
+
+
+def add_fields(endpoint: str, key: str, index_name: str, live: Dict[str, Any], fields: List[Dict[str, Any]]) -> None:
+    """Adds fields to the live index definition (an in-place, non-destructive update)."""
+    definition = {k: v for k, v in live.items() if not k.startswith("@odata")}
+    definition["fields"] = list(definition.get("fields", [])) + fields
+    headers = {"api-key": key, "Content-Type": "application/json"}
+    if live.get("@odata.etag"):
+        headers["If-Match"] = live["@odata.etag"]
+    resp = requests.put(index_url(endpoint, index_name), headers=headers, json=definition, timeout=30)
+    resp.raise_for_status()
+
+
+def validate(endpoint: str, key: str, index_name: str) -> Set[str]:
+    """Checks the live index once per process; returns the field names documents may carry."""
+    with _LOCK:
+        if index_name in _VALIDATED:
+            return _VALIDATED[index_name]
+        expected = expected_schema()
+        live = fetch_index(endpoint, key, index_name)
+        missing, mismatches = compare(expected, live)
+
+        missing_required = [f["name"] for f in missing if f["name"] in REQUIRED_FIELDS]
+        if missing_required:
+            raise SchemaError(f"Index '{index_name}' lacks required fields: {', '.join(missing_required)}")
+        dims_mismatch = [m for m in mismatches if m.startswith("embedding.dimensions")]
+        if dims_mismatch:
+            raise SchemaError(f"Index '{index_name}' vector size differs from index.json: {dims_mismatch[0]}")
+        for mismatch in mismatches:
+            logging.warning(f"Index '{index_name}' schema drift (needs a rebuild to change): {mismatch}")
+
+        writable = {f["name"] for f in live.get("fields", [])}
+        if missing:
+            names = ", ".join(f["name"] for f in missing)
+            if os.environ.get("INDEX_SCHEMA_AUTO_UPDATE", "false").lower() in ("1", "true", "yes"):
+                add_fields(endpoint, key, index_name, live, missing)
+                writable.update(f["name"] for f in missing)
+                logging.info(f"Added fields to index '{index_name}': {names}")
+            else:
+                logging.warning(
+                    f"Index '{index_name}' lacks fields {names}; they are left out of uploads. "
+                    f"Set INDEX_SCHEMA_AUTO_UPDATE=true to add them."
+                )
+        _VALIDATED[index_name] = writable
+        return writable
+
+
+def expected_dimensions(field_name: str = "embedding") -> int:
+    for field in expected_schema().get("fields", []):
+        if field["name"] == field_name:
+            return int(field.get("dimensions", 0))
+    raise KeyError(field_name)
+
+
+def restrict_fields(document: Dict[str, Any], writable: Set[str]) -> Dict[str, Any]:
+    """Drops the keys the live index does not declare."""
+    return {k: v for k, v in document.items() if k in writable}
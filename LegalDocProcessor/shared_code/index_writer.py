@@ -0,0 +1,255 @@
+"""Batched, concurrent and retry-aware writes to the search index.
+
+Azure Cognitive Search accepts at most 1000 documents and 16 MB of JSON per
+indexing request, and reports success per document: a request can "succeed"
+while some keys were throttled (503), hit a version conflict (409) or a
+transient indexing error (422). ``IndexWriter`` takes care of that:
+
+- documents are buffered and cut into batches by count and by serialized
+  size, so a country with thousands of 3072-dim vectors never exceeds the
+  request limits;
+- batches are sent on a small thread pool; ``add()`` blocks while all
+  workers are busy, so a fast producer cannot pile up batches in memory;
+- a request that fails as a whole is retried through
+  ``resilience.call_with_retries`` (a 413 is split in half instead), and
+  only the keys that failed with a retryable status are sent again, with
+  exponential backoff;
+- throughput (docs/s, MB/s), batch, retry and failure counts are kept in
+  ``stats()``;
+- leaving the ``with`` block on an exception aborts: buffered documents and
+  batches not yet sent are dropped instead of flushed, so a failed producer
+  does not finish writing half of its documents.
+
+Settings:
+
+- ``INDEX_BATCH_MAX_DOCS``: documents per request (default 1000, the service limit).
+- ``INDEX_BATCH_MAX_MB``: serialized MB per request (default 12, under the 16 MB limit).
+- ``INDEX_UPLOAD_WORKERS``: concurrent requests (default 4).
+- ``INDEX_UPLOAD_ATTEMPTS``: sends of a failed key before it is given up (default 4).
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from . import index_schema, resilience, telemetry
+
+# Per-document statuses worth sending again: conflict, transient indexing error, throttled
+RETRYABLE_KEY_STATUS = {409, 422, 429, 503}
+
+
+def _json_default(value):
+    # numpy arrays and scalars (vectors read back from a memmap)
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def document_size(document: Dict[str, Any]) -> int:
+    """Serialized size of a document in bytes, as it goes over the wire."""
+    return len(json.dumps(document, separators=(",", ":"), default=_json_default).encode("utf-8"))
+
+
+class IndexWriter:
+    """Writes documents to an index in size-bounded batches on a bounded pool.
+
+    ``action`` is ``upload`` (default), ``merge``, ``merge_or_upload`` or ``delete``.
+    Use as a context manager, or call ``close()`` (``abort()`` to drop what is
+    not sent yet); keys that could not be written are in ``failed`` (key -> last
+    error) afterwards.
+    """
+
+    def __init__(
+        self,
+        search_client,
+        writable_fields: Optional[Set[str]] = None,
+        action: str = "upload",
+        max_docs: int = 0,
+        max_bytes: int = 0,
+        workers: int = 0,
+        attempts: int = 0,
+        on_batch: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ):
+        self.search_client = search_client
+        self.writable_fields = writable_fields
+        self.action = action
+        self.max_docs = max(1, max_docs or int(os.environ.get("INDEX_BATCH_MAX_DOCS", "1000")))
+        self.max_bytes = max_bytes or int(float(os.environ.get("INDEX_BATCH_MAX_MB", "12")) * 1024 * 1024)
+        workers = max(1, workers or int(os.environ.get("INDEX_UPLOAD_WORKERS", "4")))
+        self.attempts = max(1, attempts or int(os.environ.get("INDEX_UPLOAD_ATTEMPTS", "4")))
+        self.on_batch = on_batch
+        self.failed: Dict[str, str] = {}
+        self._buffer: List[Dict[str, Any]] = []
+        self._buffer_bytes = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(workers)
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"index-{action}")
+        self._pending: List[Future] = []
+        self._aborted = False
+        self._counts = {"documents": 0, "succeeded": 0, "bytes": 0, "batches": 0, "retried_keys": 0, "split_batches": 0}
+        self._started = time.monotonic()
+        self._finished: Optional[float] = None
+
+    def __enter__(self) -> "IndexWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _send_method(self):
+        # upload_documents, merge_or_upload_documents or delete_documents
+        return getattr(self.search_client, f"{self.action}_documents")
+
+    def add(self, documents: Iterable[Dict[str, Any]]) -> None:
+        """Buffers documents and sends every batch that is full."""
+        for document in documents:
+            if self.writable_fields is not None and self.action != "delete":
+                document = index_schema.restrict_fields(document, self.writable_fields)
+            size = document_size(document)
+            if self._buffer and (len(self._buffer) >= self.max_docs or self._buffer_bytes + size > self.max_bytes):
+                self._submit()
+            self._buffer.append(document)
+            self._buffer_bytes += size
+
+    def flush(self) -> None:
+        """Sends the buffered documents and waits for every batch in flight."""
+        if self._buffer:
+            self._submit()
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self) -> Dict[str, str]:
+        """Flushes, shuts the pool down and returns the keys that failed."""
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+            if self._finished is None:
+                self._finished = time.monotonic()
+        if self.failed:
+            logging.error(f"Index {self.action} failed for {len(self.failed)} keys: {dict(list(self.failed.items())[:10])}")
+        return self.failed
+
+    def abort(self) -> None:
+        """Drops the buffered documents and the batches not started yet; batches in flight finish."""
+        self._aborted = True
+        dropped = len(self._buffer)
+        self._buffer, self._buffer_bytes = [], 0
+        pending, self._pending = self._pending, []
+        cancelled = sum(future.cancel() for future in pending)
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        if self._finished is None:
+            self._finished = time.monotonic()
+        logging.warning(f"Index {self.action} aborted: {dropped} buffered documents and {cancelled} batches dropped")
+
+    def _submit(self) -> None:
+        batch, size = self._buffer, self._buffer_bytes
+        self._buffer, self._buffer_bytes = [], 0
+        # Blocks while every worker is busy: backpressure on the producer
+        self._slots.acquire()
+        try:
+            self._pending.append(self._pool.submit(contextvars.copy_context().run, self._run_batch, batch, size))
+        except Exception:
+            self._slots.release()
+            raise
+        # Drop finished futures so a long run does not keep them all
+        self._pending = [f for f in self._pending if not f.done() or f.exception() is not None]
+
+    def _run_batch(self, batch: List[Dict[str, Any]], size: int) -> None:
+        try:
+            with telemetry.span(f"index_{self.action}", documents=len(batch), bytes=size) as span:
+                started = time.monotonic()
+                failed = self._write(batch)
+                span.set(failed=len(failed))
+            with self._lock:
+                self._counts["batches"] += 1
+                self._counts["documents"] += len(batch)
+                self._counts["succeeded"] += len(batch) - len(failed)
+                self._counts["bytes"] += size
+                self.failed.update(failed)
+            if self.on_batch is not None:
+                self.on_batch({"documents": len(batch), "failed": len(failed), "bytes": size,
+                               "seconds": round(time.monotonic() - started, 3)})
+        finally:
+            self._slots.release()
+
+    def _write(self, batch: List[Dict[str, Any]]) -> Dict[str, str]:
+        """Writes one batch, resending retryable keys; returns the keys that still failed."""
+        key_field = "id"
+        pending = batch
+        failed: Dict[str, str] = {}
+        delay = 1.0
+        for attempt in range(1, self.attempts + 1):
+            try:
+                results = self._send(pending)
+            except _TooLarge:
+                if len(pending) == 1:
+                    return {pending[0][key_field]: "document exceeds the request size limit"}
+                half = len(pending) // 2
+                with self._lock:
+                    self._counts["split_batches"] += 1
+                resent = {doc[key_field] for doc in pending}
+                failed = {key: error for key, error in failed.items() if key not in resent}
+                return {**failed, **self._write(pending[:half]), **self._write(pending[half:])}
+            except Exception as e:
+                # Retries of the whole request are exhausted: every key of it failed
+                return {**failed, **{doc[key_field]: str(e) for doc in pending}}
+            retry = []
+            by_key = {doc[key_field]: doc for doc in pending}
+            for result in results:
+                if result.succeeded:
+                    failed.pop(result.key, None)
+                    continue
+                failed[result.key] = f"{result.status_code}: {result.error_message}"
+                if result.status_code in RETRYABLE_KEY_STATUS and result.key in by_key:
+                    retry.append(by_key[result.key])
+            if not retry or attempt == self.attempts or self._aborted:
+                return failed
+            with self._lock:
+                self._counts["retried_keys"] += len(retry)
+            resilience.incr("index.retried_keys", len(retry))
+            logging.warning(f"Index {self.action}: retrying {len(retry)} keys (attempt {attempt + 1}/{self.attempts})")
+            time.sleep(delay / 2 + random.random() * delay / 2)
+            delay = min(delay * 2, 20.0)
+            pending = retry
+        return failed
+
+    def _send(self, documents: List[Dict[str, Any]]):
+        send = self._send_method()
+
+        def attempt():
+            try:
+                return send(documents=documents)
+            except Exception as e:
+                status, _ = resilience.status_and_headers(e)
+                if status == 413:
+                    raise _TooLarge() from e
+                raise
+
+        return resilience.call_with_retries(attempt, attempts=3, initial_delay=1.0, max_delay=20.0)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counts and throughput so far (or of the whole run once closed)."""
+        with self._lock:
+            counts = dict(self._counts)
+        elapsed = max(1e-6, (self._finished or time.monotonic()) - self._started)
+        counts.update(
+            failed=len(self.failed),
+            seconds=round(elapsed, 3),
+            docs_per_s=round(counts["documents"] / elapsed, 1),
+            mb_per_s=round(counts["bytes"] / elapsed / (1024 * 1024), 2),
+        )
+        return counts
+
+
+class _TooLarge(Exception):
+    """The service rejected a request as too large (413)."""
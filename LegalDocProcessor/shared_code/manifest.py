@@ -0,0 +1,272 @@
+"""Ingestion manifest: what each country document produced in the index.
+
+One entry per ISO code records the source blob (name, ETag, content hash,
+size), the chunk ids and their text hashes, chunk, parent and image counts,
+the embedding deployment and dimensions, per-stage durations and the time of
+the last ingestion. ``process_document`` writes the entry once the index holds
+the new chunks; ``delete_document`` and ``cleanup_index`` remove entries once
+their purge completed. Readers get a country's entry, or the catalog of all
+summaries (entries without chunk hashes), without querying the index.
+``unchanged()`` tells ``process_document`` that an upload repeats the content
+and pipeline settings of the recorded ingestion, so it can stop early.
+
+Backends, selected by ``MANIFEST_STORE``:
+
+- ``blob``: ``manifest/<ISO>.json`` per country plus ``manifest/catalog.json``
+  in ``KNIFE_MANIFEST_CONTAINER`` (default: ``KNIFE_SNAPSHOT_CONTAINER``;
+  never ``legaldocsrag``, whose blob trigger starts ingestion). The catalog
+  is updated with an ETag condition, so concurrent writers for different
+  countries do not drop each other's rows.
+- ``sqlite:<path>``: one database; a country's entry and chunk rows are
+  replaced in a single transaction.
+- ``memory``: a process-local stand-in for development and tests.
+
+Unset (the default) disables the manifest.
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+PREFIX = "manifest/"
+CATALOG_BLOB = f"{PREFIX}catalog.json"
+HASH_CHARS = 16
+COPY_BUFSIZE = 1024 * 1024
+
+
+def now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:HASH_CHARS]
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file, read in fixed-size pieces."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for piece in iter(lambda: f.read(COPY_BUFSIZE), b""):
+            digest.update(piece)
+    return digest.hexdigest()
+
+
+def normalize_md5(value) -> Optional[str]:
+    """Content-MD5 as base64 text, whether it arrives as bytes, a bytearray or a string."""
+    if not value:
+        return None
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(bytes(value)).decode("ascii")
+    return str(value)
+
+
+def unchanged(entry: Optional[Dict[str, Any]], pipeline: str, sha256: Optional[str] = None,
+              content_md5: Optional[str] = None) -> bool:
+    """Whether an ingestion recorded in ``entry`` already covers this content and pipeline.
+
+    Entries with failed uploads never match, so those documents are retried.
+    """
+    if not entry or entry.get("pipeline") != pipeline or entry.get("failed_uploads"):
+        return False
+    source = entry.get("source") or {}
+    if sha256 and source.get("sha256") == sha256:
+        return True
+    return bool(content_md5) and source.get("content_md5") == content_md5
+
+
+def summary(entry: Dict[str, Any]) -> Dict[str, Any]:
+    """An entry without its per-chunk hashes, as kept in the catalog."""
+    return {k: v for k, v in entry.items() if k != "chunk_hashes"}
+
+
+class ManifestStore:
+    """Per-ISO manifest entries; ``entry['iso_code']`` is the key."""
+
+    def get(self, iso_code: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def put(self, entry: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def remove(self, iso_code: str) -> None:
+        raise NotImplementedError
+
+    def catalog(self) -> Dict[str, Dict[str, Any]]:
+        """Summaries of all entries by ISO code."""
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        for iso_code in list(self.catalog()):
+            self.remove(iso_code)
+
+
+class MemoryManifestStore(ManifestStore):
+    def __init__(self):
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, iso_code):
+        with self._lock:
+            entry = self._entries.get(iso_code)
+            return json.loads(json.dumps(entry)) if entry is not None else None
+
+    def put(self, entry):
+        with self._lock:
+            self._entries[entry["iso_code"]] = json.loads(json.dumps(entry))
+
+    def remove(self, iso_code):
+        with self._lock:
+            self._entries.pop(iso_code, None)
+
+    def catalog(self):
+        with self._lock:
+            return {iso: summary(entry) for iso, entry in self._entries.items()}
+
+
+class SqliteManifestStore(ManifestStore):
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS documents (iso_code TEXT PRIMARY KEY, summary TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunks (iso_code TEXT NOT NULL, id TEXT NOT NULL, hash TEXT NOT NULL, "
+                "PRIMARY KEY (iso_code, id))"
+            )
+
+    def get(self, iso_code):
+        with self._lock:
+            row = self._conn.execute("SELECT summary FROM documents WHERE iso_code = ?", (iso_code,)).fetchone()
+            if row is None:
+                return None
+            entry = json.loads(row[0])
+            entry["chunk_hashes"] = dict(self._conn.execute(
+                "SELECT id, hash FROM chunks WHERE iso_code = ? ORDER BY rowid", (iso_code,)
+            ).fetchall())
+            return entry
+
+    def put(self, entry):
+        iso_code = entry["iso_code"]
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks WHERE iso_code = ?", (iso_code,))
+            self._conn.executemany(
+                "INSERT INTO chunks (iso_code, id, hash) VALUES (?, ?, ?)",
+                ((iso_code, chunk_id, value) for chunk_id, value in entry.get("chunk_hashes", {}).items()),
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO documents (iso_code, summary) VALUES (?, ?)",
+                (iso_code, json.dumps(summary(entry))),
+            )
+
+    def remove(self, iso_code):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks WHERE iso_code = ?", (iso_code,))
+            self._conn.execute("DELETE FROM documents WHERE iso_code = ?", (iso_code,))
+
+    def catalog(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT iso_code, summary FROM documents ORDER BY iso_code").fetchall()
+        return {iso: json.loads(value) for iso, value in rows}
+
+
+class BlobManifestStore(ManifestStore):
+    def __init__(self, container_client, attempts: int = 5):
+        self.container = container_client
+        self.attempts = attempts
+        try:
+            self.container.create_container()
+        except ResourceExistsError:
+            pass
+
+    @staticmethod
+    def entry_blob(iso_code: str) -> str:
+        return f"{PREFIX}{iso_code}.json"
+
+    def _read(self, name: str):
+        try:
+            downloader = self.container.get_blob_client(name).download_blob()
+        except ResourceNotFoundError:
+            return None, None
+        return json.loads(downloader.readall()), downloader.properties.etag
+
+    def _update_catalog(self, change) -> None:
+        """Applies ``change(catalog)`` to the catalog blob with an ETag condition."""
+        client = self.container.get_blob_client(CATALOG_BLOB)
+        for _ in range(self.attempts):
+            catalog, etag = self._read(CATALOG_BLOB)
+            catalog = catalog or {}
+            change(catalog)
+            try:
+                if etag:
+                    client.upload_blob(
+                        json.dumps(catalog), overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified
+                    )
+                else:
+                    client.upload_blob(json.dumps(catalog), overwrite=False)
+                return
+            except (ResourceModifiedError, ResourceExistsError):
+                continue
+        raise RuntimeError(f"Manifest catalog kept changing; gave up after {self.attempts} attempts")
+
+    def get(self, iso_code):
+        entry, _ = self._read(self.entry_blob(iso_code))
+        return entry
+
+    def put(self, entry):
+        iso_code = entry["iso_code"]
+        self.container.upload_blob(self.entry_blob(iso_code), json.dumps(entry), overwrite=True)
+        self._update_catalog(lambda catalog: catalog.__setitem__(iso_code, summary(entry)))
+
+    def remove(self, iso_code):
+        try:
+            self.container.delete_blob(self.entry_blob(iso_code))
+        except ResourceNotFoundError:
+            pass
+        self._update_catalog(lambda catalog: catalog.pop(iso_code, None))
+
+    def catalog(self):
+        catalog, _ = self._read(CATALOG_BLOB)
+        return catalog or {}
+
+
+_MEMORY_STORE: Optional[MemoryManifestStore] = None
+_SQLITE_STORES: Dict[str, SqliteManifestStore] = {}
+_BLOB_STORES: Dict[str, BlobManifestStore] = {}
+
+
+def from_env(blob_service_client=None) -> Optional[ManifestStore]:
+    """The configured store, or None when the manifest is disabled or cannot be opened."""
+    global _MEMORY_STORE
+    setting = os.environ.get("MANIFEST_STORE", "").strip()
+    if not setting or setting == "off":
+        return None
+    if setting == "memory":
+        if _MEMORY_STORE is None:
+            _MEMORY_STORE = MemoryManifestStore()
+        return _MEMORY_STORE
+    if setting.startswith("sqlite:"):
+        path = setting[len("sqlite:"):]
+        if path not in _SQLITE_STORES:
+            _SQLITE_STORES[path] = SqliteManifestStore(path)
+        return _SQLITE_STORES[path]
+    if setting == "blob":
+        container = os.environ.get("KNIFE_MANIFEST_CONTAINER") or os.environ.get("KNIFE_SNAPSHOT_CONTAINER")
+        if not container or container == "legaldocsrag" or blob_service_client is None:
+            logging.warning("MANIFEST_STORE=blob needs KNIFE_MANIFEST_CONTAINER (not legaldocsrag) and a storage connection")
+            return None
+        if container not in _BLOB_STORES:
+            _BLOB_STORES[container] = BlobManifestStore(blob_service_client.get_container_client(container))
+        return _BLOB_STORES[container]
+    logging.warning(f"Unknown MANIFEST_STORE '{setting}'; manifest disabled")
+    return None
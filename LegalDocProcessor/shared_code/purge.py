@@ -0,0 +1,149 @@
+"""Bulk removal of documents from the search index.
+
+``cleanup_index`` and ``delete_document`` used to read every id of the scope
+into one list and send a single ``delete_documents`` request. ``purge()``
+instead:
+
+- pages through ids in key order (``id gt '<last>'``, ordered by ``id``), so
+  each page is one cheap query and no id list grows with the index;
+- hands each page to an ``IndexWriter`` in delete mode, which sends
+  size-bounded batches concurrently and resends failed keys;
+- checks the scope's count afterwards, waiting for deletions to become
+  visible, and reports what is left;
+- stops at ``max_seconds`` and returns the last deleted key, so a caller
+  (e.g. an HTTP request under the Functions timeout) can resume from there.
+  Starting over is always safe too: deleted ids simply are not found again.
+
+Key-ordered paging needs ``id`` to be filterable and sortable (see
+``index.json``). On an index created without those attributes the engine
+falls back to draining: it re-queries the first page of the scope until it
+is empty, skipping ids it already deleted while the index catches up.
+"""
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from . import index_writer, resilience, telemetry
+
+KEY_FIELD = "id"
+
+
+def _quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _and(*clauses: Optional[str]) -> Optional[str]:
+    parts = [f"({c})" for c in clauses if c]
+    return " and ".join(parts) or None
+
+
+def count(search_client, filter_expr: Optional[str]) -> int:
+    """Number of documents matching a filter (``None`` counts the whole index)."""
+    results = search_client.search(search_text="*", filter=filter_expr, include_total_count=True, top=0)
+    return results.get_count() or 0
+
+
+def _page_ids(search_client, filter_expr: Optional[str], after: Optional[str], page_size: int, ordered: bool) -> List[str]:
+    if ordered:
+        results = search_client.search(
+            search_text="*",
+            filter=_and(filter_expr, f"{KEY_FIELD} gt {_quote(after)}" if after else None),
+            order_by=[f"{KEY_FIELD} asc"],
+            select=[KEY_FIELD],
+            top=page_size,
+        )
+    else:
+        results = search_client.search(search_text="*", filter=filter_expr, select=[KEY_FIELD], top=page_size)
+    return [doc[KEY_FIELD] for doc in results]
+
+
+def purge(
+    search_client,
+    filter_expr: Optional[str] = None,
+    page_size: int = 1000,
+    resume_after: Optional[str] = None,
+    max_seconds: Optional[float] = None,
+    verify_wait_s: float = 10.0,
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Dict[str, Any]:
+    """Deletes every document matching ``filter_expr``; returns progress and throughput.
+
+    The result has ``deleted``, ``failed``, ``pages``, ``docs_per_s``,
+    ``remaining`` (count after deletion), ``complete`` and, when stopped by
+    ``max_seconds``, ``resume_after``.
+    """
+    started = time.monotonic()
+    deadline = started + max_seconds if max_seconds else None
+    ordered = True
+    after = resume_after
+    pages = 0
+    seen = set()
+    timed_out = False
+
+    with telemetry.span("purge", filter=filter_expr or "*") as span:
+        writer = index_writer.IndexWriter(search_client, action="delete")
+        try:
+            while True:
+                if deadline is not None and time.monotonic() > deadline:
+                    timed_out = True
+                    break
+                try:
+                    ids = _page_ids(search_client, filter_expr, after, page_size, ordered)
+                except Exception as e:
+                    # 400: the live index's key is not filterable/sortable
+                    if not ordered or resilience.status_and_headers(e)[0] != 400:
+                        raise
+                    logging.warning(f"Key-ordered paging unavailable ({e}); draining the scope instead")
+                    ordered = False
+                    continue
+                if not ordered:
+                    fresh = [doc_id for doc_id in ids if doc_id not in seen]
+                    if ids and not fresh:
+                        # Deleted ids stay visible until the index refreshes
+                        writer.flush()
+                        time.sleep(1.0)
+                        continue
+                    ids = fresh
+                if not ids:
+                    break
+                pages += 1
+                if not ordered:
+                    seen.update(ids)
+                writer.add({KEY_FIELD: doc_id} for doc_id in ids)
+                after = ids[-1]
+                if on_progress is not None:
+                    progress = writer.stats()
+                    progress.update(pages=pages, last_key=after)
+                    on_progress(progress)
+        finally:
+            writer.close()
+
+        stats = writer.stats()
+        remaining = None
+        if not timed_out:
+            # Deletions become visible to queries within a few seconds
+            wait_until = time.monotonic() + verify_wait_s
+            remaining = count(search_client, filter_expr)
+            while remaining and time.monotonic() < wait_until:
+                time.sleep(1.0)
+                remaining = count(search_client, filter_expr)
+
+        deleted = stats["succeeded"]
+        result = {
+            "deleted": deleted,
+            "failed": stats["failed"],
+            "pages": pages,
+            "batches": stats["batches"],
+            "mode": "key_ordered" if ordered else "drain",
+            "seconds": round(time.monotonic() - started, 3),
+            "docs_per_s": round(deleted / max(1e-6, time.monotonic() - started), 1),
+            "remaining": remaining,
+            "complete": not timed_out and not stats["failed"] and remaining == 0,
+        }
+        if timed_out:
+            result["resume_after"] = after
+        if stats["failed"]:
+            result["failed_keys"] = sorted(writer.failed)[:20]
+        span.set(**{k: v for k, v in result.items() if isinstance(v, (int, float, str, bool))})
+    logging.info(f"Purge of {filter_expr or 'all documents'}: {result}")
+    return result
@@ -0,0 +1,240 @@
+"""Client-side token-bucket rate limiting for Azure OpenAI TPM/RPM quotas.
+
+Each deployment gets a tokens-per-minute and a requests-per-minute bucket.
+Callers estimate the tokens a request will consume (prompt plus ``max_tokens``
+for chat, input text for embeddings) and acquire them before sending.
+
+Two priority classes share a deployment's quota: interactive ``/api/ask``
+traffic may drain the buckets completely, while background ingestion stops at
+a reserve floor and then proceeds only at the refill rate. Buckets are
+corrected from the ``x-ratelimit-remaining-*`` response headers, which reflect
+the deployment-wide quota; that is how ingestion in the processor app backs off
+when ``/api/ask`` (a different app) is consuming quota.
+
+Quotas are configured with ``OPENAI_RATE_LIMITS``, a JSON object such as
+``{"text-embedding-3-large": {"tpm": 350000, "rpm": 2100}}``. Deployments
+without a configured quota learn it from ``x-ratelimit-limit-*`` headers and
+are not throttled until then.
+
+This file is kept identical in ``Legal/api/shared_code`` and
+``LegalDocProcessor/shared_code``.
+"""
+import contextvars
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Mapping, Optional
+
+from . import resilience
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Rough cost of one image at high detail, and the default completion budget
+# assumed when a chat call does not set max_tokens.
+IMAGE_TOKENS = 765
+DEFAULT_COMPLETION_TOKENS = 1000
+
+
+class RateLimitTimeout(RuntimeError):
+    """Raised when quota does not become available within the caller's timeout."""
+
+
+# Cap on acquire() waits for the current context; StageRouter lowers it while another
+# deployment of the pool could take the call instead
+_WAIT_LIMIT: contextvars.ContextVar = contextvars.ContextVar("ratelimit_wait_limit", default=None)
+
+
+@contextmanager
+def wait_limit(seconds: Optional[float]):
+    """Caps the waits of acquire() calls without an explicit timeout inside the block (None: no cap)."""
+    token = _WAIT_LIMIT.set(seconds)
+    try:
+        yield
+    finally:
+        _WAIT_LIMIT.reset(token)
+
+
+# --- Token estimation ---
+
+def estimate_tokens(text: str) -> int:
+    """Approximates the token count of a text (about four characters per token)."""
+    if not text:
+        return 0
+    return int(math.ceil(len(text) / 4.0))
+
+
+def estimate_chat_tokens(messages: Iterable[dict], max_tokens: Optional[int] = None) -> int:
+    """Estimates the quota a chat completion consumes: prompt plus the completion budget."""
+    total = 0
+    for message in messages:
+        total += 4  # per-message framing
+        content = message.get("content")
+        if isinstance(content, str):
+            total += estimate_tokens(content)
+        elif isinstance(content, list):
+            for part in content:
+                if part.get("type") == "text":
+                    total += estimate_tokens(part.get("text", ""))
+                elif part.get("type") == "image_url":
+                    total += IMAGE_TOKENS
+    return total + (max_tokens if max_tokens is not None else DEFAULT_COMPLETION_TOKENS)
+
+
+def estimate_embedding_tokens(inputs) -> int:
+    """Estimates tokens for an embeddings request (a string or list of strings)."""
+    if isinstance(inputs, str):
+        return estimate_tokens(inputs)
+    return sum(estimate_tokens(text) for text in inputs)
+
+
+# --- Buckets ---
+
+class TokenBucket:
+    """A bucket holding up to ``capacity`` units and refilling at ``capacity`` per minute."""
+
+    def __init__(self, capacity: float):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, floor: float) -> float:
+        """Seconds until ``amount`` can be taken without dropping below ``floor``."""
+        # Requests larger than the whole bucket are allowed once it is full.
+        amount = min(amount, self.capacity - floor)
+        missing = amount + floor - self.level
+        return 0.0 if missing <= 0 else missing / self.rate
+
+    def take(self, amount: float) -> None:
+        self.level -= min(amount, self.capacity)
+
+
+class DeploymentLimiter:
+    """TPM and RPM buckets for one deployment, shared by both priority classes."""
+
+    def __init__(
+        self,
+        name: str,
+        tpm: Optional[float] = None,
+        rpm: Optional[float] = None,
+        background_reserve: float = 0.25,
+    ):
+        self.name = name
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.background_reserve = background_reserve
+        self._cond = threading.Condition()
+
+    def _floor(self, bucket: TokenBucket, priority: str) -> float:
+        return bucket.capacity * self.background_reserve if priority == BACKGROUND else 0.0
+
+    def acquire(self, tokens: int, priority: str = INTERACTIVE, timeout: Optional[float] = None) -> float:
+        """Blocks until the request fits the quota; returns the seconds spent waiting."""
+        if timeout is None:
+            timeout = 20.0 if priority == INTERACTIVE else 600.0
+            if _WAIT_LIMIT.get() is not None:
+                timeout = min(timeout, _WAIT_LIMIT.get())
+        start = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait_for = 0.0
+                for bucket, amount in ((self.tokens, tokens), (self.requests, 1)):
+                    if bucket is not None:
+                        bucket.refill(now)
+                        wait_for = max(wait_for, bucket.wait_time(amount, self._floor(bucket, priority)))
+                if wait_for <= 0:
+                    if self.tokens is not None:
+                        self.tokens.take(tokens)
+                    if self.requests is not None:
+                        self.requests.take(1)
+                    waited = now - start
+                    if waited > 0:
+                        resilience.incr(f"ratelimit.waits.{priority}")
+                        resilience.incr(f"ratelimit.wait_ms.{priority}", int(waited * 1000))
+                    return waited
+                if now - start + wait_for > timeout:
+                    resilience.incr(f"ratelimit.timeouts.{priority}")
+                    raise RateLimitTimeout(
+                        f"Quota for '{self.name}' not available within {timeout:.0f}s ({priority})"
+                    )
+                # Wake periodically: header updates or interactive traffic may change the picture.
+                self._cond.wait(min(wait_for, 1.0))
+
+    def observe(self, headers: Optional[Mapping[str, str]]) -> None:
+        """Corrects the buckets from x-ratelimit-* response headers."""
+        if not headers:
+            return
+        lowered = {str(k).lower(): v for k, v in headers.items()}
+        with self._cond:
+            now = time.monotonic()
+            for kind in ("tokens", "requests"):
+                bucket = getattr(self, kind)
+                limit = _to_float(lowered.get(f"x-ratelimit-limit-{kind}"))
+                if bucket is None and limit:
+                    bucket = TokenBucket(limit)
+                    setattr(self, kind, bucket)
+                    logging.info(f"Rate limiter for '{self.name}' learned {kind} quota {limit:.0f}/min")
+                remaining = _to_float(lowered.get(f"x-ratelimit-remaining-{kind}"))
+                if bucket is not None and remaining is not None:
+                    bucket.refill(now)
+                    # The server sees every client of this deployment; never assume more than it reports.
+                    bucket.level = min(bucket.level, remaining)
+            self._cond.notify_all()
+
+
+def _to_float(value) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+# --- Registry ---
+
+_LIMITERS: Dict[str, DeploymentLimiter] = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def _configured_limits() -> dict:
+    raw = os.environ.get("OPENAI_RATE_LIMITS", "").strip()
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError:
+        logging.error("OPENAI_RATE_LIMITS is not valid JSON; client-side rate limiting disabled")
+        return {}
+
+
+def get_limiter(name: str) -> DeploymentLimiter:
+    """Returns the process-wide limiter for a deployment.
+
+    ``name`` is a deployment name or a routing label (``deployment@resource``);
+    quotas are looked up by the full name first, then by the deployment name.
+    """
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(name)
+        if limiter is None:
+            configured = _configured_limits()
+            limits = configured.get(name) or configured.get(name.split("@")[0], {})
+            limiter = DeploymentLimiter(
+                name,
+                tpm=limits.get("tpm"),
+                rpm=limits.get("rpm"),
+                background_reserve=float(os.environ.get("OPENAI_BACKGROUND_RESERVE", "0.25")),
+            )
+            _LIMITERS[name] = limiter
+        return limiter
@@ -0,0 +1,274 @@
+"""Publishes index snapshots (see ``shared_code.snapshot``) to blob storage.
+
+Every ingestion or deletion that changes a country's documents publishes a
+new snapshot version: the previous snapshot's other countries are copied,
+the changed country's rows are replaced, the file is uploaded as
+``snapshots/<version>.snap`` and the ``latest.json`` pointer is swapped with
+an ETag condition. When another instance moved the pointer in the meantime,
+the merge is redone on top of its version, so concurrent ingestions of
+different countries do not drop each other's rows.
+
+Snapshots can trail the index, so ``index_state.json`` records per country the
+stamp of the last index write and whether it completed: ingestion calls
+``mark_indexing`` before it writes the live index and ``mark_indexed`` once
+the country's documents are in place, and the snapshot it then publishes
+carries the same stamp. ``/api/ask`` queries the index for countries whose
+stamps differ (see ``shared_code.snapshot``). Full publishes take the stamps
+from ``indexed_stamps`` before they read the index, so a country written
+meanwhile is not taken as current.
+
+Settings:
+
+- ``KNIFE_SNAPSHOT_CONTAINER``: container for snapshots; publishing is off when unset.
+  It must not be the ``legaldocsrag`` container, whose blob trigger starts ingestion.
+- ``SNAPSHOT_DTYPE``: ``float32`` (default) or ``float16`` (half the size, slightly slower queries).
+- ``SNAPSHOT_KEEP``: number of snapshot versions kept in the container (default 3).
+"""
+import json
+import logging
+import os
+import tempfile
+import uuid
+from datetime import datetime, timezone
+from itertools import chain
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, ContainerClient
+
+from . import snapshot
+
+
+def container_name() -> Optional[str]:
+    return os.environ.get("KNIFE_SNAPSHOT_CONTAINER") or None
+
+
+def _read_pointer(container: ContainerClient):
+    try:
+        downloader = container.get_blob_client(snapshot.POINTER_BLOB).download_blob()
+    except ResourceNotFoundError:
+        return None, None
+    return json.loads(downloader.readall()), downloader.properties.etag
+
+
+def _container(blob_service_client: BlobServiceClient) -> ContainerClient:
+    container = blob_service_client.get_container_client(container_name())
+    try:
+        container.create_container()
+    except ResourceExistsError:
+        pass
+    return container
+
+
+def _read_state(container: ContainerClient):
+    try:
+        downloader = container.get_blob_client(snapshot.STATE_BLOB).download_blob()
+    except ResourceNotFoundError:
+        return {"countries": {}}, None
+    return json.loads(downloader.readall()), downloader.properties.etag
+
+
+def _update_state(blob_service_client: BlobServiceClient, change: Callable[[Dict[str, Any]], bool],
+                  attempts: int = 10) -> bool:
+    """Applies ``change`` to the per-country state under an ETag condition; returns whether it changed anything."""
+    container = _container(blob_service_client)
+    state_client = container.get_blob_client(snapshot.STATE_BLOB)
+    for attempt in range(1, attempts + 1):
+        state, etag = _read_state(container)
+        if not change(state["countries"]):
+            return False
+        try:
+            if etag:
+                state_client.upload_blob(
+                    json.dumps(state), overwrite=True, etag=etag, match_condition=MatchConditions.IfNotModified,
+                )
+            else:
+                state_client.upload_blob(json.dumps(state), overwrite=False)
+            return True
+        except (ResourceModifiedError, ResourceExistsError):
+            logging.info(f"Index state changed while updating it (attempt {attempt}); retrying")
+    raise RuntimeError(f"Could not update the index state after {attempts} attempts")
+
+
+def _new_stamp(iso_code: str) -> str:
+    # Versions have millisecond resolution; two writes of a country must never share a stamp
+    return f"{snapshot.new_version(iso_code)}-{uuid.uuid4().hex[:8]}"
+
+
+def mark_indexing(blob_service_client: BlobServiceClient, iso_code: str) -> Optional[str]:
+    """Records that the country's index documents are being rewritten; returns the new stamp.
+
+    Raises when the state cannot be written, so the index is never changed unrecorded.
+    Returns None when publishing is not configured.
+    """
+    if not container_name():
+        return None
+    stamp = _new_stamp(iso_code)
+
+    def change(countries):
+        countries[iso_code] = {"stamp": stamp, "indexed": False, "at": datetime.now(timezone.utc).isoformat()}
+        return True
+    _update_state(blob_service_client, change)
+    return stamp
+
+
+def mark_all_indexing(blob_service_client: BlobServiceClient, iso_codes: Iterable[str]) -> None:
+    """``mark_indexing`` for a purge of the whole index: the given countries and every one with a state."""
+    if not container_name():
+        return
+    iso_codes = set(iso_codes)
+
+    def change(countries):
+        at = datetime.now(timezone.utc).isoformat()
+        for iso_code in iso_codes | set(countries):
+            countries[iso_code] = {"stamp": _new_stamp(iso_code), "indexed": False, "at": at}
+        return bool(countries)
+    _update_state(blob_service_client, change)
+
+
+def mark_indexed(blob_service_client: BlobServiceClient, iso_code: str, stamp: Optional[str]) -> bool:
+    """Records that the write ``stamp`` completed, unless a newer one started meanwhile."""
+    if not container_name() or stamp is None:
+        return False
+
+    def change(countries):
+        entry = countries.get(iso_code)
+        if entry is None or entry["stamp"] != stamp:
+            return False
+        entry.update(indexed=True, at=datetime.now(timezone.utc).isoformat())
+        return True
+    return _update_state(blob_service_client, change)
+
+
+def forget(blob_service_client: BlobServiceClient, iso_codes: Iterable[str], everything: bool = False) -> None:
+    """Drops the state of deleted countries (all of them with ``everything``)."""
+    if not container_name():
+        return
+    iso_codes = set(iso_codes)
+
+    def change(countries):
+        removed = set(countries) if everything else iso_codes & set(countries)
+        for iso_code in removed:
+            del countries[iso_code]
+        return bool(removed)
+    _update_state(blob_service_client, change)
+
+
+def indexed_stamps(blob_service_client: BlobServiceClient) -> Dict[str, str]:
+    """Stamps of the countries whose last index write completed; read it before reading the index."""
+    if not container_name():
+        return {}
+    state, _ = _read_state(blob_service_client.get_container_client(container_name()))
+    return {iso_code: entry["stamp"] for iso_code, entry in state["countries"].items() if entry.get("indexed")}
+
+
+def write_pending(blob_service_client: BlobServiceClient, iso_code: str) -> bool:
+    """Whether a write of the country's index documents started and never completed."""
+    if not container_name():
+        return False
+    state, _ = _read_state(blob_service_client.get_container_client(container_name()))
+    entry = state["countries"].get(iso_code)
+    return entry is not None and not entry.get("indexed")
+
+
+def _prune(container: ContainerClient, current_blob: str, keep: int) -> None:
+    names = sorted(
+        (b.name for b in container.list_blobs(name_starts_with="snapshots/")),
+        reverse=True,
+    )
+    for name in names[keep:]:
+        if name != current_blob:
+            try:
+                container.delete_blob(name)
+            except ResourceNotFoundError:
+                pass
+
+
+def update_snapshot(
+    blob_service_client: BlobServiceClient,
+    replace_codes: Iterable[str],
+    rows: List[Dict[str, Any]],
+    tag: str = "",
+    replace_all: bool = False,
+    attempts: int = 5,
+    parents: Iterable[Dict[str, Any]] = (),
+    stamps: Optional[Dict[str, str]] = None,
+) -> Optional[Dict[str, Any]]:
+    """Publishes a snapshot in which ``replace_codes`` hold exactly ``rows`` and ``parents``.
+
+    ``rows`` carry ``id``, ``iso_code``, ``chunk``, ``embedding`` and optional
+    ``chunk_type``/``table_id``/``figure_id``/``parent_id``/``section_path``;
+    ``parents`` are parent sections without a vector. Empty lists remove the countries. ``stamps`` are the index state
+    stamps of the new rows' countries; the others keep the previous snapshot's.
+    With ``replace_all`` the previous snapshot is ignored and ``rows`` and
+    ``parents`` may be iterators, read once. Returns the new header, or None
+    when publishing is not configured.
+    """
+    name = container_name()
+    if not name:
+        return None
+    replace_codes = set(replace_codes)
+    dtype = os.environ.get("SNAPSHOT_DTYPE", "float32")
+    container = _container(blob_service_client)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out_path = os.path.join(tmp, "snapshot.snap")
+        version = header = None
+        for attempt in range(1, attempts + 1):
+            pointer, etag = _read_pointer(container)
+            if header is None or not replace_all:
+                # A full replacement does not depend on the previous snapshot, so it is written once
+                version = snapshot.new_version(tag)
+                base_rows: Iterable[Dict[str, Any]] = ()
+                base_parents: Iterable[Dict[str, Any]] = ()
+                merged_stamps = dict(stamps or {})
+                if pointer and not replace_all:
+                    previous_path = os.path.join(tmp, f"previous-{attempt}.snap")
+                    with open(previous_path, "wb") as f:
+                        container.get_blob_client(pointer["blob"]).download_blob().readinto(f)
+                    previous = snapshot.Snapshot(previous_path)
+                    base_rows = previous.iter_rows(exclude=replace_codes)
+                    base_parents = previous.iter_parents(exclude=replace_codes)
+                    merged_stamps = dict(
+                        {iso: stamp for iso, stamp in previous.stamps.items() if iso not in replace_codes},
+                        **merged_stamps,
+                    )
+                header = snapshot.write_snapshot(
+                    out_path, chain(base_rows, rows), version, dtype=dtype, parents=chain(base_parents, parents),
+                    stamps=merged_stamps,
+                )
+                with open(out_path, "rb") as f:
+                    container.upload_blob(snapshot.snapshot_blob_name(version), f, overwrite=True)
+            blob_name = snapshot.snapshot_blob_name(version)
+
+            new_pointer = {
+                "version": version,
+                "blob": blob_name,
+                "rows": header["rows"],
+                "dims": header["dims"],
+                "dtype": header["dtype"],
+                "countries": {iso: stop - start for iso, (start, stop) in header["countries"].items()},
+                "stamps": header["stamps"],
+                "created": header["created"],
+            }
+            pointer_client = container.get_blob_client(snapshot.POINTER_BLOB)
+            try:
+                if etag:
+                    pointer_client.upload_blob(
+                        json.dumps(new_pointer), overwrite=True,
+                        etag=etag, match_condition=MatchConditions.IfNotModified,
+                    )
+                else:
+                    pointer_client.upload_blob(json.dumps(new_pointer), overwrite=False)
+            except (ResourceModifiedError, ResourceExistsError):
+                logging.warning(f"Snapshot pointer changed while publishing {version} (attempt {attempt}); merging again")
+                if not replace_all:
+                    container.delete_blob(blob_name)
+                continue
+
+            logging.info(f"Published snapshot {version}: {header['rows']} rows, {len(header['countries'])} countries")
+            _prune(container, blob_name, int(os.environ.get("SNAPSHOT_KEEP", "3")))
+            return header
+
+    raise RuntimeError(f"Could not publish snapshot after {attempts} attempts (pointer kept changing)")
@@ -0,0 +1,189 @@
+"""Queues between the stages of staged ingestion.
+
+With ``INGEST_MODE=staged`` (see ``process_document/staged.py``) a document
+moves through ``caption``, ``embed`` and ``index`` as messages on one queue
+per stage, so each stage scales, fails and retries on its own:
+
+- a message is a small JSON body naming the run; stage outputs are kept as
+  checkpoints (see ``checkpoints``), never in the message;
+- a message sent while the target queue holds ``INGEST_QUEUE_MAX_DEPTH``
+  messages (default 100) is enqueued invisible for between half and all of
+  ``INGEST_BACKPRESSURE_WAIT_S`` seconds (default 120), so a fast upstream
+  stage cannot bury a slow downstream one and the sending invocation does
+  not sit idle waiting for it;
+- a message whose handler raises is delivered again, at most
+  ``MAX_DELIVERIES`` times (the Functions host's ``maxDequeueCount``).
+
+Backends, selected by ``INGEST_QUEUE``:
+
+- ``storage`` (default): Azure Storage queues ``ingest-caption``,
+  ``ingest-embed`` and ``ingest-index`` on ``KNIFE_STORAGE_CONNECTION_STRING``,
+  consumed by the ``ingest_caption``, ``ingest_embed`` and ``ingest_index``
+  functions.
+- ``local``: in-process queues drained by worker threads, for development,
+  end-to-end tests and ``scripts/ingest_local.py`` (``start()`` the stage
+  workers, send, then ``join()``).
+"""
+import json
+import logging
+import os
+import queue
+import random
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.queue import QueueServiceClient, TextBase64EncodePolicy
+
+STAGES = ("caption", "embed", "index")
+QUEUE_PREFIX = "ingest-"
+MAX_DELIVERIES = 5
+# A message must become visible before its default 7-day time-to-live ends
+MAX_DELAY_S = 7 * 24 * 3600 - 60
+
+
+def queue_name(stage: str) -> str:
+    return f"{QUEUE_PREFIX}{stage}"
+
+
+def backend() -> str:
+    return os.environ.get("INGEST_QUEUE", "storage").lower()
+
+
+def max_depth() -> int:
+    return int(os.environ.get("INGEST_QUEUE_MAX_DEPTH", "100"))
+
+
+def backpressure_wait() -> float:
+    return float(os.environ.get("INGEST_BACKPRESSURE_WAIT_S", "120"))
+
+
+class StageQueues:
+    def depth(self, stage: str) -> int:
+        """Approximate number of messages waiting for a stage."""
+        raise NotImplementedError
+
+    def _put(self, stage: str, message: Dict[str, Any], delay: int = 0) -> None:
+        raise NotImplementedError
+
+    def send(self, stage: str, message: Dict[str, Any]) -> None:
+        """Enqueues a message for a stage, delaying its delivery while that stage is backed up."""
+        if stage not in STAGES:
+            raise ValueError(f"Unknown ingestion stage '{stage}'")
+        limit = max_depth()
+        delay = 0
+        if self.depth(stage) >= limit:
+            # Spread the delayed messages, so they do not all become visible at once
+            wait = backpressure_wait()
+            delay = min(int(wait / 2 + random.random() * wait / 2), MAX_DELAY_S)
+            logging.info(f"Queue {queue_name(stage)} is at {limit} messages; delaying the message by {delay}s")
+        self._put(stage, message, delay)
+
+
+class StorageQueues(StageQueues):
+    def __init__(self, connection_string: str):
+        service = QueueServiceClient.from_connection_string(connection_string)
+        self._clients = {}
+        for stage in STAGES:
+            # The Functions queue trigger expects base64-encoded messages
+            client = service.get_queue_client(queue_name(stage), message_encode_policy=TextBase64EncodePolicy())
+            try:
+                client.create_queue()
+            except ResourceExistsError:
+                pass
+            self._clients[stage] = client
+
+    def depth(self, stage):
+        return self._clients[stage].get_queue_properties().approximate_message_count or 0
+
+    def _put(self, stage, message, delay=0):
+        self._clients[stage].send_message(json.dumps(message), visibility_timeout=delay or None)
+
+
+class LocalQueues(StageQueues):
+    """In-process stand-in: bounded queues, so ``put`` itself applies backpressure."""
+
+    def __init__(self, maxsize: int = 0):
+        self._queues = {stage: queue.Queue(maxsize=maxsize or max_depth()) for stage in STAGES}
+        self._in_flight = 0
+        self._idle = threading.Condition()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self.poisoned: List[Dict[str, Any]] = []
+
+    def depth(self, stage):
+        return self._queues[stage].qsize()
+
+    def send(self, stage, message):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown ingestion stage '{stage}'")
+        self._put(stage, message)
+
+    def _put(self, stage, message, deliveries: int = 0):
+        with self._idle:
+            self._in_flight += 1
+        self._queues[stage].put((message, deliveries))
+
+    def _done(self) -> None:
+        with self._idle:
+            self._in_flight -= 1
+            self._idle.notify_all()
+
+    def start(self, handlers: Dict[str, Callable[[Dict[str, Any], int], None]], workers: Dict[str, int]) -> None:
+        """Starts ``workers[stage]`` threads per stage that drain the queues.
+
+        ``handlers[stage](message, delivery_count)`` handles one message; a handler
+        that raises gets the message again, up to ``MAX_DELIVERIES`` deliveries,
+        after which it lands in ``poisoned``.
+        """
+        self._stop = threading.Event()
+
+        def work(stage: str) -> None:
+            while not self._stop.is_set():
+                try:
+                    message, deliveries = self._queues[stage].get(timeout=0.2)
+                except queue.Empty:
+                    continue
+                deliveries += 1
+                try:
+                    handlers[stage](message, deliveries)
+                except Exception as e:
+                    logging.warning(f"{queue_name(stage)} delivery {deliveries} failed: {e}")
+                    if deliveries < MAX_DELIVERIES:
+                        self._put(stage, message, deliveries)
+                    else:
+                        self.poisoned.append(dict(message, stage=stage, error=str(e)))
+                finally:
+                    self._done()
+
+        self._threads = [
+            threading.Thread(target=work, args=(stage,), name=f"{queue_name(stage)}-{n}", daemon=True)
+            for stage in STAGES for n in range(max(1, workers.get(stage, 1)))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def join(self) -> None:
+        """Waits until every queue is empty and no message is being handled, then stops the workers."""
+        with self._idle:
+            self._idle.wait_for(lambda: self._in_flight == 0)
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+
+
+_LOCAL: Optional[LocalQueues] = None
+_STORAGE: Optional[StorageQueues] = None
+
+
+def from_env(connection_string: Optional[str] = None) -> StageQueues:
+    global _LOCAL, _STORAGE
+    if backend() == "local":
+        if _LOCAL is None:
+            _LOCAL = LocalQueues()
+        return _LOCAL
+    if not connection_string:
+        raise RuntimeError("INGEST_QUEUE=storage needs KNIFE_STORAGE_CONNECTION_STRING")
+    if _STORAGE is None:
+        _STORAGE = StorageQueues(connection_string)
+    return _STORAGE
@@ -0,0 +1,67 @@
+"""Short-lived, in-process cache of the assembled document status.
+
+The admin UI polls ``document_status`` while uploads are processed. The
+status is held here for ``STATUS_CACHE_TTL_S`` seconds (default 15); polls in
+that window are answered from memory, and concurrent polls after it expires
+share one rebuild instead of each querying the index and storage.
+
+``process_document``, ``delete_document`` and ``cleanup_index`` run in the
+same worker process as ``document_status`` and call ``invalidate()`` when
+they change a country's documents, so the next poll on this instance sees
+the change at once. Other instances see it within the TTL.
+"""
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+_LOCK = threading.Lock()
+_BUILD_LOCK = threading.Lock()
+_value: Optional[Dict[str, Any]] = None
+_built = 0.0
+_generation = 0
+
+
+def ttl() -> float:
+    return float(os.environ.get("STATUS_CACHE_TTL_S", "15"))
+
+
+def invalidate() -> None:
+    """Drops the cached status; the next ``get()`` rebuilds it."""
+    global _value, _generation
+    with _LOCK:
+        _value = None
+        _generation += 1
+
+
+def _cached() -> Optional[Dict[str, Any]]:
+    age = time.monotonic() - _built
+    if _value is not None and age < ttl():
+        return dict(_value, cached=True, age_s=round(age, 1))
+    return None
+
+
+def get(build: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    """Returns the cached status, or builds and caches it when missing or expired.
+
+    The result carries ``cached`` (bool) and ``age_s``.
+    """
+    global _value, _built
+    with _LOCK:
+        hit = _cached()
+    if hit is not None:
+        return hit
+    with _BUILD_LOCK:
+        # Another request may have rebuilt it while this one waited
+        with _LOCK:
+            hit = _cached()
+            generation = _generation
+        if hit is not None:
+            return hit
+        started = time.monotonic()
+        value = build()
+        with _LOCK:
+            # An invalidation during the build means the result may already be stale
+            if generation == _generation:
+                _value, _built = value, started
+        return dict(value, cached=False, age_s=0.0)
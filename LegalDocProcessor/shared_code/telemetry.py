@@ -0,0 +1,155 @@
+"""Tracing spans and sampled structured events for the ask and ingestion pipelines.
+
+OpenTelemetry is optional. When ``opentelemetry-sdk`` is importable, spans are
+exported according to:
+
+- ``OTEL_TRACES_EXPORTER``: ``otlp`` (default when ``OTEL_EXPORTER_OTLP_ENDPOINT``
+  is set), ``console`` or ``none``.
+- ``OTEL_EXPORTER_OTLP_ENDPOINT``: collector base URL, e.g. ``http://localhost:4318``.
+- ``OTEL_SERVICE_NAME``: overrides the service name passed to ``configure()``.
+
+Otherwise ``span()`` is a cheap no-op. ``event()`` replaces per-request
+f-string logging: the fields are attached to the current span, and only a
+sampled fraction (``LOG_EVENT_SAMPLE_RATE``, default 0.1) is also written to
+the log as one JSON line.
+
+This file is kept identical in ``Legal/api/shared_code`` and
+``LegalDocProcessor/shared_code``.
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+from . import resilience
+
+try:
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    from opentelemetry.trace import Status, StatusCode
+except ImportError:  # tracing stays disabled
+    trace = None
+
+_TRACER = None
+_CONFIGURED = False
+_CURRENT: contextvars.ContextVar = contextvars.ContextVar("telemetry_span", default=None)
+
+
+def _clean(value: Any) -> Any:
+    """Coerces a value into an OpenTelemetry-compatible attribute value."""
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    if isinstance(value, (list, tuple, set)):
+        items = list(value)
+        if all(isinstance(v, (str, bool, int, float)) for v in items):
+            return items
+    return json.dumps(value, default=str)
+
+
+class Span:
+    """Wraps an OpenTelemetry span (or nothing) and counts retries made inside it."""
+
+    def __init__(self, otel_span=None):
+        self._span = otel_span
+        self.retries = 0
+
+    def set(self, **attributes: Any) -> None:
+        if self._span is not None:
+            for key, value in attributes.items():
+                if value is not None:
+                    self._span.set_attribute(key, _clean(value))
+
+    def add_event(self, name: str, fields: Dict[str, Any]) -> None:
+        if self._span is not None:
+            self._span.add_event(name, {k: _clean(v) for k, v in fields.items() if v is not None})
+
+
+def _on_retry(label: str, attempt: int, error: BaseException) -> None:
+    current = _CURRENT.get()
+    if current is not None:
+        current.retries += 1
+        current.add_event("retry", {"endpoint": label, "attempt": attempt, "error": str(error)[:200]})
+
+
+def configure(service_name: str) -> None:
+    """Sets up the tracer provider and exporter once per process."""
+    global _TRACER, _CONFIGURED
+    if _CONFIGURED:
+        return
+    _CONFIGURED = True
+    resilience.RETRY_HOOKS.append(_on_retry)
+    if trace is None:
+        return
+    exporter_name = os.environ.get("OTEL_TRACES_EXPORTER")
+    if not exporter_name:
+        exporter_name = "otlp" if os.environ.get("OTEL_EXPORTER_OTLP_ENDPOINT") else "none"
+    exporter = None
+    if exporter_name == "console":
+        exporter = ConsoleSpanExporter()
+    elif exporter_name == "otlp":
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            exporter = OTLPSpanExporter()  # reads OTEL_EXPORTER_OTLP_* settings
+        except ImportError:
+            logging.warning("OTLP exporter requested but opentelemetry-exporter-otlp-proto-http is not installed")
+    if exporter is None:
+        return
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": os.environ.get("OTEL_SERVICE_NAME", service_name)})
+    )
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    _TRACER = trace.get_tracer(service_name)
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Span]:
+    """Opens a span for a pipeline stage; the span records retry counts and errors."""
+    if _TRACER is None:
+        wrapper = Span()
+        token = _CURRENT.set(wrapper)
+        try:
+            yield wrapper
+        finally:
+            _CURRENT.reset(token)
+        return
+    with _TRACER.start_as_current_span(name, record_exception=False, set_status_on_exception=False) as otel_span:
+        wrapper = Span(otel_span)
+        wrapper.set(**attributes)
+        token = _CURRENT.set(wrapper)
+        try:
+            yield wrapper
+        except BaseException as e:
+            otel_span.record_exception(e)
+            otel_span.set_status(Status(StatusCode.ERROR, str(e)[:200]))
+            raise
+        finally:
+            _CURRENT.reset(token)
+            if wrapper.retries:
+                otel_span.set_attribute("retry.count", wrapper.retries)
+
+
+def annotate(**attributes: Any) -> None:
+    """Sets attributes on the innermost open span (no-op outside a span)."""
+    current = _CURRENT.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def event(name: str, sample_rate: Optional[float] = None, **fields: Any) -> None:
+    """Records a structured event on the current span and logs a sampled copy."""
+    current = _CURRENT.get()
+    if current is not None:
+        current.add_event(name, fields)
+    if sample_rate is None:
+        sample_rate = float(os.environ.get("LOG_EVENT_SAMPLE_RATE", "0.1"))
+    if sample_rate <= 0 or random.random() >= sample_rate:
+        return
+    logger = logging.getLogger()
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("%s %s", name, json.dumps(fields, default=str))
@@ -0,0 +1,155 @@
+"""Which vector field, and embedding model, each country is queried and written with.
+
+Query and document vectors must come from the same model, so switching
+``KNIFE_OPENAI_DEPLOY``/``OPENAI_EMBED_DEPLOY`` (or the dimensions) used to
+break retrieval until every chunk was embedded again. Instead, a second vector
+field is added next to ``embedding`` and ``scripts/migrate_embeddings.py``
+backfills it from the chunk text already in the index, one country at a time.
+Countries move to the new field as their backfill completes.
+
+Per index, the record ``index/vectors/<index>.json`` (in the container of
+the ``index_alias`` record) holds::
+
+    {"fields": {"embedding": {"deployment": "text-embedding-3-large", "dims": 3072},
+                "embedding_v2": {"deployment": "text-embedding-3-small", "dims": 1536}},
+     "default": "embedding",         # field ingestion writes and countries are queried on
+     "target": "embedding_v2",       # field being backfilled, null when no migration runs
+     "countries": {"AE": "embedding_v2", ...}}   # countries already served from another field
+
+Without a record, ``embedding`` with ``KNIFE_OPENAI_DEPLOY`` and the dimensions
+of ``index.json`` is used. While a migration runs, ingestion writes the
+default field only and returns the country to it (``settle``); the
+backfill picks it up again. Snapshots are not published meanwhile, since
+they hold one model's vectors. Updates are ETag-conditional and retried.
+"""
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+from . import index_alias, index_schema
+
+PREFIX = "index/vectors/"
+DEFAULT_FIELD = "embedding"
+
+_CACHE: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+_LOCK = threading.Lock()
+
+
+def record_blob(index_name: str) -> str:
+    return f"{PREFIX}{index_name}.json"
+
+
+def default_record() -> Dict[str, Any]:
+    return {
+        "fields": {DEFAULT_FIELD: {"deployment": os.environ.get("KNIFE_OPENAI_DEPLOY"),
+                                   "dims": index_schema.expected_dimensions()}},
+        "default": DEFAULT_FIELD,
+        "target": None,
+        "countries": {},
+    }
+
+
+def read(index_name: str) -> Tuple[Dict[str, Any], Optional[str]]:
+    """The record of an index (the default one when there is none) and its ETag."""
+    container = index_alias.container_client()
+    if container is None:
+        return default_record(), None
+    try:
+        downloader = container.get_blob_client(record_blob(index_name)).download_blob()
+    except ResourceNotFoundError:
+        return default_record(), None
+    return json.loads(downloader.readall()), downloader.properties.etag
+
+
+def update(index_name: str, change: Callable[[Dict[str, Any]], bool], attempts: int = 5) -> Dict[str, Any]:
+    """Applies ``change(record)`` with an ETag condition; ``change`` returns False to leave it as is."""
+    container = index_alias.container_client()
+    if container is None:
+        raise RuntimeError("Vector field records need KNIFE_INDEX_ALIAS_CONTAINER (or KNIFE_SNAPSHOT_CONTAINER) "
+                           "and KNIFE_STORAGE_CONNECTION_STRING")
+    try:
+        container.create_container()
+    except ResourceExistsError:
+        pass
+    client = container.get_blob_client(record_blob(index_name))
+    for _ in range(attempts):
+        record, etag = read(index_name)
+        if change(record) is False:
+            return record
+        try:
+            if etag:
+                client.upload_blob(json.dumps(record, indent=2), overwrite=True, etag=etag,
+                                   match_condition=MatchConditions.IfNotModified)
+            else:
+                client.upload_blob(json.dumps(record, indent=2), overwrite=False)
+        except (ResourceModifiedError, ResourceExistsError):
+            continue
+        with _LOCK:
+            _CACHE.pop(index_name, None)
+        return record
+    raise RuntimeError(f"Vector field record of {index_name} kept changing; gave up after {attempts} attempts")
+
+
+def current(index_name: str) -> Dict[str, Any]:
+    """The record of an index, re-read at most every ``INDEX_ALIAS_REFRESH_S`` seconds."""
+    refresh_s = float(os.environ.get("INDEX_ALIAS_REFRESH_S", "30"))
+    with _LOCK:
+        cached = _CACHE.get(index_name)
+        if cached is not None and time.monotonic() - cached[0] < refresh_s:
+            return cached[1]
+    record, _ = read(index_name)
+    with _LOCK:
+        _CACHE[index_name] = (time.monotonic(), record)
+    return record
+
+
+def write_field(record: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """(field, {"deployment", "dims"}) that ingestion embeds and writes."""
+    field = record["default"]
+    return field, record["fields"][field]
+
+
+def migrating(record: Dict[str, Any]) -> bool:
+    return bool(record.get("target"))
+
+
+def settle(index_name: str, iso_code: str, field: str) -> None:
+    """Records that a country was just written with vectors in ``field`` only.
+
+    Normally that is the default field, and a country the backfill had moved is
+    queried on it again until the backfill covers it anew. When a migration
+    finished during the ingestion, the country stays on the field it has vectors in.
+    """
+    if index_alias.container_client() is None:
+        return
+
+    def change(record):
+        countries = record.setdefault("countries", {})
+        if field == record["default"]:
+            if iso_code not in countries:
+                return False
+            del countries[iso_code]
+        elif countries.get(iso_code) == field:
+            return False
+        else:
+            countries[iso_code] = field
+    update(index_name, change)
+
+
+def mark_done(index_name: str, iso_code: str, field: str) -> None:
+    def change(record):
+        if record.get("target") != field:
+            return False
+        record.setdefault("countries", {})[iso_code] = field
+    update(index_name, change)
+
+
+def field_definition(name: str, dims: int) -> Dict[str, Any]:
+    """A vector field like ``embedding`` in ``index.json`` (same vector profile), with its own size."""
+    template = next(f for f in index_schema.expected_schema()["fields"] if f["name"] == DEFAULT_FIELD)
+    return dict(template, name=name, dimensions=dims)
@@ -0,0 +1,144 @@
+"""In-memory stand-ins for the blob storage SDK, shared by the tests.
+
+They implement the calls ``shared_code`` makes: ETag-conditional uploads,
+downloads, listing, deletes and leases, with the SDK's exceptions.
+"""
+import os
+import sys
+import threading
+import time
+import uuid
+from types import SimpleNamespace
+
+import pytest
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class FakeDownloader:
+    def __init__(self, data: bytes, etag: str):
+        self._data = data
+        self.properties = SimpleNamespace(etag=etag)
+
+    def readall(self) -> bytes:
+        return self._data
+
+    def readinto(self, stream) -> int:
+        stream.write(self._data)
+        return len(self._data)
+
+
+class FakeLease:
+    def __init__(self, blob: "FakeBlobClient", lease_id: str):
+        self.blob = blob
+        self.id = lease_id
+
+    def renew(self) -> None:
+        self.blob.container.renew_lease(self.blob.name, self.id)
+
+    def release(self) -> None:
+        self.blob.container.release_lease(self.blob.name, self.id)
+
+
+class FakeBlobClient:
+    def __init__(self, container: "FakeContainerClient", name: str):
+        self.container = container
+        self.name = name
+
+    def download_blob(self) -> FakeDownloader:
+        with self.container.lock:
+            if self.name not in self.container.blobs:
+                raise ResourceNotFoundError(f"{self.name} not found")
+            data, etag = self.container.blobs[self.name]
+        return FakeDownloader(data, etag)
+
+    def upload_blob(self, data, overwrite=False, etag=None, match_condition=None, **kwargs) -> None:
+        self.container.upload_blob(self.name, data, overwrite=overwrite, etag=etag, match_condition=match_condition)
+
+    def delete_blob(self, **kwargs) -> None:
+        self.container.delete_blob(self.name)
+
+    def acquire_lease(self, lease_duration: float = -1) -> FakeLease:
+        return FakeLease(self, self.container.acquire_lease(self.name, lease_duration))
+
+
+class FakeContainerClient:
+    def __init__(self, name: str):
+        self.name = name
+        self.blobs = {}
+        self.leases = {}
+        self.lock = threading.Lock()
+        self._created = False
+
+    def create_container(self) -> None:
+        if self._created:
+            raise ResourceExistsError(f"{self.name} exists")
+        self._created = True
+
+    def get_blob_client(self, name: str) -> FakeBlobClient:
+        return FakeBlobClient(self, name)
+
+    def upload_blob(self, name, data, overwrite=False, etag=None, match_condition=None, **kwargs) -> None:
+        if hasattr(data, "read"):
+            data = data.read()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.lock:
+            current = self.blobs.get(name)
+            if current is not None and not overwrite:
+                raise ResourceExistsError(f"{name} exists")
+            if match_condition == MatchConditions.IfNotModified and (current is None or current[1] != etag):
+                raise ResourceModifiedError(f"{name} was modified")
+            self.blobs[name] = (bytes(data), uuid.uuid4().hex)
+
+    def delete_blob(self, name: str, **kwargs) -> None:
+        with self.lock:
+            if self.blobs.pop(name, None) is None:
+                raise ResourceNotFoundError(f"{name} not found")
+
+    def list_blobs(self, name_starts_with: str = ""):
+        with self.lock:
+            return [SimpleNamespace(name=name) for name in sorted(self.blobs) if name.startswith(name_starts_with)]
+
+    def acquire_lease(self, name: str, duration: float) -> str:
+        with self.lock:
+            if name not in self.blobs:
+                raise ResourceNotFoundError(f"{name} not found")
+            held = self.leases.get(name)
+            if held is not None and held[1] > time.monotonic():
+                error = HttpResponseError(message="There is already a lease present.")
+                error.status_code = 409
+                raise error
+            lease_id = uuid.uuid4().hex
+            self.leases[name] = (lease_id, time.monotonic() + duration, duration)
+            return lease_id
+
+    def renew_lease(self, name: str, lease_id: str) -> None:
+        with self.lock:
+            held = self.leases.get(name)
+            if held is None or held[0] != lease_id:
+                raise HttpResponseError(message="The lease ID specified did not match.")
+            self.leases[name] = (lease_id, time.monotonic() + held[2], held[2])
+
+    def release_lease(self, name: str, lease_id: str) -> None:
+        with self.lock:
+            if self.leases.get(name, (None,))[0] == lease_id:
+                del self.leases[name]
+
+    def read(self, name: str) -> bytes:
+        return self.blobs[name][0]
+
+
+class FakeBlobServiceClient:
+    def __init__(self):
+        self.containers = {}
+
+    def get_container_client(self, name: str) -> FakeContainerClient:
+        return self.containers.setdefault(name, FakeContainerClient(name))
+
+
+@pytest.fixture
+def blob_service():
+    return FakeBlobServiceClient()
@@ -0,0 +1,133 @@
+"""Structure-aware chunking: headings, section paths, merging of short sections and overlap."""
+import pytest
+
+from shared_code import chunking
+
+
+def para(text, style=None, **metadata):
+    if style:
+        metadata["style"] = style
+    return {"type": "text", "content": text, "metadata": metadata}
+
+
+def sentences(prefix, count, words=12):
+    return " ".join(f"{prefix} sentence {i} " + " ".join(["word"] * words) + "." for i in range(count))
+
+
+def text_chunks(chunks):
+    return [chunk for chunk in chunks if chunk["metadata"]["chunk_type"] == "text"]
+
+
+@pytest.mark.parametrize("element, level", [
+    (para("Entry rules", "Title"), 1),
+    (para("Entry rules", "Heading 2"), 2),
+    (para("Entry rules", outline_level=2), 3),
+    (para("Part II General provisions"), 1),
+    (para("Chapter 3 Visas"), 2),
+    (para("Section IV Transit"), 3),
+    (para("Article 5"), 4),
+    (para("Art. 12a Exemptions"), 4),
+    (para("§ 3 Customs"), 4),
+    (para("Annex 1"), 4),
+    (para("Article 5 " + "applies to every traveller entering the country by air, land or sea " * 4), None),
+    (para("Travellers must carry a passport."), None),
+])
+def test_heading_levels(element, level):
+    assert chunking.heading_level(element) == level
+
+
+def test_headings_close_chunks_and_set_the_section_path():
+    elements = [
+        para("Chapter I Entry", "Heading 1"),
+        para("Article 1", "Heading 2"),
+        para(sentences("entry", 12)),
+        para("Article 2", "Heading 2"),
+        para(sentences("visa", 12)),
+        para("Chapter II Customs", "Heading 1"),
+        para(sentences("customs", 12)),
+    ]
+    chunks = chunking.build_chunks(elements, [], max_tokens=700, min_tokens=50)
+
+    assert [chunk["metadata"]["section_path"] for chunk in chunks] == [
+        ["Chapter I Entry", "Article 1"],
+        ["Chapter I Entry", "Article 2"],
+        ["Chapter II Customs"],
+    ]
+    assert chunks[0]["text"].startswith("Chapter I Entry\n\nArticle 1\n\nentry sentence 0")
+    assert "visa" not in chunks[0]["text"] and "customs" not in chunks[1]["text"]
+
+
+@pytest.mark.parametrize("elements, paths", [
+    # A short article merges into its next sibling; the chunk keeps the path both share
+    ([para("Chapter I", "Heading 1"), para("Article 1", "Heading 2"), para("Short rule."),
+      para("Article 2", "Heading 2"), para(sentences("long", 12))],
+     [["Chapter I"]]),
+    # A short chapter introduction merges into its first article
+    ([para("Chapter I", "Heading 1"), para("Short introduction."),
+      para("Article 1", "Heading 2"), para(sentences("long", 12))],
+     [["Chapter I"]]),
+    # A short last article of a chapter does not merge into the next chapter
+    ([para("Chapter I", "Heading 1"), para("Article 1", "Heading 2"), para("Short rule."),
+      para("Chapter II", "Heading 1"), para(sentences("long", 12))],
+     [["Chapter I", "Article 1"], ["Chapter II"]]),
+    # Sections long enough stand alone
+    ([para("Chapter I", "Heading 1"), para("Article 1", "Heading 2"), para(sentences("one", 12)),
+      para("Article 2", "Heading 2"), para(sentences("two", 12))],
+     [["Chapter I", "Article 1"], ["Chapter I", "Article 2"]]),
+])
+def test_short_sections_merge_with_the_common_prefix_path(elements, paths):
+    chunks = chunking.build_chunks(elements, [], max_tokens=700, min_tokens=60)
+    assert [chunk["metadata"]["section_path"] for chunk in chunks] == paths
+
+
+@pytest.mark.parametrize("max_tokens, overlap_tokens", [
+    (120, 0),
+    (120, 30),
+    (120, 60),
+    (200, 150),
+    (80, 200),
+])
+def test_long_sections_are_split_with_an_overlap_that_fits_the_budget(max_tokens, overlap_tokens):
+    elements = [para("Article 1", "Heading 1"), para(sentences("rule", 30))]
+    chunks = text_chunks(chunking.build_chunks(elements, [], max_tokens=max_tokens, overlap_tokens=overlap_tokens))
+
+    assert len(chunks) > 1
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk["text"].startswith("[Article 1]\n")
+        body = chunk["text"].split("\n", 1)[1]
+        # Every chunk's body, overlap included, stays within the budget
+        assert chunking.count_tokens(body) <= max_tokens + 5
+        overlap = [unit for unit in chunking.split_sentences(body) if unit in previous["text"]]
+        assert chunking.count_tokens(" ".join(overlap)) <= overlap_tokens + 5
+        if overlap_tokens == 0:
+            assert not overlap
+
+
+@pytest.mark.parametrize("max_tokens, overlap_tokens", [(50, 0), (50, 20), (100, 90)])
+def test_split_text_pieces_fit_the_budget(max_tokens, overlap_tokens):
+    text = sentences("clause", 20) + " " + " ".join(["unbroken"] * 300)
+    pieces = chunking.split_text(text, max_tokens, overlap_tokens)
+
+    assert len(pieces) > 1
+    assert all(chunking.count_tokens(piece) <= max_tokens + 5 for piece in pieces)
+    assert "clause sentence 0" in pieces[0] and pieces[-1].endswith("unbroken")
+
+
+def test_tables_and_images_are_single_chunks_in_their_section():
+    elements = [
+        para("Article 1", "Heading 1"),
+        {"type": "table", "content": "| Item | Limit |", "metadata": {"table_id": "3", "json_data": [["Item"]]}},
+        para(sentences("after", 2)),
+    ]
+    images = [{"content": "A map", "metadata": {"figure_id": "2", "section_path": ["Article 1"]}}]
+    chunks = chunking.build_chunks(elements, images, min_tokens=0)
+
+    assert [chunk["metadata"]["chunk_type"] for chunk in chunks] == ["table", "text", "image"]
+    assert chunks[0]["metadata"]["table_id"] == "3" and chunks[0]["metadata"]["section_path"] == ["Article 1"]
+    # The heading waits for the text after the table
+    assert chunks[1]["text"].startswith("Article 1\n\nafter sentence 0")
+    assert chunks[2]["metadata"]["figure_id"] == "2"
+
+
+def test_headings_without_body_produce_no_chunk():
+    assert chunking.build_chunks([para("Chapter I", "Heading 1"), para("Article 1", "Heading 2")], []) == []
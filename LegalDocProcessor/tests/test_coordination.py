@@ -0,0 +1,204 @@
+"""Generations, locks and the unchanged-skip check of overlapping ingestions."""
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+import process_document
+from shared_code import coordination, manifest, snapshot_store
+
+PIPELINE = "p1"
+
+
+@pytest.fixture
+def fast_leases(monkeypatch):
+    """Leases of a fraction of a second, and lock polls without the production pauses."""
+    monkeypatch.setattr(coordination, "LEASE_SECONDS", 0.3)
+    monkeypatch.setattr(coordination, "time", SimpleNamespace(
+        monotonic=time.monotonic, time=time.time, sleep=lambda seconds: time.sleep(0.02),
+    ))
+
+
+@pytest.fixture(params=["local", "sqlite", "blob"])
+def coordinators(request, tmp_path, blob_service):
+    """A factory of coordinators that share their state, as the instances of one app do."""
+    if request.param == "local":
+        shared = coordination.LocalCoordinator()
+        return lambda: shared
+    if request.param == "sqlite":
+        return lambda: coordination.SqliteCoordinator(str(tmp_path / "coordination.db"))
+    return lambda: coordination.BlobCoordinator(blob_service.get_container_client("manifest"))
+
+
+def test_a_newer_registration_supersedes_older_runs(coordinators):
+    first, second = coordinators(), coordinators()
+    older = first.register("AE")
+    newer = second.register("AE")
+
+    assert newer == older + 1
+    assert first.current("AE") == second.current("AE") == newer
+    with pytest.raises(coordination.Superseded):
+        first.check("AE", older)
+    second.check("AE", newer)
+    # Other countries are independent
+    first.check("BR", first.register("BR"))
+
+
+def test_the_null_coordinator_never_supersedes():
+    coordinator = coordination.NullCoordinator()
+    coordinator.check("AE", coordinator.register("AE"))
+    coordinator.check("AE", 0)
+
+
+def test_the_lock_serializes_runs(coordinators, fast_leases):
+    first, second = coordinators(), coordinators()
+    with first.lock("AE", timeout=5):
+        with pytest.raises(TimeoutError):
+            with second.lock("AE", timeout=0.1):
+                pass
+        # A held lock is renewed, so it outlives its lease
+        time.sleep(coordination.LEASE_SECONDS * 2)
+        with pytest.raises(TimeoutError):
+            with second.lock("AE", timeout=0.1):
+                pass
+        with second.lock("BR", timeout=0.1):
+            pass
+    with second.lock("AE", timeout=0.1):
+        pass
+
+
+def test_the_lease_of_a_crashed_holder_expires_and_is_taken_over(tmp_path, blob_service, fast_leases):
+    def crash_sqlite(coordinator):
+        assert coordinator._try_lock("AE", "crashed")
+
+    def crash_blob(coordinator):
+        lock_blob = coordinator.container.get_blob_client(f"{coordination.PREFIX}AE.lock")
+        lock_blob.upload_blob(b"", overwrite=True)
+        lock_blob.acquire_lease(lease_duration=coordination.LEASE_SECONDS)
+
+    for coordinator, crash in (
+        (coordination.SqliteCoordinator(str(tmp_path / "coordination.db")), crash_sqlite),
+        (coordination.BlobCoordinator(blob_service.get_container_client("manifest")), crash_blob),
+    ):
+        # Taken and never renewed or released, as by a process that died
+        crash(coordinator)
+        with pytest.raises(TimeoutError):
+            with coordinator.lock("AE", timeout=0):
+                pass
+        started = time.monotonic()
+        with coordinator.lock("AE", timeout=5):
+            assert time.monotonic() - started < 5
+
+
+def test_from_env_picks_the_backend(monkeypatch, tmp_path, blob_service):
+    for name in ("KNIFE_MANIFEST_CONTAINER", "KNIFE_SNAPSHOT_CONTAINER", "KNIFE_CHECKPOINT_CONTAINER"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(coordination, "_BLOB", {})
+    monkeypatch.delenv("INGEST_COORDINATION", raising=False)
+    assert isinstance(coordination.from_env(blob_service), coordination.LocalCoordinator)
+
+    monkeypatch.setenv("KNIFE_SNAPSHOT_CONTAINER", "snapshots")
+    assert isinstance(coordination.from_env(blob_service), coordination.BlobCoordinator)
+    assert isinstance(coordination.from_env(None), coordination.LocalCoordinator)
+
+    monkeypatch.setenv("INGEST_COORDINATION", f"sqlite:{tmp_path / 'c.db'}")
+    assert isinstance(coordination.from_env(blob_service), coordination.SqliteCoordinator)
+    monkeypatch.setenv("INGEST_COORDINATION", "off")
+    assert isinstance(coordination.from_env(blob_service), coordination.NullCoordinator)
+
+
+@pytest.mark.parametrize("age_s, expected", [
+    (None, 5.0),
+    (0.0, 5.0),
+    (3.0, 2.0),
+    (60.0, 0.0),
+])
+def test_only_recently_modified_blobs_are_debounced(monkeypatch, age_s, expected):
+    monkeypatch.setenv("INGEST_DEBOUNCE_S", "5")
+    last_modified = None if age_s is None else datetime.now(timezone.utc) - timedelta(seconds=age_s)
+    assert coordination.debounce_seconds(last_modified) == pytest.approx(expected, abs=0.5)
+
+
+class FakeIndex:
+    def __init__(self, ids):
+        self.ids = set(ids)
+
+    def search(self, search_text="*", filter=None, select=None, **kwargs):
+        return [{"id": doc_id} for doc_id in self.ids]
+
+
+def entry(sha256, ids=("AE_0", "AE_1")):
+    return {"iso_code": "AE", "pipeline": PIPELINE, "source": {"sha256": sha256},
+            "chunk_hashes": {doc_id: "h" for doc_id in ids}}
+
+
+@pytest.fixture
+def recorded():
+    store = manifest.MemoryManifestStore()
+    store.put(entry("old"))
+    coordinator = coordination.LocalCoordinator()
+    return store, coordinator, coordinator.register("AE")
+
+
+def confirm(store, coordinator, generation, index, blob_service=None, sha256="old"):
+    return process_document.confirm_unchanged(index, blob_service, store, coordinator, "AE", generation, PIPELINE,
+                                              sha256=sha256)
+
+
+@pytest.mark.parametrize("indexed_ids, expected", [
+    ({"AE_0", "AE_1"}, True),
+    ({"AE_0"}, False),
+    ({"AE_0", "AE_1", "AE_2"}, False),
+    (set(), False),
+])
+def test_a_skip_stands_only_while_the_index_holds_the_recorded_ids(recorded, indexed_ids, expected):
+    store, coordinator, generation = recorded
+    assert confirm(store, coordinator, generation, FakeIndex(indexed_ids)) is expected
+
+
+def test_the_manifest_is_read_again_once_the_lock_is_free(recorded):
+    store, coordinator, generation = recorded
+    locked, release = threading.Event(), threading.Event()
+
+    def writer():
+        # A run that is writing the country records a different upload before it lets go
+        with coordinator.lock("AE", timeout=5):
+            locked.set()
+            release.wait(5)
+            store.put(entry("new"))
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    locked.wait(5)
+    result = []
+    checker = threading.Thread(target=lambda: result.append(
+        confirm(store, coordinator, generation, FakeIndex({"AE_0", "AE_1"}))))
+    checker.start()
+    time.sleep(0.1)
+    assert not result, "the check must wait for the lock"
+    release.set()
+    thread.join(5)
+    checker.join(5)
+
+    assert result == [False]
+
+
+def test_a_newer_upload_supersedes_the_skip(recorded):
+    store, coordinator, generation = recorded
+    coordinator.register("AE")
+    with pytest.raises(coordination.Superseded):
+        confirm(store, coordinator, generation, FakeIndex({"AE_0", "AE_1"}))
+
+
+def test_an_incomplete_index_write_is_not_skipped(monkeypatch, recorded, blob_service):
+    store, coordinator, generation = recorded
+    monkeypatch.setenv("KNIFE_SNAPSHOT_CONTAINER", "snapshots")
+    index = FakeIndex({"AE_0", "AE_1"})
+
+    stamp = snapshot_store.mark_indexing(blob_service, "AE")
+    assert confirm(store, coordinator, generation, index, blob_service) is False
+    snapshot_store.mark_indexed(blob_service, "AE", stamp)
+    assert confirm(store, coordinator, generation, index, blob_service) is True
+    assert confirm(store, coordinator, generation, index, blob_service, sha256="other") is False
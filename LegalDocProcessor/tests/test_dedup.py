@@ -0,0 +1,105 @@
+"""Boilerplate stripping and exact/near-duplicate chunk removal."""
+import pytest
+
+from shared_code import dedup
+
+RULE = ("Hand luggage may contain liquids in containers of at most {n} ml each, packed in one "
+        "transparent resealable plastic bag of about {m} cm by {m} cm per passenger. Medicines and baby food "
+        "needed during the journey are exempt but may be checked separately at the security point, and "
+        "passengers should be ready to show a prescription or other proof that they are needed. Liquids "
+        "bought after the security check in the departure lounge may be carried on board when they remain "
+        "sealed in the bag the shop provided together with the receipt")
+
+
+def text_chunk(text, chunk_type="text"):
+    return {"text": text, "metadata": {"chunk_type": chunk_type}}
+
+
+@pytest.mark.parametrize("first, second, kept", [
+    # Identical once case, punctuation and layout are normalized
+    ("Visas are required.", "VISAS   are required", 1),
+    # Near-duplicate wording with the same numbers
+    (RULE.format(n=100, m=20), RULE.format(n=100, m=20) + ".", 1),
+    (RULE.format(n=100, m=20), RULE.format(n=100, m=20).replace("should be ready", "must be ready"), 1),
+    # Numbers differ: different rules, never duplicates
+    (RULE.format(n=100, m=20), RULE.format(n=1000, m=20), 2),
+    (RULE.format(n=100, m=20), RULE.format(n=100, m=25), 2),
+    ("Children under 6 travel free.", "Children under 12 travel free.", 2),
+    # Unrelated text
+    (RULE.format(n=100, m=20), "Firearms must be declared at the border crossing before entry.", 2),
+])
+def test_duplicates(first, second, kept):
+    report = dedup.DedupReport()
+    result = dedup.dedupe_chunks([text_chunk(first), text_chunk(second)], report=report)
+
+    assert len(result) == kept
+    # The first occurrence is the one kept
+    assert result[0]["text"] == first
+    assert report.chunks_before == 2 and report.chunks_after == kept
+    assert report.exact_duplicates + report.near_duplicates == 2 - kept
+
+
+@pytest.mark.parametrize("chunk_types, kept", [
+    (("table", "table"), 1),  # identical tables are exact duplicates
+    (("text", "table"), 2),  # the same text as a table and as prose is kept in both forms
+    (("image", "image"), 2),  # images are never deduplicated here
+])
+def test_exact_duplicates_are_per_chunk_type(chunk_types, kept):
+    chunks = [text_chunk("| Item | Limit |\n| Liquids | 100 ml |", chunk_type) for chunk_type in chunk_types]
+    assert len(dedup.dedupe_chunks(chunks)) == kept
+
+
+def test_near_duplicate_tables_are_kept():
+    tables = [text_chunk(RULE.format(n=100, m=20), "table"),
+              text_chunk(RULE.format(n=100, m=20).replace("should be ready", "must be ready"), "table")]
+    assert len(dedup.dedupe_chunks(tables)) == 2
+
+
+def element(content, style=None):
+    return {"type": "text", "content": content, "metadata": {"style": style} if style else {}}
+
+
+def is_heading(elem):
+    return (elem["metadata"].get("style") or "").startswith("Heading")
+
+
+@pytest.mark.parametrize("min_repeats, repeats, removed", [
+    (3, 3, 2),
+    (3, 4, 3),
+    (3, 2, 0),
+    (2, 2, 1),
+])
+def test_recurring_lines_are_kept_once(min_repeats, repeats, removed):
+    elements = [element(f"Official Journal - page {i}\nCONFIDENTIAL - for internal use\nRule {i} applies.")
+                for i in range(repeats)]
+
+    report = dedup.strip_boilerplate(elements, is_heading, min_repeats=min_repeats)
+
+    contents = "\n".join(elem["content"] for elem in elements)
+    assert contents.count("CONFIDENTIAL - for internal use") == repeats - removed
+    # The first occurrence stays where it was
+    assert elements[0]["content"].startswith("Official Journal - page 0\nCONFIDENTIAL")
+    assert all(f"Rule {i} applies." in contents for i in range(repeats))
+    assert report.boilerplate_lines == removed
+
+
+def test_headings_long_lines_and_other_elements_are_not_boilerplate():
+    long_line = "A long recurring paragraph " * 10
+    elements = [
+        element("General provisions", "Heading 1"),
+        element("General provisions", "Heading 1"),
+        element("General provisions", "Heading 1"),
+        element(long_line), element(long_line), element(long_line),
+        {"type": "table", "content": "General provisions", "metadata": {}},
+    ]
+    report = dedup.strip_boilerplate(elements, is_heading, max_chars=200)
+
+    assert report.boilerplate_lines == 0
+    assert len(elements) == 7
+
+
+def test_an_element_left_empty_is_dropped():
+    elements = [element("Page header"), element("Page header"), element("Page header\nBody text")]
+    dedup.strip_boilerplate(elements, is_heading)
+
+    assert [elem["content"] for elem in elements] == ["Page header", "Body text"]
@@ -0,0 +1,56 @@
+"""Per-country chunk counts of the status endpoint."""
+import pytest
+from azure.core.exceptions import HttpResponseError
+
+import document_status
+
+
+class FakeResults:
+    def __init__(self, counts):
+        self.counts = counts
+
+    def get_facets(self):
+        return {"iso_code": [{"value": iso, "count": count} for iso, count in self.counts.items()]}
+
+
+class FakeSearchClient:
+    """Counts chunks and parent sections separately; ``typed=False`` is an index without ``chunk_type``."""
+
+    def __init__(self, chunks, sections, typed=True):
+        self.chunks, self.sections, self.typed = chunks, sections, typed
+        self.filters = []
+
+    def search(self, search_text="*", facets=None, top=None, filter=None):
+        self.filters.append(filter)
+        if filter is None:
+            return FakeResults({iso: count + self.sections.get(iso, 0) for iso, count in self.chunks.items()})
+        if not self.typed:
+            error = HttpResponseError(message="Invalid expression: Could not find a property named 'chunk_type'")
+            error.status_code = 400
+            raise error
+        assert filter == "chunk_type ne 'section'"
+        return FakeResults(self.chunks)
+
+
+def test_parent_sections_are_not_counted_as_chunks():
+    client = FakeSearchClient({"ae": 12, "BR": 3}, {"ae": 4, "BR": 1})
+    assert document_status.count_chunks(client) == {"AE": 12, "BR": 3}
+
+
+def test_an_index_without_chunk_types_counts_every_document():
+    client = FakeSearchClient({"AE": 12}, {}, typed=False)
+    assert document_status.count_chunks(client) == {"AE": 12}
+    assert client.filters == ["chunk_type ne 'section'", None]
+
+
+def test_other_errors_are_raised():
+    client = FakeSearchClient({"AE": 12}, {})
+
+    def unavailable(**kwargs):
+        error = HttpResponseError(message="Service unavailable")
+        error.status_code = 503
+        raise error
+
+    client.search = unavailable
+    with pytest.raises(HttpResponseError):
+        document_status.count_chunks(client)
@@ -0,0 +1,162 @@
+"""IndexWriter batching, per-key retries, request splitting and abort."""
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from shared_code import index_writer
+
+
+class FakeSearchClient:
+    """Records every request; ``respond(ids)`` decides per-key results (status per id, 200 when absent)."""
+
+    def __init__(self, respond=None):
+        self.requests = []
+        self.respond = respond or (lambda ids: {})
+        self._lock = threading.Lock()
+
+    def upload_documents(self, documents):
+        ids = [doc["id"] for doc in documents]
+        with self._lock:
+            self.requests.append(ids)
+        statuses = self.respond(ids)
+        return [SimpleNamespace(key=key, succeeded=statuses.get(key, 200) < 300, status_code=statuses.get(key, 200),
+                                error_message=None if statuses.get(key, 200) < 300 else "failed")
+                for key in ids]
+
+    def sent(self):
+        return sorted(key for request in self.requests for key in request)
+
+
+class TooLarge(Exception):
+    status_code = 413
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(index_writer, "time", SimpleNamespace(monotonic=time.monotonic, sleep=lambda seconds: None))
+
+
+def docs(count, text=""):
+    return [{"id": f"AE_{i}", "chunk": text} for i in range(count)]
+
+
+@pytest.mark.parametrize("count, max_docs, sizes", [
+    (7, 3, [3, 3, 1]),
+    (6, 3, [3, 3]),
+    (1, 1000, [1]),
+    (0, 3, []),
+])
+def test_batches_hold_at_most_max_docs(count, max_docs, sizes):
+    client = FakeSearchClient()
+    with index_writer.IndexWriter(client, max_docs=max_docs, workers=1) as writer:
+        writer.add(docs(count))
+
+    assert [len(request) for request in client.requests] == sizes
+    assert client.sent() == sorted(f"AE_{i}" for i in range(count))
+    assert writer.failed == {}
+    assert writer.stats()["documents"] == writer.stats()["succeeded"] == count
+
+
+def test_batches_stay_under_max_bytes():
+    documents = docs(10, text="x" * 100)
+    size = index_writer.document_size(documents[0])
+    client = FakeSearchClient()
+    with index_writer.IndexWriter(client, max_docs=1000, max_bytes=3 * size + 1, workers=1) as writer:
+        writer.add(documents)
+
+    assert [len(request) for request in client.requests] == [3, 3, 3, 1]
+
+
+def test_a_document_larger_than_max_bytes_goes_alone():
+    client = FakeSearchClient()
+    with index_writer.IndexWriter(client, max_bytes=50, workers=1) as writer:
+        writer.add([{"id": "small"}, {"id": "large", "chunk": "x" * 200}, {"id": "next"}])
+
+    assert client.requests == [["small"], ["large"], ["next"]]
+
+
+def test_only_failed_retryable_keys_are_sent_again():
+    calls = []
+
+    def respond(ids):
+        calls.append(ids)
+        if len(calls) == 1:
+            return {"AE_1": 503, "AE_2": 400, "AE_3": 409}
+        if len(calls) == 2:
+            return {"AE_3": 503}
+        return {}
+
+    client = FakeSearchClient(respond)
+    with index_writer.IndexWriter(client, workers=1, attempts=4) as writer:
+        writer.add(docs(5))
+
+    assert client.requests == [["AE_0", "AE_1", "AE_2", "AE_3", "AE_4"], ["AE_1", "AE_3"], ["AE_3"]]
+    # A non-retryable status is given up at once; the others were written on a later attempt
+    assert list(writer.failed) == ["AE_2"]
+    assert writer.stats()["retried_keys"] == 3
+
+
+def test_keys_still_failing_after_the_last_attempt_are_reported():
+    client = FakeSearchClient(lambda ids: {"AE_0": 503})
+    with index_writer.IndexWriter(client, workers=1, attempts=3) as writer:
+        writer.add(docs(2))
+
+    assert client.requests == [["AE_0", "AE_1"], ["AE_0"], ["AE_0"]]
+    assert writer.failed == {"AE_0": "503: failed"}
+
+
+def test_a_request_rejected_as_too_large_is_split():
+    client = FakeSearchClient()
+    upload = client.upload_documents
+
+    def upload_at_most_two(documents):
+        if len(documents) > 2:
+            client.requests.append([doc["id"] for doc in documents])
+            raise TooLarge("Request Entity Too Large")
+        return upload(documents)
+
+    client.upload_documents = upload_at_most_two
+    with index_writer.IndexWriter(client, workers=1) as writer:
+        writer.add(docs(5))
+
+    assert writer.failed == {}
+    assert writer.stats()["split_batches"] >= 1
+    assert sorted(key for request in client.requests if len(request) <= 2 for key in request) == \
+        [f"AE_{i}" for i in range(5)]
+
+
+def test_an_error_in_the_producer_sends_nothing_after_it():
+    client = FakeSearchClient()
+
+    with pytest.raises(RuntimeError, match="embedding failed"):
+        with index_writer.IndexWriter(client, max_docs=3, workers=1) as writer:
+            writer.add(docs(4))
+            raise RuntimeError("embedding failed")
+
+    # The full batch is sent unless it had not started yet; the buffered document is dropped, not flushed
+    assert client.requests in ([], [["AE_0", "AE_1", "AE_2"]])
+
+
+def test_an_abort_stops_retries_of_the_batch_in_flight():
+    in_flight = threading.Event()
+
+    def respond(ids):
+        # The producer fails while this request is in flight
+        in_flight.set()
+        deadline = time.monotonic() + 5
+        while not writer._aborted and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return {"AE_0": 503}
+
+    client = FakeSearchClient(respond)
+    with pytest.raises(RuntimeError):
+        with index_writer.IndexWriter(client, max_docs=2, workers=1, attempts=4) as writer:
+            writer.add(docs(2))
+            writer.add(docs(1))
+            assert in_flight.wait(5)
+            raise RuntimeError("embedding failed")
+
+    assert client.requests == [["AE_0", "AE_1"]]
+    assert writer.failed == {"AE_0": "503: failed"}
@@ -0,0 +1,65 @@
+"""StageRouter spillover, the circuit breakers of its deployments, and hedged calls."""
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from shared_code import ratelimit, resilience, routing, usage  # noqa: E402
+
+
+@pytest.fixture
+def half_open(monkeypatch):
+    """A single-deployment stage whose breaker has waited out its reset timeout."""
+    dep = routing.Deployment("https://primary.openai.azure.com", "key", "gpt-4.1")
+    breaker = resilience.CircuitBreaker(dep.label, failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    monkeypatch.setattr(resilience, "get_breaker", lambda name: breaker)
+    return routing.StageRouter({"draft": [dep]}), breaker
+
+
+def test_a_quota_timeout_releases_the_half_open_probe(half_open):
+    router, breaker = half_open
+
+    def throttled(dep):
+        raise ratelimit.RateLimitTimeout("Quota not available")
+
+    with pytest.raises(ratelimit.RateLimitTimeout):
+        router.call("draft", throttled)
+
+    # The next call may probe the deployment, and closes the breaker when it succeeds
+    assert router.call("draft", lambda dep: dep.deployment) == "gpt-4.1"
+    assert breaker.state == "closed"
+
+
+def test_a_probe_in_flight_rejects_other_calls(half_open):
+    router, breaker = half_open
+    breaker.before_call()
+
+    with pytest.raises(resilience.CircuitOpenError):
+        router.call("draft", lambda dep: dep.deployment)
+
+    breaker.release()
+    assert router.call("draft", lambda dep: dep.deployment) == "gpt-4.1"
+
+
+def test_hedged_calls_record_usage_on_the_callers_tracker():
+    release = threading.Event()
+    calls = []
+
+    def search():
+        calls.append(usage.current())
+        usage.record("search", "text-embedding-3-small", {"prompt_tokens": 10})
+        if len(calls) == 1:
+            # The primary stalls, so the hedge is launched and wins
+            release.wait(5)
+        return len(calls)
+
+    with usage.track() as tracker:
+        assert resilience.hedged_call(search, "test-search", delay=0.05) == 2
+        release.set()
+
+    assert calls == [tracker, tracker]
+    assert tracker.totals()["prompt_tokens"] == 20
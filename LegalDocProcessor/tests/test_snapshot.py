@@ -0,0 +1,296 @@
+"""Snapshot files, their publication, and the fallback of /api/ask to live search.
+
+``snapshot_store`` publishes to an in-memory blob container (see conftest),
+and ``RemoteSnapshot`` reads the same container through a stand-in for
+``requests.get``, so the whole pointer and index state protocol runs.
+"""
+import importlib
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import process_document
+from shared_code import snapshot, snapshot_store
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+API_DIR = os.path.join(HERE, "..", "..", "Legal", "api")
+CONTAINER = "snapshots"
+CONTAINER_URL = f"https://account.blob.core.windows.net/{CONTAINER}?sv=sas"
+DIMS = 4
+
+
+def vector(*values):
+    return list(values) + [0.0] * (DIMS - len(values))
+
+
+def rows_of(iso_code, count, **fields):
+    return [
+        dict({"id": f"{iso_code}_{i}", "iso_code": iso_code, "chunk": f"{iso_code} chunk {i}",
+              "chunk_type": "text", "parent_id": f"{iso_code}_p0", "section_path": "Entry > Visas",
+              "embedding": vector(1.0, float(i + 1))}, **fields)
+        for i in range(count)
+    ]
+
+
+class FakeResponse:
+    def __init__(self, status_code, data=b""):
+        self.status_code = status_code
+        self._data = data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def json(self):
+        return json.loads(self._data)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self._data), chunk_size):
+            yield self._data[start:start + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+@pytest.fixture
+def published(monkeypatch, blob_service, tmp_path):
+    """The snapshot container, served to ``RemoteSnapshot`` as over HTTP."""
+    monkeypatch.setenv("KNIFE_SNAPSHOT_CONTAINER", CONTAINER)
+    container = blob_service.get_container_client(CONTAINER)
+
+    def get(url, **kwargs):
+        name = url.split("?")[0].split(f"/{CONTAINER}/", 1)[1]
+        if name not in container.blobs:
+            return FakeResponse(404)
+        return FakeResponse(200, container.read(name))
+
+    # Both apps' copies of the snapshot module read through requests.get
+    monkeypatch.setattr(snapshot.requests, "get", get)
+    return container
+
+
+def remote(tmp_path):
+    return snapshot.RemoteSnapshot(CONTAINER_URL, cache_dir=str(tmp_path / "cache"), refresh_s=0)
+
+
+@pytest.mark.parametrize("dtype", ["float32", "float16"])
+def test_round_trip_keeps_ids_vectors_fields_and_parents(tmp_path, dtype):
+    # Countries arrive interleaved; each must come back as one row range in arrival order
+    rows = rows_of("BR", 2) + rows_of("AE", 3, chunk_type="table", table_id="2") + rows_of("BR", 1)
+    rows[-1]["id"] = "BR_2"
+    parents = [{"id": "AE_p0", "iso_code": "AE", "chunk": "Entry\n\nAll visas"},
+               {"id": "BR_p0", "iso_code": "BR", "chunk": "Entrada"}]
+    path = str(tmp_path / "index.snap")
+
+    header = snapshot.write_snapshot(path, iter(rows), "v1", dtype=dtype, parents=iter(parents),
+                                     stamps={"AE": "s-ae", "FR": "s-fr"})
+    snap = snapshot.Snapshot(path)
+
+    assert header["rows"] == snap.rows == 6
+    assert snap.countries == {"AE": [0, 3], "BR": [3, 6]}
+    assert snap.stamps == {"AE": "s-ae"}
+    assert [snap.row_id(row) for row in range(snap.rows)] == ["AE_0", "AE_1", "AE_2", "BR_0", "BR_1", "BR_2"]
+    assert snap.value(0, "chunk_type") == "table" and snap.value(3, "chunk_type") == "text"
+    assert snap.value(0, "section_path") == "Entry > Visas"
+    assert snap.value(0, "not_stored") == ""
+
+    by_id = {row["id"]: row for row in rows}
+    for row in snap.iter_rows():
+        expected = np.asarray(by_id[row["id"]]["embedding"], dtype=np.float32)
+        np.testing.assert_allclose(row["embedding"], expected / np.linalg.norm(expected), atol=1e-3)
+        assert row["chunk"] == by_id[row["id"]]["chunk"]
+    assert [row["id"] for row in snap.iter_rows(exclude=["AE"])] == ["BR_0", "BR_1", "BR_2"]
+
+    assert snap.parent("AE_p0") == parents[0]
+    assert snap.parent("missing") is None
+    assert list(snap.iter_parents(exclude=["AE"])) == [parents[1]]
+
+
+def test_search_ranks_within_the_requested_countries(tmp_path):
+    rows = rows_of("AE", 3) + rows_of("BR", 3)
+    rows[4]["embedding"] = vector(0.0, 0.0, 1.0)
+    rows[1]["chunk_type"] = "table"
+    path = str(tmp_path / "index.snap")
+    snapshot.write_snapshot(path, rows, "v1")
+    snap = snapshot.Snapshot(path)
+
+    hits = snap.search(vector(0.0, 0.0, 1.0), ["BR"], k=2)
+    assert [hit["id"] for hit in hits] == ["BR_1", "BR_0"]
+    assert hits[0]["@search.score"] == pytest.approx(1.0)
+    assert {hit["iso_code"] for hit in snap.search(vector(1.0, 1.0), ["AE", "XX"], k=10)} == {"AE"}
+    assert [hit["id"] for hit in snap.search(vector(1.0), ["AE"], k=10, chunk_types=["table"])] == ["AE_1"]
+    assert snap.search(vector(1.0), ["XX"], k=3) == []
+
+
+def test_empty_snapshot(tmp_path):
+    path = str(tmp_path / "empty.snap")
+    snapshot.write_snapshot(path, [], "v0")
+    snap = snapshot.Snapshot(path)
+    assert snap.rows == 0 and snap.countries == {} and snap.parent_count == 0
+    assert list(snap.iter_rows()) == [] and snap.parent("AE_p0") is None
+
+
+def test_publishing_merges_countries_and_their_stamps(published, blob_service, tmp_path):
+    ae = snapshot_store.mark_indexing(blob_service, "AE")
+    snapshot_store.mark_indexed(blob_service, "AE", ae)
+    snapshot_store.update_snapshot(blob_service, ["AE"], rows_of("AE", 2), tag="AE", stamps={"AE": ae})
+    br = snapshot_store.mark_indexing(blob_service, "BR")
+    snapshot_store.mark_indexed(blob_service, "BR", br)
+    header = snapshot_store.update_snapshot(blob_service, ["BR"], rows_of("BR", 1), tag="BR", stamps={"BR": br})
+
+    assert header["countries"] == {"AE": [0, 2], "BR": [2, 3]}
+    assert header["stamps"] == {"AE": ae, "BR": br}
+    pointer = json.loads(published.read(snapshot.POINTER_BLOB))
+    assert pointer["version"] == header["version"]
+    assert snapshot_store.indexed_stamps(blob_service) == {"AE": ae, "BR": br}
+
+    snap = remote(tmp_path).get()
+    assert snap.version == header["version"]
+    assert [snap.row_id(row) for row in range(snap.rows)] == ["AE_0", "AE_1", "BR_0"]
+
+
+def test_countries_being_written_or_changed_since_the_snapshot_are_stale(published, blob_service, tmp_path):
+    stamp = snapshot_store.mark_indexing(blob_service, "AE")
+    snapshot_store.mark_indexed(blob_service, "AE", stamp)
+    snapshot_store.update_snapshot(blob_service, ["AE", "BR"], rows_of("AE", 1) + rows_of("BR", 1),
+                                   stamps={"AE": stamp})
+    reader = remote(tmp_path)
+    snap = reader.get()
+    # BR has no stamp on either side (written before stamps existed) and counts as current
+    assert reader.stale(snap, ["AE", "BR"]) == []
+
+    newer = snapshot_store.mark_indexing(blob_service, "AE")
+    reader.get()
+    assert snapshot_store.write_pending(blob_service, "AE")
+    assert reader.stale(snap, ["AE", "BR"]) == ["AE"]
+
+    # Written, but the snapshot still holds the rows of the previous write
+    snapshot_store.mark_indexed(blob_service, "AE", newer)
+    assert reader.stale(reader.get(), ["AE"]) == ["AE"]
+
+    snapshot_store.update_snapshot(blob_service, ["AE"], rows_of("AE", 1), stamps={"AE": newer})
+    assert reader.stale(reader.get(), ["AE"]) == []
+
+
+def test_an_older_write_does_not_complete_a_newer_one(published, blob_service):
+    older = snapshot_store.mark_indexing(blob_service, "AE")
+    newer = snapshot_store.mark_indexing(blob_service, "AE")
+
+    assert not snapshot_store.mark_indexed(blob_service, "AE", older)
+    assert snapshot_store.write_pending(blob_service, "AE")
+    assert snapshot_store.mark_indexed(blob_service, "AE", newer)
+    assert snapshot_store.indexed_stamps(blob_service) == {"AE": newer}
+
+
+def test_forget_drops_the_state_of_deleted_countries(published, blob_service):
+    for iso_code in ("AE", "BR", "FR"):
+        snapshot_store.mark_indexed(blob_service, iso_code, snapshot_store.mark_indexing(blob_service, iso_code))
+
+    snapshot_store.forget(blob_service, ["AE", "XX"])
+    assert set(snapshot_store.indexed_stamps(blob_service)) == {"BR", "FR"}
+
+    snapshot_store.mark_all_indexing(blob_service, ["DE"])
+    assert all(snapshot_store.write_pending(blob_service, iso) for iso in ("BR", "FR", "DE"))
+
+    snapshot_store.forget(blob_service, [], everything=True)
+    assert json.loads(published.read(snapshot.STATE_BLOB)) == {"countries": {}}
+
+
+def test_nothing_is_published_without_a_container(monkeypatch, blob_service):
+    monkeypatch.delenv("KNIFE_SNAPSHOT_CONTAINER", raising=False)
+    assert snapshot_store.mark_indexing(blob_service, "AE") is None
+    assert snapshot_store.update_snapshot(blob_service, ["AE"], rows_of("AE", 1)) is None
+    snapshot_store.forget(blob_service, ["AE"])
+    assert blob_service.containers == {}
+
+
+@pytest.fixture
+def ask(monkeypatch):
+    """The API's ask module, imported with the API app's own ``shared_code`` package."""
+    for name in [name for name in sys.modules if name == "shared_code" or name.startswith("shared_code.")]:
+        monkeypatch.delitem(sys.modules, name)
+    monkeypatch.syspath_prepend(API_DIR)
+    module = importlib.import_module("ask")
+    yield module
+    for name in [name for name in sys.modules if name in ("ask", "shared_code") or name.startswith("shared_code.")]:
+        del sys.modules[name]
+
+
+@pytest.fixture
+def search_service(monkeypatch, ask):
+    """Records the vector queries that reach the search service."""
+    queries = []
+
+    def post(session, url, headers, payload, timeout=15):
+        queries.append(payload)
+        return SimpleNamespace(json=lambda: {"value": [{"id": "from-search", "iso_code": "AE", "chunk": "live"}]})
+
+    monkeypatch.setattr(ask, "_post_and_raise", post)
+    monkeypatch.setattr(ask, "get_session", lambda: None)
+    return queries
+
+
+def search_hits(ask, iso_codes):
+    span = {}
+    hits = ask._search_hits(vector(1.0), iso_codes, {"search_endpoint": "https://search.invalid",
+                                                     "index_name": "knife-index", "search_key": "key"},
+                            3, None, SimpleNamespace(set=lambda **fields: span.update(fields)))
+    return hits, span
+
+
+def test_ask_falls_back_to_search_when_the_snapshot_is_stale_or_missing(
+        monkeypatch, published, blob_service, tmp_path, ask, search_service):
+    monkeypatch.setenv("RETRIEVAL_BACKEND", "snapshot")
+    monkeypatch.setenv("KNIFE_SNAPSHOT_URL", CONTAINER_URL)
+    monkeypatch.setenv("SNAPSHOT_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setenv("SNAPSHOT_REFRESH_S", "0")
+    monkeypatch.setattr(ask, "SNAPSHOT", None)
+
+    # No snapshot published yet
+    hits, span = search_hits(ask, ["AE"])
+    assert span["backend"] == "search" and [hit["id"] for hit in hits] == ["from-search"]
+
+    stamp = snapshot_store.mark_indexing(blob_service, "AE")
+    snapshot_store.mark_indexed(blob_service, "AE", stamp)
+    snapshot_store.update_snapshot(blob_service, ["AE"], rows_of("AE", 2), stamps={"AE": stamp})
+    hits, span = search_hits(ask, ["AE"])
+    assert span["backend"] == "snapshot" and hits[0]["id"].startswith("AE_")
+    assert len(search_service) == 1
+
+    # A country the snapshot does not hold
+    assert search_hits(ask, ["AE", "BR"])[1]["backend"] == "search"
+
+    # A country being written again
+    snapshot_store.mark_indexing(blob_service, "AE")
+    hits, span = search_hits(ask, ["AE"])
+    assert span["backend"] == "search" and span["snapshot_stale"] == "AE"
+    assert len(search_service) == 3
+
+
+def test_ask_cites_tables_and_figures_from_the_snapshot(monkeypatch, published, blob_service, tmp_path, ask,
+                                                       search_service):
+    monkeypatch.setenv("RETRIEVAL_BACKEND", "snapshot")
+    monkeypatch.setenv("KNIFE_SNAPSHOT_URL", CONTAINER_URL)
+    monkeypatch.setenv("SNAPSHOT_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(ask, "SNAPSHOT", None)
+    chunks = [
+        {"text": "| Item | Limit |", "metadata": {"chunk_type": "table", "table_id": "table_3",
+                                                   "section_path": ["Customs"]}},
+        {"text": "A map of the border", "metadata": {"chunk_type": "image", "figure_id": "img_2"}},
+        {"text": "Visas are required.", "metadata": {"chunk_type": "text", "section_path": ["Entry", "Visas"]}},
+    ]
+    rows = [process_document.chunk_document("AE", i, chunk, vector(1.0, float(i))) for i, chunk in enumerate(chunks)]
+    snapshot_store.update_snapshot(blob_service, ["AE"], rows)
+
+    hits, span = search_hits(ask, ["AE"])
+
+    assert span["backend"] == "snapshot" and not search_service
+    labels = {hit["id"]: ask.source_label(hit) for hit in hits}
+    assert labels == {"AE_0": "Table table_3", "AE_1": "Figure img_2", "AE_2": "Entry > Visas"}
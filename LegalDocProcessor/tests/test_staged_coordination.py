@@ -0,0 +1,180 @@
+"""Staged ingestion keeps its runs when every stage builds its own coordinator.
+
+On storage queues the stages of one run execute in different invocations, so
+each one resolves its coordinator anew. These tests run the stages through
+``scripts/ingest_local.py`` with a fresh coordinator per stage message and
+check that the run still reaches the index, and that the configurations that
+would drop runs are refused or avoided.
+
+Search and OpenAI calls are replaced by in-memory fakes; parsing, chunking,
+checkpoints, queues and coordination are the real ones.
+"""
+import dataclasses
+import os
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+from docx import Document
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+sys.path.insert(0, os.path.join(HERE, "..", "..", "scripts"))
+
+import ingest_local  # noqa: E402
+from process_document import staged  # noqa: E402
+from shared_code import coordination, stage_queue  # noqa: E402
+
+
+class FakeIndex:
+    """The SearchClient calls staged ingestion makes, over a dict."""
+
+    def __init__(self):
+        self.docs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _results(documents):
+        return [SimpleNamespace(key=doc["id"], succeeded=True, status_code=200, error_message=None)
+                for doc in documents]
+
+    def upload_documents(self, documents):
+        with self._lock:
+            self.docs.update({doc["id"]: doc for doc in documents})
+        return self._results(documents)
+
+    def delete_documents(self, documents):
+        with self._lock:
+            for doc in documents:
+                self.docs.pop(doc["id"], None)
+        return self._results(documents)
+
+    def search(self, search_text="*", filter=None, select=None, **kwargs):
+        iso_code = filter.split("'")[1]
+        with self._lock:
+            return [{"id": doc_id} for doc_id, doc in self.docs.items() if doc["iso_code"] == iso_code]
+
+
+SETTINGS = {
+    "KNIFE_SEARCH_ENDPOINT": "https://search.invalid",
+    "KNIFE_SEARCH_KEY": "key",
+    "KNIFE_SEARCH_INDEX": "knife-index",
+    "KNIFE_OPENAI_ENDPOINT": "https://openai.invalid",
+    "KNIFE_OPENAI_KEY": "key",
+    "KNIFE_OPENAI_DEPLOY": "text-embedding-3-large",
+    "INGEST_DEBOUNCE_S": "0",
+    # ingest_local.main sets these; setting them here restores them after the test
+    "INGEST_MODE": "staged",
+    "INGEST_QUEUE": "local",
+    "INGEST_CHECKPOINT": "memory",
+    "INGEST_COORDINATION": "",
+    "INGEST_CAPTION_CONCURRENCY": "1",
+    "INGEST_EMBED_CONCURRENCY": "1",
+    "INGEST_INDEX_CONCURRENCY": "1",
+}
+UNSET = (
+    "KNIFE_STORAGE_CONNECTION_STRING", "KNIFE_MANIFEST_CONTAINER", "KNIFE_SNAPSHOT_CONTAINER",
+    "KNIFE_CHECKPOINT_CONTAINER", "KNIFE_INDEX_ALIAS_CONTAINER", "MANIFEST_STORE", "OPENAI_CHAT_DEPLOY",
+    "INDEX_TARGET",
+)
+
+
+@pytest.fixture
+def environment(monkeypatch):
+    for name, value in SETTINGS.items():
+        monkeypatch.setenv(name, value)
+    for name in UNSET:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(ingest_local, "load_dotenv", lambda: None)
+    monkeypatch.setattr(staged, "CONTEXT", None)
+    monkeypatch.setattr(stage_queue, "_LOCAL", None)
+
+
+@pytest.fixture
+def index(monkeypatch, environment):
+    fake = FakeIndex()
+    monkeypatch.setattr(staged.StageContext, "search_client", lambda self, index_name: fake)
+    monkeypatch.setattr(staged.index_schema, "validate", lambda *args: {
+        "id", "iso_code", "chunk", "embedding", "chunk_type", "table_id", "figure_id", "table_md",
+        "parent_id", "section_path",
+    })
+    monkeypatch.setattr(
+        staged, "embed_batch", lambda batch, router, dims, stage="embed": [[0.5] * dims for _ in batch]
+    )
+    return fake
+
+
+@pytest.fixture
+def fresh_coordinators(monkeypatch):
+    """Gives every stage message its own coordinator, as separate processes would have."""
+    made = []
+    context = staged.get_context
+
+    def fresh_context():
+        ctx = context()
+        coordinator = coordination.from_env(ctx.blob_service_client)
+        made.append(coordinator)
+        return dataclasses.replace(ctx, coordinator=coordinator)
+
+    monkeypatch.setattr(staged, "get_context", fresh_context)
+    return made
+
+
+def country_document(path, paragraphs=12):
+    document = Document()
+    document.add_heading("Entry requirements", level=1)
+    for n in range(paragraphs):
+        document.add_paragraph(f"Rule {n}: travellers must carry the documents listed in annex {n}. " * 4)
+    document.save(path)
+    return path
+
+
+def test_stages_with_fresh_coordinators_reach_the_index(tmp_path, index, fresh_coordinators):
+    source = country_document(str(tmp_path / "AE.docx"))
+    checkpoint_dir = tmp_path / "checkpoints"
+
+    assert ingest_local.main([source, "--checkpoints", str(checkpoint_dir)]) == 0
+
+    assert os.environ["INGEST_COORDINATION"].startswith("sqlite:")
+    assert len(fresh_coordinators) >= 2
+    assert len({id(coordinator) for coordinator in fresh_coordinators}) == len(fresh_coordinators)
+    assert index.docs, "the run was dropped before its index stage wrote anything"
+    assert {doc["iso_code"] for doc in index.docs.values()} == {"AE"}
+    assert not os.path.exists(checkpoint_dir / "AE")
+
+
+def test_a_newer_upload_still_supersedes_across_fresh_coordinators(tmp_path, index, fresh_coordinators):
+    source = country_document(str(tmp_path / "AE.docx"))
+    checkpoint_dir = tmp_path / "checkpoints"
+    os.environ["INGEST_COORDINATION"] = f"sqlite:{checkpoint_dir / 'coordination.db'}"
+    embed = staged.embed_batch
+
+    def embed_then_reupload(batch, router, dims, stage="embed"):
+        # A newer upload of the country registers while the first run embeds
+        coordination.from_env().register("AE")
+        return embed(batch, router, dims, stage)
+
+    staged.embed_batch = embed_then_reupload
+    try:
+        assert ingest_local.main([source, "--checkpoints", str(checkpoint_dir)]) == 0
+    finally:
+        staged.embed_batch = embed
+    assert not index.docs
+
+
+def test_staged_mode_on_storage_queues_refuses_local_coordination(monkeypatch, environment):
+    monkeypatch.setenv("INGEST_QUEUE", "storage")
+    with pytest.raises(RuntimeError, match="blob coordination"):
+        staged.require_shared_coordination(coordination.LocalCoordinator())
+    staged.require_shared_coordination(coordination.NullCoordinator())
+
+
+def test_checkpoint_container_selects_blob_coordination(monkeypatch, environment):
+    monkeypatch.setenv("INGEST_COORDINATION", "")
+    monkeypatch.setenv("KNIFE_CHECKPOINT_CONTAINER", "ingest-checkpoints")
+    monkeypatch.setattr(coordination, "_BLOB", {})
+    container = SimpleNamespace(create_container=lambda: None)
+    client = SimpleNamespace(get_container_client=lambda name: container)
+
+    assert isinstance(coordination.from_env(client), coordination.BlobCoordinator)
@@ -4,6 +4,7 @@ import logging
 import os
 from azure.storage.blob import BlobServiceClient
 import base64
+from shared_code import status_cache
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Upload blob function processed a request.')
@@ -80,10 +81,14 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             )
         
         # Upload the blob (caption/OCR always enabled)
+        # "force": true re-ingests the document even when its content is unchanged
+        force = str(req_body.get('force', '')).lower() in ('1', 'true', 'yes')
         blob_client.upload_blob(
             decoded_data,
-            overwrite=True
+            overwrite=True,
+            metadata={'force_reingest': 'true'} if force else None
         )
+        status_cache.invalidate()
         
         logging.info(f"Successfully uploaded {filename} to container {container_name}")
         
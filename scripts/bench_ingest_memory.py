@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Peak-memory benchmark for streaming ingestion (shared_code/docx_stream.py).
+
+Generates a synthetic country document (paragraphs, tables and incompressible
+images) and runs the ingestion memory pattern on it in a fresh process per
+mode, with embeddings and index uploads replaced by local fakes:
+
+- ``legacy``: the blob read into ``bytes``, python-docx opened on it (every image
+  loaded), image bytes kept in the element list, and every chunk's 3072-float
+  embedding kept as a Python list until one final upload;
+- ``streaming``: the blob spooled to disk, a media-less copy parsed block by
+  block, images read one at a time, and embeddings uploaded in
+  ``--batch``-sized batches while only a float32 memmap keeps them for the
+  snapshot.
+
+Prints peak RSS and wall time per mode and document size; peak RSS of the
+streaming mode should stay roughly flat as the document grows.
+
+Usage: python scripts/bench_ingest_memory.py [--sizes 1,4,8] [--images-per-unit 10] [--batch 64]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import numpy as np
+from docx import Document
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LegalDocProcessor"))
+from shared_code import chunking, docx_stream  # noqa: E402
+
+DIMS = 3072
+
+
+def make_document(path: str, units: int, images_per_unit: int, image_px: int) -> None:
+    """Writes a document of ``units`` chapters, each with articles, a table and images."""
+    rng = random.Random(units)
+    doc = Document()
+    for u in range(units):
+        doc.add_heading(f"Chapter {u + 1}", level=1)
+        for a in range(40):
+            doc.add_paragraph(f"Article {u * 40 + a + 1}", style="Heading 2")
+            for _ in range(3):
+                doc.add_paragraph(" ".join(rng.choice(("knife", "blade", "length", "public", "carry", "permit",
+                                                       "prohibited", "exception", "6", "12", "cm", "the", "of"))
+                                           for _ in range(80)) + ".")
+        table = doc.add_table(rows=20, cols=4)
+        for row in table.rows:
+            for cell in row.cells:
+                cell.text = str(rng.randint(1, 1000))
+        for i in range(images_per_unit):
+            pixels = np.random.default_rng(u * 1000 + i).integers(0, 255, (image_px, image_px, 3), dtype=np.uint8)
+            buf = BytesIO()
+            Image.fromarray(pixels).save(buf, format="PNG")
+            buf.seek(0)
+            doc.add_picture(buf)
+    doc.save(path)
+
+
+def fake_embedding(text: str):
+    rng = random.Random(hash(text))
+    return [rng.random() for _ in range(DIMS)]
+
+
+def fake_upload(documents) -> None:
+    # The search SDK serializes every batch to JSON
+    json.dumps(documents)
+
+
+def to_elements(blocks):
+    for block in blocks:
+        if hasattr(block, "rows"):
+            text = "\n".join(" | ".join(cell.text for cell in row.cells) for row in block.rows)
+            yield {"type": "table", "content": text, "metadata": {}}
+        elif block.text.strip():
+            yield {"type": "text", "content": block.text, "metadata": {"style": block.style.name}}
+
+
+def run_legacy(path: str, batch: int) -> dict:
+    with open(path, "rb") as f:
+        blob = f.read()
+    doc = Document(BytesIO(blob))
+    elements = list(to_elements(docx_stream.iter_blocks(doc)))
+    images = []
+    for rel in doc.part.rels.values():
+        if "image" in rel.reltype:
+            images.append({"type": "image", "data": rel.target_part.blob, "content": "Image", "metadata": {}})
+    chunks = chunking.build_chunks(elements, images)
+    embeddings = [fake_embedding(c["text"]) for c in chunks]
+    documents = [{"id": str(i), "chunk": c["text"], "embedding": embeddings[i]} for i, c in enumerate(chunks)]
+    fake_upload(documents)
+    return {"chunks": len(chunks), "images": len(images)}
+
+
+def run_streaming(path: str, batch: int) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        package_path = os.path.join(workdir, "source.docx")
+        with open(path, "rb") as stream:
+            docx_stream.spool(stream, package_path)
+        text_path = os.path.join(workdir, "text.docx")
+        docx_stream.text_package(package_path, text_path)
+        doc = Document(text_path)
+        elements = list(to_elements(docx_stream.iter_blocks(doc)))
+        parts = docx_stream.image_parts(doc)
+        del doc
+        images = []
+        for name, _, data in docx_stream.iter_images(package_path, parts):
+            images.append({"type": "image", "content": f"Image {len(data)}", "metadata": {"filename": name}})
+            del data
+        chunks = chunking.build_chunks(elements, images)
+        vectors = np.memmap(os.path.join(workdir, "vectors.f32"), dtype="float32", mode="w+",
+                            shape=(max(1, len(chunks)), DIMS))
+        for start in range(0, len(chunks), batch):
+            embeddings = [fake_embedding(c["text"]) for c in chunks[start:start + batch]]
+            vectors[start:start + len(embeddings)] = embeddings
+            fake_upload([{"id": str(start + j), "chunk": c["text"], "embedding": embeddings[j]}
+                         for j, c in enumerate(chunks[start:start + batch])])
+        del vectors
+    return {"chunks": len(chunks), "images": len(images)}
+
+
+def child(mode: str, path: str, batch: int) -> None:
+    t0 = time.perf_counter()
+    result = (run_legacy if mode == "legacy" else run_streaming)(path, batch)
+    result.update(seconds=round(time.perf_counter() - t0, 2), peak_rss_mb=docx_stream.peak_rss_mb())
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="1,4,8", help="comma-separated document sizes in chapters")
+    parser.add_argument("--images-per-unit", type=int, default=10)
+    parser.add_argument("--image-px", type=int, default=400, help="image width/height (random RGB, ~470 KB at 400)")
+    parser.add_argument("--batch", type=int, default=64)
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child[0], args.child[1], args.batch)
+        return
+
+    print(f"{'chapters':>8} {'MB':>7} {'chunks':>7} {'images':>7} {'mode':>10} {'peak RSS MB':>12} {'seconds':>8}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for units in (int(s) for s in args.sizes.split(",")):
+            path = os.path.join(tmp, f"bench_{units}.docx")
+            make_document(path, units, args.images_per_unit, args.image_px)
+            size_mb = os.path.getsize(path) / 1024 / 1024
+            for mode in ("legacy", "streaming"):
+                out = subprocess.run(
+                    [sys.executable, __file__, "--batch", str(args.batch), "--child", mode, path],
+                    check=True, capture_output=True, text=True,
+                ).stdout
+                r = json.loads(out.strip().splitlines()[-1])
+                print(f"{units:>8} {size_mb:>7.1f} {r['chunks']:>7} {r['images']:>7} {mode:>10} "
+                      f"{r['peak_rss_mb']:>12.1f} {r['seconds']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Quota-pressure benchmark for the client-side rate limiter (shared_code/ratelimit.py).
+
+Starts a local fake Azure OpenAI endpoint that enforces a tokens-per-minute
+quota (429 + retry-after-ms + x-ratelimit-* headers, like the real service),
+then runs background "ingestion" workers hammering it while an interactive
+"ask" client sends a request every second. Runs once without and once with the
+limiter; the ingestion and ask sides use separate limiter instances, just like
+the two Function Apps, and only coordinate through the response headers.
+
+Usage: python scripts/bench_rate_limit.py [--seconds 20] [--tpm 120000] [--workers 8]
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LegalDocProcessor"))
+from shared_code import ratelimit, resilience  # noqa: E402
+
+
+class FakeQuota:
+    """Server-side token bucket mirroring an Azure OpenAI deployment quota."""
+
+    def __init__(self, tpm: int):
+        self.bucket = ratelimit.TokenBucket(tpm)
+        self.lock = threading.Lock()
+        self.throttled = 0
+
+    def consume(self, tokens: int):
+        with self.lock:
+            self.bucket.refill(time.monotonic())
+            if self.bucket.level < tokens:
+                self.throttled += 1
+                wait_ms = (tokens - self.bucket.level) / self.bucket.rate * 1000
+                return False, wait_ms, self.bucket.level
+            self.bucket.take(tokens)
+            return True, 0, self.bucket.level
+
+
+def make_handler(quota: FakeQuota, latency: float):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            ok, wait_ms, remaining = quota.consume(body["tokens"])
+            headers = {
+                "x-ratelimit-limit-tokens": str(int(quota.bucket.capacity)),
+                "x-ratelimit-remaining-tokens": str(int(remaining)),
+            }
+            if not ok:
+                headers["retry-after-ms"] = str(int(wait_ms) + 1)
+            time.sleep(latency)
+            self.send_response(200 if ok else 429)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b'{"ok": true}')
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def run_scenario(url: str, seconds: float, workers: int, tpm: int, use_limiter: bool) -> dict:
+    stop = threading.Event()
+    # Separate limiters per "app": they only learn about each other through headers.
+    ingest_limiter = ratelimit.DeploymentLimiter("bench-ingest", tpm=tpm) if use_limiter else None
+    ask_limiter = ratelimit.DeploymentLimiter("bench-ask", tpm=tpm) if use_limiter else None
+    background_done = [0]
+    background_lock = threading.Lock()
+    interactive = []
+
+    def send(session, tokens, limiter, priority, deadline):
+        def once():
+            if limiter is not None:
+                limiter.acquire(tokens, priority, timeout=deadline)
+            resp = session.post(url, json={"tokens": tokens}, timeout=10)
+            if limiter is not None:
+                limiter.observe(resp.headers)
+            resp.raise_for_status()
+            return resp
+
+        return resilience.call_with_retries(once, attempts=3, initial_delay=0.2, deadline=deadline)
+
+    def background():
+        session = requests.Session()
+        while not stop.is_set():
+            try:
+                send(session, 500, ingest_limiter, ratelimit.BACKGROUND, 60.0)
+                with background_lock:
+                    background_done[0] += 1
+            except Exception:
+                pass
+
+    def foreground():
+        session = requests.Session()
+        while not stop.is_set():
+            t0 = time.monotonic()
+            try:
+                send(session, 1500, ask_limiter, ratelimit.INTERACTIVE, 5.0)
+                interactive.append((True, time.monotonic() - t0))
+            except Exception:
+                interactive.append((False, time.monotonic() - t0))
+            time.sleep(max(0.0, 1.0 - (time.monotonic() - t0)))
+
+    threads = [threading.Thread(target=background, daemon=True) for _ in range(workers)]
+    threads.append(threading.Thread(target=foreground, daemon=True))
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join(timeout=15)
+
+    latencies = sorted(lat for ok, lat in interactive if ok)
+    return {
+        "interactive_requests": len(interactive),
+        "interactive_failed": sum(1 for ok, _ in interactive if not ok),
+        "interactive_p50_ms": int(statistics.median(latencies) * 1000) if latencies else None,
+        "interactive_max_ms": int(latencies[-1] * 1000) if latencies else None,
+        "background_tokens_per_s": int(background_done[0] * 500 / seconds),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=20.0)
+    parser.add_argument("--tpm", type=int, default=120000)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=30.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)  # retry warnings would drown the results
+
+    for use_limiter in (False, True):
+        quota = FakeQuota(args.tpm)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(quota, args.latency_ms / 1000))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/embeddings"
+        result = run_scenario(url, args.seconds, args.workers, args.tpm, use_limiter)
+        result["server_429s"] = quota.throttled
+        server.shutdown()
+        print(f"{'with limiter' if use_limiter else 'no limiter':>13}: {json.dumps(result)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Builds an in-process retrieval snapshot from the whole search index.
+
+Ingestion publishes snapshots incrementally (one country at a time); run this
+once to seed the snapshot container, or after changes made outside the
+Function App. Reads every document's id, iso_code, chunk, embedding and chunk
+metadata (type, table/figure id, parent, section path), one country at a time, and either publishes the result to
+``KNIFE_SNAPSHOT_CONTAINER`` (replacing the previous snapshot) or writes it to
+a local file.
+
+Usage:
+  python scripts/build_snapshot.py                  # publish to the snapshot container
+  python scripts/build_snapshot.py --out knife.snap # local file only
+  python scripts/build_snapshot.py --query-check    # also time top-k queries on the result
+  python scripts/build_snapshot.py --from-export backup --out knife.snap --query-check   # offline, from index_backup.py
+
+Reads KNIFE_SEARCH_ENDPOINT, KNIFE_SEARCH_KEY, KNIFE_SEARCH_INDEX (or the
+alias record's active index) and (to publish) KNIFE_STORAGE_CONNECTION_STRING
+from the environment or a .env file.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents import SearchClient
+from azure.storage.blob import BlobServiceClient
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LegalDocProcessor"))
+from shared_code import index_alias, snapshot, snapshot_store, vector_fields  # noqa: E402
+
+
+# Stored in the snapshot's string table when the index has them (see snapshot.DEFAULT_FIELDS)
+METADATA_FIELDS = ["chunk_type", "table_id", "figure_id", "parent_id", "section_path"]
+
+
+def read_index(search_client: SearchClient, vector_field: str = "embedding"):
+    """Yields all documents, querying one country at a time; ``vector_field`` is returned as ``embedding``."""
+    facets = search_client.search(search_text="*", facets=["iso_code,count:1000"], top=0).get_facets()
+    metadata = METADATA_FIELDS
+    for facet in facets.get("iso_code", []):
+        iso_code = facet["value"]
+        t0 = time.monotonic()
+        try:
+            docs = list(search_client.search(
+                search_text="*",
+                filter=f"iso_code eq '{iso_code}'",
+                select=["id", "iso_code", "chunk", vector_field] + metadata,
+            ))
+        except HttpResponseError as e:
+            if e.status_code != 400 or not metadata:
+                raise
+            # An index from before the chunk metadata fields
+            logging.warning(f"Index rejected the chunk metadata fields, reading without them: {e.message}")
+            metadata = []
+            docs = list(search_client.search(
+                search_text="*",
+                filter=f"iso_code eq '{iso_code}'",
+                select=["id", "iso_code", "chunk", vector_field],
+            ))
+        logging.info(f"{iso_code}: {len(docs)} documents in {time.monotonic() - t0:.1f}s")
+        for doc in docs:
+            if vector_field != "embedding":
+                doc["embedding"] = doc.pop(vector_field, None)
+            yield doc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--out", help="write the snapshot to this file instead of publishing it")
+    parser.add_argument("--dtype", default=os.environ.get("SNAPSHOT_DTYPE", "float32"), choices=["float32", "float16"])
+    parser.add_argument("--query-check", action="store_true", help="time filtered top-k queries on the snapshot")
+    parser.add_argument("--from-export", help="read the documents from an index_backup.py export, not the index")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    load_dotenv()
+    service = None if args.out else BlobServiceClient.from_connection_string(
+        os.environ["KNIFE_STORAGE_CONNECTION_STRING"]
+    )
+
+    # Countries without a completed index write stamp (or from an export) are answered from the index
+    # by /api/ask until ingestion publishes them again
+    stamps = {}
+    if args.from_export:
+        from index_backup import load_header, read_export
+        record = load_header(args.from_export).get("vector_fields") or vector_fields.default_record()
+        rows = (doc for doc in read_export(args.from_export, record["default"]) if doc["iso_code"] not in record["countries"])
+    else:
+        index_name = index_alias.resolve()
+        search_client = SearchClient(
+            endpoint=os.environ["KNIFE_SEARCH_ENDPOINT"],
+            index_name=index_name,
+            credential=AzureKeyCredential(os.environ["KNIFE_SEARCH_KEY"]),
+        )
+        record = vector_fields.current(index_name)
+        if vector_fields.migrating(record):
+            logging.warning(f"An embedding migration to {record['target']} is running; /api/ask ignores the snapshot "
+                            "until it finishes, and 'migrate_embeddings.py finish' publishes a new one")
+        if service is not None:
+            stamps = snapshot_store.indexed_stamps(service)
+        rows = (doc for doc in read_index(search_client, record["default"]) if doc.get("embedding"))
+
+    if args.out:
+        path = args.out
+        header = snapshot.write_snapshot(path, rows, snapshot.new_version("full"), dtype=args.dtype)
+    else:
+        os.environ["SNAPSHOT_DTYPE"] = args.dtype
+        header = snapshot_store.update_snapshot(service, [], rows, tag="full", replace_all=True, stamps=stamps)
+        if header is None:
+            sys.exit("KNIFE_SNAPSHOT_CONTAINER is not set; use --out to write a local file")
+        path = None
+    print(f"Snapshot {header['version']}: {header['rows']} rows, {len(header['countries'])} countries, "
+          f"{header['dims']} dims ({header['dtype']})")
+
+    if args.query_check and header["rows"]:
+        if path is None:
+            # The rows were streamed, so the published file is downloaded to check it
+            path = os.path.join(tempfile.mkdtemp(), "check.snap")
+            with open(path, "wb") as f:
+                service.get_container_client(snapshot_store.container_name()).get_blob_client(
+                    snapshot.snapshot_blob_name(header["version"])
+                ).download_blob().readinto(f)
+        snap = snapshot.Snapshot(path)
+        for iso_code in list(snap.countries)[:5]:
+            probe = snap.matrix[snap.countries[iso_code][0]]
+            t0 = time.perf_counter()
+            for _ in range(100):
+                hits = snap.search(probe, [iso_code], 5)
+            ms = (time.perf_counter() - t0) / 100 * 1000
+            print(f"  {iso_code}: top-5 in {ms:.3f} ms, best hit {hits[0]['id']} ({hits[0]['@search.score']:.3f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""Exports the search index to local files and restores it without calling any model.
+
+Recovering or cloning an environment used to mean ingesting every country
+again, with its captioning and embedding calls. An export holds what the
+index holds:
+
+  export DIR   reads every document, one country per partition with
+               ``--parallel`` partitions at a time, paging in key order
+               (``id gt '<last>'``), and writes per country
+               ``<ISO>.jsonl`` (text and metadata, one document per line) and
+               ``<ISO>.<field>.npy`` (a float32 or ``--dtype float16`` matrix
+               per vector field); ``export.json`` holds the index definition,
+               the vector field record and the counts
+  import DIR   uploads an export into the active index (or ``--index``,
+               created from the exported definition with ``--create``), one
+               country at a time under its ingestion lock, and deletes the
+               country's documents the export does not have; into the live
+               index the snapshot is republished from the export
+  info DIR     shows what an export holds
+
+Documents carry ``@rows`` in the JSONL, the row of each vector field they
+have a vector in (parent sections have none). ``read_export`` yields the
+documents with their vectors, e.g. for offline retrieval benchmarks; see
+also ``build_snapshot.py --from-export``.
+
+Usage:
+  python scripts/index_backup.py export backup-2026-10-18 --parallel 8
+  python scripts/index_backup.py import backup-2026-10-18 --index knife-index-v4 --create
+  python scripts/index_backup.py info backup-2026-10-18
+
+Reads KNIFE_SEARCH_ENDPOINT, KNIFE_SEARCH_KEY, KNIFE_SEARCH_INDEX (or the alias
+record's active index) and, for locks, vector field records and the
+snapshot, KNIFE_STORAGE_CONNECTION_STRING and KNIFE_SNAPSHOT_CONTAINER, from
+the environment or a .env file.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+from azure.storage.blob import BlobServiceClient
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LegalDocProcessor"))
+from shared_code import (coordination, index_alias, index_schema, index_writer, resilience,  # noqa: E402
+                         snapshot_store, vector_fields)
+
+HEADER = "export.json"
+ROWS = "@rows"
+VECTOR_TYPE = "Collection(Edm.Single)"
+PAGE_SIZE = 1000
+
+
+def search_client(index_name: str) -> SearchClient:
+    return SearchClient(
+        endpoint=os.environ["KNIFE_SEARCH_ENDPOINT"],
+        index_name=index_name,
+        credential=AzureKeyCredential(os.environ["KNIFE_SEARCH_KEY"]),
+    )
+
+
+def country_counts(client: SearchClient) -> dict:
+    facets = client.search(search_text="*", facets=["iso_code,count:1000"], top=0).get_facets()
+    return {facet["value"]: facet["count"] for facet in facets.get("iso_code", [])}
+
+
+def read_partition(client: SearchClient, iso_code: str, select: List[str]) -> Iterator[Dict[str, Any]]:
+    """Every document of a country, in pages ordered by key (drained unordered if ``id`` is not sortable)."""
+    scope = f"iso_code eq '{iso_code}'"
+    after = None
+    while True:
+        clause = f" and id gt '{after.replace(chr(39), chr(39) * 2)}'" if after else ""
+        try:
+            page = list(client.search(search_text="*", filter=scope + clause, order_by=["id asc"],
+                                      select=select, top=PAGE_SIZE))
+        except Exception as e:
+            if resilience.status_and_headers(e)[0] != 400:
+                raise
+            # The SDK pages with $skip, which is enough for one country
+            logging.warning(f"Key-ordered paging unavailable ({e}); reading {iso_code} unordered")
+            yield from client.search(search_text="*", filter=scope, select=select)
+            return
+        yield from page
+        if len(page) < PAGE_SIZE:
+            return
+        after = page[-1]["id"]
+
+
+def export_partition(client: SearchClient, iso_code: str, out_dir: str, select: List[str], vector_names: List[str],
+                     dtype: str) -> Dict[str, Any]:
+    """Writes a country's ``<ISO>.jsonl`` and ``<ISO>.<field>.npy``; returns its counts."""
+    vectors: Dict[str, List[Any]] = {name: [] for name in vector_names}
+    documents = 0
+    path = os.path.join(out_dir, f"{iso_code}.jsonl")
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        for doc in read_partition(client, iso_code, select):
+            doc = {key: value for key, value in doc.items() if not key.startswith("@search.")}
+            rows = {}
+            for name in vector_names:
+                vector = doc.pop(name, None)
+                if vector:
+                    rows[name] = len(vectors[name])
+                    vectors[name].append(vector)
+            if rows:
+                doc[ROWS] = rows
+            f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+            documents += 1
+    for name, rows in vectors.items():
+        if rows:
+            np.save(os.path.join(out_dir, f"{iso_code}.{name}.npy"), np.asarray(rows, dtype=dtype))
+    os.replace(f"{path}.tmp", path)
+    return {"documents": documents, "vectors": {name: len(rows) for name, rows in vectors.items() if rows}}
+
+
+def load_header(path: str) -> Dict[str, Any]:
+    with open(os.path.join(path, HEADER), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def read_country(path: str, iso_code: str, header: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """A country's documents from an export, vectors attached (as arrays) under their field names."""
+    matrices = {
+        name: np.load(os.path.join(path, f"{iso_code}.{name}.npy"), mmap_mode="r")
+        for name in header["partitions"][iso_code]["vectors"]
+    }
+    documents = []
+    with open(os.path.join(path, f"{iso_code}.jsonl"), encoding="utf-8") as f:
+        for line in f:
+            doc = json.loads(line)
+            for name, row in doc.pop(ROWS, {}).items():
+                doc[name] = matrices[name][row]
+            documents.append(doc)
+    return documents
+
+
+def read_export(path: str, vector_field: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """Yields an export's documents; with ``vector_field``, only those with that vector, as ``embedding``."""
+    header = load_header(path)
+    for iso_code in header["partitions"]:
+        for doc in read_country(path, iso_code, header):
+            if vector_field is None:
+                yield doc
+            elif vector_field in doc:
+                yield dict(doc, embedding=doc.pop(vector_field))
+
+
+def export(args, index_name: str) -> int:
+    endpoint, key = os.environ["KNIFE_SEARCH_ENDPOINT"], os.environ["KNIFE_SEARCH_KEY"]
+    definition = {k: v for k, v in index_schema.fetch_index(endpoint, key, index_name).items() if not k.startswith("@odata")}
+    select = [field["name"] for field in definition["fields"] if field.get("retrievable", True)]
+    vector_names = [field["name"] for field in definition["fields"] if field["type"] == VECTOR_TYPE and field["name"] in select]
+    client = search_client(index_name)
+    counts = country_counts(client)
+    os.makedirs(args.path, exist_ok=True)
+    print(f"Exporting {sum(counts.values())} documents of {len(counts)} countries from {index_name}, "
+          f"{args.parallel} at a time")
+
+    started = time.monotonic()
+    partitions: Dict[str, Dict[str, Any]] = {}
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.parallel), thread_name_prefix="export") as pool:
+        futures = {
+            pool.submit(export_partition, client, iso_code, args.path, select, vector_names, args.dtype): iso_code
+            for iso_code in sorted(counts)
+        }
+        for future in as_completed(futures):
+            iso_code = futures[future]
+            try:
+                partitions[iso_code] = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"{iso_code}: export failed: {e}", file=sys.stderr)
+                continue
+            if partitions[iso_code]["documents"] != counts[iso_code]:
+                print(f"{iso_code}: {partitions[iso_code]['documents']} documents read, {counts[iso_code]} counted "
+                      "(the index changed during the export?)", file=sys.stderr)
+    seconds = time.monotonic() - started
+    documents = sum(partition["documents"] for partition in partitions.values())
+    record, _ = vector_fields.read(index_name)
+    header = {
+        "index": index_name,
+        "exported_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "definition": definition,
+        "vector_fields": record,
+        "dtype": args.dtype,
+        "documents": documents,
+        "partitions": dict(sorted(partitions.items())),
+    }
+    with open(os.path.join(args.path, HEADER), "w", encoding="utf-8") as f:
+        json.dump(header, f, indent=2)
+    size_mb = sum(os.path.getsize(os.path.join(args.path, name)) for name in os.listdir(args.path)) / 1e6
+    print(f"{documents} documents, {size_mb:.1f} MB in {args.path} in {seconds:.1f}s "
+          f"({documents / max(seconds, 1e-6):.0f} docs/s)" + (f"; {failures} countries failed" if failures else ""))
+    return 1 if failures else 0
+
+
+def import_country(client, coordinator, path: str, header: Dict[str, Any], iso_code: str, writable: set,
+                   fresh: bool, state_client=None) -> Dict[str, Any]:
+    """Uploads a country from an export under its lock and deletes its other documents.
+
+    With ``state_client`` (a live index) the write is recorded in the snapshot index state;
+    the result's ``stamp`` is the completed write's.
+    """
+    documents = read_country(path, iso_code, header)
+    with coordinator.lock(iso_code, coordination.lock_timeout()):
+        stamp = snapshot_store.mark_indexing(state_client, iso_code) if state_client is not None else None
+        existing = set() if fresh else {
+            doc["id"] for doc in client.search(search_text="*", filter=f"iso_code eq '{iso_code}'", select=["id"])
+        }
+        with index_writer.IndexWriter(client, writable) as writer:
+            writer.add(
+                {name: value.tolist() if isinstance(value, np.ndarray) else value for name, value in doc.items()}
+                for doc in documents
+            )
+        stale = sorted(existing - {doc["id"] for doc in documents})
+        with index_writer.IndexWriter(client, action="delete") as deleter:
+            deleter.add({"id": doc_id} for doc_id in stale)
+        if stamp is not None:
+            snapshot_store.mark_indexed(state_client, iso_code, stamp)
+    return {"documents": len(documents), "failed": len(writer.failed) + len(deleter.failed), "stale": len(stale),
+            "stamp": stamp}
+
+
+def restore(args, index_name: str, blob_service_client) -> int:
+    header = load_header(args.path)
+    endpoint, key = os.environ["KNIFE_SEARCH_ENDPOINT"], os.environ["KNIFE_SEARCH_KEY"]
+    if args.create:
+        index_alias.create_index(endpoint, key, index_name, header["definition"])
+        print(f"Created {index_name} from the definition of {header['index']}")
+    live_fields = {field["name"]: field for field in index_schema.fetch_index(endpoint, key, index_name)["fields"]}
+    for field in header["definition"]["fields"]:
+        if field["type"] == VECTOR_TYPE and field["name"] in live_fields \
+                and live_fields[field["name"]].get("dimensions") != field.get("dimensions"):
+            sys.exit(f"{index_name}.{field['name']} has {live_fields[field['name']].get('dimensions')} dimensions, "
+                     f"the export {field.get('dimensions')}; import into a new index with --create")
+    missing = [field["name"] for field in header["definition"]["fields"] if field["name"] not in live_fields]
+    if missing:
+        print(f"{index_name} lacks {', '.join(missing)}; those values are not imported", file=sys.stderr)
+
+    only = {code.strip().upper() for code in args.only.split(",") if code.strip()}
+    todo = [iso_code for iso_code in header["partitions"] if not only or iso_code in only]
+    client = search_client(index_name)
+    coordinator = coordination.from_env(blob_service_client)
+    print(f"Importing {sum(header['partitions'][iso]['documents'] for iso in todo)} documents of {len(todo)} "
+          f"countries into {index_name}, {args.parallel} at a time")
+
+    live = index_alias.is_live(index_name)
+    state_client = blob_service_client if live and snapshot_store.container_name() else None
+    started = time.monotonic()
+    lock = threading.Lock()
+    totals = {"documents": 0, "failed": 0, "stale": 0}
+    stamps = {}
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.parallel), thread_name_prefix="import") as pool:
+        futures = {
+            pool.submit(import_country, client, coordinator, args.path, header, iso_code, set(live_fields),
+                        args.create, state_client): iso_code
+            for iso_code in todo
+        }
+        for future in as_completed(futures):
+            iso_code = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"documents": 0, "failed": header["partitions"][iso_code]["documents"], "stale": 0}
+                print(f"{iso_code}: import failed: {e}", file=sys.stderr)
+            with lock:
+                if result.get("stamp"):
+                    stamps[iso_code] = result["stamp"]
+                failures += bool(result["failed"])
+                for name in totals:
+                    totals[name] += result[name]
+    seconds = time.monotonic() - started
+    print(f"{totals['documents']} documents imported, {totals['stale']} stale deleted, {totals['failed']} failed "
+          f"in {seconds:.1f}s ({totals['documents'] / max(seconds, 1e-6):.0f} docs/s)")
+
+    # The vector fields' deployments and countries come along, so the index is queried as it was exported
+    record = header.get("vector_fields") or vector_fields.default_record()
+    if record != vector_fields.default_record() and index_alias.container_client() is not None:
+        def change(current):
+            current.clear()
+            current.update(record)
+        vector_fields.update(index_name, change)
+        print(f"Vector field record of {index_name} restored (default {record['default']})")
+
+    if state_client is not None and not only and not vector_fields.migrating(record):
+        # Only countries no ingestion rewrote since their import are stamped as current
+        current = snapshot_store.indexed_stamps(blob_service_client)
+        rows = (doc for doc in read_export(args.path, record["default"]) if doc["iso_code"] not in record["countries"])
+        snapshot = snapshot_store.update_snapshot(
+            blob_service_client, [], rows, tag="full", replace_all=True,
+            stamps={iso_code: stamp for iso_code, stamp in stamps.items() if current.get(iso_code) == stamp},
+        )
+        print(f"Snapshot {snapshot['version']} published from the export: {snapshot['rows']} rows")
+    return 1 if failures else 0
+
+
+def info(args) -> int:
+    header = load_header(args.path)
+    record = header.get("vector_fields") or {}
+    print(f"{header['index']} exported at {header['exported_at']}: {header['documents']} documents, "
+          f"{len(header['partitions'])} countries, vectors as {header['dtype']}")
+    for name, spec in record.get("fields", {}).items():
+        print(f"  {name}: {spec.get('deployment')} ({spec.get('dims')} dims)"
+              + (" default" if name == record.get("default") else ""))
+    for iso_code, partition in header["partitions"].items():
+        vectors = ", ".join(f"{count} {name}" for name, count in partition["vectors"].items())
+        print(f"  {iso_code}: {partition['documents']} documents" + (f", {vectors}" if vectors else ""))
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "import", "info"])
+    parser.add_argument("path", help="export directory")
+    parser.add_argument("--index", help="index to export or import into (default: the active index)")
+    parser.add_argument("--parallel", type=int, default=8, help="countries read or written at the same time")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"], help="export: vector precision")
+    parser.add_argument("--create", action="store_true", help="import: create --index from the exported definition")
+    parser.add_argument("--only", default="", help="import: comma-separated ISO codes (default: all)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    if args.command == "info":
+        return info(args)
+    if args.create and not args.index:
+        sys.exit("--create needs --index")
+    index_name = args.index or index_alias.resolve()
+    if args.command == "export":
+        return export(args, index_name)
+    connection_string = os.environ.get("KNIFE_STORAGE_CONNECTION_STRING")
+    blob_service_client = BlobServiceClient.from_connection_string(connection_string) if connection_string else None
+    return restore(args, index_name, blob_service_client)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
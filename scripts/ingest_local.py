@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Runs staged ingestion (process_document/staged.py) locally on DOCX files.
+
+The parse/chunk stage runs ``process_document.main`` on each file (in
+``--parse-workers`` threads), and in-process queues with ``--workers`` threads
+per stage stand in for the ``ingest-caption``, ``ingest-embed`` and
+``ingest-index`` storage queues. Checkpoints go to a local directory, so a
+run that failed can be repeated and resumes where its stages left off
+(``--keep-checkpoints`` leaves them in place after success too). Without a
+blob container for coordination, generations and locks go to
+``coordination.db`` in that directory, so they hold across the stages and
+across repeated runs.
+
+Captioning, embedding and the index write use the real services configured
+in the environment, so this is also the way to bulk re-ingest a folder of
+country documents with more parallelism than one Function App instance.
+Prints documents per minute and any message that failed ``MAX_DELIVERIES``
+times.
+
+Usage:
+  python scripts/ingest_local.py docs/AE.docx docs/BR.docx
+  python scripts/ingest_local.py docs/*.docx --workers caption=4,embed=8,index=2 --parse-workers 4
+
+Reads KNIFE_SEARCH_*, KNIFE_OPENAI_*, OPENAI_CHAT_DEPLOY and (optionally)
+KNIFE_STORAGE_CONNECTION_STRING from the environment or a .env file.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LegalDocProcessor"))
+
+
+class LocalBlob:
+    """The parts of ``func.InputStream`` that process_document.main reads, over a local file."""
+
+    def __init__(self, path: str):
+        self.name = f"legaldocsrag/{os.path.basename(path)}"
+        self.length = os.path.getsize(path)
+        self.metadata = {}
+        self.blob_properties = {}
+        self._file = open(path, "rb")
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def stage_counts(value: str):
+    workers = {}
+    for part in value.split(","):
+        stage, _, count = part.partition("=")
+        workers[stage.strip()] = int(count)
+    return workers
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+", help="XX.docx files to ingest")
+    parser.add_argument("--workers", type=stage_counts, default={},
+                        help="threads per stage, e.g. caption=4,embed=8,index=2 (default: INGEST_<STAGE>_CONCURRENCY)")
+    parser.add_argument("--parse-workers", type=int, default=2)
+    parser.add_argument("--checkpoints", default=".ingest-checkpoints", help="checkpoint directory")
+    parser.add_argument("--keep-checkpoints", action="store_true")
+    args = parser.parse_args(argv)
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(message)s")
+    os.environ["INGEST_MODE"] = "staged"
+    os.environ["INGEST_QUEUE"] = "local"
+    os.environ["INGEST_CHECKPOINT"] = f"dir:{os.path.abspath(args.checkpoints)}"
+    if args.keep_checkpoints:
+        os.environ["INGEST_KEEP_CHECKPOINTS"] = "true"
+
+    import process_document
+    from process_document import staged
+    from shared_code import coordination, stage_queue
+
+    if not os.environ.get("INGEST_COORDINATION") and not (
+            coordination.durable_container() and os.environ.get("KNIFE_STORAGE_CONNECTION_STRING")):
+        os.environ["INGEST_COORDINATION"] = f"sqlite:{os.path.join(os.path.abspath(args.checkpoints), 'coordination.db')}"
+
+    queues = stage_queue.from_env()
+    workers = {stage: args.workers.get(stage, staged.concurrency(stage)) for stage in stage_queue.STAGES}
+    for stage, count in workers.items():
+        # The per-process stage limit must not throttle the local workers
+        os.environ[f"INGEST_{stage.upper()}_CONCURRENCY"] = str(count)
+    queues.start(staged.local_handlers(), workers)
+
+    def parse(path: str) -> None:
+        blob = LocalBlob(path)
+        try:
+            process_document.main(blob)
+        finally:
+            blob.close()
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=max(1, args.parse_workers), thread_name_prefix="parse") as pool:
+        for future in [pool.submit(parse, path) for path in args.files]:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"Parse stage failed: {e}")
+    queues.join()
+    elapsed = time.monotonic() - started
+
+    print(f"{len(args.files)} documents in {elapsed:.1f}s ({len(args.files) / max(elapsed, 1e-6) * 60:.1f} docs/min) "
+          f"with workers {workers}")
+    for message in queues.poisoned:
+        print(f"FAILED {message['stage']} {message['run']}: {message['error']}")
+    return 1 if queues.poisoned else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
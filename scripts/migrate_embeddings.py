@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Moves the search index to another embedding model without an outage.
+
+Query and document vectors must come from the same model, so a new model
+gets its own vector field next to ``embedding`` and countries are moved to
+it one at a time (``LegalDocProcessor/shared_code/vector_fields.py`` keeps
+track; ``/api/ask`` queries each country on the field it is on):
+
+  start     adds the field to the index (``--field``, ``--deployment``,
+            ``--dims``; the dimensions are probed when omitted) and records it
+            as the migration target
+  backfill  re-embeds the chunk text already in the index into the new field,
+            one country at a time under its ingestion lock, and moves each
+            country over when it is done; no document is parsed or captioned
+            again. ``--docs-per-minute`` throttles the run on top of the
+            background-priority rate limits
+  status    shows the fields and how many countries are on each
+  finish    once every country is on the new field, makes it the default:
+            ingestion embeds with its model from then on, and the snapshot is
+            republished from it
+  abort     stops the migration; every country is queried on the default
+            field again
+
+Uploads during a migration are embedded with the default model only and
+put their country back on the default field; run ``backfill`` again before
+``finish``. The old field stays in the index (Azure AI Search cannot drop
+fields) until the next blue/green rebuild; set ``KNIFE_OPENAI_DEPLOY``,
+``OPENAI_EMBED_DEPLOY`` and the ``embedding`` dimensions in ``index.json`` to
+the new model before that rebuild.
+
+Usage:
+  python scripts/migrate_embeddings.py start --field embedding_v2 --deployment text-embedding-3-small
+  nohup python scripts/migrate_embeddings.py backfill --parallel 4 --docs-per-minute 3000 > migrate.log &
+  python scripts/migrate_embeddings.py status
+  python scripts/migrate_embeddings.py finish
+
+Reads the processor's settings (KNIFE_SEARCH_*, KNIFE_OPENAI_*, OPENAI_ROUTES,
+KNIFE_STORAGE_CONNECTION_STRING, KNIFE_SNAPSHOT_CONTAINER or
+KNIFE_INDEX_ALIAS_CONTAINER, ...) from the environment or a .env file.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+from azure.storage.blob import BlobServiceClient
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LegalDocProcessor"))
+from shared_code import coordination, index_alias, index_schema, index_writer, snapshot_store, vector_fields  # noqa: E402
+
+from build_snapshot import read_index  # noqa: E402
+from reindex import duration  # noqa: E402
+
+BATCH = 16
+
+
+class Pacer:
+    """Spaces embedding batches so that all threads together stay under ``per_minute`` documents."""
+
+    def __init__(self, per_minute: float):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self, documents: int) -> None:
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + documents * self.interval
+        time.sleep(max(0.0, start - now))
+
+
+def search_client(index_name: str) -> SearchClient:
+    return SearchClient(
+        endpoint=os.environ["KNIFE_SEARCH_ENDPOINT"],
+        index_name=index_name,
+        credential=AzureKeyCredential(os.environ["KNIFE_SEARCH_KEY"]),
+    )
+
+
+def country_counts(client: SearchClient) -> dict:
+    facets = client.search(search_text="*", facets=["iso_code,count:1000"], top=0).get_facets()
+    return {facet["value"]: facet["count"] for facet in facets.get("iso_code", [])}
+
+
+def get_router():
+    import process_document
+    return process_document.get_router(
+        os.environ["KNIFE_OPENAI_ENDPOINT"], os.environ["KNIFE_OPENAI_KEY"],
+        os.environ["KNIFE_OPENAI_DEPLOY"], os.environ.get("OPENAI_CHAT_DEPLOY"),
+    )
+
+
+def start(args, index_name: str) -> int:
+    import process_document
+
+    record, _ = vector_fields.read(index_name)
+    if vector_fields.migrating(record) and record["target"] != args.field:
+        sys.exit(f"A migration to {record['target']} is running; finish or abort it first")
+    if args.field == record["default"]:
+        sys.exit(f"{args.field} is already the default field")
+    router = get_router()
+    dims = args.dims or len(process_document.embed_text("dimension probe", router, router.embedding_stage(args.deployment)))
+    endpoint, key = os.environ["KNIFE_SEARCH_ENDPOINT"], os.environ["KNIFE_SEARCH_KEY"]
+    live = index_schema.fetch_index(endpoint, key, index_name)
+    existing = next((f for f in live.get("fields", []) if f["name"] == args.field), None)
+    if existing is None:
+        index_schema.add_fields(endpoint, key, index_name, live, [vector_fields.field_definition(args.field, dims)])
+        print(f"Added {args.field} ({dims} dims) to {index_name}")
+    elif existing.get("dimensions") != dims:
+        sys.exit(f"{index_name} already has {args.field} with {existing.get('dimensions')} dimensions, not {dims}")
+
+    def change(record):
+        record["fields"][args.field] = {"deployment": args.deployment, "dims": dims}
+        record["target"] = args.field
+    vector_fields.update(index_name, change)
+    print(f"Migrating {index_name} from {record['default']} to {args.field} ({args.deployment}); "
+          f"run: python scripts/migrate_embeddings.py backfill")
+    return 0
+
+
+def backfill_country(index_name: str, client, coordinator, router, stage: str, field: str, dims: int,
+                     iso_code: str, pacer: Pacer) -> dict:
+    """Re-embeds a country's chunks into ``field`` under its ingestion lock."""
+    import process_document
+
+    t0 = time.monotonic()
+    with coordinator.lock(iso_code, coordination.lock_timeout()):
+        docs = [
+            doc for doc in client.search(search_text="*", filter=f"iso_code eq '{iso_code}'",
+                                         select=["id", "chunk", "chunk_type"])
+            if doc.get("chunk_type") != "section" and doc.get("chunk")
+        ]
+        with index_writer.IndexWriter(client, action="merge") as writer:
+            for start in range(0, len(docs), BATCH):
+                batch = docs[start:start + BATCH]
+                pacer.wait(len(batch))
+                embeddings = process_document.embed_batch([{"text": doc["chunk"]} for doc in batch], router, dims, stage)
+                writer.add({"id": doc["id"], field: vector} for doc, vector in zip(batch, embeddings))
+        if writer.failed:
+            return {"status": "failed", "chunks": len(docs), "error": f"{len(writer.failed)} failed merges",
+                    "seconds": round(time.monotonic() - t0, 1)}
+        vector_fields.mark_done(index_name, iso_code, field)
+    return {"status": "completed", "chunks": len(docs), "seconds": round(time.monotonic() - t0, 1)}
+
+
+def backfill(args, index_name: str, blob_service_client) -> int:
+    record, _ = vector_fields.read(index_name)
+    field = record.get("target")
+    if not field:
+        sys.exit("No migration is running; run 'start' first")
+    spec = record["fields"][field]
+    client = search_client(index_name)
+    router = get_router()
+    stage = router.embedding_stage(spec["deployment"])
+    coordinator = coordination.from_env(blob_service_client)
+    only = {code.strip().upper() for code in args.only.split(",") if code.strip()}
+    countries = sorted(iso_code for iso_code in country_counts(client) if not only or iso_code in only)
+    todo = [iso_code for iso_code in countries if record["countries"].get(iso_code) != field]
+    pacer = Pacer(args.docs_per_minute)
+    print(f"Backfilling {field} for {len(todo)} of {len(countries)} countries, {args.parallel} at a time")
+
+    started = time.monotonic()
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.parallel), thread_name_prefix="backfill") as pool:
+        futures = {
+            pool.submit(backfill_country, index_name, client, coordinator, router, stage, field, spec["dims"],
+                        iso_code, pacer): iso_code
+            for iso_code in todo
+        }
+        for finished, future in enumerate(as_completed(futures), 1):
+            iso_code = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"status": "failed", "error": str(e), "chunks": 0, "seconds": 0}
+            failures += result["status"] != "completed"
+            elapsed = time.monotonic() - started
+            eta = elapsed / finished * (len(todo) - finished)
+            print(f"[{finished}/{len(todo)}] {iso_code} {result['status']} {result['chunks']} chunks "
+                  f"{result.get('error', '')} in {result['seconds']}s | elapsed {duration(elapsed)}, ETA {duration(eta)}",
+                  flush=True)
+    print(f"\n{len(todo) - failures} of {len(todo)} countries moved to {field}"
+          + ("; run backfill again for the rest" if failures else "; run 'finish' to make it the default"))
+    return 1 if failures else 0
+
+
+def status(index_name: str) -> int:
+    record, _ = vector_fields.read(index_name)
+    counts = country_counts(search_client(index_name))
+    on_field = {name: 0 for name in record["fields"]}
+    for iso_code in counts:
+        on_field[record["countries"].get(iso_code, record["default"])] += 1
+    print(json.dumps({key: value for key, value in record.items() if key != "countries"}, indent=2))
+    for name, spec in record["fields"].items():
+        role = "default" if name == record["default"] else "target" if name == record.get("target") else ""
+        print(f"{name:<20} {role:<8} {spec.get('deployment') or '':<28} {spec.get('dims') or '':>6} dims "
+              f"{on_field[name]:>4} of {len(counts)} countries")
+    return 0
+
+
+def finish(args, index_name: str, blob_service_client) -> int:
+    record, _ = vector_fields.read(index_name)
+    field = record.get("target")
+    if not field:
+        sys.exit("No migration is running")
+    client = search_client(index_name)
+    countries = set(country_counts(client))
+    behind = []
+
+    # The target stays set until the snapshot holds its vectors, so /api/ask keeps
+    # ignoring the snapshot in between. With --force, countries not moved yet stay on the old field
+    def make_default(record):
+        behind[:] = sorted(iso_code for iso_code in countries if record["countries"].get(iso_code) != field)
+        if (behind and not args.force) or record.get("target") != field:
+            return False
+        moved = {iso_code: name for iso_code, name in record["countries"].items() if name != field}
+        moved.update({iso_code: record["default"] for iso_code in behind if iso_code not in moved})
+        record["default"] = field
+        record["countries"] = moved
+    record = vector_fields.update(index_name, make_default)
+    if record["default"] != field:
+        print(f"Not finishing: {len(behind)} countries are not on {field} yet: {', '.join(behind)}")
+        return 1
+
+    if snapshot_store.container_name():
+        stamps = snapshot_store.indexed_stamps(blob_service_client)
+        rows = (
+            doc for doc in read_index(client, field)
+            if doc.get("embedding") and doc["iso_code"] not in record["countries"]
+        )
+        header = snapshot_store.update_snapshot(
+            blob_service_client, [], rows, tag="full", replace_all=True, stamps=stamps
+        )
+        print(f"Snapshot {header['version']} published from {field}: {header['rows']} rows")
+
+    def clear_target(record):
+        record["target"] = None
+    vector_fields.update(index_name, clear_target)
+    print(f"{field} ({record['fields'][field]['deployment']}) is now the default field of {index_name}")
+    return 0
+
+
+def abort(index_name: str) -> int:
+    def change(record):
+        field = record.get("target")
+        if not field:
+            return False
+        record["target"] = None
+        record["countries"] = {iso_code: name for iso_code, name in record["countries"].items() if name != field}
+    record = vector_fields.update(index_name, change)
+    print(f"No migration running; every country is queried on {record['default']} "
+          "(or the field it was re-ingested into)")
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "start", "backfill", "finish", "abort"])
+    parser.add_argument("--field", help="start: the new vector field, e.g. embedding_v2")
+    parser.add_argument("--deployment", help="start: the embedding deployment that fills it")
+    parser.add_argument("--dims", type=int, help="start: vector dimensions (default: probed from the deployment)")
+    parser.add_argument("--parallel", type=int, default=2, help="backfill: countries re-embedded at the same time")
+    parser.add_argument("--docs-per-minute", type=float, default=0,
+                        help="backfill: most chunks embedded per minute (default: only the rate limits apply)")
+    parser.add_argument("--only", default="", help="backfill: comma-separated ISO codes (default: all)")
+    parser.add_argument("--force", action="store_true", help="finish although countries are still on the old field")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    blob_service_client = BlobServiceClient.from_connection_string(os.environ["KNIFE_STORAGE_CONNECTION_STRING"])
+    index_name = index_alias.resolve()
+
+    if args.command == "status":
+        return status(index_name)
+    if args.command == "start":
+        if not args.field or not args.deployment:
+            sys.exit("start needs --field and --deployment")
+        return start(args, index_name)
+    if args.command == "backfill":
+        return backfill(args, index_name, blob_service_client)
+    if args.command == "finish":
+        return finish(args, index_name, blob_service_client)
+    if args.command == "abort":
+        return abort(index_name)
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
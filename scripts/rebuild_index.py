@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""Rebuilds the search index next to the live one and switches to it (blue/green).
+
+Readers and writers use whatever index the pointer record names
+(``LegalDocProcessor/shared_code/index_alias.py``), so the live index keeps
+answering ``/api/ask`` while its replacement is filled:
+
+  create     creates ``<KNIFE_SEARCH_INDEX>-vN`` from ``index.json`` and records it
+             as the index being built
+  populate   ingests every country document into it (like ``reindex.py``: in
+             parallel, with progress, ``--resume``); the live index, its
+             snapshot, images and manifest are not touched
+  validate   compares the candidate with the container and the live index:
+             every country present with the documents it was given, none
+             changed or deleted since, no large drop in count per ISO code
+  switch     catches up on countries uploaded or deleted during the build,
+             validates again, points the record at the candidate, records the
+             candidate's manifest entries and republishes the snapshot from it
+  rollback   points the record back at the previous index
+  status     shows the record, the indexes and their document counts
+  drop NAME  deletes an old index (never the active, previous or building one)
+
+Functions pick up a switch within ``INDEX_ALIAS_REFRESH_S`` (default 30 s).
+Countries ingested into the live index during the build are found by their
+blob ETag at switch time and ingested again into the candidate.
+
+Usage:
+  python scripts/rebuild_index.py create
+  nohup python scripts/rebuild_index.py populate --parallel 6 > rebuild.log &
+  python scripts/rebuild_index.py validate
+  python scripts/rebuild_index.py switch
+  python scripts/rebuild_index.py rollback
+
+Reads the processor's settings (KNIFE_SEARCH_*, KNIFE_OPENAI_*, OPENAI_CHAT_DEPLOY,
+KNIFE_STORAGE_CONNECTION_STRING, KNIFE_SNAPSHOT_CONTAINER, MANIFEST_STORE, ...)
+from the environment or a .env file.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+from azure.storage.blob import BlobServiceClient
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LegalDocProcessor"))
+from shared_code import index_alias, manifest, purge, snapshot_store, vector_fields  # noqa: E402
+
+from build_snapshot import read_index  # noqa: E402
+from reindex import CONTAINER, DONE, list_countries, load_state, run_countries, save_state  # noqa: E402
+
+
+def search_client(index_name: str) -> SearchClient:
+    return SearchClient(
+        endpoint=os.environ["KNIFE_SEARCH_ENDPOINT"],
+        index_name=index_name,
+        credential=AzureKeyCredential(os.environ["KNIFE_SEARCH_KEY"]),
+    )
+
+
+def country_counts(index_name: str) -> dict:
+    """Documents per ISO code in an index."""
+    facets = search_client(index_name).search(search_text="*", facets=["iso_code,count:1000"], top=0).get_facets()
+    return {facet["value"]: facet["count"] for facet in facets.get("iso_code", [])}
+
+
+def state_path(args, index_name: str) -> str:
+    return args.state or f"rebuild-{index_name}.json"
+
+
+def building_index() -> str:
+    record, _ = index_alias.read()
+    candidate = (record or {}).get("building")
+    if not candidate:
+        sys.exit("No index is being built; run 'create' first")
+    return candidate
+
+
+def populate(args, candidate: str, container, only=None) -> int:
+    """Ingests country documents into the candidate; returns the number of failures."""
+    # Ingestion writes to the candidate only: no snapshot or image GC (it is not live), its own
+    # coordination (it must not supersede live uploads), and manifest entries kept in memory
+    # until the switch, so live uploads are still compared with what the live index holds
+    os.environ.update(
+        INDEX_TARGET=candidate, INGEST_MODE="inline", INGEST_DEBOUNCE_S="0",
+        INGEST_COORDINATION="local", MANIFEST_STORE="memory",
+    )
+    path = state_path(args, candidate)
+    state = load_state(path) if getattr(args, "resume", False) or only else {"countries": {}}
+    state.setdefault("manifest", {})
+    countries = list_countries(container, only or set())
+    todo = {
+        iso_code: blob for iso_code, blob in countries.items()
+        if only or not (getattr(args, "resume", False)
+                        and state["countries"].get(iso_code, {}).get("status") in DONE
+                        and state["countries"][iso_code].get("etag") == blob.etag)
+    }
+    print(f"Populating {candidate} with {len(todo)} of {len(countries)} countries, {args.parallel} at a time")
+    failures = run_countries(container, todo, args.parallel, state, path)
+    collected = manifest.from_env()
+    for iso_code in todo:
+        entry = collected.get(iso_code)
+        if entry is not None and state["countries"][iso_code]["status"] == "completed":
+            state["manifest"][iso_code] = entry
+    save_state(path, state)
+    return failures
+
+
+def validate(args, candidate: str, container) -> list:
+    """Problems that keep the candidate from going live, as (ISO code, problem, fix) tuples.
+
+    ``fix`` is ``populate`` or ``purge`` for problems the switch can repair, else None.
+    """
+    state = load_state(state_path(args, candidate))
+    countries = list_countries(container, set())
+    candidate_counts = country_counts(candidate)
+    live_counts = country_counts(index_alias.active())
+    problems = []
+    for iso_code, blob in countries.items():
+        result = state["countries"].get(iso_code)
+        if result is None or result.get("status") not in ("completed", "empty"):
+            problems.append((iso_code, f"not populated ({(result or {}).get('status', 'missing')})", "populate"))
+        elif result.get("etag") != blob.etag:
+            problems.append((iso_code, "document changed since it was populated", "populate"))
+        elif result.get("failed_uploads"):
+            problems.append((iso_code, f"{result['failed_uploads']} failed uploads", "populate"))
+        else:
+            expected = result.get("chunks", 0) + result.get("parents", 0)
+            have = candidate_counts.get(iso_code, 0)
+            if have != expected:
+                problems.append((iso_code, f"{have} documents in {candidate}, {expected} written", "populate"))
+            live = live_counts.get(iso_code, 0)
+            if live and have < live * (1 - args.max_drop):
+                problems.append((iso_code, f"{have} documents, {live} in the live index", None))
+    for iso_code in sorted(set(candidate_counts) - set(countries)):
+        problems.append((iso_code, "document deleted since it was populated", "purge"))
+    return problems
+
+
+def print_problems(problems) -> None:
+    for iso_code, problem, fix in problems:
+        print(f"  {iso_code}: {problem}" + (f" (switch will {fix} it)" if fix else ""))
+
+
+def publish_snapshot(index_name: str, blob_service_client) -> None:
+    if not snapshot_store.container_name():
+        return
+    field = vector_fields.current(index_name)["default"]
+    stamps = snapshot_store.indexed_stamps(blob_service_client)
+    rows = (doc for doc in read_index(search_client(index_name), field) if doc.get("embedding"))
+    header = snapshot_store.update_snapshot(blob_service_client, [], rows, tag="full", replace_all=True, stamps=stamps)
+    print(f"Snapshot {header['version']} published from {index_name}: {header['rows']} rows")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["status", "create", "populate", "validate", "switch", "rollback", "drop"])
+    parser.add_argument("name", nargs="?", help="index name (create: default next version; drop: required)")
+    parser.add_argument("--parallel", type=int, default=4, help="countries populated at the same time")
+    parser.add_argument("--resume", action="store_true", help="populate: skip countries already done")
+    parser.add_argument("--state", help="progress file (default rebuild-<index>.json)")
+    parser.add_argument("--max-drop", type=float, default=0.5,
+                        help="largest accepted drop in documents per country against the live index (default 0.5)")
+    parser.add_argument("--force", action="store_true", help="switch despite validation problems; drop any index")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    endpoint, key = os.environ["KNIFE_SEARCH_ENDPOINT"], os.environ["KNIFE_SEARCH_KEY"]
+    blob_service_client = BlobServiceClient.from_connection_string(os.environ["KNIFE_STORAGE_CONNECTION_STRING"])
+    container = blob_service_client.get_container_client(CONTAINER)
+    record, _ = index_alias.read()
+    record = record or {}
+    # Opened before populate points MANIFEST_STORE at memory for the candidate's entries
+    store = manifest.from_env(blob_service_client)
+
+    if args.command == "status":
+        active = index_alias.active()
+        print(json.dumps(record or {"active": active, "note": "no alias record; KNIFE_SEARCH_INDEX is used"}, indent=2))
+        for name in index_alias.list_indexes(endpoint, key):
+            role = "active" if name == active else "previous" if name == record.get("previous") else \
+                "building" if name == record.get("building") else ""
+            counts = country_counts(name)
+            print(f"{name:<24} {role:<9} {sum(counts.values()):>8} documents, {len(counts)} countries")
+        return 0
+
+    if args.command == "create":
+        name = args.name or index_alias.versioned_name(index_alias.active(), index_alias.list_indexes(endpoint, key))
+        index_alias.create_index(endpoint, key, name)
+        index_alias.set_building(name)
+        print(f"Created {name} from index.json; populate it with: python scripts/rebuild_index.py populate")
+        return 0
+
+    if args.command == "populate":
+        return 1 if populate(args, args.name or building_index(), container) else 0
+
+    if args.command == "validate":
+        candidate = args.name or building_index()
+        problems = validate(args, candidate, container)
+        print(f"{candidate}: " + ("ready to switch" if not problems else f"{len(problems)} problems"))
+        print_problems(problems)
+        return 1 if problems else 0
+
+    if args.command == "switch":
+        candidate = args.name or building_index()
+        problems = validate(args, candidate, container)
+        repopulate = {iso_code for iso_code, _, fix in problems if fix == "populate"}
+        if repopulate:
+            print(f"Catching up on {len(repopulate)} countries: {', '.join(sorted(repopulate))}")
+            populate(args, candidate, container, only=repopulate)
+        for iso_code, _, fix in problems:
+            if fix == "purge":
+                progress = purge.purge(search_client(candidate), f"iso_code eq '{iso_code}'")
+                print(f"Purged {progress['deleted']} documents of {iso_code} from {candidate}")
+        problems = validate(args, candidate, container) if problems else []
+        if problems and not args.force:
+            print(f"Not switching to {candidate}:")
+            print_problems(problems)
+            return 1
+        updated = index_alias.switch(candidate)
+        print(f"Switched to {candidate} (previous: {updated['previous']}); functions follow within "
+              f"{os.environ.get('INDEX_ALIAS_REFRESH_S', '30')} s")
+        if store is not None:
+            for entry in load_state(state_path(args, candidate)).get("manifest", {}).values():
+                store.put(entry)
+        publish_snapshot(candidate, blob_service_client)
+        return 0
+
+    if args.command == "rollback":
+        updated = index_alias.rollback()
+        print(f"Rolled back to {updated['active']} ({updated['previous']} stays available)")
+        if store is not None:
+            # The entries describe the index rolled back from; without them the next upload re-ingests
+            store.clear()
+        publish_snapshot(updated["active"], blob_service_client)
+        return 0
+
+    if args.command == "drop":
+        if not args.name:
+            sys.exit("drop needs an index name")
+        protected = {index_alias.active(), record.get("previous"), record.get("building")}
+        if args.name in protected and not args.force:
+            sys.exit(f"{args.name} is the active, previous or building index; pass --force to drop it anyway")
+        index_alias.delete_index(endpoint, key, args.name)
+        if args.name == record.get("building"):
+            index_alias.set_building(None)
+        print(f"Dropped {args.name}")
+        return 0
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""Re-indexes every country document in ``legaldocsrag`` in parallel.
+
+After a change to the chunker, prompts or embedding model, this rebuilds the
+corpus without re-uploading documents or waiting on blob-trigger scheduling.
+It lists the ``XX.docx`` blobs at the container root and runs
+``process_document.ingest`` on ``--parallel`` countries at a time in this
+process, so they share one set of rate limiters and deployment routes
+(``OPENAI_RATE_LIMITS``, ``OPENAI_ROUTES``). The whole run stays under the
+configured quota; ingestion stays at background priority.
+
+- Progress is printed after each country: done/total, elapsed time and an ETA
+  from the throughput so far. A per-country report (status, chunks, images,
+  failed uploads, seconds, cost) follows at the end.
+- Results are saved to ``--state`` as each country finishes. ``--resume``
+  skips countries that completed (or were unchanged) with the same blob ETag,
+  so an interrupted run continues where it stopped.
+- ``--dry-run`` lists what would be processed, and which countries the
+  manifest (``MANIFEST_STORE``) would skip as unchanged, without calling any
+  model or touching the index.
+- Countries whose content and pipeline settings are unchanged are skipped
+  unless ``--force`` is given. A pipeline change (e.g. a new chunker setting)
+  re-ingests everything anyway.
+
+Ingestion runs inline (``INGEST_MODE`` is ignored) with no debounce. A blob
+uploaded during the run supersedes the country's re-index as usual.
+
+Usage:
+  python scripts/reindex.py --dry-run
+  python scripts/reindex.py --parallel 6
+  python scripts/reindex.py --only AE,BR,CH --force
+  python scripts/reindex.py --resume
+
+Reads the processor's settings (KNIFE_SEARCH_*, KNIFE_OPENAI_*, OPENAI_CHAT_DEPLOY,
+KNIFE_STORAGE_CONNECTION_STRING, ...) from the environment or a .env file.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+from azure.storage.blob import BlobServiceClient
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "LegalDocProcessor"))
+
+CONTAINER = "legaldocsrag"
+COUNTRY_BLOB = re.compile(r"^([A-Z]{2})\.docx$")
+DONE = ("completed", "skipped")
+
+
+class BlobDocument:
+    """The parts of ``func.InputStream`` that process_document.ingest reads, over a listed blob."""
+
+    def __init__(self, container, blob):
+        self.name = f"{CONTAINER}/{blob.name}"
+        self.length = blob.size
+        self.metadata = blob.metadata or {}
+        self.blob_properties = {"ETag": blob.etag, "ContentMD5": blob.content_settings.content_md5,
+                                "LastModified": blob.last_modified}
+        self._client = container.get_blob_client(blob.name)
+        self._downloader = None
+
+    def read(self, size: int = -1) -> bytes:
+        if self._downloader is None:
+            self._downloader = self._client.download_blob(max_concurrency=2)
+        return self._downloader.read(size)
+
+
+def list_countries(container, only):
+    """Country document blobs at the container root, by ISO code."""
+    found = {}
+    for blob in container.walk_blobs(include=["metadata"], delimiter="/"):
+        match = COUNTRY_BLOB.match(blob.name)
+        if match and (not only or match.group(1) in only):
+            found[match.group(1)] = blob
+    return dict(sorted(found.items()))
+
+
+def load_state(path: str) -> dict:
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"countries": {}}
+
+
+def save_state(path: str, state: dict) -> None:
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def dry_run(countries, state, resume: bool, blob_service_client) -> None:
+    import process_document
+    from shared_code import index_alias, manifest, vector_fields
+
+    store = manifest.from_env(blob_service_client)
+    catalog = store.catalog() if store is not None else {}
+    _, vector_spec = vector_fields.write_field(vector_fields.current(index_alias.resolve()))
+    pipeline = process_document.pipeline_fingerprint(
+        vector_spec["deployment"] or os.environ.get("KNIFE_OPENAI_DEPLOY"), os.environ.get("OPENAI_CHAT_DEPLOY"),
+        vector_spec["dims"],
+    )
+    force = process_document.force_requested(None)
+    plan = {"ingest": 0, "skip": 0}
+    print(f"{'ISO':<4} {'size':>10}  {'last modified':<20} action")
+    for iso_code, blob in countries.items():
+        previous = state["countries"].get(iso_code, {})
+        md5 = manifest.normalize_md5(blob.content_settings.content_md5)
+        if resume and previous.get("status") in DONE and previous.get("etag") == blob.etag:
+            action = f"skip (done in the resumed run: {previous['status']})"
+        elif not force and manifest.unchanged(catalog.get(iso_code), pipeline, content_md5=md5):
+            action = f"skip (unchanged since {catalog[iso_code].get('ingested_at')})"
+        else:
+            action = "ingest"
+        plan["ingest" if action == "ingest" else "skip"] += 1
+        print(f"{iso_code:<4} {blob.size:>10}  {blob.last_modified:%Y-%m-%d %H:%M:%S}  {action}")
+    note = "" if store is not None else " (no manifest: unchanged documents cannot be detected)"
+    print(f"\n{len(countries)} countries: {plan['ingest']} to ingest, {plan['skip']} to skip{note}")
+
+
+def run_countries(container, todo, parallel: int, state: dict, state_path: str) -> int:
+    """Ingests ``todo`` (ISO code -> listed blob) ``parallel`` at a time; returns the number of failures.
+
+    Each result is saved to ``state`` (written to ``state_path``) as it comes in; progress and
+    a final report are printed.
+    """
+    import process_document
+
+    state.setdefault("started_at", datetime.now(timezone.utc).isoformat(timespec="seconds"))
+    lock = threading.Lock()
+    started = time.monotonic()
+    finished = 0
+
+    def run(iso_code: str, blob) -> dict:
+        t0 = time.monotonic()
+        try:
+            result = process_document.ingest(BlobDocument(container, blob))
+        except Exception as e:
+            result = {"status": "failed", "error": str(e)}
+        result.update(etag=blob.etag, seconds=round(time.monotonic() - t0, 1),
+                      finished_at=datetime.now(timezone.utc).isoformat(timespec="seconds"))
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, parallel), thread_name_prefix="reindex") as pool:
+        futures = {pool.submit(run, iso_code, blob): iso_code for iso_code, blob in todo.items()}
+        for future in as_completed(futures):
+            iso_code = futures[future]
+            result = future.result()
+            with lock:
+                finished += 1
+                state["countries"][iso_code] = result
+                save_state(state_path, state)
+            elapsed = time.monotonic() - started
+            eta = elapsed / finished * (len(todo) - finished)
+            detail = f"{result.get('chunks', 0)} chunks" if result["status"] == "completed" else \
+                result.get("error") or result.get("reason") or ""
+            print(f"[{finished}/{len(todo)}] {iso_code} {result['status']} {detail} in {result['seconds']}s"
+                  f" | elapsed {duration(elapsed)}, ETA {duration(eta)}", flush=True)
+
+    print(f"\n{'ISO':<4} {'status':<11} {'chunks':>7} {'images':>7} {'failed':>7} {'seconds':>8} {'cost $':>8}  note")
+    failures = 0
+    for iso_code in todo:
+        result = state["countries"][iso_code]
+        if result["status"] not in DONE:
+            failures += 1
+        note = result.get("error") or result.get("reason") or ""
+        print(f"{iso_code:<4} {result['status']:<11} {result.get('chunks', ''):>7} {result.get('images', ''):>7} "
+              f"{result.get('failed_uploads', ''):>7} {result['seconds']:>8} {result.get('cost_usd', ''):>8}  {note}")
+    print(f"\n{len(todo) - failures} of {len(todo)} countries done in {duration(time.monotonic() - started)}; "
+          f"state in {state_path}" + ("; rerun with --resume to retry the rest" if failures else ""))
+    return failures
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--parallel", type=int, default=4, help="countries processed at the same time")
+    parser.add_argument("--only", default="", help="comma-separated ISO codes (default: all)")
+    parser.add_argument("--force", action="store_true", help="re-ingest countries the manifest reports unchanged")
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--resume", action="store_true", help="skip countries already done in --state")
+    parser.add_argument("--state", default="reindex-state.json", help="progress file")
+    args = parser.parse_args()
+
+    load_dotenv()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(threadName)s %(levelname)s %(message)s")
+    os.environ["INGEST_MODE"] = "inline"
+    os.environ["INGEST_DEBOUNCE_S"] = "0"
+    if args.force:
+        os.environ["INGEST_FORCE"] = "true"
+
+    connection_string = os.environ.get("KNIFE_STORAGE_CONNECTION_STRING")
+    if not connection_string:
+        print("KNIFE_STORAGE_CONNECTION_STRING is required", file=sys.stderr)
+        return 2
+    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+    container = blob_service_client.get_container_client(CONTAINER)
+    only = {code.strip().upper() for code in args.only.split(",") if code.strip()}
+    countries = list_countries(container, only)
+    state = load_state(args.state) if args.resume else {"countries": {}}
+
+    if args.dry_run:
+        dry_run(countries, state, args.resume, blob_service_client)
+        return 0
+
+    todo = {
+        iso_code: blob for iso_code, blob in countries.items()
+        if not (args.resume and state["countries"].get(iso_code, {}).get("status") in DONE
+                and state["countries"][iso_code].get("etag") == blob.etag)
+    }
+    print(f"Re-indexing {len(todo)} of {len(countries)} countries, {args.parallel} at a time")
+    failures = run_countries(container, todo, args.parallel, state, args.state)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())